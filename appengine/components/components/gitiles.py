@@ -317,15 +317,22 @@ def get_commit(*args, **kwargs):
 
 
 @ndb.tasklet
-def get_tree_async(hostname, project, treeish, path=None):
+def get_tree_async(
+    hostname, project, treeish, path=None, recursive=False, **fetch_kwargs):
   """Gets a tree object.
 
+  If |recursive| is True, the entries are all the files under the tree, named
+  by their path relative to the tree.
+
   Returns:
     Tree object, or None if the tree was not found.
   """
   _validate_args(hostname, project, treeish, path)
+  if recursive:
+    fetch_kwargs['params'] = {'recursive': 1}
   data = yield gerrit.fetch_json_async(
-      hostname, '%s/+/%s%s' % _quote_all(project, treeish, path))
+      hostname, '%s/+/%s%s' % _quote_all(project, treeish, path),
+      **fetch_kwargs)
   if data is None:
     raise ndb.Return(None)
 
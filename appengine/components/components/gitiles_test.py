@@ -137,6 +137,26 @@ class GitilesTestCase(test_case.TestCase):
         tree.entries[0].id, '0244aa92a18cd719c55205f99e04333840330012')
     self.assertEqual(tree.entries[0].name, 'a')
 
+  def test_get_tree_recursive(self):
+    req_path = 'project/+/deadbeef/dir'
+    self.mock_fetch_json({
+        'id': 'c244aa92a18cd719c55205f99e04333840330012',
+        'entries': [
+          {
+            'id': '0244aa92a18cd719c55205f99e04333840330012',
+            'name': 'sub/a',
+            'type': 'blob',
+            'mode': 33188,
+          },
+        ],
+    })
+
+    tree = gitiles.get_tree(
+        HOSTNAME, 'project', 'deadbeef', '/dir', recursive=True, deadline=15)
+    gerrit.fetch_json_async.assert_called_once_with(
+        HOSTNAME, req_path, params={'recursive': 1}, deadline=15)
+    self.assertEqual(['sub/a'], [e.name for e in tree.entries])
+
   def test_get_log(self):
     req_path = 'project/+log/master/'
     self.mock_fetch_json({
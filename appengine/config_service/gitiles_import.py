@@ -17,6 +17,7 @@ import logging
 import os
 import random
 import re
+import stat
 import StringIO
 import tarfile
 
@@ -48,6 +49,13 @@ DEFAULT_GITILES_IMPORT_CONFIG = service_config_pb2.ImportCfg.Gitiles(
 )
 
 
+# Maximum number of config files validated at the same time during an import.
+MAX_CONCURRENT_VALIDATIONS = 20
+# Maximum number of config files fetched at the same time during an incremental
+# import.
+MAX_CONCURRENT_FETCHES = 20
+
+
 import_attempt_metric = metrics.CounterMetric(
     'config_service/import_attempt',
     'Counter of import attempts of a config set',
@@ -129,11 +137,16 @@ def _make_gitiles_location(cfg):
       path='/' + cfg.path)
 
 
-def _import_revision(config_set, base_location, commit, project_id):
+def _import_revision(
+    config_set, base_location, commit, project_id, previous_revision=None):
   """Imports a referenced Gitiles revision into a config set.
 
   |base_location| will be used to set storage.ConfigSet.location.
 
+  If |previous_revision| is set, only the files that changed since this
+  revision, previously imported from the same location, are fetched and
+  validated. If they cannot be, the whole archive is imported instead.
+
   Updates last ImportAttempt for the config set.
 
   Puts ConfigSet initialized from arguments.
@@ -163,19 +176,31 @@ def _import_revision(config_set, base_location, commit, project_id):
 
   rev_entities = [attempt, cs_entity, storage.Revision(key=rev_key)]
 
-  # Fetch archive outside ConfigSet transaction.
-  archive = location.get_archive(
-      project_id=project_id,
-      deadline=get_gitiles_config().fetch_archive_deadline)
-  if not archive:
+  # Fetch files and save them to Blobs outside ConfigSet transaction.
+  imported = None
+  if previous_revision:
+    try:
+      imported = _read_and_validate_tree(
+          config_set, rev_key, location, previous_revision, project_id)
+    except Error as ex:
+      logging.warning(
+          'Could not import %s incrementally, importing the archive: %s',
+          config_set, ex)
+      previous_revision = None
+  if not previous_revision:
+    archive = location.get_archive(
+        project_id=project_id,
+        deadline=get_gitiles_config().fetch_archive_deadline)
+    if archive:
+      imported = _read_and_validate_archive(
+          config_set, rev_key, archive, location)
+  if imported is None:
     logging.warning(
         'Configuration %s does not exist. Probably it was deleted', config_set)
     attempt.success = True
     attempt.message = 'Config directory not found. Imported as empty'
   else:
-    # Extract files and save them to Blobs outside ConfigSet transaction.
-    files, validation_result = _read_and_validate_archive(
-        config_set, rev_key, archive, location)
+    files, validation_result = imported
     if validation_result.has_errors:
       logging.warning('Invalid revision %s@%s', config_set, revision)
       notifications.notify_gitiles_rejection(
@@ -216,38 +241,172 @@ def _read_and_validate_archive(config_set, rev_key, archive, location):
   logging.info('%s archive size: %d bytes' % (config_set, len(archive)))
 
   stream = StringIO.StringIO(archive)
-  blob_futures = []
   with tarfile.open(mode='r|gz', fileobj=stream) as tar:
-    files = {}
-    ctx = config.validation.Context()
+    files = []
     for item in tar:
       if not item.isreg():  # pragma: no cover
         continue
       logging.info('Found file "%s"', item.name)
       with contextlib.closing(tar.extractfile(item)) as extracted:
-        content = extracted.read()
-        files[item.name] = content
-        with ctx.prefix(item.name + ': '):
-          validation.validate_config(config_set, item.name, content, ctx=ctx)
-
-  if ctx.result().has_errors:
-    return [], ctx.result()
-
-  entities = []
-  for name, content in files.items():
-    content_hash = storage.compute_hash(content)
-    blob_futures.append(storage.import_blob_async(
-      content=content, content_hash=content_hash))
-    entities.append(
-      storage.File(
-        id=name,
-        parent=rev_key,
-        content_hash=content_hash,
-        url=str(location.join(name)))
-    )
+        files.append((item.name, extracted.read()))
+
+  validation_result = _validate_files_async(config_set, files).get_result()
+  if validation_result.has_errors:
+    return [], validation_result
+
+  hashes = [storage.compute_hash(content) for _, content in files]
   # Wait for Blobs to be imported before proceeding.
-  ndb.Future.wait_all(blob_futures)
-  return entities, ctx.result()
+  storage.import_blobs_async({
+    content_hash: content
+    for content_hash, (_, content) in zip(hashes, files)
+  }).get_result()
+  entities = [
+    storage.File(
+      id=name,
+      parent=rev_key,
+      content_hash=content_hash,
+      url=str(location.join(name)))
+    for content_hash, (name, _) in zip(hashes, files)
+  ]
+  return entities, validation_result
+
+
+def _read_and_validate_tree(
+    config_set, rev_key, location, previous_revision, project_id):
+  """Validates and imports the files that changed since |previous_revision|.
+
+  Compares the Git blob ids of the files in the tree at |location| with the
+  content hashes of the files of |previous_revision|, see
+  storage.compute_hash(). Only the files that differ are fetched, validated and
+  saved to Blob entities. The unchanged files keep their content hash, and
+  are validated again only if they depend on other files, see
+  validation.has_cross_file_dependencies().
+
+  Return:
+      (files, validation_result) tuple, or None if the tree does not exist.
+
+  Raises:
+    Error if a changed file could not be fetched or an unchanged one is not
+    in the storage.
+  """
+  deadline = get_gitiles_config().fetch_archive_deadline
+  tree = location.get_tree(
+      recursive=True, project_id=project_id, deadline=deadline)
+  if tree is None:
+    return None
+  hashes = {
+    e.name: 'v1:%s' % e.id
+    for e in tree.entries
+    if e.type == 'blob' and stat.S_ISREG(e.mode)
+  }
+  previous = {
+    f.key.id(): f.content_hash
+    for f in storage.File.query(
+        ancestor=ndb.Key(
+            storage.ConfigSet, config_set,
+            storage.Revision, previous_revision))
+  }
+  changed = sorted(p for p, h in hashes.items() if previous.get(p) != h)
+  dependent = sorted(
+      p for p, h in hashes.items()
+      if previous.get(p) == h and
+      validation.has_cross_file_dependencies(config_set, p))
+  logging.info(
+      '%s: %d files, %d changed since %s',
+      config_set, len(hashes), len(changed), previous_revision)
+
+  fetched = _fetch_files_async(location, changed, project_id, deadline)
+  contents = storage.get_configs_by_hashes_async(
+      [hashes[p] for p in dependent]).get_result()
+  contents = {p: contents.get(hashes[p]) for p in dependent}
+  for path, content in zip(changed, fetched.get_result()):
+    if content is None or storage.compute_hash(content) != hashes[path]:
+      raise Error(
+          'Could not fetch %s from %s' % (path, location))
+    contents[path] = content
+  missing = [p for p in dependent if contents[p] is None]
+  if missing:
+    raise Error('Blobs of %s are missing' % ', '.join(missing))
+
+  validation_result = _validate_files_async(
+      config_set, [(p, contents[p]) for p in changed + dependent]).get_result()
+  if validation_result.has_errors:
+    return [], validation_result
+
+  # Wait for Blobs to be imported before proceeding.
+  storage.import_blobs_async(
+      {hashes[p]: contents[p] for p in changed}).get_result()
+  entities = [
+    storage.File(
+      id=name,
+      parent=rev_key,
+      content_hash=content_hash,
+      url=str(location.join(name)))
+    for name, content_hash in sorted(hashes.items())
+  ]
+  return entities, validation_result
+
+
+@ndb.tasklet
+def _fetch_files_async(location, paths, project_id, deadline):
+  """Fetches files concurrently.
+
+  At most MAX_CONCURRENT_FETCHES files are fetched from Gitiles at a time.
+
+  Args:
+    location (gitiles.Location): location the paths are relative to.
+    paths (list): paths of the files to fetch.
+    project_id (str): name of the LUCI project related to the location.
+    deadline (int): urlfetch deadline of each fetch, in seconds.
+
+  Returns:
+    List of the file contents, or None for missing files, in order.
+  """
+  results = [None] * len(paths)
+  pending = iter(enumerate(paths))
+
+  @ndb.tasklet
+  def worker():
+    for i, path in pending:
+      results[i] = yield location.join(path).get_file_content_async(
+          project_id=project_id, deadline=deadline)
+
+  yield [worker() for _ in xrange(min(MAX_CONCURRENT_FETCHES, len(paths)))]
+  raise ndb.Return(results)
+
+
+@ndb.tasklet
+def _validate_files_async(config_set, files):
+  """Validates files concurrently.
+
+  At most MAX_CONCURRENT_VALIDATIONS files are validated at a time, including
+  the calls to external validation services.
+
+  Args:
+    config_set (str): name of the config set the files belong to.
+    files (list): (path, content) tuples.
+
+  Returns:
+    components.config.validation_context.Result with the messages of all
+    files, prefixed by their path, in order.
+  """
+  results = [None] * len(files)
+  pending = iter(enumerate(files))
+
+  @ndb.tasklet
+  def worker():
+    for i, (path, content) in pending:
+      results[i] = yield validation.validate_config_async(
+          config_set, path, content)
+
+  yield [worker() for _ in xrange(min(MAX_CONCURRENT_VALIDATIONS, len(files)))]
+
+  ctx = config.validation.Context()
+  for (path, _), result in zip(files, results):
+    with ctx.prefix(path + ': '):
+      for msg in result.messages:
+        ctx.msg(msg.severity, '%s', msg.text)
+  raise ndb.Return(ctx.result())
 
 
 def _import_config_set(config_set, location, project_id=None):
@@ -313,7 +472,16 @@ def _import_config_set(config_set, location, project_id=None):
     logging.info(
         'Rolling %s => %s',
         config_set_entity and config_set_entity.latest_revision, commit.sha)
-    _import_revision(config_set, location, commit, project_id)
+    # Import incrementally from the previous revision if it was imported from
+    # the same location.
+    previous_revision = None
+    if (config_set_entity and
+        config_set_entity.version == storage.ConfigSet.CUR_VERSION and
+        config_set_entity.location == str(location)):
+      previous_revision = config_set_entity.latest_revision
+    _import_revision(
+        config_set, location, commit, project_id,
+        previous_revision=previous_revision)
     import_success_metric.increment(fields={'config_set': config_set})
   except urlfetch_errors.DeadlineExceededError:
     save_attempt(False, 'Could not import: deadline exceeded')
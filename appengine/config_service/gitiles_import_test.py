@@ -81,6 +81,40 @@ class GitilesImportTestCase(test_case.TestCase):
     with open(TEST_ARCHIVE_PATH, 'r') as test_archive_file:
       gitiles.get_archive.return_value = test_archive_file.read()
 
+  def mock_gitiles_tree(self, files):
+    """Mocks the tree and file content of a revision with |files|."""
+    self.mock(gitiles, 'get_tree', mock.Mock())
+    gitiles.get_tree.return_value = gitiles.Tree(
+        id='deadbeef',
+        entries=[
+          gitiles.TreeEntry(
+              id=storage.compute_hash(content)[len('v1:'):],
+              name=path,
+              type='blob',
+              mode=0100644,
+          )
+          for path, content in sorted(files.items())
+        ],
+    )
+
+    def get_file_content_async(
+        _hostname, _project, _treeish, path, **_kwargs):
+      return future(files.get(path.lstrip('/')))
+    self.mock(gitiles, 'get_file_content_async', mock.Mock(
+        side_effect=get_file_content_async))
+
+  def put_revision(self, revision, files):
+    """Stores a previously imported revision with |files|."""
+    rev_key = ndb.Key(
+        storage.ConfigSet, 'config_set', storage.Revision, revision)
+    ndb.put_multi([storage.Revision(key=rev_key)] + [
+      storage.File(
+          id=path, parent=rev_key, content_hash=storage.compute_hash(content))
+      for path, content in files.items()
+    ])
+    for content in files.values():
+      storage.import_blob(content)
+
   def test_import_revision(self):
     self.mock_get_archive()
 
@@ -178,11 +212,13 @@ class GitilesImportTestCase(test_case.TestCase):
     self.mock_get_archive()
     self.mock(notifications, 'notify_gitiles_rejection', mock.Mock())
 
-    def validate_config(config_set, filename, content, ctx):
+    def validate_config_async(config_set, filename, content, ctx=None):
       _, _ = config_set, content
+      ctx = ctx or config.validation.Context()
       if filename == 'test_archive/x':
         ctx.error('bad config!')
-    self.mock(validation, 'validate_config', validate_config)
+      return future(ctx.result())
+    self.mock(validation, 'validate_config_async', validate_config_async)
 
     gitiles_import._import_revision(
         'config_set',
@@ -202,6 +238,195 @@ class GitilesImportTestCase(test_case.TestCase):
     self.assertEqual(val_msg.severity, config.Severity.ERROR)
     self.assertEqual(val_msg.text, 'test_archive/x: bad config!')
 
+  def test_validate_files_concurrently(self):
+    self.mock(gitiles_import, 'MAX_CONCURRENT_VALIDATIONS', 2)
+    running = []
+    max_running = []
+
+    @ndb.tasklet
+    def validate_config_async(config_set, path, content, ctx=None):
+      ctx = ctx or config.validation.Context()
+      running.append(path)
+      max_running.append(len(running))
+      yield ndb.sleep(0)
+      ctx.warning('%s in %s', content, config_set)
+      running.remove(path)
+      raise ndb.Return(ctx.result())
+    self.mock(validation, 'validate_config_async', validate_config_async)
+
+    files = [('a.cfg', 'x'), ('b.cfg', 'y'), ('c.cfg', 'z')]
+    result = gitiles_import._validate_files_async(
+        'config_set', files).get_result()
+    self.assertEqual(2, max(max_running))
+    self.assertEqual(
+        [
+          'a.cfg: x in config_set',
+          'b.cfg: y in config_set',
+          'c.cfg: z in config_set',
+        ],
+        [m.text for m in result.messages])
+    self.assertFalse(result.has_errors)
+
+  def test_import_revision_incremental(self):
+    self.put_revision('deadbeef', {'a.cfg': 'a', 'b.cfg': 'b', 'c.cfg': 'c'})
+    self.mock_gitiles_tree({'a.cfg': 'a', 'b.cfg': 'B', 'd.cfg': 'd'})
+    self.mock(gitiles, 'get_archive', mock.Mock())
+    validated = []
+
+    def validate_config_async(_config_set, path, _content, ctx=None):
+      ctx = ctx or config.validation.Context()
+      validated.append(path)
+      return future(ctx.result())
+    self.mock(validation, 'validate_config_async', validate_config_async)
+
+    loc = gitiles.Location(
+        hostname='localhost', project='project', treeish='main', path='/')
+    gitiles_import._import_revision(
+        'config_set', loc, self.test_commit, self.test_project_id,
+        previous_revision='deadbeef')
+
+    self.assertFalse(gitiles.get_archive.called)
+    gitiles.get_tree.assert_called_once_with(
+        'localhost', 'project', self.test_commit.sha, '/',
+        recursive=True, project_id=self.test_project_id, deadline=15)
+    # Only the changed files were fetched and validated.
+    self.assertEqual(
+        ['/b.cfg', '/d.cfg'],
+        sorted(c[0][3] for c in gitiles.get_file_content_async.call_args_list))
+    self.assertEqual(['b.cfg', 'd.cfg'], sorted(validated))
+
+    rev_key = ndb.Key(
+        storage.ConfigSet, 'config_set',
+        storage.Revision, self.test_commit.sha)
+    saved_files = storage.File.query(ancestor=rev_key).fetch()
+    self.assertEqual(
+        {
+          'a.cfg': storage.compute_hash('a'),
+          'b.cfg': storage.compute_hash('B'),
+          'd.cfg': storage.compute_hash('d'),
+        },
+        {f.key.id(): f.content_hash for f in saved_files})
+    self.assertEqual(
+        'B', storage.Blob.get_by_id(storage.compute_hash('B')).content)
+    self.assertEqual(
+        self.test_commit.sha,
+        storage.ConfigSet.get_by_id('config_set').latest_revision)
+    self.assert_attempt(True, 'Imported')
+
+  def test_import_revision_incremental_cross_file_dependencies(self):
+    self.put_revision('deadbeef', {'a.cfg': 'a', 'b.cfg': 'b'})
+    self.mock_gitiles_tree({'a.cfg': 'a', 'b.cfg': 'B'})
+    self.mock(notifications, 'notify_gitiles_rejection', mock.Mock())
+    self.mock(
+        validation, 'CROSS_FILE_DEPENDENCIES', [('regex:.*', 'a.cfg')])
+
+    def validate_config_async(_config_set, path, content, ctx=None):
+      ctx = ctx or config.validation.Context()
+      if path == 'a.cfg':
+        ctx.error('depends on b.cfg: %s', content)
+      return future(ctx.result())
+    self.mock(validation, 'validate_config_async', validate_config_async)
+
+    loc = gitiles.Location(
+        hostname='localhost', project='project', treeish='main', path='/')
+    gitiles_import._import_revision(
+        'config_set', loc, self.test_commit, self.test_project_id,
+        previous_revision='deadbeef')
+
+    # a.cfg did not change but was validated again, and was not fetched.
+    self.assertEqual(
+        ['/b.cfg'],
+        [c[0][3] for c in gitiles.get_file_content_async.call_args_list])
+    saved_attempt = self.assert_attempt(False, 'Validation errors')
+    self.assertEqual(
+        ['a.cfg: depends on b.cfg: a'],
+        [m.text for m in saved_attempt.validation_messages])
+    self.assertIsNone(storage.ConfigSet.get_by_id('config_set'))
+
+  def test_import_revision_incremental_no_tree(self):
+    self.mock(gitiles, 'get_tree', mock.Mock(return_value=None))
+
+    gitiles_import._import_revision(
+        'config_set',
+        gitiles.Location(
+            hostname='localhost', project='project', treeish='main', path='/'),
+        self.test_commit,
+        self.test_project_id,
+        previous_revision='deadbeef')
+    self.assert_attempt(True, 'Config directory not found. Imported as empty')
+
+  def test_import_revision_incremental_fetch_failed(self):
+    self.put_revision('deadbeef', {'a.cfg': 'a'})
+    self.mock_gitiles_tree({'a.cfg': 'A'})
+    # Gitiles returns content that does not match the blob id of the tree.
+    self.mock(gitiles, 'get_file_content_async', mock.Mock(
+        return_value=future('garbage')))
+    self.mock_get_archive()
+
+    gitiles_import._import_revision(
+        'config_set',
+        gitiles.Location(
+            hostname='localhost', project='project', treeish='main', path='/'),
+        self.test_commit,
+        self.test_project_id,
+        previous_revision='deadbeef')
+
+    # The whole archive was imported instead.
+    gitiles.get_archive.assert_called_once_with(
+        'localhost', 'project', self.test_commit.sha, '/',
+        project_id=self.test_project_id, deadline=15)
+    rev_key = ndb.Key(
+        storage.ConfigSet, 'config_set',
+        storage.Revision, self.test_commit.sha)
+    self.assertEqual(
+        ['test_archive/x'],
+        [f.key.id() for f in storage.File.query(ancestor=rev_key)])
+    self.assert_attempt(True, 'Imported')
+
+  def test_import_revision_incremental_blob_missing(self):
+    rev_key = ndb.Key(
+        storage.ConfigSet, 'config_set', storage.Revision, 'deadbeef')
+    storage.File(
+        id='a.cfg', parent=rev_key, content_hash=storage.compute_hash('a'),
+    ).put()
+    self.mock_gitiles_tree({'a.cfg': 'a', 'b.cfg': 'b'})
+    self.mock(
+        validation, 'CROSS_FILE_DEPENDENCIES', [('regex:.*', 'a.cfg')])
+    self.mock_get_archive()
+
+    gitiles_import._import_revision(
+        'config_set',
+        gitiles.Location(
+            hostname='localhost', project='project', treeish='main', path='/'),
+        self.test_commit,
+        self.test_project_id,
+        previous_revision='deadbeef')
+
+    self.assertTrue(gitiles.get_archive.called)
+    self.assert_attempt(True, 'Imported')
+
+  def test_fetch_files_concurrently(self):
+    self.mock(gitiles_import, 'MAX_CONCURRENT_FETCHES', 2)
+    running = []
+    max_running = []
+
+    @ndb.tasklet
+    def get_file_content_async(
+        _hostname, _project, _treeish, path, **_kwargs):
+      running.append(path)
+      max_running.append(len(running))
+      yield ndb.sleep(0)
+      running.remove(path)
+      raise ndb.Return(None if path == '/c.cfg' else path.upper())
+    self.mock(gitiles, 'get_file_content_async', get_file_content_async)
+
+    loc = gitiles.Location(
+        hostname='localhost', project='project', treeish='main', path='/')
+    contents = gitiles_import._fetch_files_async(
+        loc, ['a.cfg', 'b.cfg', 'c.cfg'], 'project', 15).get_result()
+    self.assertEqual(2, max(max_running))
+    self.assertEqual(['/A.CFG', '/B.CFG', None], contents)
+
   def mock_get_log(self):
     self.mock(gitiles, 'get_log', mock.Mock())
     gitiles.get_log.return_value = gitiles.Log(
@@ -212,6 +437,7 @@ class GitilesImportTestCase(test_case.TestCase):
   def test_import_config_set(self):
     self.mock_get_log()
     self.mock_get_archive()
+    self.mock_gitiles_tree({'test_archive/x': 'x\n'})
 
     storage.ConfigSet(
       location='https://localhost/project',
@@ -239,6 +465,9 @@ class GitilesImportTestCase(test_case.TestCase):
         'a1841f40264376d170269ee9473ce924b7c2c4e9',
         parent=saved_config_set.key))
     self.assert_attempt(True, 'Imported')
+    # The previous revision was imported from the same location.
+    self.assertFalse(gitiles.get_archive.called)
+    self.assertTrue(gitiles.get_tree.called)
 
     # Import second time, import_revision should not be called.
     self.mock(gitiles_import, '_import_revision', mock.Mock())
@@ -314,7 +543,9 @@ class GitilesImportTestCase(test_case.TestCase):
         'config_set',
         gitiles.Location.parse('https://localhost/project/+/main/x'),
         self.test_project_id)
-    gitiles_import._import_revision.assert_called_once()
+    gitiles_import._import_revision.assert_called_once_with(
+        'config_set', mock.ANY, self.test_commit, self.test_project_id,
+        previous_revision=None)
 
   def test_import_config_set_location_change(self):
     self.mock_get_log()
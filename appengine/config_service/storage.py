@@ -15,6 +15,10 @@ from components import config
 from components import utils
 
 
+# Maximum total size of the content of Blob entities put in a single RPC.
+MAX_BLOB_BATCH_SIZE = 4*1024*1024
+
+
 class ServiceDynamicMetadata(ndb.Model):
   """Contains service dynamic metadata.
 
@@ -311,12 +315,37 @@ def import_blob_async(content, content_hash=None):
     Content hash.
   """
   content_hash = content_hash or compute_hash(content)
-
-  # pylint: disable=E1120
-  if not Blob.get_by_id(content_hash):
-    yield Blob(id=content_hash, content=content).put_async()
+  yield import_blobs_async({content_hash: content})
   raise ndb.Return(content_hash)
 
 
+@ndb.tasklet
+def import_blobs_async(contents):
+  """Saves the Blob entities that do not exist yet.
+
+  Looks up all the blobs at once, then puts the missing ones in batches of at
+  most MAX_BLOB_BATCH_SIZE bytes of content.
+
+  Args:
+    contents: dict {content_hash: content}, see compute_hash().
+  """
+  hashes = sorted(contents)
+  existing = yield ndb.get_multi_async([ndb.Key(Blob, h) for h in hashes])
+  batches = [[]]
+  size = 0
+  for content_hash, blob in zip(hashes, existing):
+    if blob:
+      continue
+    content = contents[content_hash]
+    if batches[-1] and size + len(content) > MAX_BLOB_BATCH_SIZE:
+      batches.append([])
+      size = 0
+    batches[-1].append(Blob(id=content_hash, content=content))
+    size += len(content)
+  for batch in batches:
+    if batch:
+      yield ndb.put_multi_async(batch)
+
+
 def import_blob(content, content_hash=None):
   return import_blob_async(content, content_hash=content_hash).get_result()
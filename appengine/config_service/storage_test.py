@@ -10,6 +10,8 @@ from test_env import future
 import test_env
 test_env.setup_test_env()
 
+from google.appengine.ext import ndb
+
 from test_support import test_case
 import mock
 
@@ -133,6 +135,28 @@ class StorageTestCase(test_case.TestCase):
     self.assertIsNotNone(blob)
     self.assertEqual(blob.content, content)
 
+  def test_import_blobs(self):
+    self.mock(storage, 'MAX_BLOB_BATCH_SIZE', 5)
+    contents = ['old', 'abc', 'defg', 'hi']
+    storage.import_blob(contents[0])
+    put_multi_async = ndb.put_multi_async
+    batches = []
+    def put_multi_async_mock(entities, **kwargs):
+      batches.append(sorted(e.content for e in entities))
+      return put_multi_async(entities, **kwargs)
+    self.mock(ndb, 'put_multi_async', put_multi_async_mock)
+
+    storage.import_blobs_async(
+        {storage.compute_hash(c): c for c in contents}).get_result()
+    # 'old' already exists, the others are put in batches of at most 5 bytes.
+    self.assertEqual(
+        ['abc', 'defg', 'hi'], sorted(c for b in batches for c in b))
+    self.assertTrue(all(sum(len(c) for c in b) <= 5 for b in batches))
+    self.assertLess(1, len(batches))
+    for c in contents:
+      self.assertEqual(
+          c, storage.Blob.get_by_id(storage.compute_hash(c)).content)
+
   def test_message_field_merge(self):
     default_msg = service_config_pb2.ImportCfg(
         gitiles=service_config_pb2.ImportCfg.Gitiles(fetch_log_deadline=42))
@@ -23,6 +23,15 @@ import common
 import services
 
 
+# Config files whose validation depends on other files of their config set, as
+# (config set pattern, path pattern) tuples, see validation.compile_pattern.
+# Incremental imports validate them again even if they did not change.
+#
+# External services only receive the content of the validated file, so only
+# built-in rules can depend on other files.
+CROSS_FILE_DEPENDENCIES = []
+
+
 def validate_config_set(config_set, ctx=None):
   ctx = ctx or validation.Context.raise_on_error()
   if not any(r.match(config_set) for r in config.ALL_CONFIG_SET_RGX):
@@ -424,6 +433,17 @@ def validate_config(*args, **kwargs):
   return validate_config_async(*args, **kwargs).get_result()
 
 
+def has_cross_file_dependencies(config_set, path):
+  """Returns True if the validation of a config depends on other files.
+
+  See CROSS_FILE_DEPENDENCIES.
+  """
+  return any(
+      validation.compile_pattern(cs)(config_set) and
+      validation.compile_pattern(p)(path)
+      for cs, p in CROSS_FILE_DEPENDENCIES)
+
+
 def is_url_relative(url):
   parsed = urllib.parse.urlparse(url)
   return bool(not parsed.scheme and not parsed.netloc and parsed.path)
@@ -0,0 +1,295 @@
+# Copyright 2026 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Negative lookup index of ContentEntry keys, used by /preupload.
+
+Clients mostly preupload digests that are already present. The index tells
+which digests are certainly missing, so only the other ones are looked up in
+the datastore.
+
+The index is a Bloom filter per namespace and per first two hex letters of the
+digest, each stored in its own memcache value and cached in instance memory.
+The filters are rebuilt periodically by a task per prefix, which scans the
+ContentEntry keys under the ContentShard entities starting with this prefix
+and adds them to the filters as they are streamed. The filters are sized from
+the number of entries seen by the previous rebuild.
+
+Entries stored after a filter was built are recorded as individual memcache
+markers that outlive the filter. Entries deleted after a filter was built are
+false positives, which the datastore lookup resolves.
+
+When the index is wrong about a missing entry, e.g. memcache evicted a marker,
+the client uploads the content again. It is wasteful but not incorrect.
+"""
+
+import logging
+import struct
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import model
+
+
+# One filter is built per namespace per first two letters of the digest.
+PREFIXES = ['%02x' % i for i in range(256)]
+
+
+# The only namespace that may use ContentShard entities keyed by the first
+# letter of the digest, see model.entry_key_from_id().
+_ONE_LETTER_SHARD_NAMESPACE = 'default-gzip'
+
+
+# Number of bits per entry and of hash functions, for ~1% false positives.
+BITS_PER_ENTRY = 10
+NUM_HASHES = 7
+
+
+# Maximum size of a filter, so it fits in a memcache value.
+MAX_FILTER_BYTES = 1000*1000 - 1024
+
+
+# Maximum and minimum number of entries a filter is sized for.
+MAX_ENTRIES = MAX_FILTER_BYTES * 8 // BITS_PER_ENTRY
+MIN_ENTRIES = 1024
+
+
+# A filter is sized for this factor of the number of entries seen by the
+# previous rebuild, to leave room for the growth of the namespace.
+GROWTH_FACTOR = 1.25
+
+
+# A filter holding more than this factor of the entries it was sized for has too
+# many false positives and is not stored. About 14% with the default settings.
+MAX_LOAD_FACTOR = 2
+
+
+# The rebuild cron job runs every REBUILD_INTERVAL seconds, see cron.yaml. A
+# filter that failed to be rebuilt twice in a row expires.
+REBUILD_INTERVAL = 6*60*60
+FILTER_TTL = 2*REBUILD_INTERVAL
+
+
+# How long a filter is kept in instance memory.
+INSTANCE_CACHE_TTL = 60
+
+
+# Markers must outlive any filter built before the entry was stored. This
+# includes the time it takes to build it, at most 10 minutes.
+MARKER_TTL = FILTER_TTL + INSTANCE_CACHE_TTL + 10*60
+
+
+# The entry counts used to size the filters are kept longer than the filters,
+# so a filter that expired is still sized correctly.
+COUNTS_TTL = 4*REBUILD_INTERVAL
+
+
+_FILTERS_NAMESPACE = 'existence'
+_MARKERS_NAMESPACE = 'existence-added'
+_COUNTS_NAMESPACE = 'existence-counts'
+
+
+_HEADER = struct.Struct('<IB')
+
+
+# '<namespace>/<prefix>' -> (expiration, BloomFilter).
+_cache = {}
+
+
+class BloomFilter(object):
+  """Bloom filter of hex digests.
+
+  Digests are already uniformly distributed so the bit positions are derived
+  from the digest itself. The first two letters are skipped since all the
+  digests in a filter share them.
+  """
+
+  def __init__(self, num_bits, num_hashes=NUM_HASHES, bits=None):
+    self.num_bits = num_bits
+    self.num_hashes = num_hashes
+    self._bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+
+  @classmethod
+  def for_count(cls, count):
+    """Returns an empty filter sized for |count| entries."""
+    return cls(max(count, 1) * BITS_PER_ENTRY)
+
+  @classmethod
+  def from_string(cls, data):
+    """Loads a filter serialized with to_string()."""
+    num_bits, num_hashes = _HEADER.unpack_from(data, 0)
+    bits = bytearray(data[_HEADER.size:])
+    if len(bits) != (num_bits + 7) // 8:
+      raise ValueError('Invalid filter size')
+    return cls(num_bits, num_hashes, bits)
+
+  def to_string(self):
+    return _HEADER.pack(self.num_bits, self.num_hashes) + str(self._bits)
+
+  def add(self, digest):
+    for i in self._positions(digest):
+      self._bits[i >> 3] |= 1 << (i & 7)
+
+  def __contains__(self, digest):
+    return all(
+        self._bits[i >> 3] & (1 << (i & 7)) for i in self._positions(digest))
+
+  def _positions(self, digest):
+    # Digests are at least 40 letters long, see model.check_hash().
+    h1 = int(digest[2:18], 16)
+    h2 = int(digest[18:34], 16) | 1
+    return [(h1 + i * h2) % self.num_bits for i in xrange(self.num_hashes)]
+
+
+### Public API.
+
+
+def add(namespace, digests):
+  """Records that the ContentEntry for |digests| were just stored."""
+  memcache.set_multi(
+      {'%s/%s' % (namespace, d): 1 for d in digests},
+      time=MARKER_TTL, namespace=_MARKERS_NAMESPACE)
+
+
+def may_exist(namespace, digests):
+  """Returns a list of bool, False when a digest is certainly missing.
+
+  Digests must be valid for the namespace.
+  """
+  filters = _get_filters(namespace, set(d[:2] for d in digests))
+  # None means that it must be looked up in the markers.
+  out = [
+    None if d[:2] in filters and d not in filters[d[:2]] else True
+    for d in digests
+  ]
+  unknown = [d for d, o in zip(digests, out) if o is None]
+  if unknown:
+    markers = memcache.get_multi(
+        ['%s/%s' % (namespace, d) for d in unknown],
+        namespace=_MARKERS_NAMESPACE)
+    out = [
+      ('%s/%s' % (namespace, d)) in markers if o is None else o
+      for d, o in zip(digests, out)
+    ]
+  return out
+
+
+def rebuild(prefix, time_to_stop):
+  """Rebuilds the filters of all the namespaces for the digests starting with
+  |prefix|.
+
+  Returns the number of filters stored, or None if it ran out of time, in
+  which case the previous filters are kept until they expire.
+  """
+  assert prefix in PREFIXES, prefix
+  counts = memcache.get(prefix, namespace=_COUNTS_NAMESPACE) or {}
+  # namespace -> [BloomFilter, number of entries it is sized for, count].
+  filters = {}
+  count = 0
+  for key in _iter_keys(prefix):
+    count += 1
+    if not (count % 1000) and time.time() >= time_to_stop:
+      logging.warning(
+          'Ran out of time after %d entries for prefix %s', count, prefix)
+      return None
+    namespace, digest = key.string_id().rsplit('/', 1)
+    item = filters.get(namespace)
+    if not item:
+      capacity = min(
+          MAX_ENTRIES,
+          max(MIN_ENTRIES, int(counts.get(namespace, 0) * GROWTH_FACTOR)))
+      item = filters[namespace] = [BloomFilter.for_count(capacity), capacity, 0]
+    item[0].add(digest)
+    item[2] += 1
+
+  to_store = {}
+  for namespace, (f, capacity, items) in filters.iteritems():
+    key = '%s/%s' % (namespace, prefix)
+    if items > capacity * MAX_LOAD_FACTOR:
+      # It will be sized for this count on the next rebuild, up to MAX_ENTRIES.
+      logging.warning(
+          'Too many entries in %s for prefix %s: %d', namespace, prefix, items)
+      memcache.delete(key, namespace=_FILTERS_NAMESPACE)
+      continue
+    to_store[key] = f.to_string()
+  failed = memcache.set_multi(
+      to_store, time=FILTER_TTL, namespace=_FILTERS_NAMESPACE)
+  if failed:
+    logging.warning('Failed to store %d filters', len(failed))
+  memcache.set(
+      prefix, {namespace: item[2] for namespace, item in filters.iteritems()},
+      time=COUNTS_TTL, namespace=_COUNTS_NAMESPACE)
+  logging.info(
+      'Indexed %d entries in %d filters for prefix %s',
+      count, len(to_store) - len(failed), prefix)
+  return len(to_store) - len(failed)
+
+
+def reset_cache():
+  """Clears the filters cached in instance memory."""
+  _cache.clear()
+
+
+### Private stuff.
+
+
+def _next_prefix(prefix):
+  """Returns the smallest string greater than all the strings starting with
+  |prefix|, which is made of hex letters.
+  """
+  return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _iter_keys(prefix):
+  """Yields the ContentEntry keys of the digests starting with |prefix|."""
+  options = ndb.QueryOptions(
+      keys_only=True, read_policy=ndb.EVENTUAL_CONSISTENCY)
+  # ContentShard ids are the first letters of the digest, see
+  # model.entry_key_from_id(). The ContentEntry keys are sorted under their
+  # parent so a range over the parent keys returns all the entries for this
+  # prefix, for all the namespaces.
+  q = model.ContentEntry.query(
+      model.ContentEntry.key >= ndb.Key('ContentShard', prefix),
+      model.ContentEntry.key < ndb.Key('ContentShard', _next_prefix(prefix)),
+      default_options=options)
+  for key in q.iter(batch_size=1000):
+    yield key
+  # One namespace may use ContentShard entities keyed by a single letter, which
+  # are outside the range above. Their ContentEntry keys are sorted by digest.
+  parent = ndb.Key('ContentShard', prefix[0])
+  namespace = _ONE_LETTER_SHARD_NAMESPACE
+  q = model.ContentEntry.query(
+      model.ContentEntry.key >= ndb.Key(
+          'ContentEntry', '%s/%s' % (namespace, prefix), parent=parent),
+      model.ContentEntry.key < ndb.Key(
+          'ContentEntry', '%s/%s' % (namespace, _next_prefix(prefix)),
+          parent=parent),
+      default_options=options)
+  for key in q.iter(batch_size=1000):
+    yield key
+
+
+def _get_filters(namespace, prefixes):
+  """Returns the filters known for |namespace|, as a dict prefix -> filter."""
+  now = time.time()
+  out = {}
+  missing = []
+  for prefix in prefixes:
+    cached = _cache.get('%s/%s' % (namespace, prefix))
+    if cached and cached[0] > now:
+      out[prefix] = cached[1]
+    else:
+      missing.append('%s/%s' % (namespace, prefix))
+  if missing:
+    found = memcache.get_multi(missing, namespace=_FILTERS_NAMESPACE)
+    for key, data in found.iteritems():
+      try:
+        f = BloomFilter.from_string(data)
+      except (struct.error, ValueError) as e:
+        logging.error('Ignoring corrupted filter %s: %s', key, e)
+        continue
+      _cache[key] = (now + INSTANCE_CACHE_TTL, f)
+      out[key.rsplit('/', 1)[1]] = f
+  return out
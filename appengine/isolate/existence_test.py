@@ -0,0 +1,154 @@
+#!/usr/bin/env vpython
+# Copyright 2026 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+import hashlib
+import logging
+import sys
+import time
+import unittest
+
+import isolate_test_env as test_env
+test_env.setup_test_env()
+
+from google.appengine.api import memcache
+
+from test_support import test_case
+
+import config
+import existence
+import model
+
+
+def digest_of(content):
+  return hashlib.sha1(content).hexdigest()
+
+
+class ExistenceTest(test_case.TestCase):
+  APP_DIR = test_env.APP_DIR
+
+  def setUp(self):
+    super(ExistenceTest, self).setUp()
+    existence.reset_cache()
+
+  def tearDown(self):
+    existence.reset_cache()
+    super(ExistenceTest, self).tearDown()
+
+  def put(self, namespace, digest):
+    model.new_content_entry(model.get_entry_key(namespace, digest)).put()
+
+  def test_bloom_filter(self):
+    f = existence.BloomFilter.for_count(1000)
+    present = [digest_of(str(i)) for i in xrange(1000)]
+    for d in present:
+      f.add(d)
+    f = existence.BloomFilter.from_string(f.to_string())
+    self.assertTrue(all(d in f for d in present))
+    absent = [digest_of('absent%d' % i) for i in xrange(1000)]
+    # ~1% false positives.
+    self.assertLess(sum(d in f for d in absent), 50)
+
+  def test_bloom_filter_corrupted(self):
+    data = existence.BloomFilter.for_count(10).to_string()
+    with self.assertRaises(ValueError):
+      existence.BloomFilter.from_string(data[:-1])
+
+  def test_may_exist_no_filter(self):
+    digests = [digest_of('a'), digest_of('b')]
+    self.assertEqual([True, True], existence.may_exist('default', digests))
+
+  def test_rebuild(self):
+    present = [digest_of(str(i)) for i in xrange(50)]
+    for d in present:
+      self.put('default', d)
+    self.put('other', digest_of('other'))
+    absent = [digest_of('absent%d' % i) for i in xrange(50)]
+
+    for prefix in existence.PREFIXES:
+      self.assertIsNotNone(existence.rebuild(prefix, time.time() + 60))
+    self.assertEqual(
+        [True] * len(present), existence.may_exist('default', present))
+    # Only false positives are possible.
+    self.assertLess(sum(existence.may_exist('default', absent)), 10)
+    self.assertEqual(
+        [True], existence.may_exist('other', [digest_of('other')]))
+
+  def test_rebuild_out_of_time(self):
+    for i in xrange(2000):
+      self.put('default', '00' + digest_of(str(i))[2:])
+    self.assertIsNone(existence.rebuild('00', time.time() - 1))
+    self.assertEqual({}, existence._get_filters('default', ['00']))
+
+  def test_rebuild_too_many(self):
+    self.mock(existence, 'MIN_ENTRIES', 5)
+    self.mock(existence, 'MAX_ENTRIES', 10)
+    present = ['ab' + digest_of(str(i))[2:] for i in xrange(21)]
+    for d in present:
+      self.put('default', d)
+    self.assertEqual(0, existence.rebuild('ab', time.time() + 60))
+    # Sized for the previous count, but still over MAX_ENTRIES.
+    self.assertEqual(0, existence.rebuild('ab', time.time() + 60))
+    self.assertEqual(
+        [True] * len(present), existence.may_exist('default', present))
+
+  def test_rebuild_sized_from_previous_count(self):
+    self.mock(existence, 'MIN_ENTRIES', 5)
+    present = ['ab' + digest_of(str(i))[2:] for i in xrange(50)]
+    for d in present:
+      self.put('default', d)
+    # The first filter is too small to be useful.
+    self.assertEqual(0, existence.rebuild('ab', time.time() + 60))
+    self.assertEqual({}, existence._get_filters('default', ['ab']))
+    self.assertEqual(1, existence.rebuild('ab', time.time() + 60))
+    self.assertEqual(
+        [True] * len(present), existence.may_exist('default', present))
+    absent = ['ab' + digest_of('absent%d' % i)[2:] for i in xrange(50)]
+    self.assertLess(sum(existence.may_exist('default', absent)), 10)
+
+  def test_rebuild_one_letter_shard(self):
+    cfg = config.settings()
+    cfg.sharding_letters = 1
+    self.mock(config, 'settings', lambda: cfg)
+    gzip = ['ab' + digest_of('gzip%d' % i)[2:] for i in xrange(10)]
+    for d in gzip:
+      self.put('default-gzip', d)
+    other = ['ab' + digest_of('other%d' % i)[2:] for i in xrange(10)]
+    for d in other:
+      self.put('default', d)
+    self.put('default-gzip', 'ac' + digest_of('next')[2:])
+    key = model.get_entry_key('default-gzip', gzip[0])
+    self.assertEqual('a', key.parent().string_id())
+
+    self.assertEqual(2, existence.rebuild('ab', time.time() + 60))
+    for namespace, digests in (('default-gzip', gzip), ('default', other)):
+      self.assertEqual(
+          ['ab'], existence._get_filters(namespace, ['ab']).keys())
+      self.assertEqual(
+          [True] * len(digests), existence.may_exist(namespace, digests))
+    self.assertEqual({}, existence._get_filters('default-gzip', ['ac']))
+
+  def test_add(self):
+    old = digest_of('old')
+    self.put('default', old)
+    existence.rebuild(old[:2], time.time() + 60)
+    existence.reset_cache()
+    # Stored after the filter was built, with the same prefix.
+    new = old[:2] + digest_of('new')[2:]
+    self.assertEqual([False], existence.may_exist('default', [new]))
+    existence.add('default', [new])
+    self.assertEqual([True], existence.may_exist('default', [new]))
+    memcache.flush_all()
+    existence.reset_cache()
+    # Without the filter, it is unknown.
+    self.assertEqual([True], existence.may_exist('default', [new]))
+
+
+if __name__ == '__main__':
+  if '-v' in sys.argv:
+    unittest.TestCase.maxDiff = None
+    logging.basicConfig(level=logging.DEBUG)
+  else:
+    logging.basicConfig(level=logging.FATAL)
+  unittest.main()
@@ -18,6 +18,7 @@ from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 import config
+import existence
 import gcs
 import model
 import stats
@@ -346,6 +347,17 @@ class CronCleanupOrphanHandler(webapp2.RequestHandler):
       logging.warning('Failed to trigger task')
 
 
+class CronExistenceRebuildHandler(webapp2.RequestHandler):
+  """Triggers a taskqueue per digest prefix to rebuild the existence index."""
+  @decorators.require_cronjob
+  def get(self):
+    for prefix in existence.PREFIXES:
+      if not utils.enqueue_task(
+          '/internal/taskqueue/existence/rebuild/%s' % prefix,
+          'existence-rebuild'):
+        logging.warning('Failed to trigger task for %s', prefix)
+
+
 class CronStatsUpdateHandler(webapp2.RequestHandler):
   """Called every few minutes to update statistics."""
   @decorators.require_cronjob
@@ -440,6 +452,15 @@ class TaskCleanupOrphanHandler(webapp2.RequestHandler):
     # to this directory.
 
 
+class TaskExistenceRebuildHandler(webapp2.RequestHandler):
+  """Rebuilds the existence index for the digests starting with a prefix."""
+  # pylint: disable=no-self-use
+  @decorators.require_taskqueue('existence-rebuild')
+  def post(self, prefix):
+    # Do not run for more than 9 minutes. Exceeding 10min hard limit causes 500.
+    existence.rebuild(prefix, time.time() + 9*60)
+
+
 class TaskTagWorkerHandler(webapp2.RequestHandler):
   """Tags hot ContentEntry entities that were tested for presence.
 
@@ -635,6 +656,9 @@ def get_routes():
     webapp2.Route(
         r'/internal/cron/cleanup/trigger/orphan',
         CronCleanupOrphanHandler),
+    webapp2.Route(
+        r'/internal/cron/existence/trigger/rebuild',
+        CronExistenceRebuildHandler),
 
     # Cleanup tasks.
     webapp2.Route(
@@ -646,6 +670,9 @@ def get_routes():
     webapp2.Route(
         r'/internal/taskqueue/cleanup/orphan',
         TaskCleanupOrphanHandler),
+    webapp2.Route(
+        r'/internal/taskqueue/existence/rebuild/<prefix:[0-9a-f]{2}>',
+        TaskExistenceRebuildHandler),
 
     # Tasks triggered by other request handlers.
     webapp2.Route(
@@ -28,6 +28,7 @@ from components import utils
 from test_support import test_case
 
 import config
+import existence
 import gcs
 import handlers_backend
 import handlers_endpoints_v1
@@ -156,6 +157,19 @@ class MainTest(test_case.EndpointsTestCase):
     # Boom it's gone.
     self.assertEqual(0, model.ContentEntry.query().count())
 
+  def test_cron_existence_trigger_rebuild(self):
+    request = self.store_request('default', 'Foo')
+    self.call_api('store_inline', message_to_dict(request))
+    self.app.get(
+        '/internal/cron/existence/trigger/rebuild',
+        headers={'X-AppEngine-Cron': 'true'})
+    self.assertEqual(len(existence.PREFIXES), self.execute_tasks())
+    digest = hash_content('default', 'Foo')
+    self.assertEqual(
+        [digest[:2]],
+        existence._get_filters('default', existence.PREFIXES).keys())
+    self.assertEqual([True], existence.may_exist('default', [digest]))
+
   def test_cron_cleanup_trigger_orphan(self):
     now = 12345678.
     self.mock(time, 'time', lambda: now)
@@ -11,6 +11,7 @@ import hashlib
 import logging
 import os
 import re
+import struct
 import time
 import zlib
 
@@ -21,6 +22,7 @@ from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
 import endpoints
+import webapp2
 from protorpc import message_types
 from protorpc import messages
 from protorpc import remote
@@ -31,6 +33,7 @@ from components import utils
 
 import acl
 import config
+import existence
 import gcs
 import metrics
 import model
@@ -42,6 +45,27 @@ import stats
 MIN_SIZE_FOR_GS = 501
 
 
+# The maximum number of entries that can be retrieved at once by
+# RetrieveBatchHandler.
+MAX_BATCH_DIGESTS = 1000
+
+
+# RetrieveBatchHandler stops inlining content past this size. App Engine
+# responses are limited to 32MiB.
+MAX_BATCH_RESPONSE_SIZE = 16*1024*1024
+
+
+# Frame types of a RetrieveBatchHandler response.
+BATCH_CONTENT = 0
+BATCH_URL = 1
+BATCH_MISSING = 2
+BATCH_SKIPPED = 3
+
+
+# Frame header: type, payload length.
+_BATCH_FRAME = struct.Struct('>BI')
+
+
 ### Request Types
 
 
@@ -136,6 +160,15 @@ class TokenSigner(auth.TokenKind):
   secret_key = auth.SecretKey('isolate_upload_token')
 
 
+def get_url_signer():
+  """Returns a CloudStorageURLSigner object for the configured bucket."""
+  settings = config.settings()
+  return gcs.URLSigner(
+      settings.gs_bucket,
+      settings.gs_client_id_email,
+      settings.gs_private_key)
+
+
 @ndb.transactional
 def store_and_enqueue_verify_task(entry, task_queue_host):
   entry.put()
@@ -418,6 +451,7 @@ class IsolateService(remote.Service):
         raise endpoints.InternalServerErrorException(
             'Unable to store the entity: %s.' % e.__class__.__name__)
 
+    existence.add(namespace, [digest])
     stats.add_entry(
         stats.STORE, entry.compressed_size,
         'GS; %s' % entry.key.id() if uploaded_to_gs else 'inline')
@@ -460,19 +494,23 @@ class IsolateService(remote.Service):
     Arguments:
       entries: a DigestCollection to be posted
 
-    Yields:
-      (Digest, ContentEntry or None)
+    Returns:
+      list of (Digest, ContentEntry or None)
 
     Raises:
       BadRequestException if any digest is not a valid hexadecimal number.
     """
-    # Kick off all queries in parallel. Build mapping Future -> digest.
-    def fetch(digest):
-      key = entry_key_or_error(
-          entries.namespace.namespace, digest.digest)
-      return key.get_async(use_cache=False)
-
-    return utils.async_apply(entries.items, fetch, unordered=True)
+    namespace = entries.namespace.namespace
+    keys = [entry_key_or_error(namespace, d.digest) for d in entries.items]
+    # Only fetch the entities that are not known to be missing, in one batch.
+    candidates = existence.may_exist(
+        namespace, [d.digest for d in entries.items])
+    found = iter(ndb.get_multi(
+        [k for k, c in zip(keys, candidates) if c], use_cache=False))
+    return [
+      (d, next(found) if c else None)
+      for d, c in zip(entries.items, candidates)
+    ]
 
   @classmethod
   def partition_collection(cls, entries):
@@ -532,11 +570,7 @@ class IsolateService(remote.Service):
   def gs_url_signer(self):
     """On demand instance of CloudStorageURLSigner object."""
     if not self._gs_url_signer:
-      settings = config.settings()
-      self._gs_url_signer = gcs.URLSigner(
-          settings.gs_bucket,
-          settings.gs_client_id_email,
-          settings.gs_private_key)
+      self._gs_url_signer = get_url_signer()
     return self._gs_url_signer
 
   @staticmethod
@@ -561,8 +595,168 @@ class IsolateService(remote.Service):
     return self.request_state.headers.get('User-Agent', '')
 
 
+class RetrieveBatchHandler(auth.ApiHandler):
+  """Retrieves many entries in a single round trip.
+
+  The request is a JSON dict {'namespace': <namespace>, 'digests': [...]}.
+
+  The response is application/octet-stream, with one frame per requested
+  digest, in order. A frame is a type byte and a big endian 32 bits payload
+  length, followed by the payload:
+  - BATCH_CONTENT: the content as stored, i.e. compressed in compressed
+    namespaces.
+  - BATCH_URL: a signed URL to download the content from GCS.
+  - BATCH_MISSING: no payload, the entry doesn't exist.
+  - BATCH_SKIPPED: no payload, the response is full. The entry must be
+    retrieved separately.
+  """
+
+  @auth.require(acl.isolate_readable, log_identity=True)
+  def post(self):
+    body = self.parse_body()
+    namespace = body.get('namespace')
+    digests = body.get('digests')
+    if (not isinstance(namespace, basestring) or
+        not re.match(r'^%s$' % model.NAMESPACE_RE, namespace)):
+      self.abort_with_error(400, text='Invalid namespace')
+    if (not isinstance(digests, list) or
+        not all(isinstance(d, basestring) for d in digests)):
+      self.abort_with_error(400, text='digests must be a list of strings')
+    if len(digests) > MAX_BATCH_DIGESTS:
+      self.abort_with_error(
+          400, text='Only up to %d items can be retrieved at once' %
+          MAX_BATCH_DIGESTS)
+    namespace = namespace.encode('utf-8')
+    digests = [d.encode('utf-8') for d in digests]
+    try:
+      keys = [model.get_entry_key(namespace, d) for d in digests]
+    except ValueError as e:
+      self.abort_with_error(400, text=str(e))
+
+    cached = memcache.get_multi(digests, namespace='table_%s' % namespace)
+    lookup = [k for d, k in zip(digests, keys) if d not in cached]
+    stored = dict(zip(lookup, ndb.get_multi(lookup)))
+
+    out = []
+    size = 0
+    signer = None
+    for digest, key in zip(digests, keys):
+      content = cached.get(digest)
+      found = 'memcache'
+      if content is None:
+        entry = stored[key]
+        if not entry:
+          out.append(_BATCH_FRAME.pack(BATCH_MISSING, 0))
+          continue
+        content = entry.content
+        found = 'inline'
+      if content is not None:
+        if size + len(content) > MAX_BATCH_RESPONSE_SIZE:
+          out.append(_BATCH_FRAME.pack(BATCH_SKIPPED, 0))
+          continue
+        size += len(content)
+        stats.add_entry(stats.RETURN, len(content), found)
+        out.append(_BATCH_FRAME.pack(BATCH_CONTENT, len(content)))
+        out.append(content)
+        continue
+      # The data is in GS.
+      if not signer:
+        signer = get_url_signer()
+      url = str(signer.get_download_url(
+          filename=key.id(), expiration=DEFAULT_LINK_EXPIRATION))
+      metrics.file_size(entry.compressed_size)
+      stats.add_entry(
+          stats.RETURN, entry.compressed_size, 'GS; %s' % key.id())
+      out.append(_BATCH_FRAME.pack(BATCH_URL, len(url)))
+      out.append(url)
+    logging.debug('Returned %d entries, %d bytes inline', len(digests), size)
+    self.response.headers['Content-Type'] = 'application/octet-stream'
+    self.response.write(''.join(out))
+
+
+class RetrieveRawHandler(auth.ApiHandler):
+  """Retrieves an entry as application/octet-stream.
+
+  Same as IsolateService.retrieve, without the base64 encoding of the content
+  in a JSON response. The content is returned as stored, i.e. compressed in
+  compressed namespaces, starting at the 'offset' query parameter. Entries
+  stored in GCS are redirected to a signed URL.
+  """
+
+  @auth.require(acl.isolate_readable, log_identity=True)
+  def get(self, namespace, digest):
+    try:
+      offset = int(self.request.get('offset') or 0)
+    except ValueError:
+      self.abort_with_error(400, text='offset must be an integer')
+    try:
+      key = model.get_entry_key(namespace, digest)
+    except ValueError as e:
+      self.abort_with_error(400, text=str(e))
+
+    content = memcache.get(digest, namespace='table_%s' % namespace)
+    found = 'memcache'
+    if content is None:
+      entry = key.get()
+      if not entry:
+        self.abort_with_error(404, text='Unable to retrieve the entry.')
+      content = entry.content  # will be None if entity is in GCS
+      found = 'inline'
+
+    size = len(content) if content is not None else entry.compressed_size
+    if offset < 0 or offset > size:
+      self.abort_with_error(
+          400,
+          text='Invalid offset %d. Offset must be between 0 and content '
+          'length.' % offset)
+
+    if content is not None:
+      stats.add_entry(stats.RETURN, size - offset, found)
+      self.response.headers['Content-Type'] = 'application/octet-stream'
+      self.response.write(content[offset:])
+      return
+
+    # The data is in GS.
+    metrics.file_size(size - offset)
+    stats.add_entry(stats.RETURN, size - offset, 'GS; %s' % key.id())
+    self.redirect(str(get_url_signer().get_download_url(
+        filename=key.id(), expiration=DEFAULT_LINK_EXPIRATION)))
+
+
+class StoreInlineRawHandler(auth.ApiHandler):
+  """Stores a relatively small entry uploaded as application/octet-stream.
+
+  Same as IsolateService.store_inline, without the base64 encoding of the
+  content in a JSON request. The upload ticket returned by preupload is passed
+  as the 'upload_ticket' query parameter.
+  """
+
+  @auth.require(acl.isolate_writable, log_identity=True)
+  def post(self):
+    if self.request.content_type != 'application/octet-stream':
+      self.abort_with_error(
+          400, text='Expecting an application/octet-stream body')
+    request = StorageRequest(
+        upload_ticket=self.request.GET.get('upload_ticket'),
+        content=self.request.body)
+    try:
+      response = IsolateService.storage_helper(request, False)
+    except endpoints.ServiceException as e:
+      self.abort_with_error(e.http_status, text=e.message)
+    self.send_response({'ok': response.ok})
+
+
 def get_routes():
-  return endpoints_webapp2.api_routes([
+  return [
+      webapp2.Route(
+          r'/api/isolateservice/v1/retrieve_batch', RetrieveBatchHandler),
+      webapp2.Route(
+          r'/api/isolateservice/v1/retrieve_raw/<namespace:%s>/'
+          r'<digest:[0-9a-f]+>' % model.NAMESPACE_RE,
+          RetrieveRawHandler),
+      webapp2.Route(
+          r'/api/isolateservice/v1/store_inline_raw', StoreInlineRawHandler),
+  ] + endpoints_webapp2.api_routes([
       config.ConfigApi,
       IsolateService,
   ], base_path='/api')
@@ -7,8 +7,11 @@ import base64
 import hashlib
 import json
 import logging
+import struct
 import sys
+import time
 import unittest
+import urllib
 import zlib
 import mock
 from Crypto.PublicKey import RSA
@@ -18,8 +21,10 @@ test_env.setup_test_env()
 
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
 
 from protorpc.remote import protojson
+import webapp2
 import webtest
 
 from components import auth
@@ -28,6 +33,7 @@ from components import utils
 from test_support import test_case
 
 import config
+import existence
 import gcs
 import handlers_backend
 import handlers_endpoints_v1
@@ -251,6 +257,33 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
     # find enqueued tasks
     self.assertEqual(1, self.execute_tasks())
 
+  def test_check_existing_uses_existence_index(self):
+    """Assert that entries known to be missing are not looked up."""
+    namespace = 'default'
+    collection = generate_collection(namespace, ['old', 'new', 'new9'])
+    old = model.get_entry_key(namespace, collection.items[0].digest)
+    model.new_content_entry(old).put()
+    for prefix in existence.PREFIXES:
+      existence.rebuild(prefix, time.time() + 60)
+    # Stored after the index was built.
+    request = self.store_request(namespace, 'new')
+    self.call_api('store_inline', message_to_dict(request))
+
+    fetched = []
+    get_multi = ndb.get_multi
+    def mocked_get_multi(keys, **kwargs):
+      fetched.extend(keys)
+      return get_multi(keys, **kwargs)
+    self.mock(ndb, 'get_multi', mocked_get_multi)
+    response = self.call_api('preupload', message_to_dict(collection), 200)
+    self.assertEqual([2], [int(i['index']) for i in response.json['items']])
+    self.assertEqual(
+        [old, model.get_entry_key(namespace, collection.items[1].digest)],
+        fetched)
+
+    # remove tasks so tearDown doesn't complain
+    _ = self.execute_tasks()
+
   def test_store_inline_ok(self):
     """Assert that inline content storage completes successfully."""
     namespace = 'default'
@@ -526,6 +559,161 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
     with self.call_should_fail('404'):
       self.call_api('retrieve', message_to_dict(retrieve_request), 200)
 
+  def raw_app(self):
+    """Returns a webtest.TestApp for the handlers outside of endpoints."""
+    # Not authenticated through OAuth in tests.
+    self.mock(
+        handlers_endpoints_v1.RetrieveBatchHandler, 'xsrf_token_enforce_on',
+        ())
+    self.mock(
+        handlers_endpoints_v1.StoreInlineRawHandler, 'xsrf_token_enforce_on',
+        ())
+    return webtest.TestApp(
+        webapp2.WSGIApplication(handlers_endpoints_v1.get_routes()),
+        extra_environ={'REMOTE_ADDR': self.source_ip})
+
+  def retrieve_batch(self, namespace, digests, status=200):
+    """Calls retrieve_batch and returns the list of (type, payload) frames."""
+    response = self.raw_app().post_json(
+        '/api/isolateservice/v1/retrieve_batch',
+        {'namespace': namespace, 'digests': digests}, status=status)
+    if status != 200:
+      return None
+    self.assertEqual('application/octet-stream', response.content_type)
+    frames = []
+    body = response.body
+    offset = 0
+    while offset < len(body):
+      kind, length = struct.unpack_from('>BI', body, offset)
+      offset += 5
+      frames.append((kind, body[offset:offset+length]))
+      offset += length
+    return frames
+
+  def test_retrieve_batch_ok(self):
+    """Assert that many entries are retrieved at once, in order."""
+    namespace = 'default'
+    # In memcache.
+    request = self.store_request(namespace, 'Endymion')
+    self.call_api('store_inline', message_to_dict(request), 200)
+    # In the datastore.
+    request = self.store_request(namespace, 'Hyperion')
+    self.call_api('store_inline', message_to_dict(request), 200)
+    memcache.delete(
+        hash_content(namespace, 'Hyperion'), namespace='table_%s' % namespace)
+    # In GS.
+    content = pad_string('Lamia')
+    request = self.store_request(namespace, content)
+    self.mock(gcs, 'get_file_info', get_file_info_factory(content))
+    self.call_api('finalize_gs_upload', message_to_dict(request), 200)
+
+    frames = self.retrieve_batch(namespace, [
+        hash_content(namespace, 'Hyperion'),
+        hash_content(namespace, 'missing'),
+        hash_content(namespace, content),
+        hash_content(namespace, 'Endymion'),
+    ])
+    self.assertEqual(4, len(frames))
+    self.assertEqual(
+        (handlers_endpoints_v1.BATCH_CONTENT, 'Hyperion'), frames[0])
+    self.assertEqual((handlers_endpoints_v1.BATCH_MISSING, ''), frames[1])
+    self.assertEqual(handlers_endpoints_v1.BATCH_URL, frames[2][0])
+    self.assertTrue(frames[2][1].startswith(self.store_prefix))
+    self.assertEqual(
+        (handlers_endpoints_v1.BATCH_CONTENT, 'Endymion'), frames[3])
+
+    # clear the taskqueue
+    self.assertEqual(1, self.execute_tasks())
+
+  def test_retrieve_batch_skipped(self):
+    """Assert that entries past the response size limit are skipped."""
+    namespace = 'default'
+    for content in ('Ode', 'on a', 'Grecian Urn'):
+      request = self.store_request(namespace, content)
+      self.call_api('store_inline', message_to_dict(request), 200)
+    self.mock(handlers_endpoints_v1, 'MAX_BATCH_RESPONSE_SIZE', 8)
+    frames = self.retrieve_batch(
+        namespace,
+        [hash_content(namespace, c) for c in ('Ode', 'Grecian Urn', 'on a')])
+    self.assertEqual([
+      (handlers_endpoints_v1.BATCH_CONTENT, 'Ode'),
+      (handlers_endpoints_v1.BATCH_SKIPPED, ''),
+      (handlers_endpoints_v1.BATCH_CONTENT, 'on a'),
+    ], frames)
+
+  def test_retrieve_batch_invalid(self):
+    """Assert that invalid requests are rejected."""
+    self.retrieve_batch('~bad', [], status=400)
+    self.retrieve_batch('default', ['0' * 39], status=400)
+    self.mock(handlers_endpoints_v1, 'MAX_BATCH_DIGESTS', 1)
+    self.retrieve_batch('default', ['0' * 40] * 2, status=400)
+
+  def store_inline_raw(self, ticket, content, status=200):
+    """Calls store_inline_raw and returns the response."""
+    return self.raw_app().post(
+        '/api/isolateservice/v1/store_inline_raw?upload_ticket=%s' %
+        urllib.quote(ticket),
+        content, content_type='application/octet-stream', status=status)
+
+  def retrieve_raw(self, namespace, digest, offset=0, status=200):
+    """Calls retrieve_raw and returns the response."""
+    return self.raw_app().get(
+        '/api/isolateservice/v1/retrieve_raw/%s/%s?offset=%d' % (
+            namespace, digest, offset),
+        status=status)
+
+  def test_store_inline_raw_ok(self):
+    """Assert that raw inline content is stored and verified."""
+    namespace = 'default'
+    request = self.store_request(namespace, 'sibilance')
+    embedded = validate(
+        request.upload_ticket, handlers_endpoints_v1.UPLOAD_MESSAGES[0])
+    response = self.store_inline_raw(request.upload_ticket, request.content)
+    self.assertEqual({'ok': True}, response.json)
+    stored = model.get_entry_key(embedded['n'], embedded['d']).get()
+    self.assertEqual(request.content, stored.content)
+
+  def test_store_inline_raw_bad_digest(self):
+    """Assert that raw inline content is rejected when data do not match."""
+    namespace = 'default'
+    request = self.store_request(namespace, 'anseres sacri')
+    self.store_inline_raw(
+        request.upload_ticket, ':)' + request.content[2:], status=400)
+    self.store_inline_raw(
+        request.upload_ticket + '7', request.content, status=400)
+    self.store_inline_raw('', request.content, status=400)
+
+  def test_retrieve_raw_ok(self):
+    """Assert that content is retrieved as is, from memcache or the DB."""
+    content = 'La Belle Dame sans Merci'
+    namespace = 'default'
+    request = self.store_request(namespace, content)
+    self.store_inline_raw(request.upload_ticket, request.content)
+    digest = hash_content(namespace, content)
+    response = self.retrieve_raw(namespace, digest)
+    self.assertEqual('application/octet-stream', response.content_type)
+    self.assertEqual(content, response.body)
+    memcache.flush_all()
+    self.assertEqual(content[3:], self.retrieve_raw(namespace, digest, 3).body)
+    self.retrieve_raw(namespace, digest, len(content) + 1, status=400)
+    self.retrieve_raw(
+        namespace, hash_content(namespace, 'missing'), status=404)
+    self.retrieve_raw(namespace, '0' * 39, status=400)
+
+  def test_retrieve_raw_gs_redirect(self):
+    """Assert that GS entities are redirected to a signed URL."""
+    content = pad_string('Hyperion')
+    namespace = 'default'
+    request = self.store_request(namespace, content)
+    self.mock(gcs, 'get_file_info', get_file_info_factory(content))
+    self.call_api('finalize_gs_upload', message_to_dict(request), 200)
+    response = self.retrieve_raw(
+        namespace, hash_content(namespace, content), status=302)
+    self.assertTrue(response.location.startswith(self.store_prefix))
+
+    # clear the taskqueue
+    self.assertEqual(1, self.execute_tasks())
+
   def test_server_details_ok(self):
     """Assert that server_details returns the correct version."""
     response = self.call_api('server_details', {}, 200).json
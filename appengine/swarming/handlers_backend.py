@@ -298,6 +298,15 @@ class TaskDimensionsHandler(webapp2.RequestHandler):
       self.response.set_status(429, 'Need to retry')
 
 
+class BotDimensionsHandler(webapp2.RequestHandler):
+  """Rebuilds the task queues of a bot in the background."""
+
+  @decorators.silence(datastore_errors.Timeout)
+  @decorators.require_taskqueue('rebuild-bot-cache')
+  def post(self):
+    task_queues.rebuild_bot_cache_async(self.request.body).get_result()
+
+
 class TaskSendPubSubMessage(webapp2.RequestHandler):
   """Sends PubSub notification about task completion."""
 
@@ -439,6 +448,8 @@ def get_routes():
     ('/internal/taskqueue/cleanup/tasks/delete', TaskDeleteTasksHandler),
     ('/internal/taskqueue/important/task_queues/rebuild-cache',
         TaskDimensionsHandler),
+    ('/internal/taskqueue/important/task_queues/rebuild-bot-cache',
+        BotDimensionsHandler),
     (r'/internal/taskqueue/important/pubsub/notify-task/<task_id:[0-9a-f]+>',
         TaskSendPubSubMessage),
     ('/internal/taskqueue/important/external_scheduler/notify-tasks',
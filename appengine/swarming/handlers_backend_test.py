@@ -188,6 +188,8 @@ class BackendTest(test_env_handlers.AppTestBase):
          '/internal/taskqueue/important/pubsub/notify-task/abcabcabc'),
         ('rebuild-task-cache',
          '/internal/taskqueue/important/task_queues/rebuild-cache'),
+        ('rebuild-bot-cache',
+         '/internal/taskqueue/important/task_queues/rebuild-bot-cache'),
         ('tsmon', '/internal/taskqueue/monitoring/tsmon/executors'),
         ('named-cache-task',
          '/internal/taskqueue/important/named_cache/update-pool'),
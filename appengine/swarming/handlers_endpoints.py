@@ -487,6 +487,12 @@ TaskStatesRequest = endpoints.ResourceContainer(
     task_id=messages.StringField(1, repeated=True))
 
 
+TaskStatesWaitRequest = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    task_id=messages.StringField(1, repeated=True),
+    timeout_secs=messages.IntegerField(2))
+
+
 TasksCountRequest = endpoints.ResourceContainer(
     message_types.VoidMessage,
     end=messages.FloatField(3),
@@ -746,25 +752,31 @@ class SwarmingTasksService(remote.Service):
     """
     logging.debug('%s', request)
     result_keys = [_to_keys(task_id)[1] for task_id in request.task_id]
+    states = task_result.get_states(result_keys)
+    return swarming_rpcs.TaskStates(
+        states=[swarming_rpcs.TaskState(state) for state in states])
 
-    # Hot path. Fetch everything we can from memcache.
-    entities = ndb.get_multi(
-        result_keys, use_cache=True, use_memcache=True, use_datastore=False)
-    states = [t.state if t else task_result.State.PENDING for t in entities]
-    # Now fetch both the ones in non-stable state or not in memcache.
-    missing_keys = [
-      result_keys[i] for i, state in enumerate(states)
-      if state in task_result.State.STATES_RUNNING
-    ]
-    if missing_keys:
-      more = ndb.get_multi(
-          missing_keys, use_cache=False, use_memcache=False, use_datastore=True)
-      # This relies on missing_keys being in the same order as states (for
-      # common elements).
-      for i, s in enumerate(states):
-        if s in task_result.State.STATES_RUNNING:
-          states[i] = more.pop(0).state
+  @gae_ts_mon.instrument_endpoint()
+  @auth.endpoints_method(
+      TaskStatesWaitRequest, swarming_rpcs.TaskStates,
+      http_method='GET')
+  @auth.require(acl.can_view_all_tasks, log_identity=True)
+  def wait_states(self, request):
+    """Returns task state for a specific set of tasks once one of them is done.
 
+    Returns as soon as one of the tasks is neither PENDING nor RUNNING, or after
+    timeout_secs seconds. This replaces polling get_states() in a loop.
+    """
+    logging.debug('%s', request)
+    result_keys = [_to_keys(task_id)[1] for task_id in request.task_id]
+    timeout_secs = request.timeout_secs
+    if timeout_secs is None:
+      timeout_secs = task_scheduler.WAIT_STATES_MAX_SECS
+    if not 0 <= timeout_secs <= task_scheduler.WAIT_STATES_MAX_SECS:
+      raise endpoints.BadRequestException(
+          'timeout_secs must be between 0 and %d' %
+          task_scheduler.WAIT_STATES_MAX_SECS)
+    states = task_scheduler.wait_task_states(result_keys, timeout_secs)
     return swarming_rpcs.TaskStates(
         states=[swarming_rpcs.TaskState(state) for state in states])
 
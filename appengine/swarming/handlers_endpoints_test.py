@@ -1928,6 +1928,40 @@ class TasksApiTest(BaseTest):
     actual = self.call_api('get_states', body=message_to_dict(request)).json
     self.assertEqual(expected, actual)
 
+  def test_wait_states_ok(self):
+    """Asserts that wait_states returns once a task is done."""
+    self.mock(random, 'getrandbits', lambda _: 0x88)
+    self.set_as_bot()
+    self.bot_poll()
+    self.set_as_user()
+    _, first_id = self.client_create_task_raw(name='first')
+    self.mock(random, 'getrandbits', lambda _: 0x66)
+    self.mock_now(self.now, 60)
+    _, second_id = self.client_create_task_raw(name='second')
+
+    self.set_as_privileged_user()
+    # Nothing is done yet.
+    request = handlers_endpoints.TaskStatesWaitRequest.combined_message_class(
+        task_id=[first_id, second_id], timeout_secs=0)
+    expected = {u'states': ['PENDING', 'PENDING']}
+    actual = self.call_api('wait_states', body=message_to_dict(request)).json
+    self.assertEqual(expected, actual)
+
+    self.set_as_bot()
+    self.bot_run_task()
+    self.set_as_privileged_user()
+    request = handlers_endpoints.TaskStatesWaitRequest.combined_message_class(
+        task_id=[first_id, second_id], timeout_secs=30)
+    expected = {u'states': ['COMPLETED', 'PENDING']}
+    actual = self.call_api('wait_states', body=message_to_dict(request)).json
+    self.assertEqual(expected, actual)
+
+  def test_wait_states_invalid_timeout(self):
+    self.set_as_privileged_user()
+    request = handlers_endpoints.TaskStatesWaitRequest.combined_message_class(
+        task_id=['1d69b9f088008910'], timeout_secs=3600)
+    self.call_api('wait_states', body=message_to_dict(request), status=400)
+
   def test_count_indexes(self):
     # Asserts that no combination crashes.
     _, _, now_120, start, end = self._gen_two_tasks()
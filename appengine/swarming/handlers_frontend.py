@@ -10,11 +10,13 @@ implemented using the webapp2 framework.
 
 import collections
 import os
+import re
 
 import webapp2
 
 import handlers_bot
 import handlers_endpoints
+import swarming_rpcs
 import template
 
 from components import auth
@@ -23,11 +25,17 @@ from server import acl
 from server import bot_code
 from server import bot_groups_config
 from server import config
+from server import realms
+from server import task_pack
 
 
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 
 
+# Single byte range supported by TaskOutputHandler.
+_RANGE_RE = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+
 # Helper class for displaying the sort options in html templates.
 SortOptions = collections.namedtuple('SortOptions', ['key', 'name'])
 
@@ -146,6 +154,64 @@ class UIHandler(auth.AuthenticatingHandler):
     return csp
 
 
+class TaskOutputHandler(auth.AuthenticatingHandler):
+  """Streams the output of a task as plain text.
+
+  The byte range to return can be specified either with a single 'bytes=' Range
+  header or with the 'offset' and 'length' query parameters. The ETag changes
+  whenever output is added or the task state changes, so a client tailing the
+  output only transfers the new bytes.
+  """
+
+  @auth.require(acl.can_access, log_identity=True)
+  def get(self, task_id):
+    try:
+      request_key, result_key = task_pack.get_request_and_result_keys(task_id)
+      offset = int(self.request.get('offset') or 0)
+      length = int(self.request.get('length') or 0)
+    except ValueError as e:
+      self.abort(400, str(e))
+    request = request_key.get()
+    if not request:
+      self.abort(404, '%s not found.' % task_id)
+    realms.check_task_get_acl(request)
+    result = result_key.get()
+    if not result:
+      self.abort(404, '%s not found.' % task_id)
+
+    size = result.get_output_size()
+    state = swarming_rpcs.TaskState(result.state).name
+    etag = '"%s-%d-%d"' % (state, result.stdout_chunks or 0, size)
+    self.response.headers['Accept-Ranges'] = 'bytes'
+    self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    self.response.headers['ETag'] = etag
+    self.response.headers['X-Swarming-Task-State'] = state
+    if self.request.headers.get('If-None-Match') == etag:
+      self.response.set_status(304)
+      return
+
+    m = _RANGE_RE.match(self.request.headers.get('Range', ''))
+    if m:
+      offset = int(m.group(1))
+      end = int(m.group(2)) if m.group(2) else None
+      if offset >= size or (end is not None and end < offset):
+        self.response.headers['Content-Range'] = 'bytes */%d' % size
+        self.response.set_status(416)
+        return
+      length = end + 1 - offset if end is not None else 0
+    if offset < 0 or length < 0:
+      self.abort(400, 'offset and length must be positive')
+    if not length or offset + length > size:
+      length = max(size - offset, 0)
+    if m:
+      self.response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+          offset, offset + length - 1, size)
+      self.response.set_status(206)
+    self.response.content_length = length
+    if length:
+      self.response.app_iter = result.iter_output(offset, length)
+
+
 class WarmupHandler(webapp2.RequestHandler):
   def get(self):
     auth.warmup()
@@ -166,6 +232,7 @@ def get_routes():
   routes = [
       ('/_ah/mail/<to:.+>', EmailHandler),
       ('/_ah/warmup', WarmupHandler),
+      ('/tasks/<task_id:[0-9a-fA-F]+>/stdout', TaskOutputHandler),
   ]
 
   if not utils.should_disable_ui_routes():
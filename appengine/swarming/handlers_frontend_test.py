@@ -15,9 +15,13 @@ import test_env_handlers
 
 import webtest
 
+from google.appengine.ext import ndb
+
+from components import utils
 import handlers_frontend
 import template
 from server import bot_code
+from server import task_queues
 
 
 class FrontendTest(test_env_handlers.AppTestBase):
@@ -162,6 +166,59 @@ class FrontendTest(test_env_handlers.AppTestBase):
     self.set_as_admin()
     self.app.get('/restricted/config')
 
+  def _run_task(self):
+    @ndb.non_transactional
+    def enqueue_task_async(_url, queue_name, payload):
+      self.assertEqual('rebuild-task-cache', queue_name)
+      return task_queues.rebuild_task_cache_async(payload)
+    self.mock(utils, 'enqueue_task_async', enqueue_task_async)
+    self.mock(utils, 'enqueue_task', lambda *_args, **_kwargs: True)
+    self.mock_default_pool_acl([])
+    self.set_as_bot()
+    self.bot_poll()
+    self.set_as_user()
+    self.client_create_task_raw()
+    self.set_as_bot()
+    task_id = self.bot_run_task()
+    self.set_as_privileged_user()
+    return task_id
+
+  def test_task_output(self):
+    task_id = self._run_task()
+    output = u'rÉsult string'.encode('utf-8')
+    url = '/tasks/%s/stdout' % task_id
+    response = self.app.get(url, status=200)
+    self.assertEqual(output, response.body)
+    self.assertEqual('COMPLETED', response.headers['X-Swarming-Task-State'])
+    etag = response.headers['ETag']
+
+    # The ETag only changes when there is new output.
+    self.app.get(url, headers={'If-None-Match': etag}, status=304)
+
+    response = self.app.get(url + '?offset=1&length=2', status=200)
+    self.assertEqual(output[1:3], response.body)
+
+    response = self.app.get(url, headers={'Range': 'bytes=3-7'}, status=206)
+    self.assertEqual(output[3:8], response.body)
+    self.assertEqual(
+        'bytes 3-7/%d' % len(output), response.headers['Content-Range'])
+    response = self.app.get(url, headers={'Range': 'bytes=3-'}, status=206)
+    self.assertEqual(output[3:], response.body)
+    response = self.app.get(
+        url, headers={'Range': 'bytes=%d-' % len(output)}, status=416)
+    self.assertEqual(
+        'bytes */%d' % len(output), response.headers['Content-Range'])
+    response = self.app.get(url, headers={'Range': 'bytes=5-4'}, status=416)
+    self.assertEqual(
+        'bytes */%d' % len(output), response.headers['Content-Range'])
+    response = self.app.get(url, headers={'Range': 'bytes=5-5'}, status=206)
+    self.assertEqual(output[5:6], response.body)
+
+  def test_task_output_not_found(self):
+    self.set_as_privileged_user()
+    self.app.get('/tasks/1d69b9f088008910/stdout', status=404)
+    self.app.get('/tasks/1d69b9f088008911/stdout', status=404)
+
 
 if __name__ == '__main__':
   if '-v' in sys.argv:
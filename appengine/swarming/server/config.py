@@ -36,6 +36,10 @@ DIMENSION_VALUE_LENGTH = 256
 # Regular expression for dimension key.
 DIMENSION_KEY_RE = r'^[a-zA-Z\-\_\.][0-9a-zA-Z\-\_\.]*$'
 
+# Maximum value of SettingsCfg.output_buffer_size. The buffer is saved in the
+# TaskRunResult entity, which is limited to 1MiB with all its other properties.
+MAX_OUTPUT_BUFFER_SIZE = 256*1024
+
 
 def settings_info():
   """Returns information about the settings file.
@@ -159,6 +163,15 @@ def _validate_settings(cfg, ctx):
   with ctx.prefix('reusable_task_age_secs '):
     within_year(cfg.reusable_task_age_secs)
 
+  with ctx.prefix('output_buffer_size '):
+    if cfg.output_buffer_size < 0:
+      ctx.error('cannot be negative')
+    elif cfg.output_buffer_size > MAX_OUTPUT_BUFFER_SIZE:
+      ctx.error('cannot be more than %d', MAX_OUTPUT_BUFFER_SIZE)
+  with ctx.prefix('max_output_size '):
+    if cfg.max_output_size < 0:
+      ctx.error('cannot be negative')
+
   if cfg.HasField('isolate'):
     with ctx.prefix('isolate: '):
       _validate_isolate_settings(cfg.isolate, ctx)
@@ -169,6 +169,21 @@ class ConfigTest(test_case.TestCase):
                 'reusable_task_age_secs cannot be more than a year',
             ])
 
+    self.validator_test(
+        config._validate_settings,
+        config_pb2.SettingsCfg(output_buffer_size=-1, max_output_size=-1), [
+            'output_buffer_size cannot be negative',
+            'max_output_size cannot be negative',
+        ])
+
+    self.validator_test(
+        config._validate_settings,
+        config_pb2.SettingsCfg(
+            output_buffer_size=config.MAX_OUTPUT_BUFFER_SIZE + 1), [
+                'output_buffer_size cannot be more than %d' %
+                config.MAX_OUTPUT_BUFFER_SIZE,
+            ])
+
     self.validator_test(
         config._validate_settings,
         config_pb2.SettingsCfg(
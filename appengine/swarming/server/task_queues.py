@@ -55,6 +55,7 @@ import json
 import logging
 import random
 import struct
+import threading
 
 from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
@@ -95,6 +96,13 @@ _KEEP_DEAD = datetime.timedelta(days=1, minutes=10)
 _EXPIRATION_TIME_TASK_QUEUES = 60 * 5
 
 
+# Expiration time of the pseudo-lock taken while a background rebuild of a
+# bot's task queues is pending, to not enqueue it on every poll. It is renewed
+# when the rebuild starts and must outlive it; a push task is aborted after 10
+# minutes.
+_EXPIRATION_TIME_REBUILD_BOT_CACHE = 10 * 60
+
+
 class Error(Exception):
   pass
 
@@ -201,12 +209,15 @@ class TaskDimensionsSet(ndb.Model):
 
   def match_bot(self, bot_dimensions):
     """Returns True if this bot can run this request dimensions set."""
-    # Always called via TaskDimensions.match_bot().
-    for d in self.dimensions_flat:
-      key, value = d.split(':', 1)
-      if value not in bot_dimensions.get(key, []):
-        return False
-    return True
+    return self.match_bot_mask(bot_dimensions_mask(bot_dimensions))
+
+  def match_bot_mask(self, bot_mask):
+    """Returns True if the bot with this bot_dimensions_mask() can run this
+    request dimensions set.
+    """
+    # Always called via TaskDimensions.match_bot_mask().
+    mask = _REGISTRY.flat_mask(self.dimensions_flat)
+    return bot_mask & mask == mask
 
   def _pre_put_hook(self):
     super(TaskDimensionsSet, self)._pre_put_hook()
@@ -282,8 +293,14 @@ class TaskDimensions(ndb.Model):
   def match_bot(self, bot_dimensions):
     """Returns the TaskDimensionsSet that matches this bot_dimensions, if any.
     """
+    return self.match_bot_mask(bot_dimensions_mask(bot_dimensions))
+
+  def match_bot_mask(self, bot_mask):
+    """Returns the TaskDimensionsSet that matches the bot with this
+    bot_dimensions_mask(), if any.
+    """
     for s in self.sets:
-      if s.match_bot(bot_dimensions):
+      if s.match_bot_mask(bot_mask):
         return s
     return None
 
@@ -318,6 +335,118 @@ class TaskDimensions(ndb.Model):
 _CAP_FUTURES_LIMIT = 50
 
 
+# Maximum number of entries in each _DimensionsRegistry cache before it is
+# flushed.
+_REGISTRY_CACHE_SIZE = 10000
+
+
+# Maximum number of interned 'key:value' in _DimensionsRegistry before it is
+# rebuilt. Every bot adds its 'id:<bot_id>', so this bounds both the memory and
+# the length of the bitsets.
+_REGISTRY_MAX_BITS = 4096
+
+
+# Number of low bits of each bitset used to tag its _DimensionsRegistry
+# generation.
+_GENERATION_BITS = 64
+
+
+class _Generation(object):
+  """Bit positions and cached bitsets of one _DimensionsRegistry generation."""
+
+  def __init__(self, number):
+    # The low bits of every bitset are the generation number followed by its
+    # complement. Neither is a subset of the other for different numbers, so a
+    # bitset never matches one of another generation.
+    half = _GENERATION_BITS // 2
+    low = number & ((1 << half) - 1)
+    self.number = number
+    self.marker = low | ((~low & ((1 << half) - 1)) << half)
+    # 'key:value' -> bit position.
+    self.bits = {}
+    # tuple('key:value') -> bitset.
+    self.flat_masks = {}
+    # Hashable request dimensions -> tuple of bitsets.
+    self.dimensions_masks = {}
+
+
+class _DimensionsRegistry(object):
+  """Interns 'key:value' dimensions as bit positions.
+
+  A set of dimensions is then represented as an integer bitset and checking
+  whether a bot can run a request dimensions set is a single AND and compare,
+  instead of re-deriving and comparing the 'key:value' strings on every call.
+
+  The registry is per instance. Once it interned _REGISTRY_MAX_BITS
+  'key:value', it is rebuilt from scratch as a new generation, which drops all
+  the cached bitsets. A bitset computed before a rebuild never matches one
+  computed after, so a caller holding one across a rebuild only misses matches
+  until it computes it again.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._generation = _Generation(0)
+
+  def mask(self, flat):
+    """Returns the bitset for an iterable of 'key:value'."""
+    return self._mask(self._generation, flat)
+
+  def flat_mask(self, flat):
+    """Same as mask() for a sorted list of 'key:value', with a cache."""
+    gen = self._generation
+    key = tuple(flat)
+    mask = gen.flat_masks.get(key)
+    if mask is None:
+      if len(gen.flat_masks) >= _REGISTRY_CACHE_SIZE:
+        gen.flat_masks.clear()
+      mask = self._mask(gen, flat)
+      gen.flat_masks[key] = mask
+    return mask
+
+  def dimensions_masks(self, dimensions):
+    """Returns a tuple of bitsets, one per OR expansion of the request
+    dimensions, with a cache.
+    """
+    gen = self._generation
+    key = tuple(sorted((k, tuple(v)) for k, v in dimensions.items()))
+    masks = gen.dimensions_masks.get(key)
+    if masks is None:
+      if len(gen.dimensions_masks) >= _REGISTRY_CACHE_SIZE:
+        gen.dimensions_masks.clear()
+      masks = tuple(
+          self.flat_mask(f) for f in expand_dimensions_to_flats(dimensions))
+      gen.dimensions_masks[key] = masks
+    return masks
+
+  def _mask(self, gen, flat):
+    """Returns the bitset for an iterable of 'key:value' in this generation.
+
+    If the registry is rebuilt meanwhile, returns the bitset in the new
+    generation instead. The caches of the old generation are dropped anyway.
+    """
+    flat = list(flat)
+    mask = gen.marker
+    for f in flat:
+      bit = gen.bits.get(f)
+      if bit is None:
+        with self._lock:
+          if gen is self._generation and len(gen.bits) >= _REGISTRY_MAX_BITS:
+            logging.info(
+                '_DimensionsRegistry: rebuilding after %d dimensions',
+                len(gen.bits))
+            self._generation = _Generation(gen.number + 1)
+          if gen is self._generation:
+            bit = gen.bits.setdefault(f, _GENERATION_BITS + len(gen.bits))
+        if bit is None:
+          return self._mask(self._generation, flat)
+      mask |= 1 << bit
+    return mask
+
+
+_REGISTRY = _DimensionsRegistry()
+
+
 def _validate_dimensions_flat(obj):
   """Validates obj.dimensions_flat; throws BadValueError if invalid."""
   if not obj.dimensions_flat:
@@ -372,8 +501,8 @@ def _delete_stale_BotTaskDimensions_async(bot_dimensions, bot_root_key,
 
 
 @ndb.tasklet
-def _update_BotTaskDimensions_slice_async(bot_dimensions, bot_root_key, now,
-                                          matches, q):
+def _update_BotTaskDimensions_slice_async(bot_mask, bot_root_key, now, matches,
+                                          q):
   """Updates BotTaskDimensions for task queues with the TaskDimensions query for
   this bot.
 
@@ -391,9 +520,9 @@ def _update_BotTaskDimensions_slice_async(bot_dimensions, bot_root_key, now,
     while (yield qit.has_next_async()):
       iter_cnt += 1
       task_dimensions = qit.next()
-      # match_bot() returns a TaskDimensionsSet if there's a match. It may still
-      # be expired.
-      s = task_dimensions.match_bot(bot_dimensions)
+      # match_bot_mask() returns a TaskDimensionsSet if there's a match. It may
+      # still be expired.
+      s = task_dimensions.match_bot_mask(bot_mask)
       dimensions_hash = task_dimensions.key.integer_id()
       if s and s.valid_until_ts >= now:
         match_cnt += 1
@@ -419,9 +548,12 @@ def _update_BotTaskDimensions_slice_async(bot_dimensions, bot_root_key, now,
 @ndb.tasklet
 def _update_BotTaskDimensions_async(bot_dimensions, bot_root_key, now, matches):
   """Updates all task queues known for this bot."""
+  # Compile the bot dimensions once, so matching each TaskDimensionsSet is a
+  # single bitset comparison.
+  bot_mask = bot_dimensions_mask(bot_dimensions)
   # There's one per pool plus one for the bot id.
   yield [
-      _update_BotTaskDimensions_slice_async(bot_dimensions, bot_root_key, now,
+      _update_BotTaskDimensions_slice_async(bot_mask, bot_root_key, now,
                                             matches, q)
       for q in _get_task_queries_for_bot(bot_dimensions)
   ]
@@ -530,6 +662,19 @@ def _hash_data(data):
   return int(struct.unpack('<L', digest[:4])[0]) or 1
 
 
+def _hash_data_v2(data):
+  """Returns a 63 bits hash that is always larger than 32 bits."""
+  assert isinstance(data, str), repr(data)
+  digest = hashlib.md5(data).digest()
+  # It must fit a positive int64 to be usable as a key id in a ndb.Key.
+  h = struct.unpack('<Q', digest[:8])[0] & 0x7FFFFFFFFFFFFFFF
+  # Make it distinguishable from a version 1 hash. See
+  # dimensions_hash_version().
+  if h <= 0xFFFFFFFF:
+    h |= 1 << 32
+  return h
+
+
 @ndb.tasklet
 def _remove_old_entity_async(key, now):
   """Removes a stale TaskDimensions or BotTaskDimensions instance.
@@ -564,6 +709,65 @@ def _get_query_BotTaskDimensions_keys(task_dimensions_flat):
   return q.iter(batch_size=100, keys_only=True, deadline=15)
 
 
+@ndb.tasklet
+def _add_queue_to_memcache_async(bot_id, dimensions_hash):
+  """Adds a task queue to the bot's task queues cached for get_queues().
+
+  Falls back to deleting the cached list if it was concurrently updated.
+
+  The BotTaskDimensions is already stored, so the task queue is not lost if the
+  cached list is evicted; get_queues() then queries it back.
+  """
+  ctx = ndb.get_context()
+  queues = yield ctx.memcache_gets(bot_id, namespace='task_queues')
+  if queues is None:
+    # Nothing cached, get_queues() will query the BotTaskDimensions.
+    raise ndb.Return(None)
+  if dimensions_hash in queues:
+    raise ndb.Return(None)
+  logging.debug(
+      'Adding task queue %d to cached task queues. bot_id: %s',
+      dimensions_hash, bot_id)
+  ok = yield ctx.memcache_cas(
+      bot_id,
+      sorted(queues + [dimensions_hash]),
+      namespace='task_queues',
+      time=_EXPIRATION_TIME_TASK_QUEUES)
+  if not ok:
+    logging.debug('Deleting cached task queues. bot_id: %s', bot_id)
+    yield ctx.memcache_delete(bot_id, namespace='task_queues')
+
+
+@ndb.tasklet
+def _enqueue_rebuild_bot_cache_async(bot_root_key, bot_dimensions):
+  """Enqueues a background _rebuild_bot_cache_async() for this bot.
+
+  Returns:
+    True if a task was enqueued, False if one is already pending.
+  """
+  bot_id = bot_root_key.string_id()
+  # add() returns True if the entry was added, False otherwise. The entry is
+  # removed once the rebuild is done.
+  res = yield ndb.get_context().memcache_add(
+      bot_id, True, time=_EXPIRATION_TIME_REBUILD_BOT_CACHE,
+      namespace='task_queues_rebuild')
+  if not res:
+    raise ndb.Return(False)
+  payload = utils.encode_to_json({
+    u'bot_id': bot_id,
+    u'dimensions': bot_dimensions,
+  })
+  res = yield utils.enqueue_task_async(
+      '/internal/taskqueue/important/task_queues/rebuild-bot-cache',
+      'rebuild-bot-cache',
+      payload=payload)
+  if not res:
+    yield ndb.get_context().memcache_delete(
+        bot_id, namespace='task_queues_rebuild')
+    raise Error('Failed to trigger task queue; please try again')
+  raise ndb.Return(True)
+
+
 @ndb.tasklet
 def _refresh_BotTaskDimensions_async(now, valid_until_ts, task_dimensions_flat,
                                      bot_task_key):
@@ -607,8 +811,9 @@ def _refresh_BotTaskDimensions_async(now, valid_until_ts, task_dimensions_flat,
         'Keeping stored BotTaskDimensions.'
         'bot_id: %s, valid_until_ts: %s', bot_id, bot_task.valid_until_ts)
   if need_memcache_clear:
-    logging.debug('Deleting cached task queues. bot_id: %s', bot_id)
-    yield ndb.get_context().memcache_delete(bot_id, namespace='task_queues')
+    # Push the new task queue to the bot's cached list instead of forcing
+    # get_queues() to query all its BotTaskDimensions again.
+    yield _add_queue_to_memcache_async(bot_id, bot_task_key.integer_id())
   else:
     logging.debug('Keeping cached task queues. bot_id: %s, valid_until_ts: %s',
                   bot_id, bot_task.valid_until_ts)
@@ -660,13 +865,13 @@ def _tidy_stale_BotTaskDimensions(now):
 
 
 @ndb.tasklet
-def _assert_task_props_async(properties, expiration_ts):
+def _assert_task_props_async(properties, expiration_ts, version):
   """Asserts a TaskDimensions for a specific TaskProperties.
 
   Implementation of assert_task_async().
   """
   # TODO(maruel): Make it a tasklet.
-  dimensions_hash = hash_dimensions(properties.dimensions)
+  dimensions_hash = hash_dimensions(properties.dimensions, version)
   data = {
     u'dimensions': properties.dimensions,
     u'dimensions_hash': str(dimensions_hash),
@@ -940,27 +1145,72 @@ def bot_dimensions_to_flat(dimensions):
   return expanded[0]
 
 
-def hash_dimensions(dimensions):
-  """Returns a 32 bits int that is a hash of the request dimensions specified.
+def bot_dimensions_mask(bot_dimensions):
+  """Returns the bot dimensions as an integer bitset of its interned
+  '<key>:<value>'.
+
+  The bitset is only meaningful within this instance; it must not be stored.
+  It never matches the request bitsets once the registry is rebuilt.
+  """
+  return _REGISTRY.mask(bot_dimensions_to_flat(bot_dimensions))
+
+
+def dimensions_masks(dimensions):
+  """Returns the request dimensions as a tuple of integer bitsets, one per
+  expansion returned by expand_dimensions_to_flats().
+
+  A bot matches the request dimensions if, for any of the bitsets,
+  bot_mask & mask == mask, where bot_mask is from bot_dimensions_mask().
+
+  The bitsets are only meaningful within this instance; they must not be
+  stored.
+  """
+  return _REGISTRY.dimensions_masks(dimensions)
+
+
+def hash_dimensions(dimensions, version=1):
+  """Returns an int that is a hash of the request dimensions specified.
 
   Arguments:
     dimensions: dict(str, str)
+    version: hashing scheme, see TaskRequest.dimensions_hash_version.
+      - 1: 32 bits hash. It can confuse keys and values, e.g.
+        {'a': ['b', 'c', 'd']} and {'a': ['b'], 'c': ['d']} have the same
+        hash.
+      - 2: 63 bits hash of an unambiguous encoding. It is always larger than
+        0xFFFFFFFF.
 
   The return value is guaranteed to be a non-zero int so it can be used as a key
   id in a ndb.Key.
   """
   # This horrible code is the product of micro benchmarks.
-  # TODO(maruel): This is incorrect, as it can confuse keys and values. But
-  # changing the algo is non-trivial.
   data = ''
+  if version == 1:
+    for k, values in sorted(dimensions.items()):
+      data += k.encode('utf8')
+      data += '\000'
+      assert isinstance(values, (list, tuple)), values
+      for v in values:
+        data += v.encode('utf8')
+        data += '\000'
+    return _hash_data(data)
+
+  assert version == 2, version
+  # Each string is prefixed with its length and each key with its number of
+  # values, so two different dimensions dicts never have the same encoding.
   for k, values in sorted(dimensions.items()):
-    data += k.encode('utf8')
-    data += '\000'
     assert isinstance(values, (list, tuple)), values
+    k = k.encode('utf8')
+    data += '%d:%s%d:' % (len(k), k, len(values))
     for v in values:
-      data += v.encode('utf8')
-      data += '\000'
-  return _hash_data(data)
+      v = v.encode('utf8')
+      data += '%d:%s' % (len(v), v)
+  return _hash_data_v2(data)
+
+
+def dimensions_hash_version(dimensions_hash):
+  """Returns the version of hash_dimensions() that returned this hash."""
+  return 1 if dimensions_hash <= 0xFFFFFFFF else 2
 
 
 @ndb.tasklet
@@ -974,8 +1224,15 @@ def assert_bot_async(bot_root_key, bot_dimensions):
     bot_root_key: ndb.Key to bot_management.BotRoot
     bot_dimensions: dictionary of the bot dimensions
 
+  When SettingsCfg.rebuild_bot_cache_in_background is set and the bot already
+  has task queues registered, the rebuild is enqueued in a task queue instead
+  of running inline. The bot keeps using its previous task queues meanwhile;
+  this is safe as every candidate task is matched against the bot dimensions
+  before being reaped.
+
   Returns:
-    Number of matches or None if hit the cache, thus nothing was updated.
+    Number of matches or None if hit the cache or if the rebuild is done in the
+    background, thus nothing was updated.
   """
   # Check if the bot dimensions changed since last _rebuild_bot_cache_async()
   # call and still valids. It rebuilds cache every 20-40 minutes to avoid
@@ -993,6 +1250,16 @@ def assert_bot_async(bot_root_key, bot_dimensions):
         bot_dimensions)
     raise ndb.Return(None)
 
+  if obj and config.settings().rebuild_bot_cache_in_background:
+    # The bot polled before, so it has a usable list of task queues. Do not
+    # make its poll latency depend on the number of task queues in its pools.
+    enqueued = yield _enqueue_rebuild_bot_cache_async(
+        bot_root_key, bot_dimensions)
+    logging.debug(
+        'assert_bot_async: rebuilding in background. bot_id: %s, '
+        'enqueued: %s', bot_root_key.string_id(), enqueued)
+    raise ndb.Return(None)
+
   matches = yield _rebuild_bot_cache_async(bot_dimensions, bot_root_key)
   raise ndb.Return(matches)
 
@@ -1033,11 +1300,12 @@ def assert_task_async(request):
   # It's important that the TaskRequest to not be stored in the DB yet, still
   # its key could be set.
   exp_ts = request.created_ts
+  version = request.dimensions_hash_version or 1
   futures = []
   for i in range(request.num_task_slices):
     t = request.task_slice(i)
     exp_ts += datetime.timedelta(seconds=t.expiration_secs)
-    futures.append(_assert_task_props_async(t.properties, exp_ts))
+    futures.append(_assert_task_props_async(t.properties, exp_ts, version))
   for f in futures:
     yield f
 
@@ -1104,13 +1372,18 @@ def probably_has_capacity(dimensions):
   Returns:
     True or False if the capacity is cached, None otherwise.
   """
-  dimensions_hash = str(hash_dimensions(dimensions))
+  # The task queue may be registered with either version of hash_dimensions().
+  keys = [str(hash_dimensions(dimensions, v)) for v in (1, 2)]
   # Sadly, the fact that the key is not there doesn't mean that this task queue
   # is dead. For example:
   # - memcache could have been cleared manually or could be malfunctioning.
   # - in the case where a single bot can service the dimensions, the bot may not
   #   have been polling for N+1 seconds.
-  return memcache.get(dimensions_hash, namespace='task_queues_tasks')
+  found = memcache.get_multi(keys, namespace='task_queues_tasks')
+  for key in keys:
+    if key in found:
+      return found[key]
+  return None
 
 
 def set_has_capacity(dimensions, seconds):
@@ -1119,9 +1392,9 @@ def set_has_capacity(dimensions, seconds):
   Arguments:
     seconds: the amount of time this 'fact' should be kept.
   """
-  dimensions_hash = str(hash_dimensions(dimensions))
-  memcache.set(
-      dimensions_hash, True, time=seconds, namespace='task_queues_tasks')
+  memcache.set_multi(
+      {str(hash_dimensions(dimensions, v)): True for v in (1, 2)},
+      time=seconds, namespace='task_queues_tasks')
 
 
 @ndb.tasklet
@@ -1186,6 +1459,36 @@ def rebuild_task_cache_async(payload):
   raise ndb.Return(True)
 
 
+@ndb.tasklet
+def rebuild_bot_cache_async(payload):
+  """Rebuilds the BotTaskDimensions cache for a single bot in the background.
+
+  Arguments:
+  - payload: dict as created in _enqueue_rebuild_bot_cache_async() with:
+    - 'bot_id': the bot to refresh
+    - 'dimensions': the bot dimensions at the time of the poll
+
+  Returns:
+    Number of matches.
+  """
+  data = json.loads(payload)
+  bot_id = data[u'bot_id']
+  bot_root_key = ndb.Key('BotRoot', bot_id)
+  # Renew the pseudo-lock, so the time the task spent in the queue doesn't
+  # count and no other rebuild is enqueued for this bot while this one runs.
+  yield ndb.get_context().memcache_set(
+      bot_id, True, time=_EXPIRATION_TIME_REBUILD_BOT_CACHE,
+      namespace='task_queues_rebuild')
+  try:
+    matches = yield _rebuild_bot_cache_async(data[u'dimensions'], bot_root_key)
+  finally:
+    # Allow the next poll to enqueue a new rebuild if the dimensions changed
+    # again in the meantime.
+    yield ndb.get_context().memcache_delete(
+        bot_id, namespace='task_queues_rebuild')
+  raise ndb.Return(matches)
+
+
 def cron_tidy_stale():
   """Searches for all stale BotTaskDimensions and TaskDimensions and delete
   them.
@@ -7,7 +7,9 @@
 import datetime
 import logging
 import os
+import random
 import sys
+import time
 import unittest
 
 # Setups environment.
@@ -25,6 +27,7 @@ import handlers_backend
 
 from components import utils
 from server import bot_management
+from server import config
 from server import task_queues
 from server import task_request
 
@@ -352,6 +355,47 @@ class TaskQueuesApiTest(test_env_handlers.AppTestBase):
     self.assertEqual(1, task_queues.TaskDimensions.query().count())
     self.assertEqual([], task_queues.get_queues(bot_root_key))
 
+  def test_rebuild_task_cache_async_memcache_delta(self):
+    # The new task queue is pushed to the bot's cached task queues.
+    self.assertEqual(0, _assert_bot())
+    bot_root_key = bot_management.get_root_key(u'bot1')
+    self.assertEqual([], task_queues.get_queues(bot_root_key))
+    self._assert_task()
+    self.assertEqual(
+        [1843498234], memcache.get('bot1', namespace='task_queues'))
+    self.assertEqual([1843498234], task_queues.get_queues(bot_root_key))
+
+  def test_rebuild_bot_cache_async(self):
+    cfg = config.settings()
+    cfg.rebuild_bot_cache_in_background = True
+    self.mock(config, 'settings', lambda: cfg)
+    now = datetime.datetime(2010, 1, 2, 3, 4, 5)
+    self.mock_now(now)
+    self._assert_task()
+    bot_root_key = bot_management.get_root_key(u'bot1')
+    # The first time a bot is seen, the rebuild is done inline.
+    self.assertEqual(1, _assert_bot())
+    self.assertEqual([1843498234], task_queues.get_queues(bot_root_key))
+
+    # The bot loses the dimension; the rebuild is done in the background. The
+    # previous task queues are kept meanwhile.
+    self.mock_now(now, 60)
+    dimensions = {u'os': [u'Windows']}
+    self.assertEqual(None, _assert_bot(dimensions=dimensions))
+    # The rebuild is only enqueued once.
+    self.assertEqual(None, _assert_bot(dimensions=dimensions))
+    self.assertEqual([1843498234], task_queues.get_queues(bot_root_key))
+    self.assertEqual(
+        True, memcache.get('bot1', namespace='task_queues_rebuild'))
+    self.assertEqual(1, self.execute_tasks())
+    self.assertEqual(
+        None, memcache.get('bot1', namespace='task_queues_rebuild'))
+    self.assertEqual([], task_queues.get_queues(bot_root_key))
+    self.assert_count(0, task_queues.BotTaskDimensions)
+    # Now that it is rebuilt, it's a cache hit.
+    self.assertEqual(None, _assert_bot(dimensions=dimensions))
+    self.assertEqual(0, self.execute_tasks())
+
   def test_rebuild_task_cache_async_fail(self):
     # pylint: disable=unused-argument
     @ndb.tasklet
@@ -616,6 +660,21 @@ class TaskQueuesApiTest(test_env_handlers.AppTestBase):
     self.assertEqual(
         [1843498234], memcache.get('bot1', namespace='task_queues'))
 
+  def test_probably_has_capacity_get_queues_v2(self):
+    # The capacity is found for tasks using either version of the hash.
+    d = {u'pool': [u'default'], u'os': [u'Ubuntu-16.04']}
+    _assert_bot()
+    request = _gen_request(properties=_gen_properties(dimensions=d))
+    request.dimensions_hash_version = 2
+    task_queues.assert_task_async(request).get_result()
+    self.assertEqual(1, self.execute_tasks())
+    self.assertEqual(None, task_queues.probably_has_capacity(d))
+    bot_root_key = bot_management.get_root_key(u'bot1')
+    self.assertEqual(
+        [task_queues.hash_dimensions(d, 2)],
+        task_queues.get_queues(bot_root_key))
+    self.assertEqual(True, task_queues.probably_has_capacity(d))
+
   def test_set_has_capacity(self):
     d = {u'pool': [u'default'], u'os': [u'Ubuntu-16.04']}
     # By default, nothing has capacity. None means no data.
@@ -735,11 +794,108 @@ class TaskQueuesApiTest(test_env_handlers.AppTestBase):
     self.assert_count(1, task_queues.TaskDimensions)
     self.assertEqual([], task_queues.get_queues(bot_root_key))
 
+  def test_bot_dimensions_mask(self):
+    bot_dimensions = {
+        u'cpu': [u'x86-64', u'x64'],
+        u'id': [u'bot1'],
+        u'pool': [u'default'],
+    }
+    mask = task_queues.bot_dimensions_mask(bot_dimensions)
+    # The registry is stable.
+    self.assertEqual(mask, task_queues.bot_dimensions_mask(bot_dimensions))
+    self.assertEqual(
+        4, bin(mask >> task_queues._GENERATION_BITS).count('1'))
+    # The order of the values doesn't matter.
+    bot_dimensions[u'cpu'] = [u'x64', u'x86-64']
+    self.assertEqual(mask, task_queues.bot_dimensions_mask(bot_dimensions))
+
+  def test_dimensions_masks(self):
+    bot_mask = task_queues.bot_dimensions_mask({
+        u'cpu': [u'x86-64', u'x64'],
+        u'id': [u'bot1'],
+        u'pool': [u'default'],
+    })
+    def match(dimensions):
+      return [
+          bot_mask & m == m for m in task_queues.dimensions_masks(dimensions)
+      ]
+    self.assertEqual([True], match({u'pool': [u'default']}))
+    self.assertEqual(
+        [True], match({u'cpu': [u'x64', u'x86-64'], u'pool': [u'default']}))
+    self.assertEqual([False], match({u'pool': [u'other']}))
+    self.assertEqual(
+        [False, True], match({u'cpu': [u'arm|x64'], u'pool': [u'default']}))
+
+  def test_dimensions_registry_rebuild(self):
+    self.mock(task_queues, '_REGISTRY_MAX_BITS', 3)
+    registry = task_queues._DimensionsRegistry()
+    bot_mask = registry.mask([u'id:bot1', u'pool:default'])
+    masks = registry.dimensions_masks({u'pool': [u'default']})
+    self.assertEqual(
+        [True], [bot_mask & m == m for m in masks])
+    # The third 'key:value' fits, the fourth one rebuilds the registry.
+    registry.mask([u'id:bot2'])
+    self.assertEqual(3, len(registry._generation.bits))
+    bot3_mask = registry.mask([u'id:bot3', u'pool:default'])
+    self.assertEqual(1, registry._generation.number)
+    self.assertEqual(2, len(registry._generation.bits))
+    # The cached bitsets were dropped with the previous generation.
+    new_masks = registry.dimensions_masks({u'pool': [u'default']})
+    self.assertNotEqual(masks, new_masks)
+    self.assertEqual([True], [bot3_mask & m == m for m in new_masks])
+    # A bitset of the previous generation never matches.
+    self.assertEqual([False], [bot_mask & m == m for m in new_masks])
+    self.assertEqual([False], [bot3_mask & m == m for m in masks])
+
+  def test_match_bot_mask(self):
+    # Randomized equivalence with a naive implementation.
+    rnd = random.Random(0)
+    keys = [u'cpu', u'gpu', u'os', u'pool']
+    values = [u'a', u'b', u'c', u'd']
+    def gen():
+      return {
+          k: sorted(rnd.sample(values, rnd.randint(1, 2)))
+          for k in rnd.sample(keys, rnd.randint(1, len(keys)))
+      }
+    for _ in range(500):
+      bot_dimensions = gen()
+      bot_dimensions[u'id'] = [u'bot1']
+      flat = task_queues.expand_dimensions_to_flats(gen())[0]
+      expected = all(
+          d.split(':', 1)[1] in bot_dimensions.get(d.split(':', 1)[0], [])
+          for d in flat)
+      s = task_queues.TaskDimensionsSet(dimensions_flat=flat)
+      self.assertEqual(expected, s.match_bot(bot_dimensions))
+      self.assertEqual(
+          expected,
+          s.match_bot_mask(task_queues.bot_dimensions_mask(bot_dimensions)))
+
   def test_hash_dimensions(self):
     with self.assertRaises(AttributeError):
       task_queues.hash_dimensions('this is not json')
     # Assert it doesn't return 0.
     self.assertEqual(3649838548, task_queues.hash_dimensions({}))
+    self.assertEqual(338333539836370388, task_queues.hash_dimensions({}, 2))
+
+  def test_hash_dimensions_v2(self):
+    # Version 1 confuses keys and values.
+    dim1 = {u'a': [u'b', u'c', u'd']}
+    dim2 = {u'a': [u'b'], u'c': [u'd']}
+    self.assertEqual(
+        task_queues.hash_dimensions(dim1), task_queues.hash_dimensions(dim2))
+    self.assertEqual(6016124694932756144, task_queues.hash_dimensions(dim1, 2))
+    self.assertEqual(7578086740634633565, task_queues.hash_dimensions(dim2, 2))
+
+  def test_dimensions_hash_version(self):
+    d = {u'pool': [u'default'], u'os': [u'Ubuntu-16.04']}
+    self.assertEqual(
+        1,
+        task_queues.dimensions_hash_version(task_queues.hash_dimensions(d)))
+    self.assertEqual(
+        2,
+        task_queues.dimensions_hash_version(task_queues.hash_dimensions(d, 2)))
+    self.assertEqual(1, task_queues.dimensions_hash_version(0xffffffff))
+    self.assertEqual(2, task_queues.dimensions_hash_version(1 << 32))
 
   def test_hash_or_dimensions(self):
     dim1 = _gen_request(
@@ -837,6 +993,73 @@ class TaskQueuesApiTest(test_env_handlers.AppTestBase):
     self.assertEqual([], task_queues.get_queues(bot_root_key))
 
 
+@unittest.skipUnless(
+    os.environ.get('SWARMING_BENCHMARK'), 'set SWARMING_BENCHMARK=1 to run')
+class TaskQueuesBenchmarkTest(test_env_handlers.AppTestBase):
+  """Compares the compiled dimensions matcher with the string based one.
+
+  Run with: SWARMING_BENCHMARK=1 ./task_queues_test.py TaskQueuesBenchmarkTest
+  """
+  # Number of TaskDimensionsSet in the pool.
+  QUEUES = 5000
+
+  def setUp(self):
+    super(TaskQueuesBenchmarkTest, self).setUp()
+    rnd = random.Random(0)
+    self.bot_dimensions = {
+        u'cpu': [u'x86', u'x86-64'],
+        u'gpu': [u'none'],
+        u'id': [u'bot1'],
+        u'os': [u'Linux', u'Ubuntu', u'Ubuntu-16.04'],
+        u'pool': [u'default'],
+    }
+    self.sets = []
+    for i in range(self.QUEUES):
+      d = {
+          u'os': [rnd.choice([u'Linux', u'Mac', u'Windows'])],
+          u'pool': [u'default'],
+          u'cpu': [rnd.choice([u'x86', u'arm'])],
+          u'foo': [u'bar%d' % (i % 50)],
+      }
+      if i % 2:
+        del d[u'foo']
+      self.sets.append(
+          task_queues.TaskDimensionsSet(
+              dimensions_flat=task_queues.expand_dimensions_to_flats(d)[0]))
+
+  @staticmethod
+  def _match_bot_flat(s, bot_dimensions):
+    # The string based implementation, as it was before the bitsets.
+    for d in s.dimensions_flat:
+      key, value = d.split(':', 1)
+      if value not in bot_dimensions.get(key, []):
+        return False
+    return True
+
+  def _bench(self, name, fn, rounds):
+    start = time.time()
+    for _ in range(rounds):
+      matches = fn()
+    duration = time.time() - start
+    sys.stdout.write(
+        '\n%s: %d sets in %.2fms\n' %
+        (name, len(self.sets), duration * 1000. / rounds))
+    return matches
+
+  def test_compare(self):
+    rounds = 20
+    by_flat = self._bench(
+        'flat', lambda: [
+            s for s in self.sets
+            if self._match_bot_flat(s, self.bot_dimensions)
+        ], rounds)
+    def compiled():
+      bot_mask = task_queues.bot_dimensions_mask(self.bot_dimensions)
+      return [s for s in self.sets if s.match_bot_mask(bot_mask)]
+    by_mask = self._bench('bitset', compiled, rounds)
+    self.assertEqual(by_flat, by_mask)
+
+
 if __name__ == '__main__':
   if '-v' in sys.argv:
     unittest.TestCase.maxDiff = None
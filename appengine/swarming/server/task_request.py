@@ -1244,6 +1244,12 @@ class TaskRequest(ndb.Model):
   # ResultDB property in task new request.
   resultdb = ndb.LocalStructuredProperty(ResultDBCfg, compressed=True)
 
+  # Version of task_queues.hash_dimensions() used for the task queues of this
+  # request. It is set once so all the TaskSlice of a request are enqueued
+  # consistently even if the setting changes while the request is pending.
+  # None means version 1.
+  dimensions_hash_version = ndb.IntegerProperty(indexed=False)
+
   @property
   def num_task_slices(self):
     """Returns the number of TaskSlice, supports old entities."""
@@ -1323,8 +1329,9 @@ class TaskRequest(ndb.Model):
     # to_dict() doesn't recurse correctly into ndb.LocalStructuredProperty! It
     # will call the default method and not the overridden one. :(
     out = super(TaskRequest, self).to_dict(exclude=[
-        'manual_tags', 'properties_old', 'pubsub_auth_token',
-        'resultdb_update_token', 'service_account_token', 'task_slice'
+        'dimensions_hash_version', 'manual_tags', 'properties_old',
+        'pubsub_auth_token', 'resultdb_update_token', 'service_account_token',
+        'task_slice'
     ])
     if self.properties_old:
       out['properties'] = self.properties_old.to_dict()
@@ -1826,6 +1833,9 @@ def init_new_request(request, allow_high_priority, template_apply):
   request.service_account = request.service_account or u'none'
   request.service_account_token = None
 
+  if config.settings().use_dimensions_hash_v2:
+    request.dimensions_hash_version = 2
+
   task_template, extra_tags = _select_task_template(request.pool,
                                                     template_apply)
 
@@ -883,6 +883,15 @@ class TaskRequestApiTest(TestCase):
         'b1230281cc4bcc8d9458dab0810c86fcfaf8e4124351f4d39517833eb9541465',
         request.task_slice(0).properties_hash(request).encode('hex'))
 
+  def test_init_new_request_dimensions_hash_version(self):
+    self.assertEqual(None, _gen_request().dimensions_hash_version)
+    cfg = config.settings()
+    cfg.use_dimensions_hash_v2 = True
+    self.mock(config, 'settings', lambda: cfg)
+    request = _gen_request()
+    self.assertEqual(2, request.dimensions_hash_version)
+    self.assertNotIn('dimensions_hash_version', request.to_dict())
+
   def test_init_new_request_bot_service_account(self):
     request = _gen_request(service_account='bot')
     request.put()
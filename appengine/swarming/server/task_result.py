@@ -64,6 +64,7 @@ Graph of schema:
     +---------------+     +---------------+
 """
 
+import bisect
 import collections
 import datetime
 import logging
@@ -79,6 +80,7 @@ from components import datastore_utils
 from components import utils
 from proto.api import swarming_pb2  # pylint: disable=no-name-in-module
 from server import bq_state
+from server import config
 from server import large
 from server import resultdb
 from server import task_pack
@@ -197,7 +199,11 @@ class TaskOutput(ndb.Model):
   # Maximum number of chunks.
   PUT_MAX_CHUNKS = 1024
 
-  # Maximum content size saved in a TaskOutput.
+  # Number of chunks fetched at once when reading the output.
+  GET_BATCH_CHUNKS = 16
+
+  # Default maximum content size saved in a TaskOutput. It can be overridden
+  # with SettingsCfg.max_output_size.
   @classmethod
   def PUT_MAX_CONTENT(cls):
     return cls.PUT_MAX_CHUNKS * cls.CHUNK_SIZE
@@ -817,10 +823,28 @@ class _TaskResultCommon(ndb.Model):
     Returns:
       str with content, None if there wasn't any content.
     """
-    run_result_key = self.run_result_key
-    if not run_result_key or not self.stdout_chunks:
+    if not self.run_result_key or not self.stdout_chunks:
       # The task was not reaped or no output was streamed yet.
       return None
+    return ''.join(self.iter_output(offset, length))
+
+  def iter_output(self, offset, length):
+    """Yields the stdout content for this task.
+
+    TaskOutputChunk entities are fetched TaskOutput.GET_BATCH_CHUNKS at a time,
+    so the memory used is bounded by the batch size and not by the output
+    size.
+
+    Arguments:
+      offset: offset in the stream which start returning the data.
+      length: number of bytes to return. If 0, fetch the whole content.
+
+    Yields:
+      str with parts of the content.
+    """
+    run_result_key = self.run_result_key
+    if not run_result_key or not self.stdout_chunks:
+      return
 
     chunk_size = TaskOutput.CHUNK_SIZE
     length = length or (self.stdout_chunks * chunk_size - offset)
@@ -830,26 +854,74 @@ class _TaskResultCommon(ndb.Model):
     end = offset + length
     last_chunk = min((end + chunk_size-1) / chunk_size, self.stdout_chunks)
 
-    # Retrieve the subset of TaskOutputChunk needed.
+    # The output not yet written to TaskOutputChunk is buffered in the
+    # TaskRunResult.
+    run_result = self
+    if run_result_key != self.key:
+      run_result = run_result_key.get()
+    buf = run_result.stdout_buffer if run_result else None
+
     output_key = _run_result_key_to_output_key(run_result_key)
+    void = None
+    for batch_start in range(
+        first_chunk, last_chunk, TaskOutput.GET_BATCH_CHUNKS):
+      batch_end = min(batch_start + TaskOutput.GET_BATCH_CHUNKS, last_chunk)
+      keys = [
+          _output_key_to_output_chunk_key(output_key, i)
+          for i in range(batch_start, batch_end)
+      ]
+      parts = []
+      for i, e in enumerate(ndb.get_multi(keys), batch_start):
+        if i == self.stdout_chunks - 1:
+          # The last chunk may be partial or only in the buffer.
+          parts.append(e.chunk if e else '')
+        elif e:
+          # The rest of this chunk may still be buffered.
+          parts.append(e.chunk.ljust(chunk_size, '\x00'))
+        else:
+          if not void:
+            void = '\x00' * TaskOutput.CHUNK_SIZE
+          parts.append(void)
+      data = ''.join(parts)
+      base = batch_start * chunk_size
+      if buf:
+        lo = max(run_result.stdout_buffer_start, base)
+        hi = min(
+            run_result.stdout_buffer_start + len(buf), batch_end * chunk_size)
+        if lo < hi:
+          data = _overlay(
+              data,
+              buf[lo - run_result.stdout_buffer_start:
+                  hi - run_result.stdout_buffer_start],
+              lo - base)
+
+      # Process the output.
+      data = data[max(offset - base, 0):end - base]
+      if data:
+        yield data
+
+  def get_output_size(self):
+    """Returns the size in bytes of the stdout content for this task."""
+    run_result_key = self.run_result_key
+    if not run_result_key or not self.stdout_chunks:
+      return 0
+    last_chunk = self.stdout_chunks - 1
     keys = [
-        _output_key_to_output_chunk_key(output_key, i)
-        for i in range(first_chunk, last_chunk)
+        _output_key_to_output_chunk_key(
+            _run_result_key_to_output_key(run_result_key), last_chunk),
     ]
-    void = None
-    parts = []
-    for e in ndb.get_multi(keys):
-      if e:
-        parts.append(e.chunk)
-      else:
-        if not void:
-          void = '\x00' * TaskOutput.CHUNK_SIZE
-        parts.append(void)
-
-    # Process the output.
-    start_offset = offset % chunk_size
-    end_offset = end - (first_chunk * chunk_size)
-    return ''.join(parts)[start_offset:end_offset]
+    if run_result_key != self.key:
+      keys.append(run_result_key)
+    entities = ndb.get_multi(keys)
+    run_result = entities[1] if run_result_key != self.key else self
+    size = last_chunk * TaskOutput.CHUNK_SIZE
+    if entities[0]:
+      size += len(entities[0].chunk)
+    if run_result and run_result.stdout_buffer:
+      size = max(
+          size,
+          run_result.stdout_buffer_start + len(run_result.stdout_buffer))
+    return size
 
   def _pre_put_hook(self):
     """Use extra validation that cannot be validated throught 'validator'."""
@@ -963,6 +1035,17 @@ class TaskRunResult(_TaskResultCommon):
   # task is RUNNING and set to None once the task terminates.
   dead_after_ts = ndb.DateTimeProperty()
 
+  # Output received from the bot but not yet written to TaskOutputChunk
+  # entities, starting at offset stdout_buffer_start. Contiguous updates are
+  # coalesced here up to SettingsCfg.output_buffer_size bytes, which saves a
+  # read and a write of the last TaskOutputChunk per update.
+  stdout_buffer = ndb.BlobProperty(compressed=True)
+  stdout_buffer_start = ndb.IntegerProperty(indexed=False)
+
+  # Number of bytes of output dropped because they were past
+  # SettingsCfg.max_output_size.
+  stdout_dropped = ndb.IntegerProperty(indexed=False)
+
   @property
   def created_ts(self):
     return self.request.created_ts
@@ -1001,21 +1084,81 @@ class TaskRunResult(_TaskResultCommon):
   def append_output(self, output, output_chunk_start):
     """Appends output to the stdout.
 
+    The output past SettingsCfg.max_output_size is dropped. When
+    SettingsCfg.output_buffer_size is set, contiguous output is coalesced in
+    self.stdout_buffer and only written to TaskOutputChunk entities once the
+    buffer is full or the output is not contiguous anymore.
+
     Returns the entities to save.
     """
-    entities, self.stdout_chunks = _output_append(
-        _run_result_key_to_output_key(self.key),
-        self.stdout_chunks,
-        output,
-        output_chunk_start)
-    assert self.stdout_chunks <= TaskOutput.PUT_MAX_CHUNKS
-    return entities
+    cfg = config.settings()
+    max_size = cfg.max_output_size or TaskOutput.PUT_MAX_CONTENT()
+    dropped = max(0, output_chunk_start + len(output) - max(
+        max_size, output_chunk_start))
+    if dropped:
+      logging.warning('Dropping output\n%d bytes were lost', dropped)
+      self.stdout_dropped = (self.stdout_dropped or 0) + dropped
+      output = output[:len(output) - dropped]
+    if not output:
+      return []
+
+    # stdout_chunks covers the buffered output too, so readers know how far to
+    # read.
+    end = output_chunk_start + len(output)
+    self.stdout_chunks = max(
+        self.stdout_chunks or 0,
+        (end + TaskOutput.CHUNK_SIZE - 1) / TaskOutput.CHUNK_SIZE)
+
+    writes = []
+    if self.stdout_buffer:
+      if (self.stdout_buffer_start + len(self.stdout_buffer) ==
+          output_chunk_start):
+        output = self.stdout_buffer + output
+        output_chunk_start = self.stdout_buffer_start
+      else:
+        writes.append((self.stdout_buffer, self.stdout_buffer_start))
+      self.stdout_buffer = None
+      self.stdout_buffer_start = None
+
+    # The buffer size is validated, but the TaskRunResult must never go over
+    # the entity size limit.
+    buffer_size = min(cfg.output_buffer_size, config.MAX_OUTPUT_BUFFER_SIZE)
+    if len(output) < buffer_size and self.state in State.STATES_RUNNING:
+      self.stdout_buffer = output
+      self.stdout_buffer_start = output_chunk_start
+    else:
+      writes.append((output, output_chunk_start))
+    return self._write_output(writes)
+
+  def flush_output(self):
+    """Writes the buffered output to TaskOutputChunk entities.
+
+    Returns the entities to save.
+    """
+    if not self.stdout_buffer:
+      return []
+    writes = [(self.stdout_buffer, self.stdout_buffer_start)]
+    self.stdout_buffer = None
+    self.stdout_buffer_start = None
+    return self._write_output(writes)
 
   def to_dict(self):
     out = super(TaskRunResult, self).to_dict()
+    # The output buffer is an implementation detail.
+    out.pop('stdout_buffer')
+    out.pop('stdout_buffer_start')
+    out.pop('stdout_dropped')
     out['try_number'] = self.try_number
     return out
 
+  def _write_output(self, writes):
+    if not writes:
+      return []
+    entities, number_chunks = _output_append(
+        _run_result_key_to_output_key(self.key), writes)
+    self.stdout_chunks = max(self.stdout_chunks or 0, number_chunks)
+    return entities
+
   def _pre_put_hook(self):
     super(TaskRunResult, self)._pre_put_hook()
     if not self.started_ts:
@@ -1295,108 +1438,97 @@ def _output_key_to_output_chunk_key(output_key, chunk_number):
   return ndb.Key(TaskOutputChunk, chunk_number+1, parent=output_key)
 
 
-def _output_append(output_key, number_chunks, output, output_chunk_start):
+def _output_append(output_key, writes):
   """Appends output to a TaskOutput in TaskOutputChunk entities.
 
   Creates new TaskOutputChunk entities as necessary as children of
   TaskRunResult/TaskOutput.
 
-  It silently drops saving the output if it goes over ~100Mib.
-
-  Does one DB read by key and no puts. It's the responsibility of the caller to
+  Does at most one DB read by key and no puts. TaskOutputChunk entities that
+  are fully overwritten are not read. It's the responsibility of the caller to
   save the entities.
 
   Arguments:
     output_key: ndb.Key to TaskOutput that is the parent of TaskOutputChunk.
-    number_chunks: Current number of TaskOutputChunk instances. If 0, this means
-        there is not data yet.
-    output: Actual content to append.
-    output_chunk_start: Index of the data to be written to.
+    writes: list of (output, output_chunk_start) to write in order, where
+        output is the actual content to append and output_chunk_start the index
+        of the data to be written to.
 
   Returns:
     A tuple of (list of entities to save, number_chunks). The number_chunks is
-    the number of TaskOutputChunk instances for this output.
+    the minimum number of TaskOutputChunk instances for this output.
   """
-  assert output and isinstance(output, str), output
   assert output_key.kind() == 'TaskOutput', output_key
 
-  # Split everything in small bits.
-  chunks = []
-  while output:
-    chunk_number = output_chunk_start / TaskOutput.CHUNK_SIZE
-    if chunk_number >= TaskOutput.PUT_MAX_CHUNKS:
-      # TODO(maruel): Log into TaskOutput that data was dropped.
-      logging.warning('Dropping output\n%d bytes were lost', len(output))
-      break
-    key = _output_key_to_output_chunk_key(output_key, chunk_number)
-    start = output_chunk_start % TaskOutput.CHUNK_SIZE
-    next_start = TaskOutput.CHUNK_SIZE - start
-    chunks.append((key, start, output[:next_start]))
-    output = output[next_start:]
-    number_chunks = max(number_chunks, chunk_number + 1)
-    output_chunk_start = (chunk_number+1)*TaskOutput.CHUNK_SIZE
-
-  if not chunks:
-    return [], number_chunks
+  # Split everything in small bits, grouped per TaskOutputChunk.
+  chunks = collections.OrderedDict()
+  number_chunks = 0
+  for output, output_chunk_start in writes:
+    assert output and isinstance(output, str), output
+    while output:
+      chunk_number = output_chunk_start / TaskOutput.CHUNK_SIZE
+      start = output_chunk_start % TaskOutput.CHUNK_SIZE
+      next_start = TaskOutput.CHUNK_SIZE - start
+      chunks.setdefault(chunk_number, []).append((start, output[:next_start]))
+      output = output[next_start:]
+      number_chunks = max(number_chunks, chunk_number + 1)
+      output_chunk_start = (chunk_number+1)*TaskOutput.CHUNK_SIZE
 
   # Get the TaskOutputChunk from the DB. Normally it would be only one entity
-  # (the last incomplete one) but this code supports arbitrary overwrite.
-  #
-  # number_chunks should normally be used to skip entities that are assumed to
-  # not be present but we don't assume the number_chunks is valid for safety.
-  #
-  # This means an unneeded get() is done on the missing chunk.
-  entities = ndb.get_multi(i[0] for i in chunks)
+  # (the last incomplete one) but this code supports arbitrary overwrite. The
+  # chunks that are completely overwritten by the first write are not fetched.
+  to_fetch = [
+      chunk_number for chunk_number, parts in chunks.items()
+      if parts[0][0] or len(parts[0][1]) != TaskOutput.CHUNK_SIZE
+  ]
+  fetched = dict(zip(to_fetch, ndb.get_multi(
+      _output_key_to_output_chunk_key(output_key, i) for i in to_fetch)))
 
   # Update the entities.
-  for i, (key, start, output_chunk) in enumerate(chunks):
-    if not entities[i]:
-      # Fill up for missing entities.
-      entities[i] = TaskOutputChunk(key=key)
-    chunk = entities[i]
-    # Magically combine everything.
-    end = start + len(output_chunk)
-    if len(chunk.chunk) < start:
-      # Insert blank data automatically.
-      chunk.gaps.extend((len(chunk.chunk), start))
-      chunk.chunk = chunk.chunk + '\x00' * (start-len(chunk.chunk))
-
-    # Strip gaps that are being written to.
-    new_gaps = []
-    for j in range(0, len(chunk.gaps), 2):
-      # All values are relative to the starting offset of the chunk itself.
-      gap_start = chunk.gaps[j]
-      gap_end = chunk.gaps[j + 1]
-      # If the gap overlaps the chunk being written, strip it. Cases:
-      #   Gap:     |   |
-      #   Chunk: |   |
-      if start <= gap_start <= end and end <= gap_end:
-        gap_start = end
-
-      #   Gap:     |   |
-      #   Chunk:     |   |
-      if gap_start <= start and start <= gap_end <= end:
-        gap_end = start
-
-      #   Gap:       |  |
-      #   Chunk:   |      |
-      if start <= gap_start <= end and start <= gap_end <= end:
-        continue
-
-      #   Gap:     |      |
-      #   Chunk:     |  |
-      if gap_start < start < gap_end and gap_start <= end <= gap_end:
-        # Create a hole.
-        new_gaps.extend((gap_start, start))
-        new_gaps.extend((end, gap_end))
-      else:
-        new_gaps.extend((gap_start, gap_end))
-
-    chunk.gaps = new_gaps
-    chunk.chunk = chunk.chunk[:start] + output_chunk + chunk.chunk[end:]
+  entities = []
+  for chunk_number, parts in chunks.items():
+    chunk = fetched.get(chunk_number) or TaskOutputChunk(
+        key=_output_key_to_output_chunk_key(output_key, chunk_number))
+    for start, output_chunk in parts:
+      _output_chunk_write(chunk, start, output_chunk)
+    entities.append(chunk)
   return entities, number_chunks
 
 
+def _output_chunk_write(chunk, start, output_chunk):
+  """Writes output_chunk at offset start in a TaskOutputChunk."""
+  end = start + len(output_chunk)
+  if len(chunk.chunk) < start:
+    # Insert blank data automatically.
+    chunk.gaps.extend((len(chunk.chunk), start))
+    chunk.chunk = chunk.chunk + '\x00' * (start-len(chunk.chunk))
+
+  # Strip gaps that are being written to. gaps is a sorted list of
+  # [start, end) boundaries, so an odd index means the offset is inside a gap,
+  # which then has to be cut at this offset.
+  gaps = list(chunk.gaps)
+  i = bisect.bisect_left(gaps, start)
+  j = bisect.bisect_right(gaps, end)
+  new_gaps = gaps[:i]
+  if i % 2:
+    new_gaps.append(start)
+  if j % 2:
+    new_gaps.append(end)
+  new_gaps.extend(gaps[j:])
+  chunk.gaps = new_gaps
+  chunk.chunk = chunk.chunk[:start] + output_chunk + chunk.chunk[end:]
+
+
+def _overlay(data, buf, offset):
+  """Returns data with buf written at offset.
+
+  Data before offset is padded with NUL bytes as needed.
+  """
+  if len(data) < offset:
+    data += '\x00' * (offset - len(data))
+  return data[:offset] + buf + data[offset+len(buf):]
+
+
 def _outputchunk_key_to_request(output_chunk_key):
   """Returns the ndb.Key for the TaskRequest."""
   summary_key = output_chunk_key.parent().parent().parent()
@@ -1561,6 +1693,34 @@ def yield_active_run_result_keys():
   return q.iter(keys_only=True)
 
 
+def get_states(result_keys):
+  """Returns the State of each task result in result_keys.
+
+  Fetches everything possible from memcache, then fetches from the DB the
+  entities that are not in memcache or in a non-stable state. A missing entity
+  is reported as PENDING.
+  """
+  # Hot path. Fetch everything we can from memcache.
+  entities = ndb.get_multi(
+      result_keys, use_cache=True, use_memcache=True, use_datastore=False)
+  states = [t.state if t else State.PENDING for t in entities]
+  # Now fetch both the ones in non-stable state or not in memcache.
+  missing_keys = [
+    result_keys[i] for i, state in enumerate(states)
+    if state in State.STATES_RUNNING
+  ]
+  if missing_keys:
+    more = ndb.get_multi(
+        missing_keys, use_cache=False, use_memcache=False, use_datastore=True)
+    # This relies on missing_keys being in the same order as states (for
+    # common elements).
+    for i, s in enumerate(states):
+      if s in State.STATES_RUNNING:
+        t = more.pop(0)
+        states[i] = t.state if t else State.PENDING
+  return states
+
+
 def get_run_results_query(start, end, sort, state, bot_id):
   """Returns TaskRunResult.query() with these filters.
 
@@ -31,6 +31,7 @@ from test_support import test_case
 
 from proto.api import swarming_pb2  # pylint: disable=no-name-in-module
 from server import bq_state
+from server import config
 from server import large
 from server import task_pack
 from server import task_request
@@ -1439,6 +1440,28 @@ class TaskResultApiTest(TestCase):
     # Indirectly tested by API.
     pass
 
+  def test_get_states(self):
+    run_result = _gen_run_result()
+    result_summary = run_result.result_summary_key.get()
+    missing_key = task_pack.unpack_result_summary_key('1d69b9f088008810')
+    expected = [
+        task_result.State.RUNNING,
+        task_result.State.RUNNING,
+        task_result.State.PENDING,
+    ]
+    self.assertEqual(
+        expected,
+        task_result.get_states(
+            [result_summary.key, run_result.key, missing_key]))
+
+    run_result.state = task_result.State.TIMED_OUT
+    run_result.completed_ts = utils.utcnow()
+    run_result.dead_after_ts = None
+    run_result.put()
+    self.assertEqual(
+        [task_result.State.RUNNING, task_result.State.TIMED_OUT],
+        task_result.get_states([result_summary.key, run_result.key]))
+
 
 class TestOutput(TestCase):
 
@@ -1447,6 +1470,12 @@ class TestOutput(TestCase):
         task_result.TaskOutputChunk.key)
     self.assertEqual(expected, [t.to_dict() for t in q.fetch()])
 
+  def mock_settings(self, **kwargs):
+    cfg = config.settings()
+    for k, v in kwargs.items():
+      setattr(cfg, k, v)
+    self.mock(config, 'settings', lambda: cfg)
+
   def test_append_output(self):
     # Force tedious chunking.
     self.mock(task_result.TaskOutput, 'CHUNK_SIZE', 2)
@@ -1486,6 +1515,93 @@ class TestOutput(TestCase):
     self.assertTrue(calls[0][0].startswith('Dropping '), calls[0][0])
     self.assertEqual(1, calls[0][1])
 
+  def test_append_output_max_output_size(self):
+    self.mock_settings(max_output_size=5)
+    run_result = _gen_run_result()
+    ndb.put_multi(run_result.append_output('FooBar', 0))
+    self.assertEqual([], run_result.append_output('Baz', 6))
+    self.assertEqual('FooBa', run_result.get_output(0, 0))
+    self.assertEqual(4, run_result.stdout_dropped)
+    self.assertNotIn('stdout_dropped', run_result.to_dict())
+
+  def test_append_output_aligned(self):
+    # Chunks that are fully overwritten are not read.
+    self.mock(task_result.TaskOutput, 'CHUNK_SIZE', 2)
+    run_result = _gen_run_result()
+    fetched = []
+    get_multi = ndb.get_multi
+    def get_multi_mock(keys, **kwargs):
+      keys = list(keys)
+      fetched.extend(k.integer_id() for k in keys)
+      return get_multi(keys, **kwargs)
+    self.mock(ndb, 'get_multi', get_multi_mock)
+
+    ndb.put_multi(run_result.append_output('FooBar', 0))
+    self.assertEqual([], fetched)
+    ndb.put_multi(run_result.append_output('Bazz', 5))
+    # Only the first and the last partial chunks are read.
+    self.assertEqual([3, 5], fetched)
+    self.assertEqual('FooBaBazz', run_result.get_output(0, 0))
+
+  def test_append_output_buffered(self):
+    self.mock_settings(output_buffer_size=10)
+    self.mock(task_result.TaskOutput, 'CHUNK_SIZE', 4)
+    run_result = _gen_run_result()
+
+    # Contiguous output is coalesced in the TaskRunResult.
+    self.assertEqual([], run_result.append_output('Foo', 0))
+    self.assertEqual([], run_result.append_output('Bar', 3))
+    run_result.put()
+    self.assertTaskOutputChunk([])
+    self.assertEqual(2, run_result.stdout_chunks)
+    self.assertEqual('FooBar', run_result.key.get().get_output(0, 0))
+    self.assertEqual('oBa', run_result.key.get().get_output(2, 3))
+
+    # The buffer is written once it is full.
+    ndb.put_multi(run_result.append_output('BazQux', 6))
+    self.assertEqual(None, run_result.stdout_buffer)
+    self.assertTaskOutputChunk([
+        {'chunk': 'FooB', 'gaps': []},
+        {'chunk': 'arBa', 'gaps': []},
+        {'chunk': 'zQux', 'gaps': []},
+    ])
+    self.assertEqual('FooBarBazQux', run_result.get_output(0, 0))
+
+  def test_append_output_buffered_not_contiguous(self):
+    self.mock_settings(output_buffer_size=10)
+    run_result = _gen_run_result()
+    ndb.put_multi(run_result.append_output('Foo', 0))
+    # Writing elsewhere flushes the previous buffer.
+    entities = run_result.append_output('Bar', 5)
+    self.assertEqual(1, len(entities))
+    ndb.put_multi(entities + [run_result])
+    self.assertTaskOutputChunk([{'chunk': 'Foo', 'gaps': []}])
+    self.assertEqual('Foo\x00\x00Bar', run_result.get_output(0, 0))
+
+    # The summary reads the buffer from the TaskRunResult.
+    result_summary = run_result.result_summary_key.get()
+    result_summary.stdout_chunks = run_result.stdout_chunks
+    self.assertEqual('Foo\x00\x00Bar', result_summary.get_output(0, 0))
+
+  def test_append_output_buffered_completed(self):
+    self.mock_settings(output_buffer_size=10)
+    run_result = _gen_run_result()
+    ndb.put_multi(run_result.append_output('Foo', 0))
+    run_result.state = task_result.State.COMPLETED
+    ndb.put_multi(run_result.append_output('Bar', 3))
+    self.assertEqual(None, run_result.stdout_buffer)
+    self.assertTaskOutputChunk([{'chunk': 'FooBar', 'gaps': []}])
+
+  def test_flush_output(self):
+    self.mock_settings(output_buffer_size=10)
+    run_result = _gen_run_result()
+    self.assertEqual([], run_result.flush_output())
+    ndb.put_multi(run_result.append_output('Foo', 0))
+    ndb.put_multi(run_result.flush_output())
+    self.assertEqual(None, run_result.stdout_buffer)
+    self.assertTaskOutputChunk([{'chunk': 'Foo', 'gaps': []}])
+    self.assertEqual('Foo', run_result.get_output(0, 0))
+
   def test_append_output_partial(self):
     run_result = _gen_run_result()
     ndb.put_multi(run_result.append_output('Foo', 10))
@@ -1576,6 +1692,18 @@ class TestOutput(TestCase):
         'gaps': [3, 4, 7, 8]
     }])
 
+  def test_append_output_multiple_gaps(self):
+    run_result = _gen_run_result()
+    ndb.put_multi(run_result.append_output('Foo', 3))
+    ndb.put_multi(run_result.append_output('Bar', 10))
+    ndb.put_multi(run_result.append_output('Baz', 7))
+    expected_output = '\x00\x00\x00Foo\x00BazBar'
+    self.assertEqual(expected_output, run_result.get_output(0, 0))
+    self.assertTaskOutputChunk([{
+        'chunk': expected_output,
+        'gaps': [0, 3, 6, 7]
+    }])
+
   def test_append_output_reverse_order_second_chunk(self):
     # Write the data in reverse order in multiple calls.
     self.mock(task_result.TaskOutput, 'CHUNK_SIZE', 16)
@@ -1634,6 +1762,51 @@ class TestOutput(TestCase):
     ndb.put_multi(run_result.append_output(b'😀😃😄😁😆', 0))
     self.assertEqual(b'😀😃😄😁', run_result.get_output(0, 16))
 
+  def test_iter_output(self):
+    self.mock(task_result.TaskOutput, 'CHUNK_SIZE', 2)
+    self.mock(task_result.TaskOutput, 'GET_BATCH_CHUNKS', 2)
+    run_result = _gen_run_result()
+    ndb.put_multi(run_result.append_output('FooBarBaz', 0))
+    calls = []
+    get_multi = ndb.get_multi
+    def get_multi_mock(keys, **kwargs):
+      keys = list(keys)
+      calls.append(len(keys))
+      return get_multi(keys, **kwargs)
+    self.mock(ndb, 'get_multi', get_multi_mock)
+
+    self.assertEqual(['FooB', 'arBa', 'z'], list(run_result.iter_output(0, 0)))
+    self.assertEqual([2, 2, 1], calls)
+    self.assertEqual(['oBar', 'B'], list(run_result.iter_output(2, 5)))
+    self.assertEqual([], list(run_result.iter_output(9, 0)))
+
+  def test_iter_output_buffered(self):
+    self.mock_settings(output_buffer_size=100)
+    self.mock(task_result.TaskOutput, 'CHUNK_SIZE', 2)
+    self.mock(task_result.TaskOutput, 'GET_BATCH_CHUNKS', 2)
+    run_result = _gen_run_result()
+    ndb.put_multi(run_result.append_output('Foo', 0))
+    ndb.put_multi(run_result.append_output('Bar', 5) + [run_result])
+    self.assertEqual(
+        ['Foo\x00', '\x00Bar'], list(run_result.iter_output(0, 0)))
+    result_summary = run_result.result_summary_key.get()
+    result_summary.stdout_chunks = run_result.stdout_chunks
+    self.assertEqual(
+        ['Foo\x00', '\x00Bar'], list(result_summary.iter_output(0, 0)))
+
+  def test_get_output_size(self):
+    self.mock_settings(output_buffer_size=10)
+    self.mock(task_result.TaskOutput, 'CHUNK_SIZE', 4)
+    run_result = _gen_run_result()
+    self.assertEqual(0, run_result.get_output_size())
+    ndb.put_multi(run_result.append_output('FooBar', 0))
+    self.assertEqual(6, run_result.get_output_size())
+    ndb.put_multi(run_result.flush_output() + [run_result])
+    self.assertEqual(6, run_result.get_output_size())
+    result_summary = run_result.result_summary_key.get()
+    result_summary.stdout_chunks = run_result.stdout_chunks
+    self.assertEqual(6, result_summary.get_output_size())
+
 if __name__ == '__main__':
   logging.basicConfig(
       level=logging.DEBUG if '-v' in sys.argv else logging.ERROR)
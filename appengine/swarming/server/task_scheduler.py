@@ -17,6 +17,7 @@ import urlparse
 
 from google.appengine.api import app_identity
 from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 from components import auth
@@ -39,11 +40,24 @@ from server import task_result
 from server import task_to_run
 
 
+# Maximum number of seconds wait_task_states() can wait for. It must stay well
+# below the request deadline.
+WAIT_STATES_MAX_SECS = 45
+
+
 ### Private stuff.
 
 
 _PROBABILITY_OF_QUICK_COMEBACK = 0.05
 
+# Delay between two checks for state change notifications in
+# wait_task_states().
+_WAIT_STATES_POLL_SECS = 1.
+
+# Memcache namespace of the state change notifications sent by
+# _notify_state_change().
+_STATE_CHANGE_NAMESPACE = 'task_state_change'
+
 # When falling back from external scheduler, requests that belong to any
 # external scheduler are ignored for this duration at the beginning of their
 # life. This number should be larger than the bot polling period.
@@ -221,6 +235,9 @@ def _expire_task(to_run_key, request, inline):
     logging.info(
         'Expired %s', task_pack.pack_result_summary_key(result_summary_key))
     ts_mon_metrics.on_task_expired(summary, to_run_key.get())
+    task_to_run.remove_from_dispatch_index(to_run_key)
+  if new_to_run:
+    task_to_run.add_to_dispatch_index(new_to_run)
   return summary, new_to_run
 
 
@@ -327,6 +344,8 @@ def _reap_task(bot_dimensions, bot_version, to_run_key, request,
     # The bot will reap the next available task in case of failure, no big deal.
     run_result = None
     secret_bytes = None
+  if run_result:
+    task_to_run.remove_from_dispatch_index(to_run_key)
   return run_result, secret_bytes
 
 
@@ -406,6 +425,8 @@ def _handle_dead_bot(run_result_key):
     else:
       run_result.state = task_result.State.BOT_DIED
     result_summary.set_from_run_result(run_result, request)
+    # Write the output buffered from previous updates, if any.
+    to_put += tuple(run_result.flush_output())
 
     futures = ndb.put_multi_async(to_put)
     # if result_summary.state != orig_summary_state:
@@ -501,6 +522,30 @@ def _maybe_taskupdate_notify_via_tq(
     external_scheduler.notify_requests(
         es_cfg, [(request, result_summary)], True, False)
 
+  _notify_state_change(result_summary.key)
+
+
+def _notify_state_change(result_summary_key):
+  """Wakes up the wait_task_states() calls waiting on this task.
+
+  The notification is sent once the current transaction, if any, commits.
+  """
+  task_id = task_pack.pack_result_summary_key(result_summary_key)
+  ndb.get_context().call_on_commit(
+      lambda: memcache.incr(
+          task_id, initial_value=0, namespace=_STATE_CHANGE_NAMESPACE))
+
+
+def _get_state_change_versions(result_keys):
+  """Returns the state change notification counters for result_keys."""
+  task_ids = []
+  for key in result_keys:
+    if key.kind() == 'TaskRunResult':
+      key = task_pack.run_result_key_to_result_summary_key(key)
+    task_ids.append(task_pack.pack_result_summary_key(key))
+  versions = memcache.get_multi(task_ids, namespace=_STATE_CHANGE_NAMESPACE)
+  return [versions.get(i) for i in task_ids]
+
 
 def _pubsub_notify(task_id, topic, auth_token, userdata):
   """Sends PubSub notification about task completion.
@@ -766,6 +811,9 @@ def _bot_update_tx(run_result_key, bot_id, output, output_chunk_start,
   if output:
     # This does 1 multi GETs. This also modifies run_result in place.
     to_put.extend(run_result.append_output(output, output_chunk_start or 0))
+  if run_result.state not in task_result.State.STATES_RUNNING:
+    # Write the output buffered from previous updates, if any.
+    to_put.extend(run_result.flush_output())
   if performance_stats:
     performance_stats.key = task_pack.run_result_key_to_performance_stats_key(
         run_result.key)
@@ -854,6 +902,7 @@ def _cancel_task_tx(request, result_summary, kill_running, bot_id, now, es_cfg,
 
     # Add it to the negative cache.
     task_to_run.set_lookup_cache(to_run_key, False)
+    task_to_run.remove_from_dispatch_index(to_run_key)
 
     to_run = to_run_future.get_result()
     entities.append(to_run)
@@ -1236,6 +1285,8 @@ def schedule_request(request, secret_bytes, enable_resultdb):
   _gen_key = lambda: _gen_new_keys(result_summary, to_run, secret_bytes)
   extra = filter(bool, [result_summary, to_run, secret_bytes])
   datastore_utils.insert(request, new_key_callback=_gen_key, extra=extra)
+  if to_run:
+    task_to_run.add_to_dispatch_index(to_run)
 
   # Note: This external_scheduler call is blocking, and adds risk
   # of the HTTP handler being slow or dying after the task was already made
@@ -1477,6 +1528,7 @@ def bot_update_task(run_result_key, bot_id, output, output_chunk_start,
     # in memcache.
     ndb.get_context()._clear_memcache([result_summary_key,
                                        run_result_key]).check_success()
+    _notify_state_change(result_summary_key)
   assert bool(error) != bool(run_result), (error, run_result)
   if error:
     logging.error('Task %s %s', packed, error)
@@ -1544,8 +1596,10 @@ def bot_terminate_task(run_result_key, bot_id):
     run_result.modified_ts = now
     run_result.dead_after_ts = None
     result_summary.set_from_run_result(run_result, request)
+    # Write the output buffered from previous updates, if any.
+    to_put = [run_result, result_summary] + run_result.flush_output()
 
-    futures = ndb.put_multi_async((run_result, result_summary))
+    futures = ndb.put_multi_async(to_put)
     _maybe_taskupdate_notify_via_tq(
         result_summary, request, es_cfg, transactional=True)
     for f in futures:
@@ -1641,6 +1695,37 @@ def cancel_task(request, result_key, kill_running, bot_id):
   return datastore_utils.transaction(run)
 
 
+def wait_task_states(result_keys, timeout_secs):
+  """Returns the State of each task once one of them is done.
+
+  Returns as soon as one of the tasks is neither PENDING nor RUNNING, or after
+  timeout_secs seconds. Instead of polling the DB, it waits for the state change
+  notifications sent by _notify_state_change() and only fetches the states
+  again when one is received.
+
+  Arguments:
+    result_keys: list of TaskResultSummary or TaskRunResult ndb.Key.
+    timeout_secs: maximum number of seconds to wait for.
+
+  Returns:
+    list of State, one per key in result_keys.
+  """
+  deadline = time.time() + timeout_secs
+  while True:
+    # Read the counters before the states, so a change happening in between is
+    # not missed.
+    versions = _get_state_change_versions(result_keys)
+    states = task_result.get_states(result_keys)
+    if any(s not in task_result.State.STATES_RUNNING for s in states):
+      return states
+    while True:
+      if time.time() >= deadline:
+        return states
+      time.sleep(min(_WAIT_STATES_POLL_SECS, max(deadline - time.time(), 0)))
+      if _get_state_change_versions(result_keys) != versions:
+        break
+
+
 ### Cron job.
 
 
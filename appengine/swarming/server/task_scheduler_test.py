@@ -1792,6 +1792,22 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
     self.assertEqual(1, self.execute_tasks())
     self.assertEqual(3, len(pub_sub_calls))  # killing -> KILLED
 
+  def test_bot_terminate_task_buffered_output(self):
+    cfg = config.settings()
+    cfg.output_buffer_size = 100
+    self.mock(config, 'settings', lambda: cfg)
+    run_result = self._quick_reap(1, 0)
+    self.assertEqual(State.RUNNING, _bot_update_task(run_result.key))
+    self.assertEqual('hi', run_result.key.get().stdout_buffer)
+
+    self.assertEqual(
+        None, task_scheduler.bot_terminate_task(run_result.key, 'localhost'))
+    run_result = run_result.key.get()
+    self.assertEqual(State.BOT_DIED, run_result.state)
+    self.assertIsNone(run_result.stdout_buffer)
+    self.assertEqual(1, task_result.TaskOutputChunk.query().count())
+    self.assertEqual('hi', run_result.get_output(0, 0))
+
   def test_bot_terminate_task_wrong_bot(self):
     run_result = self._quick_reap(1, 0)
     expected = (
@@ -1825,6 +1841,36 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
     actual = task_to_run._lookup_cache_is_taken_async(to_run_key).get_result()
     self.assertEqual(True, actual)
 
+  def test_wait_task_states(self):
+    self._register_bot(0, self.bot_dimensions)
+    result_summary = self._quick_schedule(1)
+    sleeps = []
+    self.mock(task_scheduler.time, 'sleep', sleeps.append)
+
+    # Nothing is done, it returns once the timeout is reached.
+    self.assertEqual(
+        [State.PENDING],
+        task_scheduler.wait_task_states([result_summary.key], 0))
+    self.assertEqual([], sleeps)
+
+    # The cancellation wakes up the waiter.
+    def sleep(delay):
+      sleeps.append(delay)
+      if len(sleeps) == 2:
+        task_scheduler.cancel_task(
+            result_summary.request_key.get(), result_summary.key, False, None)
+    self.mock(task_scheduler.time, 'sleep', sleep)
+    self.assertEqual(
+        [State.CANCELED],
+        task_scheduler.wait_task_states([result_summary.key], 30))
+    self.assertEqual([1., 1.], sleeps)
+
+    # A task already done returns immediately.
+    self.assertEqual(
+        [State.CANCELED],
+        task_scheduler.wait_task_states([result_summary.key], 30))
+    self.assertEqual(2, len(sleeps))
+
   def test_cancel_task_with_id(self):
     # Cancel a pending task.
     pub_sub_calls = self.mock_pub_sub()
@@ -2199,6 +2245,26 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
 
     self.assertEqual(0, self.execute_tasks())
 
+  def test_cron_handle_bot_died_buffered_output(self):
+    cfg = config.settings()
+    cfg.output_buffer_size = 100
+    self.mock(config, 'settings', lambda: cfg)
+    run_result = self._quick_reap(1, 0)
+    self.assertEqual(State.RUNNING, _bot_update_task(run_result.key))
+    self.assertEqual('hi', run_result.key.get().stdout_buffer)
+    request = run_result.request_key.get()
+
+    self.mock_now(
+        self.now + datetime.timedelta(seconds=request.bot_ping_tolerance_secs),
+        1)
+    self.assertEqual(([run_result.task_id], 0),
+                     task_scheduler.cron_handle_bot_died())
+    run_result = run_result.key.get()
+    self.assertEqual(State.BOT_DIED, run_result.state)
+    self.assertIsNone(run_result.stdout_buffer)
+    self.assertEqual(1, task_result.TaskOutputChunk.query().count())
+    self.assertEqual('hi', run_result.get_output(0, 0))
+
   def test_cron_handle_bot_died_no_update_not_idempotent(self):
     # A bot reaped a task but the handler returned HTTP 500, leaving the task in
     # a lingering state.
@@ -31,7 +31,10 @@ Graph of the schema:
 
 import collections
 import datetime
+import heapq
+import itertools
 import logging
+import threading
 import time
 
 from google.appengine.api import datastore_errors
@@ -40,6 +43,9 @@ from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 from components import utils
+
+import ts_mon_metrics
+
 from server import bot_management
 from server import config
 from server import task_pack
@@ -47,6 +53,48 @@ from server import task_queues
 from server import task_request
 
 
+# Maximum age in seconds of a queue in the dispatch index before it is refreshed
+# from the datastore. This bounds how long a task enqueued through another
+# instance stays invisible to the bots polling this instance.
+_DISPATCH_INDEX_MAX_AGE = 10.
+
+
+# Queues not polled for this long in seconds are dropped from the dispatch
+# index to bound the instance memory usage.
+_DISPATCH_INDEX_EVICT_AGE = 5 * 60.
+
+
+# Maximum number of TaskToRun fetched per queue when refreshing the dispatch
+# index. Each poll reaps at most one task so it is unlikely a queue is drained
+# past this limit within _DISPATCH_INDEX_MAX_AGE.
+_DISPATCH_INDEX_FETCH_LIMIT = 500
+
+
+# Number of TaskToRun candidates validated together by _validate_tasks_async().
+# It matches the page size used in _yield_potential_tasks().
+_VALIDATION_WINDOW = 10
+
+
+# Maximum number of _validate_tasks_async() windows in flight.
+_VALIDATION_PIPELINE = 5
+
+
+# Number of TaskToRun fetched per query page by _yield_strict_tasks().
+_STRICT_PAGE_SIZE = 10
+
+
+# Number of pages _yield_strict_tasks() keeps buffered per queue ahead of the
+# items yielded, so the next page is usually there before it is needed.
+_STRICT_PREFETCH_PAGES = 3
+
+
+# Maximum number of seconds _yield_strict_tasks() blocks in total waiting for
+# slower queues to prove the order of the items it yields. The time the caller
+# spends between items doesn't count. Past it, the items already fetched
+# are yielded in order of priority like _yield_potential_tasks() does.
+_STRICT_MAX_WAIT = 1.
+
+
 ### Models.
 
 
@@ -144,7 +192,9 @@ class TaskToRun(ndb.Model):
     out = super(TaskToRun, self).to_dict()
     # Consistent formatting makes it easier to reason about.
     if out['queue_number']:
-      out['queue_number'] = '0x%016x' % out['queue_number']
+      # Version 2 queue numbers are negative, see _queue_number_base().
+      out['queue_number'] = '0x%016x' % (
+          out['queue_number'] & 0xFFFFFFFFFFFFFFFF)
     out['try_number'] = self.try_number
     out['task_slice_index'] = self.task_slice_index
     return out
@@ -161,11 +211,31 @@ class TaskToRun(ndb.Model):
 ### Private functions.
 
 
+def _queue_number_base(dimensions_hash):
+  """Returns the lowest TaskToRun.queue_number of the queue for this
+  dimensions_hash.
+
+  A queue spans 2**31 values. There are two layouts, depending on
+  task_queues.dimensions_hash_version():
+  - version 1: the 32 bits hash is the top bits of a positive 63 bit value.
+  - version 2: the top 32 bits of the 63 bits hash are the top bits of a
+    negative value, so the queues never overlap with version 1 queues.
+  """
+  # dimensions_hash should be 32 bits but on AppEngine, which is using 32 bits
+  # python, it is silently upgraded to long.
+  assert isinstance(dimensions_hash, (int, long)), repr(dimensions_hash)
+  assert 0 < dimensions_hash <= 0x7FFFFFFFFFFFFFFF, hex(dimensions_hash)
+  if task_queues.dimensions_hash_version(dimensions_hash) == 1:
+    return long(dimensions_hash) << 31
+  return ((long(dimensions_hash) >> 31) << 31) - (1 << 63)
+
+
 def _gen_queue_number(dimensions_hash, timestamp, priority):
-  """Generates a 63 bit packed value used for TaskToRun.queue_number.
+  """Generates a 64 bit packed value used for TaskToRun.queue_number.
 
   Arguments:
-  - dimensions_hash: 32 bit integer to classify in a queue.
+  - dimensions_hash: task_queues.hash_dimensions() to classify in a queue. See
+        _queue_number_base() for the layout.
   - timestamp: datetime.datetime when the TaskRequest was filed in. This value
         is used for FIFO or LIFO ordering (depending on configuration) with a
         100ms granularity; the year is ignored.
@@ -173,14 +243,12 @@ def _gen_queue_number(dimensions_hash, timestamp, priority):
         priority.
 
   Returns:
-    queue_number is a 63 bit integer with dimension_hash, timestamp at 100ms
-    resolution plus priority.
+    queue_number is a 64 bit integer with dimension_hash, timestamp at 100ms
+    resolution plus priority. The lowest 31 bits are the same for both
+    layouts, so queue numbers of both versions can be sorted together by
+    _queue_number_order_priority().
   """
-  # dimensions_hash should be 32 bits but on AppEngine, which is using 32 bits
-  # python, it is silently upgraded to long.
-  assert isinstance(dimensions_hash, (int, long)), repr(dimensions_hash)
-  assert dimensions_hash > 0 and dimensions_hash <= 0xFFFFFFFF, hex(
-      dimensions_hash)
+  high_part = _queue_number_base(dimensions_hash)
   assert isinstance(timestamp, datetime.datetime), repr(timestamp)
   task_request.validate_priority(priority)
 
@@ -206,9 +274,6 @@ def _gen_queue_number(dimensions_hash, timestamp, priority):
   low_part = (long(priority) << 22) + t
   assert low_part >= 0 and low_part <= 0xFFFFFFFF, '0x%X is out of band' % (
       low_part)
-  # int may be 32 bits, upgrade to long for consistency, albeit this is
-  # significantly slower.
-  high_part = long(dimensions_hash) << 31
   return high_part | low_part
 
 
@@ -258,66 +323,109 @@ class _QueryStats(object):
   broken = 0
   cache_lookup = 0
   expired = 0
+  # TaskToRun in one of the bot's queues but whose TaskRequest dimensions do
+  # not match the bot; each one is a wasted TaskRequest fetch.
   hash_mismatch = 0
   ignored = 0
   no_queue = 0
-  real_mismatch = 0
+  # TaskToRun yielded by _yield_potential_tasks() after a lower priority one.
+  priority_inversions = 0
   total = 0
+  # Time spent in each stage of _validate_tasks_async(), in seconds.
+  cache_lookup_secs = 0.
+  fetch_secs = 0.
+  match_secs = 0.
 
   def __str__(self):
     return (
         '%d total, %d exp %d no_queue, %d hash mismatch, %d cache negative, '
-        '%d dimensions mismatch, %d ignored, %d broken') % (
+        '%d ignored, %d broken, %d priority inversions; '
+        'cache lookup %.3fs, fetch %.3fs, match %.3fs') % (
             self.total, self.expired, self.no_queue, self.hash_mismatch,
-            self.cache_lookup, self.real_mismatch, self.ignored, self.broken)
+            self.cache_lookup, self.ignored, self.broken,
+            self.priority_inversions, self.cache_lookup_secs, self.fetch_secs,
+            self.match_secs)
 
 
 @ndb.tasklet
-def _validate_task_async(bot_dimensions, stats, now, to_run):
-  """Validates the TaskToRun and updates stats.
+def _validate_tasks_async(bot_dimensions, stats, now, to_runs):
+  """Validates a window of TaskToRun in bulk and updates stats.
+
+  It is done in three stages, each one a single RPC or CPU pass for the whole
+  window:
+  - one memcache lookup for the negative cache of all the candidates.
+  - one datastore get for the TaskRequest of the remaining candidates.
+  - match the dimensions of the TaskRequest against the bot.
 
   Returns:
-    None if the task cannot be reaped by this bot.
-    TaskRequest if this is a good candidate to reap.
+    list of (TaskRequest, TaskToRun) that are good candidates to reap, in the
+    same order as to_runs.
   """
   # TODO(maruel): Create one TaskToRun per TaskRunResult.
-  packed = task_pack.pack_request_key(
-      task_to_run_key_to_request_key(to_run.key)) + '0'
-  stats.total += 1
-
+  stats.total += len(to_runs)
+  start = time.time()
   # Do this after the basic weeding out but before fetching TaskRequest.
-  neg = yield _lookup_cache_is_taken_async(to_run.key)
-  if neg:
-    logging.debug('_validate_task_async(%s): negative cache', packed)
-    stats.cache_lookup += 1
-    raise ndb.Return((None, None))
-
-  # Ok, it's now worth taking a real look at the entity.
-  request = yield task_to_run_key_to_request_key(to_run.key).get_async()
-  props = request.task_slice(to_run.task_slice_index).properties
-
-  # The hash may have conflicts. Ensure the dimensions actually match by
-  # verifying the TaskRequest.
-  #
-  # There's a probability of 2**-31 of conflicts, which is low enough for our
-  # purpose.
-  if not match_dimensions(props.dimensions, bot_dimensions):
-    logging.debug('_validate_task_async(%s): dimensions mismatch', packed)
-    stats.real_mismatch += 1
-    raise ndb.Return((None, None))
-
-  # Expire as the bot polls by returning it, and task_scheduler will handle it.
-  if to_run.expiration_ts < now:
-    logging.debug(
-        '_validate_task_async(%s): expired %s < %s',
-        packed, to_run.expiration_ts, now)
-    stats.expired += 1
-  else:
-    # It's a valid task! Note that in the meantime, another bot may have reaped
-    # it. This is verified one last time in task_scheduler._reap_task() by
-    # calling set_lookup_cache().
-    logging.info('_validate_task_async(%s): ready to reap!', packed)
-  raise ndb.Return((request, to_run))
+  keys = [_memcache_to_run_key(to_run.key) for to_run in to_runs]
+  neg = yield memcache.Client().get_multi_async(keys, namespace='task_to_run')
+  candidates = []
+  for key, to_run in zip(keys, to_runs):
+    if neg.get(key):
+      logging.debug('_validate_tasks_async(%s): negative cache', key)
+      stats.cache_lookup += 1
+    else:
+      candidates.append(to_run)
+  fetched = time.time()
+  stats.cache_lookup_secs += fetched - start
+
+  # Ok, it's now worth taking a real look at the entities. A TaskRequest may be
+  # listed more than once, e.g. for a retry.
+  request_keys = list(set(
+      task_to_run_key_to_request_key(to_run.key) for to_run in candidates))
+  requests = yield ndb.get_multi_async(request_keys)
+  requests = dict(zip(request_keys, requests))
+  matched = time.time()
+  stats.fetch_secs += matched - fetched
+
+  out = []
+  bot_mask = task_queues.bot_dimensions_mask(bot_dimensions)
+  for to_run in candidates:
+    packed = task_pack.pack_request_key(
+        task_to_run_key_to_request_key(to_run.key)) + '0'
+    request = requests[task_to_run_key_to_request_key(to_run.key)]
+    if not request:
+      logging.warning('_validate_tasks_async(%s): missing request', packed)
+      stats.broken += 1
+      continue
+    props = request.task_slice(to_run.task_slice_index).properties
+
+    # The hash may have conflicts. Ensure the dimensions actually match by
+    # verifying the TaskRequest.
+    #
+    # Version 1 hashes have a probability of 2**-31 of conflicts, plus the ones
+    # caused by confusing keys and values. Version 2 queues have 32 bits of a
+    # hash without the ambiguity. See task_queues.hash_dimensions().
+    if not match_dimensions(props.dimensions, bot_dimensions, bot_mask):
+      logging.debug('_validate_tasks_async(%s): hash mismatch', packed)
+      stats.hash_mismatch += 1
+      ts_mon_metrics.on_dispatch_hash_mismatch(
+          1 if to_run.queue_number > 0 else 2)
+      continue
+
+    # Expire as the bot polls by returning it, and task_scheduler will handle
+    # it.
+    if to_run.expiration_ts < now:
+      logging.debug(
+          '_validate_tasks_async(%s): expired %s < %s',
+          packed, to_run.expiration_ts, now)
+      stats.expired += 1
+    else:
+      # It's a valid task! Note that in the meantime, another bot may have
+      # reaped it. This is verified one last time in task_scheduler._reap_task()
+      # by calling set_lookup_cache().
+      logging.info('_validate_tasks_async(%s): ready to reap!', packed)
+    out.append((request, to_run))
+  stats.match_secs += time.time() - matched
+  raise ndb.Return(out)
 
 
 def _yield_pages_async(q, size):
@@ -343,23 +451,318 @@ def _yield_pages_async(q, size):
 
 def _get_task_to_run_query(dimensions_hash):
   """Returns a ndb.Query of TaskToRun within this dimensions_hash queue."""
-  # dimensions_hash should be 32 bits but on AppEngine, which is using 32 bits
-  # python, it is silently upgraded to long.
-  assert isinstance(dimensions_hash, (int, long)), repr(dimensions_hash)
   opts = ndb.QueryOptions(deadline=30)
-  # See _gen_queue_number() as of why << 31. This query cannot use the key
+  # See _queue_number_base() for the layout. This query cannot use the key
   # because it is not a root entity.
+  base = _queue_number_base(dimensions_hash)
   return TaskToRun.query(default_options=opts).order(
           TaskToRun.queue_number).filter(
-              TaskToRun.queue_number >= (dimensions_hash << 31),
-              TaskToRun.queue_number < ((dimensions_hash+1) << 31))
+              TaskToRun.queue_number >= base,
+              TaskToRun.queue_number < base + (1 << 31))
+
+
+class _DispatchQueue(object):
+  """Reapable TaskToRun entities for a single dimensions_hash.
+
+  The entities are kept in a binary heap ordered by queue_number. Removed
+  entities are left in place as tombstones and skipped by the readers, so the
+  heap is only rebuilt once tombstones make up half of it.
+  """
+
+  def __init__(self, refreshed):
+    # Heap of (queue_number, sequence, TaskToRun). The sequence number breaks
+    # ties so TaskToRun entities are never compared.
+    self.heap = []
+    # ndb.Key of the TaskToRun in the heap, including the tombstones.
+    self.keys = set()
+    # ndb.Key -> utils.time_time() of the TaskToRun removed since the heap was
+    # last rebuilt.
+    self.removed = {}
+    # ndb.Key -> utils.time_time() of the TaskToRun enqueued through this
+    # instance.
+    self.local = {}
+    # utils.time_time() of the last refresh from the datastore.
+    self.refreshed = refreshed
+    # utils.time_time() of the last poll that looked at this queue.
+    self.used = refreshed
+
+  def add(self, to_run, seq):
+    if to_run.key in self.keys:
+      if to_run.key not in self.removed:
+        return
+      del self.removed[to_run.key]
+      self.heap = [e for e in self.heap if e[2].key != to_run.key]
+      heapq.heapify(self.heap)
+    self.keys.add(to_run.key)
+    heapq.heappush(self.heap, (to_run.queue_number, seq, to_run))
+
+  def remove(self, to_run_key, now):
+    if to_run_key not in self.keys or to_run_key in self.removed:
+      return
+    self.removed[to_run_key] = now
+    if len(self.removed) * 2 >= len(self.heap):
+      self.heap = [e for e in self.heap if e[2].key not in self.removed]
+      heapq.heapify(self.heap)
+      self.keys.difference_update(self.removed)
+      for key in self.removed:
+        self.local.pop(key, None)
+      self.removed = {}
+
+
+class _DispatchIndex(object):
+  """In-memory index of the reapable TaskToRun, with one heap per queue.
+
+  It is maintained incrementally by task_scheduler when tasks are enqueued,
+  reaped or expired through this instance. Since it is per instance, each queue
+  is also periodically refreshed from the datastore to pick up the changes done
+  by the other instances.
+
+  It is only an accelerator, it is never authoritative: every TaskToRun yielded
+  is still validated by _validate_tasks_async() and the reaping transaction.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    # _queue_number_base(dimensions_hash) -> _DispatchQueue.
+    self._queues = {}
+    self._seq = itertools.count()
+
+  def add(self, to_run):
+    """Adds a reapable TaskToRun to its queue, if the queue is indexed."""
+    if not to_run.queue_number:
+      return
+    base = to_run.queue_number - _queue_number_order_priority(to_run)
+    with self._lock:
+      q = self._queues.get(base)
+      if q:
+        q.add(to_run, next(self._seq))
+        q.local[to_run.key] = utils.time_time()
+
+  def remove(self, to_run_key):
+    """Removes a TaskToRun that is not reapable anymore."""
+    now = utils.time_time()
+    with self._lock:
+      for q in self._queues.values():
+        q.remove(to_run_key, now)
+
+  def clear(self):
+    with self._lock:
+      self._queues.clear()
+
+  def snapshot(self, dimensions_hashes):
+    """Returns a list of (heap copy, removed keys) for the queues requested,
+    refreshing the stale ones from the datastore first.
+    """
+    now = utils.time_time()
+    bases = [_queue_number_base(h) for h in dimensions_hashes]
+    with self._lock:
+      for base, q in list(self._queues.items()):
+        if now - q.used > _DISPATCH_INDEX_EVICT_AGE:
+          del self._queues[base]
+      stale = [
+          h for h, base in zip(dimensions_hashes, bases)
+          if (base not in self._queues or
+              now - self._queues[base].refreshed > _DISPATCH_INDEX_MAX_AGE)
+      ]
+    if stale:
+      self._refresh(stale, now)
+    out = []
+    with self._lock:
+      for base in bases:
+        q = self._queues.get(base)
+        if q:
+          q.used = now
+          out.append((list(q.heap), q.removed))
+    return out
+
+  def _refresh(self, dimensions_hashes, now):
+    """Reloads these queues from the datastore in parallel."""
+    # Note that the default ndb.EVENTUAL_CONSISTENCY is used so stale items may
+    # be returned. It's handled specifically by consumers of the index.
+    futures = [
+        _get_task_to_run_query(h).fetch_async(
+            _DISPATCH_INDEX_FETCH_LIMIT, deadline=30)
+        for h in dimensions_hashes
+    ]
+    for h, f in zip(dimensions_hashes, futures):
+      entities = f.get_result()
+      base = _queue_number_base(h)
+      with self._lock:
+        old = self._queues.get(base)
+        q = _DispatchQueue(now)
+        for to_run in entities:
+          # The ndb.Query ask for a valid queue_number but under load, it
+          # happens the value is not valid anymore.
+          if to_run.queue_number:
+            q.add(to_run, next(self._seq))
+        if old:
+          # Keep the entities recently enqueued through this instance that the
+          # eventually consistent query may have missed.
+          cutoff = now - _DISPATCH_INDEX_MAX_AGE
+          for _, _, to_run in old.heap:
+            added = old.local.get(to_run.key)
+            if added and added >= cutoff and to_run.key not in old.removed:
+              q.add(to_run, next(self._seq))
+              q.local[to_run.key] = added
+          # Same for the entities recently reaped or expired.
+          for key, removed in old.removed.items():
+            if removed >= cutoff:
+              q.remove(key, removed)
+        self._queues[base] = q
+    logging.debug(
+        '_DispatchIndex: refreshed %d queues in %.3fs', len(dimensions_hashes),
+        utils.time_time() - now)
+
+
+_DISPATCH_INDEX = _DispatchIndex()
+
+
+def _yield_indexed_tasks(bot_id, dimensions_hashes):
+  """Yields the TaskToRun from the dispatch index in strict order of priority.
+
+  This is an exact k-way merge of the per-queue heaps. Each heap is walked
+  lazily from its root, pushing the children of a node only once the node is
+  yielded, so the cost is proportional to the number of entities consumed, not
+  to the size of the queues.
+  """
+  start = utils.time_time()
+  snapshots = _DISPATCH_INDEX.snapshot(dimensions_hashes)
+  logging.debug(
+      '_yield_indexed_tasks(%s): %d items in %d queues in %.3fs', bot_id,
+      sum(len(heap) for heap, _ in snapshots), len(snapshots),
+      utils.time_time() - start)
+  # Heap of (priority, sequence, snapshot index, node index).
+  frontier = []
+  for i, (heap, _) in enumerate(snapshots):
+    if heap:
+      qn, seq, _ = heap[0]
+      frontier.append((qn & 0x7FFFFFFF, seq, i, 0))
+  heapq.heapify(frontier)
+  while frontier:
+    _, _, i, node = heapq.heappop(frontier)
+    heap, removed = snapshots[i]
+    for child in (2 * node + 1, 2 * node + 2):
+      if child < len(heap):
+        qn, seq, _ = heap[child]
+        heapq.heappush(frontier, (qn & 0x7FFFFFFF, seq, i, child))
+    to_run = heap[node][2]
+    if to_run.key not in removed:
+      yield to_run
+
+
+class _StrictQueue(object):
+  """Pages of a single task queue as read by _yield_strict_tasks()."""
+
+  def __init__(self, dimensions_hash):
+    self._pages = _yield_pages_async(
+        _get_task_to_run_query(dimensions_hash), _STRICT_PAGE_SIZE)
+    self._future = next(self._pages, None)
+    # TaskToRun fetched but not yielded yet, in order of priority.
+    self.items = collections.deque()
+    # Lowest _queue_number_order_priority() the pages not fetched yet may
+    # contain, None until the first page is fetched. The query is ordered by
+    # queue_number and all the items of a queue share the same high bits, so
+    # it is the one of the last item fetched.
+    self.watermark = None
+
+  @property
+  def exhausted(self):
+    return not self._future and not self.items
+
+  def is_blocking(self, order):
+    """Returns True if a page not fetched yet may contain a TaskToRun with a
+    higher priority than order.
+    """
+    return (
+        not self.items and bool(self._future) and
+        (self.watermark is None or self.watermark < order))
+
+  def poll(self):
+    """Buffers the page if it was fetched and prefetches the next one."""
+    if not self._future or not self._future.done():
+      return
+    page = self._future.get_result()
+    self._future = None
+    if page:
+      self.watermark = _queue_number_order_priority(page[-1])
+      # The ndb.Query ask for a valid queue_number but under load, it happens
+      # the value is not valid anymore.
+      self.items.extend(i for i in page if i.queue_number)
+    self.prefetch()
+
+  def prefetch(self):
+    """Fetches the next page if not enough items are buffered."""
+    if (self._pages and not self._future and
+        len(self.items) < _STRICT_PAGE_SIZE * _STRICT_PREFETCH_PAGES):
+      self._future = next(self._pages, None)
+      if not self._future:
+        self._pages = None
+
+
+def _yield_strict_tasks(bot_id, dimensions_hashes):
+  """Queries all the known task queues in parallel and yields the tasks in
+  strict order of priority.
+
+  A TaskToRun is only yielded once the watermark of every other queue proves it
+  has no pending TaskToRun with a higher priority, unless this takes more than
+  _STRICT_MAX_WAIT seconds in total. Only the time blocked waiting for a
+  blocking queue counts, not the time the caller spends between items. The
+  pages are prefetched ahead of the items yielded to hide the query latency.
+  """
+  start = time.time()
+  queues = [_StrictQueue(h) for h in dimensions_hashes]
+  waits = 0
+  # Seconds spent blocked waiting for the queues that hold back the strict
+  # order.
+  blocked = 0.
+  strict = True
+  while True:
+    for q in queues:
+      q.poll()
+    heads = [q for q in queues if q.items]
+    if not heads:
+      if all(q.exhausted for q in queues):
+        break
+      ndb.eventloop.run1()
+      waits += 1
+      continue
+    best = min(heads, key=lambda q: _queue_number_order_priority(q.items[0]))
+    order = _queue_number_order_priority(best.items[0])
+    if strict and any(q.is_blocking(order) for q in queues):
+      if blocked < _STRICT_MAX_WAIT:
+        t = time.time()
+        ndb.eventloop.run1()
+        blocked += time.time() - t
+        waits += 1
+        continue
+      logging.warning(
+          '_yield_strict_tasks(%s): gave up on the strict order after blocking '
+          '%.3fs', bot_id, blocked)
+      strict = False
+    yield best.items.popleft()
+    best.prefetch()
+  logging.debug(
+      '_yield_strict_tasks(%s): exhausted %d queues in %.3fs, %d waits, '
+      'blocked %.3fs', bot_id, len(queues), time.time() - start, waits, blocked)
+
+
+def _dispatch_mode():
+  """Returns how _yield_potential_tasks() reads the task queues."""
+  settings = config.settings()
+  if settings.use_dispatch_index:
+    return 'index'
+  if settings.use_strict_priority_dispatch:
+    return 'strict'
+  return 'opportunistic'
 
 
 def _yield_potential_tasks(bot_id):
   """Queries all the known task queues in parallel and yields the task in order
   of priority.
 
-  The ordering is opportunistic, not strict. There's a risk of not returning
+  Unless SettingsCfg.use_dispatch_index or use_strict_priority_dispatch is set,
+  the ordering is opportunistic, not strict. The strict ordering is only
+  waited for up to _STRICT_MAX_WAIT seconds. There's a risk of not returning
   exactly in the priority order depending on index staleness and query execution
   latency. The number of queries is unbounded.
 
@@ -373,6 +776,19 @@ def _yield_potential_tasks(bot_id):
   """
   bot_root_key = bot_management.get_root_key(bot_id)
   potential_dimensions_hashes = task_queues.get_queues(bot_root_key)
+  mode = _dispatch_mode()
+  if mode != 'opportunistic':
+    yielder = _yield_indexed_tasks if mode == 'index' else _yield_strict_tasks
+    try:
+      for to_run in yielder(bot_id, potential_dimensions_hashes):
+        yield to_run
+    except apiproxy_errors.DeadlineExceededError as e:
+      # See below.
+      logging.error(
+          'Failed to yield a task due to an RPC timeout. Returning no '
+          'task to the bot: %s', e)
+    return
+
   # Note that the default ndb.EVENTUAL_CONSISTENCY is used so stale items may be
   # returned. It's handled specifically by consumers of this function.
   start = time.time()
@@ -493,8 +909,9 @@ def new_task_to_run(request, task_slice_index):
     offset += request.task_slice(i).expiration_secs
   exp = request.created_ts + datetime.timedelta(seconds=offset)
   h = request.task_slice(task_slice_index).properties.dimensions
-  qn = _gen_queue_number(
-      task_queues.hash_dimensions(h), request.created_ts, request.priority)
+  dimensions_hash = task_queues.hash_dimensions(
+      h, request.dimensions_hash_version or 1)
+  qn = _gen_queue_number(dimensions_hash, request.created_ts, request.priority)
   return TaskToRun(
       key=request_to_task_to_run_key(request, 1, task_slice_index),
       created_ts=created,
@@ -502,17 +919,39 @@ def new_task_to_run(request, task_slice_index):
       expiration_ts=exp)
 
 
-def match_dimensions(request_dimensions, bot_dimensions):
-  """Returns True if the bot dimensions satisfies the request dimensions."""
+def match_dimensions(request_dimensions, bot_dimensions, bot_mask=None):
+  """Returns True if the bot dimensions satisfies the request dimensions.
+
+  bot_mask is task_queues.bot_dimensions_mask(bot_dimensions). It can be
+  specified to not recompute it when matching multiple requests for the same
+  bot.
+  """
   assert isinstance(request_dimensions, dict), request_dimensions
   assert isinstance(bot_dimensions, dict), bot_dimensions
   if not frozenset(request_dimensions).issubset(bot_dimensions):
     return False
 
-  bot_flat = frozenset(task_queues.bot_dimensions_to_flat(bot_dimensions))
+  if bot_mask is None:
+    bot_mask = task_queues.bot_dimensions_mask(bot_dimensions)
   return any(
-      frozenset(f).issubset(bot_flat)
-      for f in task_queues.expand_dimensions_to_flats(request_dimensions))
+      bot_mask & m == m
+      for m in task_queues.dimensions_masks(request_dimensions))
+
+
+def add_to_dispatch_index(to_run):
+  """Registers a newly enqueued TaskToRun in this instance's dispatch index.
+
+  Must be called once the TaskToRun is stored. It is a no-op if the queue is
+  not indexed yet, as it will be loaded from the datastore on first use.
+  """
+  _DISPATCH_INDEX.add(to_run)
+
+
+def remove_from_dispatch_index(to_run_key):
+  """Removes a TaskToRun that was reaped or expired from this instance's
+  dispatch index.
+  """
+  _DISPATCH_INDEX.remove(to_run_key)
 
 
 def set_lookup_cache(to_run_key, is_available_to_schedule):
@@ -569,9 +1008,17 @@ def yield_next_available_task_to_dispatch(bot_dimensions):
   now = utils.utcnow()
   stats = _QueryStats()
   bot_id = bot_dimensions[u'id'][0]
+  window = []
   futures = collections.deque()
+  # Lowest priority yielded so far by _yield_potential_tasks().
+  last_order = None
   try:
     for ttr in _yield_potential_tasks(bot_id):
+      order = _queue_number_order_priority(ttr)
+      if last_order is not None and order < last_order:
+        stats.priority_inversions += 1
+      else:
+        last_order = order
       duration = (utils.utcnow() - now).total_seconds()
       if duration > 40.:
         # Stop searching after too long, since the odds of the request blowing
@@ -581,12 +1028,16 @@ def yield_next_available_task_to_dispatch(bot_dimensions):
         # search to 40s, it gives 20s to complete the reaping and complete the
         # HTTP request.
         return
-      futures.append(_validate_task_async(bot_dimensions, stats, now, ttr))
+      window.append(ttr)
+      if len(window) < _VALIDATION_WINDOW:
+        continue
+      futures.append(
+          _validate_tasks_async(bot_dimensions, stats, now, window))
+      window = []
       while futures:
         # Keep a FIFO or LIFO queue ordering, depending on configuration.
         if futures[0].done():
-          request, task = futures[0].get_result()
-          if request and task:
+          for request, task in futures[0].get_result():
             yield request, task
             # If the code is still executed, it means that the task reaping
             # wasn't successful. Note that this includes expired ones, which is
@@ -594,14 +1045,17 @@ def yield_next_available_task_to_dispatch(bot_dimensions):
             stats.ignored += 1
           futures.popleft()
         # Don't batch too much.
-        if len(futures) < 50:
+        if len(futures) < _VALIDATION_PIPELINE:
           break
         futures[0].wait()
 
-    # No more tasks to yield. Empty the pending futures.
+    # No more tasks to yield. Validate the partial window and empty the pending
+    # futures.
+    if window:
+      futures.append(
+          _validate_tasks_async(bot_dimensions, stats, now, window))
     while futures:
-      request, task = futures[0].get_result()
-      if request and task:
+      for request, task in futures[0].get_result():
         yield request, task
         # If the code is still executed, it means that the task reaping
         # wasn't successful. Same as above about expired.
@@ -611,11 +1065,12 @@ def yield_next_available_task_to_dispatch(bot_dimensions):
     # Don't leave stray RPCs as much as possible, this can mess up following
     # HTTP handlers.
     ndb.Future.wait_all(futures)
-    # stats output is a bit misleading here, as many _validate_task_async()
+    # stats output is a bit misleading here, as many _validate_tasks_async()
     # could be started yet never yielded.
     logging.debug(
         'yield_next_available_task_to_dispatch(%s) in %.3fs: %s',
         bot_id, (utils.utcnow() - now).total_seconds(), stats)
+    ts_mon_metrics.on_dispatch_poll(_dispatch_mode(), stats.priority_inversions)
 
 
 def yield_expired_task_to_run():
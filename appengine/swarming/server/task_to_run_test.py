@@ -4,10 +4,12 @@
 # that can be found in the LICENSE file.
 
 import datetime
+import itertools
 import logging
 import os
 import random
 import sys
+import time
 import unittest
 
 # Setups environment.
@@ -21,6 +23,7 @@ from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 
 import handlers_backend
+import ts_mon_metrics
 
 from components import auth_testing
 from components import utils
@@ -159,6 +162,7 @@ class TaskToRunApiTest(test_env_handlers.AppTestBase):
     cfg = config.settings()
     cfg.use_lifo = True
     self.mock(config, 'settings', lambda: cfg)
+    task_to_run._DISPATCH_INDEX.clear()
 
   def _enqueue(self, *args, **kwargs):
     return self._enqueue_orig(*args, use_dedicated_module=False, **kwargs)
@@ -245,13 +249,19 @@ class TaskToRunApiTest(test_env_handlers.AppTestBase):
         ((1, '9998-12-31 23:59:59.999', 0), (0x80000000, 0)),
         ((1, '9998-12-31 23:59:59.999', 1), (0x80400000, 1)),
         ((1, '9998-12-31 23:59:59.999', 255), (0xbfc00000, 255)),
+        # Version 2 hashes use the negative values, seen here as unsigned.
+        ((1 << 32, '1970-01-01 00:00:00.000', 0), (0x8000000192cc0300, 75)),
+        ((0x7fffffffffffffff, '1970-01-01 00:00:00.000', 255),
+         (0xffffffffd28c0300, 330)),
     ]
     # pylint: enable=bad-whitespace
     for i, ((dimensions_hash, timestamp, priority),
             (expected_v, expected_p)) in enumerate(data):
       d = datetime.datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S.%f')
       actual = task_to_run._gen_queue_number(dimensions_hash, d, priority)
-      self.assertEqual((i, '0x%016x' % expected_v), (i, '0x%016x' % actual))
+      self.assertEqual(
+          (i, '0x%016x' % expected_v),
+          (i, '0x%016x' % (actual & 0xffffffffffffffff)))
       # Ensure we can extract the priority back. That said, it is corrupted by
       # time.
       v = task_to_run.TaskToRun(queue_number=actual)
@@ -301,6 +311,21 @@ class TaskToRunApiTest(test_env_handlers.AppTestBase):
     actual = task_to_run.new_task_to_run(request, 1).to_dict()
     self.assertEqual(expected, actual)
 
+  def test_new_task_to_run_dimensions_hash_v2(self):
+    config.settings().use_dimensions_hash_v2 = True
+    request_dimensions = {u'os': [u'Windows-3.1.1'], u'pool': [u'default']}
+    request = self.mkreq(
+        1,
+        _gen_request(
+            properties=_gen_properties(dimensions=request_dimensions),
+            priority=20,
+            created_ts=self.now))
+    self.assertEqual(2, request.dimensions_hash_version)
+    to_run = task_to_run.new_task_to_run(request, 0)
+    # Same priority part as in test_new_task_to_run().
+    self.assertEqual('0xd546d52f97bd248e', to_run.to_dict()['queue_number'])
+    self.assertTrue(to_run.is_reapable)
+
   def test_new_task_to_run_limits(self):
     # Generate a TaskRequest with eight TaskSlice.
     slices = [
@@ -745,6 +770,113 @@ class TaskToRunApiTest(test_env_handlers.AppTestBase):
     actual = _yield_next_available_task_to_dispatch(bot_dimensions)
     self.assertEqual(expected, actual)
 
+  def test_yield_next_available_task_to_dispatch_batched(self):
+    # All the candidates are validated with a single memcache and datastore
+    # lookup; the negative cache still applies and the order is preserved.
+    request_dimensions = {u'os': [u'Windows-3.1.1'], u'pool': [u'default']}
+    to_runs = []
+    for i in range(3):
+      self.mock_now(self.now, i)
+      request = self.mkreq(
+          int(not i),
+          _gen_request(
+              properties=_gen_properties(dimensions=request_dimensions)))
+      to_run = task_to_run.new_task_to_run(request, 0)
+      to_run.put()
+      to_runs.append(to_run)
+    task_to_run.set_lookup_cache(to_runs[1].key, False)
+
+    calls = []
+    orig = task_to_run._validate_tasks_async
+    def validate_tasks_async(bot_dimensions, stats, now, window):
+      calls.append(len(window))
+      return orig(bot_dimensions, stats, now, window)
+    self.mock(task_to_run, '_validate_tasks_async', validate_tasks_async)
+
+    bot_dimensions = {
+        u'id': [u'localhost'],
+        u'os': [u'Windows-3.1.1'],
+        u'pool': [u'default'],
+    }
+    actual = _yield_next_available_task_to_dispatch(bot_dimensions)
+    # LIFO.
+    expected = [
+        '0x%016x' % to_runs[2].queue_number,
+        '0x%016x' % to_runs[0].queue_number,
+    ]
+    self.assertEqual(expected, [i['queue_number'] for i in actual])
+    self.assertEqual([3], calls)
+
+  def test_yield_next_available_task_to_dispatch_dimensions_hash_v2(self):
+    # Tasks enqueued with both versions of the dimensions hash are dispatched
+    # together, in order of priority.
+    request_dimensions = {u'os': [u'Windows-3.1.1'], u'pool': [u'default']}
+    self._gen_new_task_to_run(
+        1,
+        properties=_gen_properties(dimensions=request_dimensions),
+        priority=10)
+    config.settings().use_dimensions_hash_v2 = True
+    self.mock_now(self.now, 60)
+    # It's a new task queue.
+    self._gen_new_task_to_run(
+        1,
+        properties=_gen_properties(dimensions=request_dimensions),
+        priority=20)
+    bot_dimensions = {
+        u'id': [u'localhost'],
+        u'os': [u'Windows-3.1.1'],
+        u'pool': [u'default'],
+    }
+    actual = _yield_next_available_task_to_dispatch(bot_dimensions)
+    expected = ['0x1a3aa663153d248e', '0xd546d52f97bd2236']
+    self.assertEqual(expected, [i['queue_number'] for i in actual])
+    bot_root_key = bot_management.get_root_key(u'localhost')
+    self.assertEqual(
+        [1, 2],
+        sorted(
+            task_queues.dimensions_hash_version(h)
+            for h in task_queues.get_queues(bot_root_key)))
+
+  def test_yield_next_available_task_to_dispatch_hash_mismatch(self):
+    mismatches = []
+    self.mock(ts_mon_metrics, 'on_dispatch_hash_mismatch', mismatches.append)
+    # These two dimensions have the same version 1 hash.
+    request_dimensions_1 = {
+        u'os': [u'Windows-3.1.1', u'p', u'x'],
+        u'pool': [u'default'],
+    }
+    request_dimensions_2 = {
+        u'os': [u'Windows-3.1.1'],
+        u'p': [u'x'],
+        u'pool': [u'default'],
+    }
+    bot_dimensions = {
+        u'id': [u'localhost'],
+        u'os': [u'Windows-3.1.1'],
+        u'p': [u'x'],
+        u'pool': [u'default'],
+    }
+    self._gen_new_task_to_run(
+        1, properties=_gen_properties(dimensions=request_dimensions_1))
+    self._gen_new_task_to_run(
+        1, properties=_gen_properties(dimensions=request_dimensions_2))
+    actual = _yield_next_available_task_to_dispatch(bot_dimensions)
+    self.assertEqual(1, len(actual))
+    self.assertEqual([1], mismatches)
+
+    # With the version 2 hash, the task queues are not shared anymore.
+    config.settings().use_dimensions_hash_v2 = True
+    task_queues.cleanup_after_bot(bot_management.get_root_key(u'localhost'))
+    self.mock_now(self.now, 60)
+    self._gen_new_task_to_run(
+        1, properties=_gen_properties(dimensions=request_dimensions_1))
+    self._gen_new_task_to_run(
+        1, properties=_gen_properties(dimensions=request_dimensions_2))
+    actual = _yield_next_available_task_to_dispatch(bot_dimensions)
+    self.assertEqual(2, len(actual))
+    # Only the version 1 task is a mismatch.
+    self.assertEqual([1, 1], mismatches)
+
   def test_yield_next_available_task_to_dispatch_fifo(self):
     cfg = config.settings()
     cfg.use_lifo = False
@@ -880,6 +1012,115 @@ class TaskToRunApiTest(test_env_handlers.AppTestBase):
     actual = _yield_next_available_task_to_dispatch(bot_dimensions)
     self.assertEqual(expected, actual)
 
+  def test_yield_next_available_task_to_dispatch_strict(self):
+    # The order is strict across the queues, even when the queues are read one
+    # item at a time.
+    config.settings().use_strict_priority_dispatch = True
+    self.mock(task_to_run, '_STRICT_PAGE_SIZE', 1)
+    self.mock(task_to_run, '_STRICT_PREFETCH_PAGES', 1)
+    polls = []
+    self.mock(
+        ts_mon_metrics, 'on_dispatch_poll', lambda *args: polls.append(args))
+    request_dimensions_1 = {u'os': [u'Windows-3.1.1'], u'pool': [u'default']}
+    request_dimensions_2 = {u'id': [u'localhost'], u'pool': [u'default']}
+    self._gen_new_task_to_run(
+        1,
+        properties=_gen_properties(dimensions=request_dimensions_1),
+        priority=10)
+    self.mock_now(self.now, 60)
+    self._gen_new_task_to_run(
+        0,
+        properties=_gen_properties(dimensions=request_dimensions_2),
+        priority=50)
+    self.mock_now(self.now, 120)
+    self._gen_new_task_to_run(
+        0,
+        properties=_gen_properties(dimensions=request_dimensions_1),
+        priority=20)
+    self.mock_now(self.now, 180)
+    self._gen_new_task_to_run(
+        0,
+        properties=_gen_properties(dimensions=request_dimensions_1),
+        priority=60)
+
+    bot_dimensions = {
+        u'id': [u'localhost'],
+        u'os': [u'Windows-3.1.1'],
+        u'pool': [u'default'],
+    }
+    actual = _yield_next_available_task_to_dispatch(bot_dimensions)
+    expected = [
+        '0x1a3aa663153d248e',
+        '0x1a3aa66317bd1fde',
+        '0x5385bf749f3d2236',
+        '0x1a3aa66321bd1d86',
+    ]
+    self.assertEqual(expected, [i['queue_number'] for i in actual])
+    self.assertEqual([('strict', 0)], polls)
+
+  def test_yield_next_available_task_to_dispatch_strict_max_wait(self):
+    # Once _STRICT_MAX_WAIT elapsed, the tasks already fetched are yielded
+    # without waiting for the other queues but none is lost.
+    config.settings().use_strict_priority_dispatch = True
+    self.mock(task_to_run, '_STRICT_PAGE_SIZE', 1)
+    self.mock(task_to_run, '_STRICT_PREFETCH_PAGES', 1)
+    self.mock(task_to_run, '_STRICT_MAX_WAIT', 0)
+    request_dimensions_1 = {u'os': [u'Windows-3.1.1'], u'pool': [u'default']}
+    request_dimensions_2 = {u'id': [u'localhost'], u'pool': [u'default']}
+    self._gen_new_task_to_run(
+        1,
+        properties=_gen_properties(dimensions=request_dimensions_1),
+        priority=10)
+    self.mock_now(self.now, 60)
+    self._gen_new_task_to_run(
+        0,
+        properties=_gen_properties(dimensions=request_dimensions_2),
+        priority=50)
+    self.mock_now(self.now, 120)
+    self._gen_new_task_to_run(
+        0,
+        properties=_gen_properties(dimensions=request_dimensions_1),
+        priority=20)
+
+    bot_dimensions = {
+        u'id': [u'localhost'],
+        u'os': [u'Windows-3.1.1'],
+        u'pool': [u'default'],
+    }
+    actual = _yield_next_available_task_to_dispatch(bot_dimensions)
+    expected = [
+        '0x1a3aa663153d248e',
+        '0x1a3aa66317bd1fde',
+        '0x5385bf749f3d2236',
+    ]
+    self.assertEqual(expected, sorted(i['queue_number'] for i in actual))
+
+  def test_yield_next_available_task_to_dispatch_priority_inversions(self):
+    polls = []
+    self.mock(
+        ts_mon_metrics, 'on_dispatch_poll', lambda *args: polls.append(args))
+    request_dimensions = {u'os': [u'Windows-3.1.1'], u'pool': [u'default']}
+    _, to_run_1 = self._gen_new_task_to_run(
+        1,
+        properties=_gen_properties(dimensions=request_dimensions),
+        priority=10)
+    _, to_run_2 = self._gen_new_task_to_run(
+        0,
+        properties=_gen_properties(dimensions=request_dimensions),
+        priority=20)
+    # Simulates a slow query for the higher priority task.
+    self.mock(
+        task_to_run, '_yield_potential_tasks',
+        lambda _bot_id: iter([to_run_2, to_run_1]))
+    bot_dimensions = {
+        u'id': [u'localhost'],
+        u'os': [u'Windows-3.1.1'],
+        u'pool': [u'default'],
+    }
+    self.assertEqual(
+        2, len(_yield_next_available_task_to_dispatch(bot_dimensions)))
+    self.assertEqual([('opportunistic', 1)], polls)
+
   def test_yield_next_available_task_to_run_task_terminate(self):
     request_dimensions = {u'id': [u'fake-id']}
     _request, task = self._gen_new_task_to_run(
@@ -983,6 +1224,107 @@ class TaskToRunApiTest(test_env_handlers.AppTestBase):
     to_run.put()
     self.assertEqual(False, to_run.is_reapable)
 
+  def _enable_dispatch_index(self):
+    cfg = config.settings()
+    cfg.use_dispatch_index = True
+    self.mock(config, 'settings', lambda: cfg)
+    self.time = 1000.
+    self.mock(utils, 'time_time', lambda: self.time)
+
+  def test_add_to_dispatch_index(self):
+    self._enable_dispatch_index()
+    request_dimensions = {u'os': [u'Windows-3.1.1'], u'pool': [u'default']}
+    self._gen_new_task_to_run(
+        1,
+        properties=_gen_properties(dimensions=request_dimensions),
+        priority=50)
+    bot_dimensions = {
+        u'id': [u'localhost'],
+        u'os': [u'Windows-3.1.1'],
+        u'pool': [u'default'],
+    }
+    # This primes the index for the queue.
+    actual = _yield_next_available_task_to_dispatch(bot_dimensions)
+    self.assertEqual(['0x1a3aa6631f3d248e'], [i['queue_number'] for i in actual])
+
+    # A higher priority task is enqueued. It is not visible until either it is
+    # added to the index or the queue is refreshed.
+    self.mock_now(self.now, 60)
+    request = self.mkreq(
+        0,
+        _gen_request(
+            properties=_gen_properties(dimensions=request_dimensions),
+            priority=10))
+    to_run = task_to_run.new_task_to_run(request, 0)
+    to_run.put()
+    actual = _yield_next_available_task_to_dispatch(bot_dimensions)
+    self.assertEqual(['0x1a3aa6631f3d248e'], [i['queue_number'] for i in actual])
+
+    task_to_run.add_to_dispatch_index(to_run)
+    actual = _yield_next_available_task_to_dispatch(bot_dimensions)
+    expected = ['0x1a3aa663153d2236', '0x1a3aa6631f3d248e']
+    self.assertEqual(expected, [i['queue_number'] for i in actual])
+
+  def test_remove_from_dispatch_index(self):
+    self._enable_dispatch_index()
+    request_dimensions = {u'os': [u'Windows-3.1.1'], u'pool': [u'default']}
+    _, to_run = self._gen_new_task_to_run(
+        1, properties=_gen_properties(dimensions=request_dimensions))
+    bot_dimensions = {
+        u'id': [u'localhost'],
+        u'os': [u'Windows-3.1.1'],
+        u'pool': [u'default'],
+    }
+    self.assertEqual(
+        1, len(_yield_next_available_task_to_dispatch(bot_dimensions)))
+    task_to_run.remove_from_dispatch_index(to_run.key)
+    self.assertEqual([], _yield_next_available_task_to_dispatch(bot_dimensions))
+    # Removing twice or an unknown key is fine.
+    task_to_run.remove_from_dispatch_index(to_run.key)
+
+    # The queue is refreshed from the DB once it is stale.
+    self.time += task_to_run._DISPATCH_INDEX_MAX_AGE + 1
+    self.assertEqual(
+        1, len(_yield_next_available_task_to_dispatch(bot_dimensions)))
+
+  def test_yield_next_available_task_to_dispatch_dispatch_index(self):
+    # Same as test_yield_next_available_task_to_dispatch_multi_priority() but
+    # through the dispatch index; the order is strict across the queues.
+    self._enable_dispatch_index()
+    request_dimensions_1 = {u'os': [u'Windows-3.1.1'], u'pool': [u'default']}
+    self._gen_new_task_to_run(
+        1,
+        properties=_gen_properties(dimensions=request_dimensions_1),
+        priority=10)
+    self.mock_now(self.now, 60)
+    request_dimensions_2 = {u'id': [u'localhost'], u'pool': [u'default']}
+    request2 = self.mkreq(
+        0,
+        _gen_request(
+            properties=_gen_properties(dimensions=request_dimensions_2),
+            priority=50))
+    task_to_run.new_task_to_run(request2, 0).put()
+    self.mock_now(self.now, 120)
+    request3 = self.mkreq(
+        0,
+        _gen_request(
+            properties=_gen_properties(dimensions=request_dimensions_1),
+            priority=20))
+    task_to_run.new_task_to_run(request3, 0).put()
+
+    bot_dimensions = {
+        u'id': [u'localhost'],
+        u'os': [u'Windows-3.1.1'],
+        u'pool': [u'default'],
+    }
+    actual = _yield_next_available_task_to_dispatch(bot_dimensions)
+    expected = [
+        '0x1a3aa663153d248e',
+        '0x1a3aa66317bd1fde',
+        '0x5385bf749f3d2236',
+    ]
+    self.assertEqual(expected, [i['queue_number'] for i in actual])
+
   def test_set_lookup_cache(self):
     # Create two TaskToRun on the same TaskRequest and assert that affecting one
     # negative cache entry doesn't affect the other.
@@ -1017,6 +1359,78 @@ class TaskToRunApiTest(test_env_handlers.AppTestBase):
     to_run.put()
 
 
+@unittest.skipUnless(
+    os.environ.get('SWARMING_BENCHMARK'), 'set SWARMING_BENCHMARK=1 to run')
+class TaskToRunBenchmarkTest(test_env_handlers.AppTestBase):
+  """Compares polling through the datastore queries and the dispatch index.
+
+  Run with: SWARMING_BENCHMARK=1 ./task_to_run_test.py TaskToRunBenchmarkTest
+  """
+  # Number of queues the bot can run tasks from.
+  QUEUES = 500
+  # Number of pending TaskToRun across all the queues.
+  TASKS = 10000
+  # Number of TaskToRun consumed per poll.
+  POLLED = 50
+
+  def setUp(self):
+    super(TaskToRunBenchmarkTest, self).setUp()
+    self.now = datetime.datetime(2019, 01, 02, 03, 04, 05, 06)
+    self.mock_now(self.now)
+    task_to_run._DISPATCH_INDEX.clear()
+    rnd = random.Random(0)
+    self.hashes = [i + 1 for i in range(self.QUEUES)]
+    entities = []
+    for i in range(self.TASKS):
+      created = self.now - datetime.timedelta(seconds=rnd.randint(0, 3600))
+      request_key = ndb.Key(task_request.TaskRequest, 0x7fffffffffff0000 - i)
+      entities.append(
+          task_to_run.TaskToRun(
+              key=ndb.Key(task_to_run.TaskToRun, 1, parent=request_key),
+              created_ts=created,
+              queue_number=task_to_run._gen_queue_number(
+                  self.hashes[i % self.QUEUES], created, rnd.randint(0, 255)),
+              expiration_ts=self.now + datetime.timedelta(hours=1)))
+    ndb.put_multi(entities)
+    self.expected = sorted(
+        entities, key=task_to_run._queue_number_order_priority)[:self.POLLED]
+    self.mock(task_queues, 'get_queues', lambda _: self.hashes)
+    self.queries = 0
+    orig = task_to_run._get_task_to_run_query
+    def get_task_to_run_query(dimensions_hash):
+      self.queries += 1
+      return orig(dimensions_hash)
+    self.mock(task_to_run, '_get_task_to_run_query', get_task_to_run_query)
+
+  def _bench(self, use_dispatch_index, polls):
+    cfg = config.settings()
+    cfg.use_dispatch_index = use_dispatch_index
+    self.mock(config, 'settings', lambda: cfg)
+    self.queries = 0
+    start = time.time()
+    for _ in range(polls):
+      actual = list(
+          itertools.islice(
+              task_to_run._yield_potential_tasks(u'bot1'), self.POLLED))
+    duration = time.time() - start
+    sys.stdout.write(
+        '\n%s: %d polls in %.3fs (%.1fms/poll), %d queries\n' %
+        ('dispatch index' if use_dispatch_index else 'queries', polls,
+         duration, duration * 1000. / polls, self.queries))
+    return actual
+
+  def test_compare(self):
+    polls = 10
+    by_query = self._bench(False, polls)
+    by_index = self._bench(True, polls)
+    # The dispatch index is exact, unlike the query path that is best effort.
+    self.assertEqual(
+        [i.key for i in self.expected], [i.key for i in by_index])
+    self.assertEqual(self.POLLED, len(by_query))
+    # Only the first poll hits the DB.
+    self.assertEqual(self.QUEUES, self.queries)
+
+
 if __name__ == '__main__':
   if '-v' in sys.argv:
     unittest.TestCase.maxDiff = None
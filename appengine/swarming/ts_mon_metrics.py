@@ -243,6 +243,29 @@ _bot_auth_successes = gae_ts_mon.CounterMetric(
     ])
 
 
+# Instance metric. Metric fields:
+# - hash_version = version of task_queues.hash_dimensions() of the queue.
+_dispatch_hash_mismatches = gae_ts_mon.CounterMetric(
+    'swarming/tasks/dispatch/hash_mismatch',
+    'Number of TaskRequest fetched while polling for a bot whose dimensions do '
+    'not match the bot, e.g. because of a dimensions hash collision', [
+        gae_ts_mon.IntegerField('hash_version'),
+    ])
+
+
+# Instance metric. Metric fields:
+# - mode = how the task queues are read, one of 'index', 'strict' or
+#   'opportunistic'.
+_dispatch_priority_inversions = gae_ts_mon.CumulativeDistributionMetric(
+    'swarming/tasks/dispatch/priority_inversions',
+    'Number of TaskToRun considered for a bot after a lower priority one, per '
+    'poll', [
+        gae_ts_mon.StringField('mode'),
+    ],
+    bucketer=gae_ts_mon.FixedWidthBucketer(width=1),
+)
+
+
 ### Private stuff.
 
 
@@ -503,6 +526,15 @@ def on_bot_auth_success(auth_method, condition):
   })
 
 
+def on_dispatch_hash_mismatch(hash_version):
+  _dispatch_hash_mismatches.increment(fields={'hash_version': hash_version})
+
+
+def on_dispatch_poll(mode, priority_inversions):
+  _dispatch_priority_inversions.add(
+      priority_inversions, fields={'mode': mode})
+
+
 def set_global_metrics(kind, payload=None):
   if kind == 'jobs':
     _set_jobs_metrics(payload)
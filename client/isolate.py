@@ -47,6 +47,7 @@ import six
 from utils import logging_utils
 from utils import file_path
 from utils import fs
+from utils import hash_index
 from utils import subprocess42
 
 
@@ -578,12 +579,15 @@ class CompleteState(object):
     self.saved_state.update_isolated(command, infiles, relative_cwd)
     logging.debug(self)
 
-  def files_to_metadata(self, subdir, collapse_symlinks):
+  def files_to_metadata(self, subdir, collapse_symlinks, index=None):
     """Updates self.saved_state.files with the files' mode and hash.
 
     If |subdir| is specified, filters to a subdirectory. The resulting .isolated
     file is tainted.
 
+    If |index| is specified, files that didn't change since they were last
+    hashed are not read again.
+
     See isolated_format.file_to_metadata() for more information.
     """
     for infile in sorted(self.saved_state.files):
@@ -591,14 +595,14 @@ class CompleteState(object):
         self.saved_state.files.pop(infile)
       else:
         filepath = os.path.join(self.root_dir, infile)
-        # This code used to try to reuse the previous data if possible in
-        # saved_state. This performance optimization is not done anymore. This
-        # code is going away soon and shouldn't be used in new code.
+        # Reusing the previous data in saved_state is not done anymore; the
+        # hash index, keyed on the file's stat(), is used instead.
         meta = isolated_format.file_to_metadata(
             filepath,
             collapse_symlinks)
         if 'l' not in meta:
-          meta['h'] = isolated_format.hash_file(filepath, self.saved_state.algo)
+          meta['h'] = isolated_format.hash_file(
+              filepath, self.saved_state.algo, index)
         self.saved_state.files[infile] = meta
 
   def save_files(self):
@@ -634,7 +638,7 @@ class CompleteState(object):
     return out
 
 
-def load_complete_state(options, cwd, subdir, skip_update):
+def load_complete_state(options, cwd, subdir, skip_update, index=None):
   """Loads a CompleteState.
 
   This includes data from .isolate and .isolated.state files. Never reads the
@@ -649,6 +653,7 @@ def load_complete_state(options, cwd, subdir, skip_update):
             to CompleteState.root_dir.
     skip_update: Skip trying to load the .isolate file and processing the
                  dependencies. It is useful when not needed, like when tracing.
+    index: optional hash_index.HashIndex used when hashing the files.
   """
   assert not options.isolate or os.path.isabs(options.isolate)
   assert not options.isolated or os.path.isabs(options.isolated)
@@ -712,7 +717,8 @@ def load_complete_state(options, cwd, subdir, skip_update):
     subdir = subdir.replace('/', os.path.sep)
 
   if not skip_update:
-    complete_state.files_to_metadata(subdir, options.collapse_symlinks)
+    complete_state.files_to_metadata(subdir, options.collapse_symlinks,
+                                     index)
   return complete_state
 
 
@@ -739,10 +745,10 @@ def create_isolate_tree(outdir, root_dir, files, relative_cwd):
 
 
 @tools.profile
-def prepare_for_archival(options, cwd):
+def prepare_for_archival(options, cwd, index=None):
   """Loads the isolated file and create |infiles| for archival."""
   complete_state = load_complete_state(
-      options, cwd, options.subdir, False)
+      options, cwd, options.subdir, False, index)
   # Make sure that complete_state isn't modified until save_files() is
   # called, because any changes made to it here will propagate to the files
   # created (which is probably not intended).
@@ -830,13 +836,14 @@ def _expand_directories_and_symlinks(indir, infiles, denylist, follow_symlinks,
   return out
 
 
-def isolate_and_archive(trees, server_ref):
+def isolate_and_archive(trees, server_ref, index=None):
   """Isolates and uploads a bunch of isolated trees.
 
   Args:
     trees: list of pairs (Options, working directory) that describe what tree
         to isolate. Options are processed by 'process_isolate_options'.
     server_ref: isolate_storage.ServerRef instance.
+    index: optional hash_index.HashIndex shared by all the trees.
 
   Returns a dict {target name -> isolate hash or None}, where target name is
   a name of *.isolated file without an extension (e.g. 'base_unittests').
@@ -866,7 +873,8 @@ def isolate_and_archive(trees, server_ref):
     for opts, cwd in trees:
       target_name = os.path.splitext(os.path.basename(opts.isolated))[0]
       try:
-        complete_state, files, isolated_hash = prepare_for_archival(opts, cwd)
+        complete_state, files, isolated_hash = prepare_for_archival(
+            opts, cwd, index)
         files_generators.append(emit_files(complete_state.root_dir, files))
         isolated_hashes[target_name] = isolated_hash[0]
         print('%s  %s' % (isolated_hash[0], target_name))
@@ -891,6 +899,13 @@ def isolate_and_archive(trees, server_ref):
   return isolated_hashes
 
 
+def _load_hash_index(options):
+  """Returns the hash_index.HashIndex specified by --hash-index, if any."""
+  if not options.hash_index:
+    return None
+  return hash_index.HashIndex.load(options.hash_index)
+
+
 def parse_archive_command_line(args, cwd):
   """Given list of arguments for 'archive' command returns parsed options.
 
@@ -927,8 +942,13 @@ def CMDarchive(parser, args):
   isolateserver.process_isolate_server_options(parser, options, True)
   server_ref = isolate_storage.ServerRef(
       options.isolate_server, options.namespace)
-  result = isolate_and_archive([(options, six.text_type(os.getcwd()))],
-                               server_ref)
+  index = _load_hash_index(options)
+  try:
+    result = isolate_and_archive([(options, six.text_type(os.getcwd()))],
+                                 server_ref, index)
+  finally:
+    if index is not None:
+      index.save(options.hash_index)
   if result is None:
     return EXIT_CODE_UPLOAD_ERROR
   assert len(result) == 1, result
@@ -989,7 +1009,12 @@ def CMDbatcharchive(parser, args):
   # Perform the archival, all at once.
   server_ref = isolate_storage.ServerRef(
       options.isolate_server, options.namespace)
-  isolated_hashes = isolate_and_archive(work_units, server_ref)
+  index = _load_hash_index(options)
+  try:
+    isolated_hashes = isolate_and_archive(work_units, server_ref, index)
+  finally:
+    if index is not None:
+      index.save(options.hash_index)
 
   # TODO(vadimsh): isolate_and_archive returns None on upload failure, there's
   # no way currently to figure out what *.isolated file from a batch were
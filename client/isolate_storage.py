@@ -7,11 +7,11 @@
 
 import base64
 import hashlib
+import json
 import logging
 import re
-import sys
+import struct
 import threading
-import time
 import types
 
 from utils import file_path
@@ -21,6 +21,7 @@ import isolated_format
 
 # third_party/
 import six
+from six.moves import urllib
 
 # Chunk size to use when reading from network stream.
 NET_IO_FILE_CHUNK = 16 * 1024
@@ -31,6 +32,18 @@ NET_IO_FILE_CHUNK = 16 * 1024
 DOWNLOAD_READ_TIMEOUT = 60
 
 
+# Frame types of a retrieve_batch response, see RetrieveBatchHandler in
+# appengine/isolate/handlers_endpoints_v1.py.
+_BATCH_CONTENT = 0
+_BATCH_URL = 1
+_BATCH_FRAME = struct.Struct('>BI')
+
+
+# Default maximum number of bytes of item content held in memory at once by
+# concurrent uploads. Only uploads inlined in an API call are buffered; uploads
+# to Google Storage are streamed and do not count against it.
+UPLOAD_MEMORY_BUDGET = 256 * 1024 * 1024
+
 
 class ServerRef(object):
   """ServerRef is a reference to the remote cache.
@@ -166,6 +179,23 @@ class StorageApi(object):
     """
     raise NotImplementedError()
 
+  def fetch_batch(self, digests):
+    """Fetches many small objects in a single round trip.
+
+    It is an optimization; the objects that are not returned must be fetched
+    with fetch().
+
+    Arguments:
+      digests: list of hash digests of items to download.
+
+    Returns:
+      dict of digest -> iterable of chunks of the item, for the items fetched.
+
+    Raises:
+      IOError if the request failed.
+    """
+    return {}
+
   def push(self, item, push_state, content=None):
     """Uploads an |item| with content generated by |content| generator.
 
@@ -183,10 +213,15 @@ class StorageApi(object):
     a source of original uncompressed data). This is implemented by Storage
     class.
 
+    |content| should preferably be a callable returning a new generator each
+    time it is called, so the data can be streamed and re-read on retry
+    instead of being buffered in memory.
+
     Arguments:
       item: Item object that holds information about an item being pushed.
       push_state: push state object as returned by 'contains' call.
-      content: a generator that yields chunks to push, item.content() if None.
+      content: a callable returning a generator of chunks to push, a list of
+          chunks or a generator; item.content if None.
 
     Returns:
       None.
@@ -226,53 +261,54 @@ class _IsolateServerPushState(object):
     self.size = size
 
 
-def guard_memory_use(server, content, size):
-  """Guards a server against using excessive memory while uploading.
-
-  The server needs to contain a _memory_use int and a _lock mutex; this function
-  then uses those values to track memory usage in a thread-safe way.
+class MemoryBudget(object):
+  """Limits the memory used by concurrent uploads that buffer their content.
 
-  If a request would cause the memory usage to exceed a safe maximum,
-  this function sleeps in 0.1s increments until memory usage falls
-  below the maximum.
+  A request larger than the whole budget is admitted when nothing else is in
+  flight, so a single large item can't deadlock.
   """
-  if isinstance(content, (six.string_types, list)):
-    # Memory is already used, too late.
-    with server._lock:
-      server._memory_use += size
-  else:
-    # TODO(vadimsh): Do not read from |content| generator when retrying push.
-    # If |content| is indeed a generator, it can not be re-winded back to the
-    # beginning of the stream. A retry will find it exhausted. A possible
-    # solution is to wrap |content| generator with some sort of caching
-    # restartable generator. It should be done alongside streaming support
-    # implementation.
-    #
-    # In theory, we should keep the generator, so that it is not serialized in
-    # memory. Sadly net.HttpService.request() requires the body to be
-    # serialized.
-    assert isinstance(content, types.GeneratorType), repr(content)
-    slept = False
-    # HACK HACK HACK. Please forgive me for my sins but OMG, it works!
-    # One byte less than 512mb. This is to cope with incompressible content.
-    max_size = int(sys.maxsize * 0.25)
-    while True:
-      with server._lock:
-        # This is due to 32 bits python when uploading very large files. The
-        # problem is that it's comparing uncompressed sizes, while we care
-        # about compressed sizes since it's what is serialized in memory.
-        # The first check assumes large files are compressible and that by
-        # throttling one upload at once, we can survive. Otherwise, kaboom.
-        memory_use = server._memory_use
-        if ((size >= max_size and not memory_use) or
-            (memory_use + size <= max_size)):
-          server._memory_use += size
-          memory_use = server._memory_use
-          break
-      time.sleep(0.1)
-      slept = True
-    if slept:
-      logging.info('Unblocked: %d %d', memory_use, size)
+
+  def __init__(self, limit):
+    self._limit = limit
+    self._used = 0
+    self._cond = threading.Condition()
+
+  @property
+  def used(self):
+    return self._used
+
+  def acquire(self, size):
+    """Blocks until |size| bytes can be used without exceeding the budget."""
+    with self._cond:
+      waited = False
+      while self._used and self._used + size > self._limit:
+        waited = True
+        self._cond.wait(1)
+      self._used += size
+      if waited:
+        logging.info('Unblocked: %d %d', self._used, size)
+
+  def release(self, size):
+    """Returns |size| bytes to the budget."""
+    with self._cond:
+      self._used -= size
+      assert self._used >= 0, self._used
+      self._cond.notify_all()
+
+
+def _content_factory(item, content):
+  """Returns a callable returning a new iterable over the content to push."""
+  if content is None:
+    return item.content
+  if callable(content):
+    return content
+  if isinstance(content, bytes):
+    return lambda: [content]
+  if isinstance(content, types.GeneratorType):
+    # A generator can't be rewound, buffer it so retries can re-read it.
+    data = b''.join(content)
+    return lambda: [data]
+  return lambda: content
 
 
 class IsolateServer(StorageApi):
@@ -282,7 +318,13 @@ class IsolateServer(StorageApi):
   Works only within single namespace.
   """
 
-  def __init__(self, server_ref):
+  def __init__(self, server_ref, memory_budget=None):
+    """
+    Args:
+      server_ref: ServerRef instance.
+      memory_budget: maximum number of bytes buffered by concurrent inline
+          uploads, UPLOAD_MEMORY_BUDGET if None.
+    """
     super(IsolateServer, self).__init__()
     # Handle the specific internal use case.
     assert (isinstance(server_ref, ServerRef) or
@@ -296,7 +338,12 @@ class IsolateServer(StorageApi):
     }
     self._lock = threading.Lock()
     self._server_caps = None
-    self._memory_use = 0
+    self._memory_budget = MemoryBudget(
+        UPLOAD_MEMORY_BUDGET if memory_budget is None else memory_budget)
+    # Set when the server doesn't implement retrieve_batch.
+    self._batch_unsupported = False
+    # Set when the server doesn't implement retrieve_raw and store_inline_raw.
+    self._raw_unsupported = False
 
   @property
   def _server_capabilities(self):
@@ -325,6 +372,31 @@ class IsolateServer(StorageApi):
 
   def fetch(self, digest, _size, offset):
     assert offset >= 0
+    if not self._raw_unsupported:
+      source_url = '%s/api/isolateservice/v1/retrieve_raw/%s/%s?offset=%d' % (
+          self.server_ref.url, self.server_ref.namespace,
+          six.ensure_str(digest), offset)
+      logging.debug('download_file(%s)', source_url)
+      connection = net.url_open(
+          source_url,
+          expected_error_codes=(404,),
+          follow_redirects=False,
+          read_timeout=DOWNLOAD_READ_TIMEOUT)
+      if not connection:
+        raise IOError(
+            'Attempted to fetch from %s; no data exist: %s / %s.' % (
+              source_url, self.server_ref.namespace, digest))
+      if connection.code != 404:
+        location = connection.get_header('Location')
+        source = (
+            self._fetch_url(digest, location, offset) if location else
+            connection.iter_content(NET_IO_FILE_CHUNK))
+        for data in source:
+          yield data
+        return
+      # Either the item is missing or the server doesn't implement retrieve_raw,
+      # the JSON API below tells which.
+
     source_url = '%s/_ah/api/isolateservice/v1/retrieve' % (
         self.server_ref.url)
     logging.debug('download_file(%s, %d)', source_url, offset)
@@ -334,6 +406,9 @@ class IsolateServer(StorageApi):
       raise IOError(
           'Attempted to fetch from %s; no data exist: %s / %s.' % (
             source_url, self.server_ref.namespace, digest))
+    if not self._raw_unsupported:
+      logging.info('%s does not support retrieve_raw', self.server_ref.url)
+      self._raw_unsupported = True
 
     # for DB uploads
     content = response.get('content')
@@ -346,7 +421,56 @@ class IsolateServer(StorageApi):
           'Invalid response while fetching %s: %s' % (digest, response))
 
     # for GS entities
-    connection = net.url_open(response['url'])
+    for data in self._fetch_url(digest, response['url'], offset):
+      yield data
+
+  def fetch_batch(self, digests):
+    if self._batch_unsupported:
+      return {}
+    url = '%s/api/isolateservice/v1/retrieve_batch' % self.server_ref.url
+    response = net.url_open(
+        url,
+        data={
+            'digests': [six.ensure_str(d, encoding='utf-8') for d in digests],
+            'namespace': self.server_ref.namespace,
+        },
+        content_type=net.JSON_CONTENT_TYPE,
+        expected_error_codes=(404,),
+        read_timeout=DOWNLOAD_READ_TIMEOUT,
+        stream=False)
+    if not response:
+      raise IOError('Failed to fetch %d items from %s' % (len(digests), url))
+    if response.code == 404:
+      logging.info('%s does not support retrieve_batch', self.server_ref.url)
+      self._batch_unsupported = True
+      return {}
+    try:
+      data = response.read()
+    except net.TimeoutError:
+      raise IOError('Timed out fetching %d items from %s' % (len(digests), url))
+
+    out = {}
+    offset = 0
+    for digest in digests:
+      if offset + _BATCH_FRAME.size > len(data):
+        raise IOError('Truncated retrieve_batch response')
+      kind, length = _BATCH_FRAME.unpack_from(data, offset)
+      offset += _BATCH_FRAME.size
+      payload = data[offset:offset + length]
+      if len(payload) != length:
+        raise IOError('Truncated retrieve_batch response')
+      offset += length
+      if kind == _BATCH_CONTENT:
+        out[digest] = [payload]
+      elif kind == _BATCH_URL:
+        out[digest] = self._fetch_url(digest, six.ensure_str(payload), 0)
+      # Missing and skipped items are fetched individually.
+    logging.debug('Fetched %d of %d items in a batch', len(out), len(digests))
+    return out
+
+  def _fetch_url(self, digest, url, offset):
+    """Yields the content of an item stored in GS."""
+    connection = net.url_open(url)
     if not connection:
       raise IOError(
           'Failed to download %s / %s' % (self.server_ref.namespace, digest))
@@ -389,9 +513,11 @@ class IsolateServer(StorageApi):
     assert isinstance(push_state, _IsolateServerPushState)
     assert not push_state.finalized, "push_state is not finalized"
 
-    # Default to item.content().
-    content = item.content() if content is None else content
-    guard_memory_use(self, content, push_state.size)
+    content = _content_factory(item, content)
+    # Only inline uploads buffer the content, uploads to GS are streamed.
+    buffered = 0 if push_state.finalize_url else push_state.size
+    if buffered:
+      self._memory_budget.acquire(buffered)
 
     try:
       # This push operation may be a retry after failed finalization call below,
@@ -427,8 +553,8 @@ class IsolateServer(StorageApi):
               (item.digest, response))
       push_state.finalized = True
     finally:
-      with self._lock:
-        self._memory_use -= push_state.size
+      if buffered:
+        self._memory_budget.release(buffered)
 
   def contains(self, items):
     # Ensure all items were initialized with 'prepare' call. Storage does that.
@@ -507,17 +633,20 @@ class IsolateServer(StorageApi):
       url: URL to upload the data to.
       push_state: an _IsolateServicePushState instance
       item: the original Item to be uploaded
-      content: an iterable that yields 'str' chunks.
+      content: a callable returning an iterable that yields 'str' chunks.
     """
-    # A cheezy way to avoid memcpy of (possibly huge) file, until streaming
-    # upload support is implemented.
-    if isinstance(content, list) and len(content) == 1:
-      content = content[0]
-    else:
-      content = b''.join(content)
-
     # DB upload
     if not push_state.finalize_url:
+      chunks = content()
+      # A cheezy way to avoid memcpy of a single chunk.
+      if isinstance(chunks, list) and len(chunks) == 1:
+        content = chunks[0]
+      else:
+        content = b''.join(chunks)
+      if not self._raw_unsupported:
+        success = self._do_push_raw(push_state, content)
+        if success is not None:
+          return success
       url = '%s/%s' % (self.server_ref.url, push_state.upload_url)
       content = base64.b64encode(content)
       data = {
@@ -527,11 +656,21 @@ class IsolateServer(StorageApi):
       response = net.url_read_json(url=url, data=data)
       return response is not None and response.get('ok')
 
-    # upload to GS
+    # upload to GS. The content is streamed and read again from the start on
+    # retry. The MD5 is calculated on the fly for the last attempt.
+    md5 = [hashlib.md5()]
+    def stream():
+      md5[:] = [hashlib.md5()]
+      for chunk in content():
+        md5[0].update(chunk)
+        yield chunk
+
+    # The compressed size is not known in advance, it is sent chunked then.
+    size = None if self.server_ref.is_with_compression else push_state.size
     url = push_state.upload_url
     response = net.url_open(
         content_type='application/octet-stream',
-        data=content,
+        data=net.RestartableBody(stream, size),
         method='PUT',
         headers={'Cache-Control': 'public, max-age=31536000'},
         url=url)
@@ -547,10 +686,37 @@ class IsolateServer(StorageApi):
     goog_hash = response.headers.get('x-goog-hash')
     assert goog_hash, response.headers
     md5_x_goog_hash = 'md5=' + six.ensure_str(
-        base64.b64encode(hashlib.md5(content).digest()))
+        base64.b64encode(md5[0].digest()))
     return md5_x_goog_hash in goog_hash
 
 
+  def _do_push_raw(self, push_state, content):
+    """Uploads inline content as is, without encoding it in a JSON body.
+
+    Returns None if the server doesn't support it, otherwise True on success.
+    """
+    url = '%s/api/isolateservice/v1/store_inline_raw?%s' % (
+        self.server_ref.url,
+        urllib.parse.urlencode({
+            'upload_ticket': push_state.preupload_status['upload_ticket'],
+        }))
+    response = net.url_open(
+        url,
+        data=content,
+        content_type='application/octet-stream',
+        expected_error_codes=(404,))
+    if not response:
+      return False
+    if response.code == 404:
+      logging.info('%s does not support store_inline_raw', self.server_ref.url)
+      self._raw_unsupported = True
+      return None
+    try:
+      return bool(json.loads(response.read()).get('ok'))
+    except (net.TimeoutError, ValueError):
+      return False
+
+
 def get_storage_api(server_ref):
   """Returns an object that implements low-level StorageApi interface.
 
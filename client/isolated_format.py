@@ -16,12 +16,23 @@ import six
 
 from utils import file_path
 from utils import fs
+from utils import hash_index
 from utils import tools
 
 # Version stored and expected in .isolated files.
 ISOLATED_FILE_VERSION = '2.0'
 
 
+# Version stored in .isolated files listing chunked files. Clients expecting an
+# older version can't fetch them.
+CHUNKED_FILE_VERSION = '2.1'
+
+
+# Version stored in .isolated files listing files bundled in a tar file. Clients
+# expecting an older version can't fetch them.
+BUNDLED_FILE_VERSION = '2.1'
+
+
 # Chunk size to use when doing disk I/O.
 DISK_FILE_CHUNK = 1024 * 1024
 
@@ -39,7 +50,38 @@ SUPPORTED_ALGOS = {
 SUPPORTED_ALGOS_REVERSE = dict((v, k) for k, v in SUPPORTED_ALGOS.items())
 
 
-SUPPORTED_FILE_TYPES = ['basic', 'tar']
+SUPPORTED_FILE_TYPES = ['basic', 'chunked', 'tar']
+
+
+# Files at least this large can be archived as content-defined chunks, see
+# chunk_file().
+CHUNKED_FILE_THRESHOLD = 16 * 1024 * 1024
+
+
+# Bounds of the size of a chunk. The last chunk of a file may be smaller.
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+
+
+def _gen_chunk_symbols():
+  """Returns a table mapping every byte to one of 4 symbols, 64 bytes each."""
+  order = sorted(range(256), key=lambda i: hashlib.sha256(
+      b'isolated chunk symbol' + bytes(bytearray([i]))).digest())
+  symbols = bytearray(256)
+  for rank, i in enumerate(order):
+    symbols[i] = rank & 3
+  return bytes(symbols)
+
+
+# The rolling hash used to find chunk boundaries maps every byte to one of 4
+# symbols with _CHUNK_SYMBOLS. A chunk ends after the bytes whose symbols match
+# _CHUNK_PATTERN, about every 1MiB on random data. Both tables are derived from
+# fixed strings and must never change, otherwise files stop sharing chunks
+# across versions.
+_CHUNK_SYMBOLS = _gen_chunk_symbols()
+_CHUNK_PATTERN = bytes(bytearray(
+    (bytearray(hashlib.sha256(b'isolated chunk pattern').digest())[i >> 2] >>
+     (2 * (i & 3))) & 3 for i in range(10)))
 
 
 class IsolatedError(ValueError):
@@ -58,11 +100,22 @@ def is_valid_hash(value, algo):
   return bool(re.match(r'^[a-fA-F0-9]{%d}$' % size, value))
 
 
-def hash_file(filepath, algo):
+def hash_file(filepath, algo, index=None):
   """Calculates the hash of a file without reading it all in memory at once.
 
   |algo| should be one of hashlib hashing algorithm.
+
+  If |index| is a hash_index.HashIndex, it is consulted first so an unchanged
+  file costs a single stat, and updated once the file is hashed.
   """
+  name = None
+  if index is not None:
+    name = hash_index.algo_name(algo)
+    if name:
+      before = fs.stat(filepath)
+      cached = index.get(before, name)
+      if cached:
+        return cached
   digest = algo()
   with fs.open(filepath, 'rb') as f:
     while True:
@@ -70,9 +123,77 @@ def hash_file(filepath, algo):
       if not chunk:
         break
       digest.update(chunk)
+    after = os.fstat(f.fileno()) if name else None
+  if name and hash_index.stat_key(before, name) == hash_index.stat_key(
+      after, name):
+    # Only index the digest if the file didn't change while being read.
+    index.add(after, name, digest.hexdigest())
   return digest.hexdigest()
 
 
+def chunk_file(filepath, algo, index=None):
+  """Splits a file in content-defined chunks.
+
+  A chunk boundary only depends on the 10 bytes before it, so inserting or
+  removing data in a file only changes the chunks around the modification.
+
+  The rolling hash is computed with bytes.translate() and the boundaries are
+  found with bytes.find(), so the bytes are never iterated over in python.
+
+  If |index| is a hash_index.HashIndex, the digest of an unchanged file is taken
+  from it so only the chunks are hashed, like hash_file() does. It is updated
+  once the file is hashed.
+
+  Returns:
+    tuple(hex digest of the whole file, list of (hex digest, size) of each
+    chunk).
+  """
+  name = None
+  cached = None
+  if index is not None:
+    name = hash_index.algo_name(algo)
+    if name:
+      before = fs.stat(filepath)
+      cached = index.get(before, name)
+  digest = None if cached else algo()
+  chunks = []
+  # The data not yet chunked is buf[pos:] and its symbols are symbols[pos:].
+  buf = b''
+  symbols = b''
+  pos = 0
+  eof = False
+  with fs.open(filepath, 'rb') as f:
+    while True:
+      if not eof and len(buf) - pos < CHUNK_MAX_SIZE:
+        # Read ahead generously so the buffers are rarely copied.
+        data = f.read(4 * CHUNK_MAX_SIZE)
+        eof = not data
+        if digest:
+          digest.update(data)
+        buf = buf[pos:] + data
+        symbols = symbols[pos:] + data.translate(_CHUNK_SYMBOLS)
+        pos = 0
+        continue
+      if pos == len(buf):
+        break
+      end = min(len(buf), pos + CHUNK_MAX_SIZE)
+      if end - pos > CHUNK_MIN_SIZE:
+        # Only look for a boundary within the bytes of the current chunk.
+        i = symbols.find(
+            _CHUNK_PATTERN, pos + CHUNK_MIN_SIZE - len(_CHUNK_PATTERN), end)
+        if i != -1:
+          end = i + len(_CHUNK_PATTERN)
+      chunks.append((algo(buf[pos:end]).hexdigest(), end - pos))
+      pos = end
+    after = os.fstat(f.fileno()) if name else None
+  if cached:
+    return cached, chunks
+  if name and hash_index.stat_key(before, name) == hash_index.stat_key(
+      after, name):
+    index.add(after, name, digest.hexdigest())
+  return digest.hexdigest(), chunks
+
+
 class IsolatedFile(object):
   """Represents a single parsed .isolated file."""
 
@@ -468,6 +589,25 @@ def load_isolated(content, algo):
           elif subsubkey == 's':
             if not isinstance(subsubvalue, six.integer_types):
               raise IsolatedError('Expected int or long, got %r' % subsubvalue)
+          elif subsubkey == 'b':
+            if version < (2, 1):
+              raise IsolatedError(
+                  'Key \'b\' is only allowed starting version 2.1')
+            if not isinstance(subsubvalue, six.string_types):
+              raise IsolatedError('Expected string, got %r' % subsubvalue)
+          elif subsubkey == 'c':
+            if version < (2, 1):
+              raise IsolatedError(
+                  'Key \'c\' is only allowed starting version 2.1')
+            if not isinstance(subsubvalue, list) or not subsubvalue:
+              raise IsolatedError('Expected non-empty list, got %r' %
+                                  subsubvalue)
+            for chunk in subsubvalue:
+              if (not isinstance(chunk, list) or len(chunk) != 2 or
+                  not is_valid_hash(chunk[0], algo) or
+                  not isinstance(chunk[1], six.integer_types)):
+                raise IsolatedError(
+                    'Expected [%s, size], got %r' % (algo_name, chunk))
           elif subsubkey == 't':
             if subsubvalue not in SUPPORTED_FILE_TYPES:
               raise IsolatedError('Expected one of \'%s\', got %r' % (
@@ -490,6 +630,20 @@ def load_isolated(content, algo):
           raise IsolatedError(
               'Cannot use \'m\' (mode) and \'l\' (link), got: %r' %
               subvalue)
+        if 'b' in subvalue and (
+            not isinstance(value.get(subvalue['b']), dict) or
+            value[subvalue['b']].get('t') != 'tar'):
+          raise IsolatedError(
+              '\'b\' (bundle) must reference a tar file, got: %r' % subvalue)
+        if bool('c' in subvalue) != (subvalue.get('t') == 'chunked'):
+          raise IsolatedError(
+              '\'c\' (chunks) must be set only for chunked files, got: %r' %
+              subvalue)
+        if 'c' in subvalue and (
+            sum(size for _, size in subvalue['c']) != subvalue.get('s')):
+          raise IsolatedError(
+              'The size of the chunks must add up to \'s\' (size), got: %r' %
+              subvalue)
 
     elif key == 'includes':
       if not isinstance(value, list):
@@ -40,6 +40,7 @@ import isolate_storage
 import local_caching
 from utils import file_path
 from utils import fs
+from utils import hash_index
 from utils import logging_utils
 from utils import net
 from utils import on_error
@@ -73,6 +74,14 @@ DEADLOCK_TIMEOUT = 5 * 60
 ITEMS_PER_CONTAINS_QUERIES = (20, 20, 50, 50, 50, 100)
 
 
+# Items up to FETCH_BATCH_ITEM_SIZE bytes are fetched in batches of up to
+# FETCH_BATCH_MAX_ITEMS items and FETCH_BATCH_MAX_SIZE bytes, in a single round
+# trip per batch. The server returns at most 1000 items and 16MiB per batch.
+FETCH_BATCH_ITEM_SIZE = 64 * 1024
+FETCH_BATCH_MAX_ITEMS = 500
+FETCH_BATCH_MAX_SIZE = 8 * 1024 * 1024
+
+
 # A list of already compressed extension types that should not receive any
 # compression before being uploaded.
 ALREADY_COMPRESSED_TYPES = [
@@ -91,6 +100,12 @@ ALREADY_COMPRESSED_TYPES = [
     'zip',
 ]
 
+# Bounds how far the hashing stage can run ahead of the first file not hashed
+# yet, so items are emitted in order without buffering the whole tree.
+HASH_MAX_INFLIGHT_BYTES = 1024 * 1024 * 1024
+HASH_MAX_INFLIGHT_FILES = 4096
+
+
 # The delay (in seconds) to wait between logging statements when retrieving the
 # required files. This is intended to let the user know that the program is
 # still running.
@@ -307,8 +322,12 @@ def _get_zip_compression_level(filename):
   return 0 if file_ext in ALREADY_COMPRESSED_TYPES else 7
 
 
-def create_directories(base_directory, files):
-  """Creates the directory structure needed by the given list of files."""
+def create_directories(base_directory, files, thread_pool=None):
+  """Creates the directory structure needed by the given list of files.
+
+  If |thread_pool| is provided, the directories at the same depth are created
+  concurrently on it.
+  """
   logging.debug('create_directories(%s, %d)', base_directory, len(files))
   # Creates the tree of directories to create.
   directories = set(os.path.dirname(f) for f in files)
@@ -316,15 +335,34 @@ def create_directories(base_directory, files):
     while item:
       directories.add(item)
       item = os.path.dirname(item)
-  for d in sorted(directories):
+  # Depth -> directories. A directory is created after all its parents.
+  levels = {}
+  for d in directories:
     if d:
+      levels.setdefault(d.count(os.path.sep), []).append(d)
+  for depth in sorted(levels):
+    for d in sorted(levels[depth]):
       abs_d = os.path.join(base_directory, d)
-      if not fs.isdir(abs_d):
-        fs.mkdir(abs_d)
+      if thread_pool:
+        thread_pool.add_task(threading_utils.PRIORITY_HIGH, _ensure_dir, abs_d)
+      else:
+        _ensure_dir(abs_d)
+    if thread_pool:
+      thread_pool.join()
+
+
+def _ensure_dir(path):
+  if not fs.isdir(path):
+    fs.mkdir(path)
 
 
-def _create_symlinks(base_directory, files):
-  """Creates any symlinks needed by the given set of files."""
+def _create_symlinks(base_directory, files, thread_pool=None):
+  """Creates any symlinks needed by the given set of files.
+
+  If |thread_pool| is provided, the symlinks are created concurrently on it.
+  Either way, a conflicting symlink is raised before returning, so a fetch is
+  aborted before downloading anything.
+  """
   for filepath, properties in files:
     if 'l' not in properties:
       continue
@@ -333,12 +371,23 @@ def _create_symlinks(base_directory, files):
       logging.warning('Ignoring symlink %s', filepath)
       continue
     outfile = os.path.join(base_directory, filepath)
-    try:
-      os.symlink(properties['l'], outfile)  # pylint: disable=E1101
-    except OSError as e:
-      if e.errno == errno.EEXIST:
-        raise AlreadyExists('File %s already exists.' % outfile)
-      raise
+    if thread_pool:
+      thread_pool.add_task(
+          threading_utils.PRIORITY_HIGH, _create_symlink, properties['l'],
+          outfile)
+    else:
+      _create_symlink(properties['l'], outfile)
+  if thread_pool:
+    thread_pool.join()
+
+
+def _create_symlink(target, outfile):
+  try:
+    os.symlink(target, outfile)  # pylint: disable=E1101
+  except OSError as e:
+    if e.errno == errno.EEXIST:
+      raise AlreadyExists('File %s already exists.' % outfile)
+    raise
 
 
 class _ThreadFile(object):
@@ -357,6 +406,10 @@ class _ThreadFile(object):
     self._data.send_result(b)
     self._offset += len(b)
 
+  def abort(self):
+    """Makes the reader raise the exception being handled."""
+    self._data.send_exception()
+
   def close(self):
     self._data.send_done()
 
@@ -365,10 +418,16 @@ class FileItem(isolate_storage.Item):
   """A file to push to Storage.
 
   Its digest and size may be provided in advance, if known. Otherwise they will
-  be derived from the file content.
+  be derived from the file content, consulting |index| if provided.
   """
 
-  def __init__(self, path, algo, digest=None, size=None, high_priority=False):
+  def __init__(self,
+               path,
+               algo,
+               digest=None,
+               size=None,
+               high_priority=False,
+               index=None):
     super(FileItem, self).__init__(
         digest,
         size if size is not None else fs.stat(path).st_size,
@@ -376,6 +435,7 @@ class FileItem(isolate_storage.Item):
         compression_level=_get_zip_compression_level(path))
     self._path = path
     self._algo = algo
+    self._index = index
     self._meta = None
 
   @property
@@ -389,7 +449,8 @@ class FileItem(isolate_storage.Item):
   @property
   def digest(self):
     if not self._digest:
-      self._digest = isolated_format.hash_file(self._path, self._algo)
+      self._digest = isolated_format.hash_file(
+          self._path, self._algo, self._index)
     return self._digest
 
   @property
@@ -405,13 +466,93 @@ class FileItem(isolate_storage.Item):
     return file_read(self.path)
 
 
+class ChunkedFileItem(FileItem):
+  """A large file pushed to Storage as content-defined chunks.
+
+  Only its chunks are pushed, see chunks(). The .isolated lists the file with
+  type 'chunked' and its chunks in 'c', so a new version of the file only
+  needs its modified chunks to be uploaded and fetched.
+
+  The digest of the whole file is taken from |index| if provided, like for
+  FileItem, but the file is still read to split it.
+  """
+
+  def __init__(self, path, algo, size=None, index=None):
+    super(ChunkedFileItem, self).__init__(path, algo, size=size, index=index)
+    self._chunks = None
+
+  @classmethod
+  def accepts(cls, item):
+    """Returns True if the file is large enough to be chunked."""
+    return bool(item.size >= isolated_format.CHUNKED_FILE_THRESHOLD and
+                not item.high_priority)
+
+  @property
+  def digest(self):
+    if not self._digest:
+      self._digest, self._chunks = isolated_format.chunk_file(
+          self.path, self.algo, self._index)
+    return self._digest
+
+  @property
+  def meta(self):
+    if not self._meta:
+      self._meta = isolated_format.file_to_metadata(self.path, False)
+      self._meta['h'] = self.digest
+      self._meta['t'] = u'chunked'
+      self._meta['c'] = [[d, s] for d, s in self._chunks]
+    return self._meta
+
+  def chunks(self):
+    """Yields a FileChunk for each chunk, hashing the file if needed."""
+    _ = self.digest
+    offset = 0
+    for digest, size in self._chunks:
+      yield FileChunk(self.path, offset, digest, size)
+      offset += size
+
+  def content(self):
+    for chunk in self.chunks():
+      for data in chunk.content():
+        yield data
+
+
+class FileChunk(isolate_storage.Item):
+  """A chunk of a ChunkedFileItem to push to Storage."""
+
+  def __init__(self, path, offset, digest, size):
+    super(FileChunk, self).__init__(
+        digest, size, compression_level=_get_zip_compression_level(path))
+    self._path = path
+    self._offset = offset
+
+  def content(self):
+    remaining = self.size
+    for data in file_read(self._path, offset=self._offset):
+      if len(data) >= remaining:
+        yield data[:remaining]
+        return
+      remaining -= len(data)
+      yield data
+
+
 class TarBundle(isolate_storage.Item):
-  """Tarfile to push to Storage.
+  """Tarfile bundling small files to push to Storage.
 
-  Its digest is the digest of all the files it contains. It is generated on the
-  fly.
+  The tarfile is generated on the fly and is deterministic: members are sorted
+  by path and only their relative path, size and mode are recorded. So its
+  digest only depends on the files it contains.
+
+  The .isolated lists both the bundle, with type 'tar', and each of its members
+  with their own digest and a 'b' key referencing the bundle.
   """
 
+  # Files larger than this are always archived individually.
+  MAX_FILE_SIZE = 64 * 1024
+  # Bundles with less files than this are not worth it; the files are archived
+  # individually.
+  MIN_FILES = 5
+
   def __init__(self, root, algo):
     # 2 trailing 512 bytes headers.
     super(TarBundle, self).__init__(size=1024)
@@ -432,27 +573,33 @@ class TarBundle(isolate_storage.Item):
 
   @property
   def size(self):
+    """Estimated size until the bundle is hashed, then the exact size."""
     if self._size is None:
       self._prepare()
     return self._size
 
+  @property
+  def path(self):
+    """Path of the bundle in the .isolated, relative to the root."""
+    return self.digest + '.tar'
+
+  @classmethod
+  def accepts(cls, item):
+    """Returns True if the file is small enough to be bundled."""
+    return bool(item.size and item.size <= cls.MAX_FILE_SIZE and
+                not item.high_priority)
+
   def try_add(self, item):
     """Try to add this file to the bundle.
 
-    It is extremely naive but this should be just enough for
-    https://crbug.com/825418.
-
-    Future improvements should be in the Go code, and the Swarming bot should be
-    migrated to use the Go code instead.
+    Returns False if the file can't be bundled or the bundle is full.
     """
-    if not item.size:
+    if not self.accepts(item):
       return False
-    # pylint: disable=unreachable
-    rounded = (item.size + 512) & ~511
+    # A header plus the content rounded up to 512 bytes blocks.
+    rounded = 512 + ((item.size + 511) & ~511)
     if rounded + self._size > self._archive_max_size:
       return False
-    # https://crbug.com/825418
-    return False
     self._size += rounded
     self._items.append(item)
     return True
@@ -460,17 +607,28 @@ class TarBundle(isolate_storage.Item):
   def yield_item_path_meta(self):
     """Returns a tuple(Item, filepath, meta_dict).
 
-    If the bundle contains less than 5 items, the items are yielded.
+    If the bundle contains less than MIN_FILES items, the items are yielded
+    with no metadata, like _directory_to_metadata() does. Otherwise the bundle
+    itself is yielded with no path nor metadata; use files_meta() once it is
+    hashed.
     """
-    if len(self._items) < 5:
+    if len(self._items) < self.MIN_FILES:
       # The tarball is too small, yield individual items, if any.
       for item in self._items:
-        yield item, item.path[self._root_len:], item.meta
-    else:
-      # This ensures self._meta is set.
-      p = self.digest + '.tar'
-      # Yield itself as a tarball.
-      yield self, p, self._meta
+        yield item, item.path[self._root_len:], None
+    elif self._items:
+      yield self, None, None
+
+  def files_meta(self):
+    """Returns the .isolated entries for the bundle and its members."""
+    # Hashes the bundle first, so its metadata is set.
+    path = self.path
+    out = {path: self._meta}
+    for item in self._items:
+      meta = item.meta.copy()
+      meta['b'] = path
+      out[item.path[self._root_len:]] = meta
+    return out
 
   def content(self):
     """Generates the tarfile content on the fly."""
@@ -479,12 +637,18 @@ class TarBundle(isolate_storage.Item):
       try:
         t = tarfile.open(
             fileobj=obj, mode='w', format=tarfile.PAX_FORMAT, encoding='utf-8')
-        for item in self._items:
-          logging.info(' tarring %s', item.path)
-          t.add(item.path)
+        for relpath, item in sorted(
+            (self._arcname(i), i) for i in self._items):
+          logging.debug(' tarring %s', item.path)
+          ti = tarfile.TarInfo(relpath)
+          ti.size = item.size
+          ti.mode = item.meta.get('m', 0o500)
+          with fs.open(item.path, 'rb') as f:
+            t.addfile(ti, f)
         t.close()
       except Exception:
         logging.exception('Internal failure')
+        obj.abort()
       finally:
         obj.close()
 
@@ -496,6 +660,9 @@ class TarBundle(isolate_storage.Item):
     finally:
       t.join()
 
+  def _arcname(self, item):
+    return item.path[self._root_len:].replace(os.path.sep, '/')
+
   def _prepare(self):
     h = self._algo()
     total = 0
@@ -612,7 +779,7 @@ class Storage(object):
       signal.signal(s, h)
     return False
 
-  def upload_items(self, items, verify_push=False):
+  def upload_items(self, items, verify_push=False, hash_stats=None):
     """Uploads a generator of Item to the isolate server.
 
     It figures out what items are missing from the server and uploads only them.
@@ -647,6 +814,8 @@ class Storage(object):
       items: list of isolate_storage.Item instances that represents data to
              upload.
       verify_push: verify files are uploaded correctly by fetching from server.
+      hash_stats: optional StageStats of the stage that hashed |items|, to be
+             reported along the upload stats.
 
     Returns:
       List of items that were uploaded. All other items are already there.
@@ -659,6 +828,7 @@ class Storage(object):
     missing = Queue.Queue()
     uploaded = []
     exc_channel = threading_utils.TaskChannel()
+    start = time.time()
 
     def _create_items_batches_thread():
       """Creates batches for /contains RPC lookup from individual items.
@@ -805,7 +975,10 @@ class Storage(object):
 
     logging.info('All %s files are uploaded', len(uploaded))
     if seen:
-      _print_upload_stats(seen.values(), uploaded)
+      upload_stats = StageStats()
+      upload_stats.add(uploaded)
+      upload_stats.duration = time.time() - start
+      _print_upload_stats(seen.values(), uploaded, hash_stats, upload_stats)
     return uploaded
 
   def _async_push(self, channel, item, push_state, verify_push=False):
@@ -850,32 +1023,15 @@ class Storage(object):
 
       return item
 
-    # If zipping is not required, just start a push task. Don't pass 'content'
-    # so that it can create a new generator when it retries on failures.
-    if not self.server_ref.is_with_compression:
-      self.net_thread_pool.add_task_with_channel(channel, priority, _push, None)
-      return
-
-    # If zipping is enabled, zip in a separate thread.
-    def zip_and_push():
-      # TODO(vadimsh): Implement streaming uploads. Before it's done, assemble
-      # content right here. It will block until all file is zipped.
-      try:
-        if self._aborted:
-          raise Aborted()
-        stream = zip_compress(item.content(), item.compression_level)
-        # In Python3, zlib.compress returns a byte object instead of str.
-        data = six.b('').join(stream)
-      except Exception as exc:
-        logging.error('Failed to zip \'%s\': %s', item, exc)
-        channel.send_exception()
-        return
-      # Pass '[data]' explicitly because the compressed data is not same as the
-      # one provided by 'item'. Since '[data]' is a list, it can safely be
-      # reused during retries.
-      self.net_thread_pool.add_task_with_channel(
-          channel, priority, _push, [data])
-    self.cpu_thread_pool.add_task(priority, zip_and_push)
+    # Don't pass 'content' if zipping is not required so that it can create a
+    # new generator when it retries on failures.
+    content = None
+    if self.server_ref.is_with_compression:
+      # Zip while streaming; the callable restarts compression on retries so
+      # the compressed data is never assembled in memory.
+      content = lambda: zip_compress(item.content(), item.compression_level)
+    self.net_thread_pool.add_task_with_channel(
+        channel, priority, _push, content)
 
   def push(self, item, push_state):
     """Synchronously pushes a single item to the server.
@@ -899,10 +1055,11 @@ class Storage(object):
       assert pushed is item
     return item
 
-  def _fetch(self, digest, size, sink):
+  def _fetch(self, digest, size, sink, stream=None):
     try:
       # Prepare reading pipeline.
-      stream = self._storage_api.fetch(digest, size, 0)
+      if stream is None:
+        stream = self._storage_api.fetch(digest, size, 0)
       if self.server_ref.is_with_compression:
         stream = zip_decompress(stream, isolated_format.DISK_FILE_CHUNK)
       # Run |stream| through verifier that will assert its size.
@@ -914,7 +1071,7 @@ class Storage(object):
       logging.exception('Failed to fetch %s', digest)
       raise
 
-  def async_fetch(self, channel, priority, digest, size, sink):
+  def async_fetch(self, channel, priority, digest, size, sink, stream=None):
     """Starts asynchronous fetch from the server in a parallel thread.
 
     Arguments:
@@ -923,15 +1080,43 @@ class Storage(object):
       digest: hex digest of an item to download.
       size: expected size of the item (after decompression).
       sink: function that will be called as sink(generator).
+      stream: content already fetched from the server, if any. It is only used
+          on the first attempt, retries fetch the item again.
     """
+    prefetched = [stream] if stream is not None else []
     def fetch():
-      self._fetch(digest, size, sink)
+      self._fetch(digest, size, sink, prefetched.pop() if prefetched else None)
       return digest
 
     # Don't bother with zip_thread_pool for decompression. Decompression is
     # really fast and most probably IO bound anyway.
     self.net_thread_pool.add_task_with_channel(channel, priority, fetch)
 
+  def async_fetch_batch(self, channel, priority, items):
+    """Starts asynchronous fetch of many small items in a single round trip.
+
+    The items the server doesn't return are fetched individually.
+
+    Arguments:
+      channel: TaskChannel that receives back each digest when its download
+          ends.
+      priority: thread pool task priority for the fetch.
+      items: list of (digest, size, sink), see async_fetch().
+    """
+    def fetch_batch():
+      fetched = {}
+      try:
+        fetched = self._storage_api.fetch_batch([i[0] for i in items])
+      except IOError as e:
+        logging.warning('Failed to fetch %d items at once: %s', len(items), e)
+      finally:
+        # The items are always sent to |channel|, even on unexpected errors.
+        for digest, size, sink in items:
+          self.async_fetch(
+              channel, priority, digest, size, sink, fetched.get(digest))
+
+    self.net_thread_pool.add_task(priority, fetch_batch)
+
 
 class FetchQueue(object):
   """Fetches items from Storage and places them into ContentAddressedCache.
@@ -960,9 +1145,60 @@ class FetchQueue(object):
       size=local_caching.UNKNOWN_FILE_SIZE,
       priority=threading_utils.PRIORITY_MED):
     """Starts asynchronous fetch of item |digest|."""
+    if self._needs_fetch(digest, size):
+      self._start_fetch(digest, size, priority)
+
+  def add_many(self, items, priority=threading_utils.PRIORITY_MED):
+    """Starts asynchronous fetch of all |items| as a single batch.
+
+    The cache makes room for all the missing items up front, then they are
+    fetched largest first so the biggest downloads don't end up last on a
+    single connection. Small items are coalesced in batches fetched in a
+    single round trip each.
+
+    Arguments:
+      items: dict of digest -> size.
+
+    Raises:
+      local_caching.NoMoreSpace before fetching anything if the missing items
+      can't fit in the cache.
+    """
+    # Touch all the cached items first so they are protected from eviction.
+    missing = [
+        (digest, size) for digest, size in sorted(items.items())
+        if self._needs_fetch(digest, size)
+    ]
+    sizes = [size for _, size in missing]
+    self.cache.reserve(sizes)
+    logging.info(
+        'Fetching %d missing items of %d, %.1fkiB', len(missing), len(items),
+        sum(s for s in sizes if s != local_caching.UNKNOWN_FILE_SIZE) / 1024.)
+    # Items of unknown size are fetched last.
+    missing.sort(
+        key=lambda x: -1 if x[1] == local_caching.UNKNOWN_FILE_SIZE else x[1],
+        reverse=True)
+    batch = []
+    batch_size = 0
+    for digest, size in missing:
+      if (size == local_caching.UNKNOWN_FILE_SIZE or
+          size > FETCH_BATCH_ITEM_SIZE):
+        self._start_fetch(digest, size, priority)
+        continue
+      if (len(batch) == FETCH_BATCH_MAX_ITEMS or
+          batch_size + size > FETCH_BATCH_MAX_SIZE):
+        self._start_fetch_batch(batch, priority)
+        batch = []
+        batch_size = 0
+      batch.append((digest, size))
+      batch_size += size
+    if batch:
+      self._start_fetch_batch(batch, priority)
+
+  def _needs_fetch(self, digest, size):
+    """Returns True if |digest| is neither being fetched nor already cached."""
     # Fetching it now?
     if digest in self._pending:
-      return
+      return False
 
     # Mark this file as in use, verify_all_cached will later ensure it is still
     # in cache.
@@ -972,24 +1208,27 @@ class FetchQueue(object):
     if digest in self._fetched:
       # 'touch' returns True if item is in cache and not corrupted.
       if self.cache.touch(digest, size):
-        return
+        return False
       logging.error('%s is corrupted', digest)
       self._fetched.remove(digest)
+    return True
 
-    # TODO(maruel): It should look at the free disk space, the current cache
-    # size and the size of the new item on every new item:
-    # - Trim the cache as more entries are listed when free disk space is low,
-    #   otherwise if the amount of data downloaded during the run > free disk
-    #   space, it'll crash.
-    # - Make sure there's enough free disk space to fit all dependencies of
-    #   this run! If not, abort early.
-
-    # Start fetching.
+  def _start_fetch(self, digest, size, priority):
     self._pending.add(digest)
     self.storage.async_fetch(
         self._channel, priority, digest, size,
         functools.partial(self.cache.write, digest))
 
+  def _start_fetch_batch(self, items, priority):
+    if len(items) == 1:
+      self._start_fetch(items[0][0], items[0][1], priority)
+      return
+    self._pending.update(digest for digest, _ in items)
+    self.storage.async_fetch_batch(
+        self._channel, priority,
+        [(digest, size, functools.partial(self.cache.write, digest))
+         for digest, size in items])
+
   def wait_on(self, digest):
     """Updates digests to be waited on by 'wait'."""
     # Calculate once the already fetched items. These will be retrieved first.
@@ -1164,8 +1403,12 @@ class IsolatedBundle(object):
     in 'includes' is important.
 
     As a side effect this method starts asynchronous fetch of all data files
-    by adding them to |fetch_queue|. It doesn't wait for data files to finish
-    fetching though.
+    by adding them to |fetch_queue| as a single batch once all *.isolated files
+    are loaded. It doesn't wait for data files to finish fetching though.
+
+    Raises:
+      local_caching.NoMoreSpace before fetching any data file if they can't
+      fit in the cache.
     """
     self.root = isolated_format.IsolatedFile(root_isolated_hash, algo)
 
@@ -1212,7 +1455,7 @@ class IsolatedBundle(object):
           if not node.is_loaded:
             break
           # Not visited and loaded -> process it and continue the traversal.
-          self._start_fetching_files(node, fetch_queue)
+          self._add_files(node)
           processed.add(node)
 
     # All *.isolated files should be processed by now and only them.
@@ -1220,20 +1463,30 @@ class IsolatedBundle(object):
     assert all_isolateds == processed, (all_isolateds, processed)
     assert fetch_queue.wait_queue_empty, 'FetchQueue should have been emptied'
 
+    # Now that the whole tree is known, fetch the hashed files in one batch.
+    # Bundled files are extracted from their bundle instead and chunked files
+    # are assembled from their chunks.
+    items = {}
+    for props in self.files.values():
+      if 'c' in props:
+        items.update(props['c'])
+      elif 'h' in props and 'b' not in props:
+        items[props['h']] = props['s']
+    fetch_queue.add_many(items)
+
     # Extract 'command' and other bundle properties.
     for node in isolated_format.walk_includes(self.root):
       self._update_self(node)
     self.relative_cwd = self.relative_cwd or ''
 
-  def _start_fetching_files(self, isolated, fetch_queue):
-    """Starts fetching files from |isolated| that are not yet being fetched.
-
-    Modifies self.files.
-    """
+  def _add_files(self, isolated):
+    """Adds files from |isolated| that are not yet overridden to self.files."""
     files = isolated.data.get('files', {})
     logging.debug('fetch_files(%s, %d)', isolated.obj_hash, len(files))
     for filepath, properties in files.items():
-      if self._filter_cb and not self._filter_cb(filepath):
+      # Bundles are not filtered, their members are.
+      if (self._filter_cb and properties.get('t') != 'tar' and
+          not self._filter_cb(filepath)):
         continue
 
       # Root isolated has priority on the files being mapped. In particular,
@@ -1241,11 +1494,6 @@ class IsolatedBundle(object):
       if filepath not in self.files:
         self.files[filepath] = properties
 
-        # Preemptively request hashed files.
-        if 'h' in properties:
-          fetch_queue.add(
-              properties['h'], properties['s'], threading_utils.PRIORITY_MED)
-
   def _update_self(self, node):
     """Extracts bundle global parameters from loaded *.isolated file.
 
@@ -1278,11 +1526,17 @@ def get_storage(server_ref):
   return Storage(isolate_storage.get_storage_api(server_ref))
 
 
-def _map_file(dst, digest, props, cache, use_symlinks):
+def _map_file(dst, digest, props, cache, use_symlinks, members=None):
   """Put downloaded file to destination path. This function is used for multi
   threaded file putting.
+
+  For a tar bundle, |members| is the set of relative paths to extract, or None
+  to extract all of them.
   """
   with tools.Profiler("_map_file for %s" % dst):
+    if props.get('t') == 'chunked':
+      _assemble_chunks(dst, props, cache)
+      return
     with cache.getfileobj(digest) as srcfileobj:
       filetype = props.get('t', 'basic')
 
@@ -1304,6 +1558,8 @@ def _map_file(dst, digest, props, cache, use_symlinks):
             # reverse.
             other_sep = '/' if os.path.sep == '\\' else '\\'
             name = ti.name.replace(other_sep, os.path.sep)
+            if members is not None and name not in members:
+              continue
             fp = os.path.normpath(os.path.join(basedir, name))
             if not fp.startswith(basedir):
               logging.error('Path(%r) is outside root directory', fp)
@@ -1319,6 +1575,16 @@ def _map_file(dst, digest, props, cache, use_symlinks):
         raise isolated_format.IsolatedError('Unknown file type %r' % filetype)
 
 
+def _assemble_chunks(dst, props, cache):
+  """Writes a chunked file by concatenating its chunks from the cache."""
+  with fs.open(dst, 'wb') as dstfileobj:
+    for digest, size in props['c']:
+      with cache.getfileobj(digest) as srcfileobj:
+        fileobj_copy(dstfileobj, srcfileobj, size)
+  # Ignore all bits apart from the user.
+  fs.chmod(dst, (props.get('m') or 0o500) & 0o700)
+
+
 def fetch_isolated(isolated_hash, storage, cache, outdir, use_symlinks,
                    filter_cb=None):
   """Aggressively downloads the .isolated file(s), then download all the files.
@@ -1362,28 +1628,42 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, use_symlinks,
     bundle.fetch(fetch_queue, isolated_hash, algo)
 
   with tools.Profiler('GetRest'):
-    # Create file system hierarchy.
-    file_path.ensure_tree(outdir)
-    create_directories(outdir, bundle.files)
-    _create_symlinks(outdir, bundle.files.items())
-
-    # Ensure working directory exists.
-    cwd = os.path.normpath(os.path.join(outdir, bundle.relative_cwd))
-    file_path.ensure_tree(cwd)
-
-    # Multimap: digest -> list of pairs (path, props).
-    remaining = {}
-    for filepath, props in bundle.files.items():
-      if 'h' in props:
-        remaining.setdefault(props['h'], []).append((filepath, props))
-        fetch_queue.wait_on(props['h'])
-
-    # Now block on the remaining files to be downloaded and mapped.
-    logging.info('Retrieving remaining files (%d of them)...',
-        fetch_queue.pending_count)
-    last_update = time.time()
-
     with threading_utils.ThreadPool(2, 32, 32) as putfile_thread_pool:
+      # Create file system hierarchy. The symlinks are created once the
+      # directories exist, before any file is mapped.
+      file_path.ensure_tree(outdir)
+      create_directories(outdir, bundle.files, putfile_thread_pool)
+      _create_symlinks(outdir, bundle.files.items(), putfile_thread_pool)
+
+      # Ensure working directory exists.
+      cwd = os.path.normpath(os.path.join(outdir, bundle.relative_cwd))
+      file_path.ensure_tree(cwd)
+
+      # Multimap: digest -> list of pairs (path, props). The paths are sorted
+      # so the copies of one item are placed directory by directory. A chunked
+      # file is listed under each of its chunks.
+      remaining = {}
+      # Bundle path -> set of its members to extract.
+      members = {}
+      # Chunked file path -> set of its chunks not yet fetched.
+      missing_chunks = {}
+      for filepath, props in sorted(bundle.files.items()):
+        if 'b' in props:
+          members.setdefault(props['b'], set()).add(filepath)
+        elif 'c' in props:
+          missing_chunks[filepath] = set(d for d, _ in props['c'])
+          for digest in missing_chunks[filepath]:
+            remaining.setdefault(digest, []).append((filepath, props))
+            fetch_queue.wait_on(digest)
+        elif 'h' in props:
+          remaining.setdefault(props['h'], []).append((filepath, props))
+          fetch_queue.wait_on(props['h'])
+
+      # Now block on the remaining files to be downloaded and mapped.
+      logging.info('Retrieving remaining files (%d of them)...',
+          fetch_queue.pending_count)
+      last_update = time.time()
+
       with threading_utils.DeadlockDetector(DEADLOCK_TIMEOUT) as detector:
         while remaining:
           detector.ping()
@@ -1392,13 +1672,26 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, use_symlinks,
           digest = fetch_queue.wait()
 
           # Create the files in the destination using item in cache as the
-          # source.
+          # source. Bundles are extracted concurrently like any other file.
           for filepath, props in remaining.pop(digest):
             fullpath = os.path.join(outdir, filepath)
 
-            putfile_thread_pool.add_task(threading_utils.PRIORITY_HIGH,
-                                         _map_file, fullpath, digest, props,
-                                         cache, use_symlinks)
+            if filepath in missing_chunks:
+              # A chunked file is assembled once all its chunks are fetched.
+              missing_chunks[filepath].discard(digest)
+              if missing_chunks[filepath]:
+                continue
+              del missing_chunks[filepath]
+
+            to_extract = None
+            if props.get('t') == 'tar':
+              # Bundles without a listing of their members are extracted
+              # entirely, unless files are filtered.
+              to_extract = members.get(
+                  filepath, set() if filter_cb else None)
+            putfile_thread_pool.add_task(
+                threading_utils.PRIORITY_HIGH, _map_file, fullpath, digest,
+                props, cache, use_symlinks, to_extract)
 
           # Report progress.
           duration = time.time() - last_update
@@ -1424,16 +1717,28 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, use_symlinks,
   return bundle
 
 
-def _directory_to_metadata(root, algo, denylist):
+def _directory_to_metadata(root,
+                           algo,
+                           denylist,
+                           index=None,
+                           bundle_files=False,
+                           chunk_files=False):
   """Yields every file and/or symlink found.
 
+  Files are hashed through |index| if provided. Small files are bundled
+  in TarBundle if |bundle_files| is True. Large files are ChunkedFileItem if
+  |chunk_files| is True.
+
   Yields:
-    tuple(FileItem, relpath, metadata)
-    For a symlink, FileItem is None.
+    tuple(Item, relpath, metadata)
+    For a symlink, Item is None. For an individual file, metadata is None so
+    the file is not hashed right away; use FileItem.meta once it is. For a
+    TarBundle, relpath and metadata are None; use TarBundle.files_meta() once
+    it is hashed.
   """
   # Current tar file bundle, if any.
   root = file_path.get_native_path_case(root)
-  bundle = TarBundle(root, algo)
+  bundle = TarBundle(root, algo) if bundle_files else None
   for relpath, issymlink in isolated_format.expand_directory_and_symlink(
       root,
       u'.' + os.path.sep,
@@ -1448,26 +1753,35 @@ def _directory_to_metadata(root, algo, denylist):
       continue
 
     prio = relpath.endswith('.isolated')
-    if bundle.try_add(FileItem(path=filepath, algo=algo, high_priority=prio)):
+    item = FileItem(
+        path=filepath,
+        algo=algo,
+        size=None,
+        high_priority=prio,
+        index=index)
+    if chunk_files and ChunkedFileItem.accepts(item):
+      item = ChunkedFileItem(filepath, algo, item.size, index=index)
+    if bundle and TarBundle.accepts(item):
+      if not bundle.try_add(item):
+        # The bundle is full, flush it and start a new one.
+        for i, p, m in bundle.yield_item_path_meta():
+          yield i, p, m
+        bundle = TarBundle(root, algo)
+        bundle.try_add(item)
       # The file was added to the current pending tarball and won't be archived
       # individually.
       continue
 
-    # Flush and reset the bundle.
-    for i, p, m in bundle.yield_item_path_meta():
-      yield i, p, m
-    bundle = TarBundle(root, algo)
-
     # Yield the file individually.
-    item = FileItem(path=filepath, algo=algo, size=None, high_priority=prio)
-    yield item, relpath, item.meta
+    yield item, relpath, None
 
-  for i, p, m in bundle.yield_item_path_meta():
-    yield i, p, m
+  if bundle:
+    for i, p, m in bundle.yield_item_path_meta():
+      yield i, p, m
 
 
-def _print_upload_stats(items, missing):
-  """Prints upload stats."""
+def _print_upload_stats(items, missing, hash_stats=None, upload_stats=None):
+  """Prints upload stats, including the throughput of each stage if known."""
   total = len(items)
   total_size = sum(f.size for f in items)
   logging.info(
@@ -1486,29 +1800,145 @@ def _print_upload_stats(items, missing):
                len(cache_miss), cache_miss_size / 1024.,
                len(cache_miss) * 100. / total,
                cache_miss_size * 100. / total_size if total_size else 0)
+  if hash_stats:
+    hash_stats.log('hashed:')
+  if upload_stats:
+    upload_stats.log('uploaded:')
+
+
+class StageStats(object):
+  """Throughput of one stage of the archival pipeline."""
+
+  def __init__(self):
+    self.files = 0
+    self.size = 0
+    self.duration = 0.
+
+  def __nonzero__(self):
+    return bool(self.files)
+
+  __bool__ = __nonzero__
+
+  def add(self, items):
+    for item in items:
+      self.files += 1
+      self.size += item.size
+
+  def log(self, name):
+    duration = max(self.duration, 0.001)
+    logging.info('%-12s%6d, %9.1fkiB, %8.1f files/s, %7.1fMiB/s', name,
+                 self.files, self.size / 1024., self.files / duration,
+                 self.size / 1024. / 1024. / duration)
+
+
+def _hash_items(entries, stats=None):
+  """Hashes the items of |entries| in parallel.
+
+  Hashing is CPU bound and hashlib releases the GIL while hashing large
+  buffers, as does reading the files, so a thread per core is used.
 
+  Arguments:
+    entries: iterable of tuples whose first element is an isolate_storage.Item
+             or None.
+    stats: optional StageStats updated with the items hashed.
+
+  Yields:
+    The tuples of |entries|, in the same order, once their item's digest is
+    known.
+  """
+  start = time.time()
+  pending = collections.deque()
+  done = set()
+  inflight = [0]
+  channel = threading_utils.TaskChannel()
 
-def _enqueue_dir(dirpath, denylist, hash_algo, hash_algo_name):
+  def _hash(index, item):
+    # Computes and caches the digest.
+    _ = item.digest
+    return index
+
+  def _pop():
+    _, entry, size = pending.popleft()
+    inflight[0] -= size
+    if entry[0] and stats is not None:
+      stats.add([entry[0]])
+    return entry
+
+  def _drain(blocking):
+    # Yields the entries at the head of the queue that are hashed. Only waits
+    # for the head to be hashed if |blocking| or if too much is in flight.
+    while pending:
+      index = pending[0][0]
+      if index in done:
+        done.remove(index)
+        yield _pop()
+        continue
+      if not blocking and (inflight[0] < HASH_MAX_INFLIGHT_BYTES and
+                           len(pending) < HASH_MAX_INFLIGHT_FILES):
+        try:
+          done.add(channel.next(timeout=0))
+        except threading_utils.TaskChannel.Timeout:
+          return
+      else:
+        done.add(channel.next())
+
+  threads = max(threading_utils.num_processors(), 1)
+  with threading_utils.ThreadPool(0, threads, 0, 'hash') as pool:
+    for index, entry in enumerate(entries):
+      size = entry[0].size if entry[0] else 0
+      pending.append((index, entry, size))
+      inflight[0] += size
+      if entry[0]:
+        pool.add_task(0, channel.wrap_task(_hash), index, entry[0])
+      else:
+        done.add(index)
+      for e in _drain(False):
+        yield e
+    for e in _drain(True):
+      yield e
+  if stats is not None:
+    stats.duration += time.time() - start
+
+
+def _enqueue_dir(dirpath,
+                 denylist,
+                 hash_algo,
+                 hash_algo_name,
+                 index=None,
+                 hash_stats=None,
+                 bundle_files=False,
+                 chunk_files=False):
   """Called by archive_files_to_storage for a directory.
 
-  Create an .isolated file.
+  Create an .isolated file. The files are hashed in parallel.
 
   Yields:
-    FileItem for every file found, plus one for the .isolated file itself.
+    FileItem, FileChunk or TarBundle for every file found, plus one for the
+    .isolated file itself.
   """
   files = {}
-  for item, relpath, meta in _directory_to_metadata(dirpath, hash_algo,
-                                                    denylist):
+  version = isolated_format.ISOLATED_FILE_VERSION
+  for item, relpath, meta in _hash_items(
+      _directory_to_metadata(dirpath, hash_algo, denylist, index,
+                             bundle_files, chunk_files), hash_stats):
     # item is None for a symlink.
-    files[relpath] = meta
-    if item:
+    if isinstance(item, TarBundle):
+      files.update(item.files_meta())
+      version = isolated_format.BUNDLED_FILE_VERSION
+    else:
+      files[relpath] = meta or item.meta
+    if isinstance(item, ChunkedFileItem):
+      version = isolated_format.CHUNKED_FILE_VERSION
+      for chunk in item.chunks():
+        yield chunk
+    elif item:
       yield item
 
   # TODO(maruel): If there' not file, don't yield an .isolated file.
   data = {
     'algo': hash_algo_name,
     'files': files,
-    'version': isolated_format.ISOLATED_FILE_VERSION,
+    'version': version,
   }
   # Keep the file in memory. This is fine because .isolated files are relatively
   # small.
@@ -1521,7 +1951,10 @@ def _enqueue_dir(dirpath, denylist, hash_algo, hash_algo_name):
 def _archive_files_to_storage_internal(storage,
                                        files,
                                        denylist,
-                                       verify_push=False):
+                                       verify_push=False,
+                                       index=None,
+                                       bundle_files=False,
+                                       chunk_files=False):
   """Stores every entry into remote storage and returns stats.
 
   Arguments:
@@ -1531,6 +1964,10 @@ def _archive_files_to_storage_internal(storage,
           Duplicates are skipped.
     denylist: function that returns True if a file should be omitted.
     verify_push: verify files are uploaded correctly by fetching from server.
+    index: optional hash_index.HashIndex used to skip hashing unchanged
+          files.
+    bundle_files: bundle small files of directories in tar archives.
+    chunk_files: archive large files of directories as content-defined chunks.
 
   Returns:
     tuple(OrderedDict(path: hash), list(FileItem cold), list(FileItem hot)).
@@ -1547,10 +1984,11 @@ def _archive_files_to_storage_internal(storage,
   channel = threading_utils.TaskChannel()
   exc_channel = threading_utils.TaskChannel()
   uploaded_digests = set()
+  hash_stats = StageStats()
 
   def _upload_items():
     try:
-      results = storage.upload_items(channel, verify_push)
+      results = storage.upload_items(channel, verify_push, hash_stats)
       uploaded_digests.update(f.digest for f in results)
     except Exception:
       exc_channel.send_exception()
@@ -1572,7 +2010,8 @@ def _archive_files_to_storage_internal(storage,
           # Uploading a whole directory.
           item = None
           for item in _enqueue_dir(filepath, denylist, hash_algo,
-                                   hash_algo_name):
+                                   hash_algo_name, index, hash_stats,
+                                   bundle_files, chunk_files):
             channel.send_result(item)
             items_found.append(item)
             # The very last item will be the .isolated file.
@@ -1584,7 +2023,8 @@ def _archive_files_to_storage_internal(storage,
               path=filepath,
               algo=hash_algo,
               size=None,
-              high_priority=f.endswith('.isolated'))
+              high_priority=f.endswith('.isolated'),
+              index=index)
           channel.send_result(item)
           items_found.append(item)
         else:
@@ -1627,7 +2067,13 @@ def _archive_files_to_storage_internal(storage,
 
 # TODO(crbug.com/1073832):
 # remove this if process leak in coverage build was fixed.
-def archive_files_to_storage(storage, files, denylist, verify_push=False):
+def archive_files_to_storage(storage,
+                             files,
+                             denylist,
+                             verify_push=False,
+                             index=None,
+                             bundle_files=False,
+                             chunk_files=False):
   """Calls _archive_files_to_storage_internal with retry.
 
   Arguments:
@@ -1648,7 +2094,8 @@ def archive_files_to_storage(storage, files, denylist, verify_push=False):
   while True:
     try:
       return _archive_files_to_storage_internal(storage, files, denylist,
-                                                verify_push)
+                                                verify_push, index,
+                                                bundle_files, chunk_files)
     except Exception:
       if backoff > 100:
         raise
@@ -1686,11 +2133,23 @@ def CMDarchive(parser, args):
     parser.error('Nothing to upload')
   files = (six.ensure_text(f) for f in files)
   denylist = tools.gen_denylist(options.blacklist)
+  index = None
+  if options.hash_index:
+    index = hash_index.HashIndex.load(options.hash_index)
   try:
     with get_storage(server_ref) as storage:
-      results, _cold, _hot = archive_files_to_storage(storage, files, denylist)
+      results, _cold, _hot = archive_files_to_storage(
+          storage,
+          files,
+          denylist,
+          index=index,
+          bundle_files=options.bundle_small_files,
+          chunk_files=options.chunk_large_files)
   except (Error, local_caching.NoMoreSpace) as e:
     parser.error(e.args[0])
+  finally:
+    if index is not None:
+      index.save(options.hash_index)
   print('\n'.join('%s %s' % (h, f) for f, h in results.items()))
   return 0
 
@@ -1791,6 +2250,32 @@ def add_archive_options(parser):
       default=list(DEFAULT_DENYLIST),
       help='List of regexp to use as denylist filter when uploading '
       'directories')
+  parser.add_option(
+      '--hash-index',
+      metavar='FILE',
+      default=os.environ.get('ISOLATE_HASH_INDEX'),
+      help='File keeping the digests of files already hashed, so unchanged '
+      'files are not read again on the next archival. Defaults to the '
+      'ISOLATE_HASH_INDEX environment variable')
+  parser.add_option(
+      '--bundle-small-files',
+      action='store_true',
+      default=bool(os.environ.get('ISOLATE_BUNDLE_SMALL_FILES')),
+      help='Uploads the small files of directories in tar bundles, reducing '
+      'the number of RPCs. The resulting .isolated can only be fetched by '
+      'clients supporting version %s. Defaults to True if env var '
+      'ISOLATE_BUNDLE_SMALL_FILES is set' % isolated_format.BUNDLED_FILE_VERSION)
+  parser.add_option(
+      '--chunk-large-files',
+      action='store_true',
+      default=bool(os.environ.get('ISOLATE_CHUNK_LARGE_FILES')),
+      help='Uploads the files of directories larger than %dMiB as '
+      'content-defined chunks, so only the chunks modified since a previous '
+      'version are uploaded and fetched. The resulting .isolated can only be '
+      'fetched by clients supporting version %s. Defaults to True if env var '
+      'ISOLATE_CHUNK_LARGE_FILES is set' % (
+          isolated_format.CHUNKED_FILE_THRESHOLD // 1024 // 1024,
+          isolated_format.CHUNKED_FILE_VERSION))
 
 
 def add_isolate_server_options(parser):
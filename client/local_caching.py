@@ -4,7 +4,9 @@
 
 """Define local cache policies."""
 
+import contextlib
 import errno
+import heapq
 import io
 import logging
 import os
@@ -12,6 +14,7 @@ import random
 import string
 import subprocess
 import sys
+import threading
 import time
 
 from utils import file_path
@@ -89,23 +92,42 @@ def trim_caches(caches, path, min_free_space, max_age_secs):
   free_disk = file_path.get_free_space(path) if min_free_space else 0
   total = []
   if min_ts or free_disk:
-    while True:
-      oldest = [(c, c.get_oldest()) for c in caches if len(c) > 0]
-      if not oldest:
-        break
-      oldest.sort(key=lambda k: k[1])
-      c, ts = oldest[0]
+    # Heap of the oldest entry of each cache.
+    oldest = [(c.get_oldest(), i) for i, c in enumerate(caches) if len(c) > 0]
+    heapq.heapify(oldest)
+    while oldest:
+      ts, i = oldest[0]
       if ts >= min_ts and free_disk >= min_free_space:
-        break
-      total.append(c.remove_oldest())
-      if min_free_space:
+        # The free disk space is estimated from the size of the evicted items.
+        # Confirm it before stopping.
+        if not min_free_space:
+          break
         free_disk = file_path.get_free_space(path)
+        if free_disk >= min_free_space:
+          break
+      size = caches[i].remove_oldest()
+      total.append(size)
+      free_disk += max(size, 0)
+      if len(caches[i]) > 0:
+        heapq.heapreplace(oldest, (caches[i].get_oldest(), i))
+      else:
+        heapq.heappop(oldest)
   # Evaluate each cache's own policies.
   for c in caches:
     total.extend(c.trim())
   return total
 
 
+def _int_size(size):
+  """Returns the size of a DiskContentAddressedCache LRU value."""
+  return size
+
+
+def _named_cache_size(value):
+  """Returns the size of a NamedCache LRU value."""
+  return value[1]
+
+
 class NamedCacheError(Exception):
   """Named cache specific error."""
 
@@ -294,6 +316,22 @@ class ContentAddressedCache(Cache):
     """
     raise NotImplementedError()
 
+  def reserve(self, sizes):
+    """Makes room for new items before they are written.
+
+    Items touched or written during this run are never evicted.
+
+    Arguments:
+      sizes: list of the sizes of the items about to be written.
+
+    Returns:
+      Slice with the size of evicted items.
+
+    Raises:
+      NoMoreSpace without evicting anything if the items can't fit.
+    """
+    raise NotImplementedError()
+
 
 class MemoryContentAddressedCache(ContentAddressedCache):
   """ContentAddressedCache implementation that stores everything in memory."""
@@ -305,8 +343,9 @@ class MemoryContentAddressedCache(ContentAddressedCache):
     """
     super(MemoryContentAddressedCache, self).__init__(None)
     self._file_mode_mask = file_mode_mask
-    # Items in a LRU lookup dict(digest: size).
+    # Items in a LRU lookup dict(digest: content).
     self._lru = lru.LRUDict()
+    self._lru.set_size_fn(len)
 
   # Cache interface implementation.
 
@@ -325,7 +364,7 @@ class MemoryContentAddressedCache(ContentAddressedCache):
   @property
   def total_size(self):
     with self._lock:
-      return sum(len(i) for i in self._lru.values())
+      return self._lru.total_size
 
   def get_oldest(self):
     with self._lock:
@@ -376,6 +415,10 @@ class MemoryContentAddressedCache(ContentAddressedCache):
       self._lru.touch(digest)
     return io.BytesIO(d)
 
+  def reserve(self, sizes):
+    """Memory is not accounted for by MemoryContentAddressedCache."""
+    return []
+
   def write(self, digest, content):
     # Assemble whole stream before taking the lock.
     data = six.b('').join(content)
@@ -389,8 +432,15 @@ class DiskContentAddressedCache(ContentAddressedCache):
   """Stateful LRU cache in a flat hash table in a directory.
 
   Saves its state as json file.
+
+  Lookups and LRU bumps only take one of SHARDS locks, picked by digest, so
+  concurrent fetches do not serialize on the cache. LRU bumps are queued in
+  their shard and applied in a batch before the LRU order is next used, that
+  is before any eviction or save. Removing an item from the LRU requires both
+  self._lock and the item's shard lock.
   """
   STATE_FILE = u'state.json'
+  SHARDS = 16
 
   def __init__(self, cache_dir, policies, trim, time_fn=None):
     """
@@ -400,9 +450,12 @@ class DiskContentAddressedCache(ContentAddressedCache):
       trim: if True to enforce |policies| right away.
           It can be done later by calling trim() explicitly.
     """
-    # All protected methods (starting with '_') except _path should be called
-    # with self._lock held.
+    # All protected methods (starting with '_') except _path and _shard should
+    # be called with self._lock held. Lock order is self._lock first, then the
+    # shard locks in increasing index.
     super(DiskContentAddressedCache, self).__init__(cache_dir)
+    # Each shard is (lock, list of digests touched and not yet bumped).
+    self._shards = [(threading.Lock(), []) for _ in range(self.SHARDS)]
     self.policies = policies
     self.state_file = os.path.join(cache_dir, self.STATE_FILE)
     # Items in a LRU lookup dict(digest: size).
@@ -429,19 +482,25 @@ class DiskContentAddressedCache(ContentAddressedCache):
 
   def __iter__(self):
     # This is not thread-safe.
+    with self._lock:
+      self._apply_touches()
     return self._lru.__iter__()
 
   def __contains__(self, digest):
-    with self._lock:
+    # Bumping an item in the LRU removes and re-adds it, which is done while
+    # holding its shard lock.
+    lock, _ = self._shard(digest)
+    with lock:
       return digest in self._lru
 
   @property
   def total_size(self):
     with self._lock:
-      return sum(self._lru.values())
+      return self._lru.total_size
 
   def get_oldest(self):
     with self._lock:
+      self._apply_touches()
       try:
         # (key, (value, ts))
         return self._lru.get_oldest()[1][1]
@@ -449,17 +508,18 @@ class DiskContentAddressedCache(ContentAddressedCache):
         return None
 
   def remove_oldest(self):
-    with self._lock:
+    with self._lock, self._all_shards():
       # TODO(maruel): Update self._added.
       return self._remove_lru_file(True)
 
   def save(self):
     with self._lock:
+      self._apply_touches()
       return self._save()
 
   def trim(self):
     """Forces retention policies."""
-    with self._lock:
+    with self._lock, self._all_shards():
       return self._trim()
 
   def cleanup(self):
@@ -471,7 +531,7 @@ class DiskContentAddressedCache(ContentAddressedCache):
     At that point, the cache was already loaded, trimmed to respect cache
     policies.
     """
-    with self._lock:
+    with self._lock, self._all_shards():
       fs.chmod(self.cache_dir, 0o700)
       # Ensure that all files listed in the state still exist and add new ones.
       previous = set(self._lru)
@@ -506,7 +566,7 @@ class DiskContentAddressedCache(ContentAddressedCache):
 
     # Verify hash of every single item to detect corruption. the corrupted
     # files will be evicted.
-    with self._lock:
+    with self._lock, self._all_shards():
       for digest, (_, timestamp) in list(self._lru._items.items()):
         # verify only if the mtime is grather than the timestamp in state.json
         # to avoid take too long time.
@@ -526,7 +586,10 @@ class DiskContentAddressedCache(ContentAddressedCache):
   # ContentAddressedCache interface implementation.
 
   def __contains__(self, digest):
-    with self._lock:
+    # Bumping an item in the LRU removes and re-adds it, which is done while
+    # holding its shard lock.
+    lock, _ = self._shard(digest)
+    with lock:
       return digest in self._lru
 
   def touch(self, digest, size):
@@ -540,28 +603,37 @@ class DiskContentAddressedCache(ContentAddressedCache):
     # Do the check outside the lock.
     looks_valid = is_valid_file(self._path(digest), size)
 
-    # Update its LRU position.
-    with self._lock:
+    lock, touched = self._shard(digest)
+    if looks_valid:
+      # Queue the LRU bump. The item can't be evicted without holding the
+      # shard lock, and evicting applies the queued bumps first.
+      with lock:
+        if digest in self._lru:
+          touched.append(digest)
+          return True
+
+    with self._lock, lock:
       if digest not in self._lru:
         if looks_valid:
           # Exists but not in the LRU anymore.
           self._delete_file(digest, size)
         return False
-      if not looks_valid:
-        self._lru.pop(digest)
-        # Exists but not in the LRU anymore.
-        self._delete_file(digest, size)
-        return False
-      self._lru.touch(digest)
-      self._protected = self._protected or digest
-    return True
+      if looks_valid:
+        # Added while waiting for the lock.
+        self._touch(digest)
+        return True
+      self._lru.pop(digest)
+      # Exists but not in the LRU anymore.
+      self._delete_file(digest, size)
+      return False
 
   def getfileobj(self, digest):
     try:
       f = fs.open(self._path(digest), 'rb')
     except IOError:
       raise CacheMiss(digest)
-    with self._lock:
+    lock, _ = self._shard(digest)
+    with lock:
       try:
         self._used.append(self._lru[digest])
       except KeyError:
@@ -599,6 +671,54 @@ class DiskContentAddressedCache(ContentAddressedCache):
       self._add(digest, size)
     return digest
 
+  def reserve(self, sizes):
+    """Evicts in one batch the least recently used items needed to fit |sizes|.
+
+    Unknown sizes are assumed to be empty.
+    """
+    needed = sum(s for s in sizes if s != UNKNOWN_FILE_SIZE)
+    with self._lock, self._all_shards():
+      self._free_disk = file_path.get_free_space(self.cache_dir)
+      total_size = self._lru.total_size
+      count = len(self._lru)
+
+      def fits(evicted, freed):
+        if (self.policies.max_cache_size and
+            total_size - freed + needed > self.policies.max_cache_size):
+          return False
+        if (self.policies.max_items and
+            count - evicted + len(sizes) > self.policies.max_items):
+          return False
+        return (self._free_disk + freed - needed >=
+                self.policies.min_free_space)
+
+      # Items more recent than the first protected one were referenced during
+      # this run and can't be evicted.
+      evicted = 0
+      freed = 0
+      for digest, size in self._lru.items():
+        if fits(evicted, freed) or digest == self._protected:
+          break
+        evicted += 1
+        freed += size
+      if not fits(evicted, freed):
+        raise NoMoreSpace(
+            ('Not enough space to fetch the whole isolated tree.\n'
+             '  %s\n  cache=%d bytes (%.3f GiB), %d items; '
+             '%s bytes (%.3f GiB) free_space; '
+             '%d items of %d bytes (%.3f GiB) to fetch') % (
+                 self.policies, total_size, float(total_size) / 1024**3,
+                 count, self._free_disk, float(self._free_disk) / 1024**3,
+                 len(sizes), needed, float(needed) / 1024**3))
+
+      trimmed = [self._remove_lru_file(True) for _ in range(evicted)]
+      if trimmed:
+        logging.info(
+            'Evicted %d file(s) (%.1fkb) to fetch %d file(s) (%.1fkb)',
+            len(trimmed), sum(trimmed) / 1024., len(sizes), needed / 1024.)
+        self._save()
+      return trimmed
+
   # Internal functions.
 
   def _load(self, trim, time_fn):
@@ -621,6 +741,7 @@ class DiskContentAddressedCache(ContentAddressedCache):
         file_path.rmtree(self.cache_dir)
         fs.makedirs(self.cache_dir)
         self._free_disk = file_path.get_free_space(self.cache_dir)
+    self._lru.set_size_fn(_int_size)
     if time_fn:
       self._lru.time_fn = time_fn
     if trim:
@@ -638,6 +759,56 @@ class DiskContentAddressedCache(ContentAddressedCache):
       file_path.set_read_only(self.state_file, False)
     self._lru.save(self.state_file)
 
+  def _shard(self, digest):
+    """Returns the (lock, touched digests) shard of |digest|."""
+    return self._shards[hash(digest) % len(self._shards)]
+
+  @contextlib.contextmanager
+  def _all_shards(self):
+    """Holds all the shard locks, which is needed to evict items.
+
+    The queued LRU bumps are applied first.
+    """
+    self._lock.assert_locked()
+    for lock, _ in self._shards:
+      lock.acquire()
+    try:
+      self._apply_touches(shards_locked=True)
+      yield
+    finally:
+      for lock, _ in reversed(self._shards):
+        lock.release()
+
+  def _apply_touches(self, shards_locked=False):
+    """Bumps the LRU position of the items touched since the last call.
+
+    Each shard's lock is held while its bumps are applied, since bumping an
+    item removes and re-adds it in the LRU, and lookups only hold the shard
+    lock.
+
+    Arguments:
+      shards_locked: True if the caller already holds all the shard locks.
+    """
+    self._lock.assert_locked()
+    for lock, touched in self._shards:
+      if not shards_locked:
+        lock.acquire()
+      try:
+        for digest in touched:
+          # It may have been removed by touch() since, if it became invalid.
+          if digest in self._lru:
+            self._touch(digest)
+        del touched[:]
+      finally:
+        if not shards_locked:
+          lock.release()
+
+  def _touch(self, digest):
+    """Marks |digest| as the most recently used item and protects it."""
+    self._lock.assert_locked()
+    self._lru.touch(digest)
+    self._protected = self._protected or digest
+
   def _trim(self):
     """Trims anything we don't know, make sure enough free space exists."""
     self._lock.assert_locked()
@@ -655,11 +826,8 @@ class DiskContentAddressedCache(ContentAddressedCache):
 
     # Ensure maximum cache size.
     if self.policies.max_cache_size:
-      total_size = sum(self._lru.values())
-      while total_size > self.policies.max_cache_size:
-        e = self._remove_lru_file(True)
-        evicted.append(e)
-        total_size -= e
+      while self._lru.total_size > self.policies.max_cache_size:
+        evicted.append(self._remove_lru_file(True))
 
     # Ensure maximum number of items in the cache.
     if self.policies.max_items and len(self._lru) > self.policies.max_items:
@@ -676,7 +844,7 @@ class DiskContentAddressedCache(ContentAddressedCache):
       evicted.append(self._remove_lru_file(True))
 
     if evicted:
-      total_usage = sum(self._lru.values())
+      total_usage = self._lru.total_size
       usage_percent = 0.
       if total_usage:
         usage_percent = 100. * float(total_usage) / self.policies.max_cache_size
@@ -703,7 +871,7 @@ class DiskContentAddressedCache(ContentAddressedCache):
     try:
       digest, _ = self._lru.get_oldest()
       if not allow_protected and digest == self._protected:
-        total_size = sum(self._lru.values())
+        total_size = self._lru.total_size
         msg = ('Not enough space to fetch the whole isolated tree.\n'
                ' %s\n  cache=%d bytes (%.3f GiB), %d items; '
                '%s bytes (%.3f GiB) free_space') % (
@@ -725,7 +893,9 @@ class DiskContentAddressedCache(ContentAddressedCache):
     if size == UNKNOWN_FILE_SIZE:
       size = fs.stat(self._path(digest)).st_size
     self._added.append(size)
-    self._lru.add(digest, size)
+    lock, _ = self._shard(digest)
+    with lock:
+      self._lru.add(digest, size)
     self._free_disk -= size
     # Do a quicker version of self._trim(). It only enforces free disk space,
     # not cache size limits. It doesn't actually look at real free disk space,
@@ -733,11 +903,14 @@ class DiskContentAddressedCache(ContentAddressedCache):
     # real trimming but doing this quick version here makes it possible to map
     # an isolated that is larger than the current amount of free disk space when
     # the cache size is already large.
-    while (self.policies.min_free_space and self._lru and
-           self._free_disk < self.policies.min_free_space):
-      # self._free_disk is updated by this call.
-      if self._remove_lru_file(False) == -1:
-        break
+    if not (self.policies.min_free_space and
+            self._free_disk < self.policies.min_free_space):
+      return
+    with self._all_shards():
+      while self._lru and self._free_disk < self.policies.min_free_space:
+        # self._free_disk is updated by this call.
+        if self._remove_lru_file(False) == -1:
+          break
 
   def _delete_file(self, digest, size=UNKNOWN_FILE_SIZE):
     """Deletes cache file from the file system.
@@ -817,6 +990,7 @@ class NamedCache(Cache):
         self._lru = lru.LRUDict()
       with self._lock:
         self._try_upgrade()
+    self._lru.set_size_fn(_named_cache_size)
     if time_fn:
       self._lru.time_fn = time_fn
 
@@ -988,7 +1162,7 @@ class NamedCache(Cache):
   @property
   def total_size(self):
     with self._lock:
-      return sum(size for _rel_path, size in self._lru.values())
+      return self._lru.total_size
 
   def get_oldest(self):
     with self._lock:
@@ -1043,13 +1217,17 @@ class NamedCache(Cache):
               'NamedCache.trim(): Removed %r(%d) due to max_age_secs(%d)',
               name, size, self._policies.max_age_secs)
 
-      # Trim according to minimum free space.
+      # Trim according to minimum free space. The free space is estimated from
+      # the size of the removed items and only checked once it looks enough.
       if self._policies.min_free_space:
+        free_space = file_path.get_free_space(self.cache_dir)
         while self._lru:
-          free_space = file_path.get_free_space(self.cache_dir)
           if free_space >= self._policies.min_free_space:
-            break
+            free_space = file_path.get_free_space(self.cache_dir)
+            if free_space >= self._policies.min_free_space:
+              break
           name, size = self._remove_lru_item()
+          free_space += size
           evicted.append(size)
           logging.info(
               'NamedCache.trim(): Removed %r(%d) due to min_free_space(%d)',
@@ -1058,8 +1236,7 @@ class NamedCache(Cache):
       # Trim according to maximum total size.
       if self._policies.max_cache_size:
         while self._lru:
-          total = sum(size for _rel_cache, size in self._lru.values())
-          if total <= self._policies.max_cache_size:
+          if self._lru.total_size <= self._policies.max_cache_size:
             break
           name, size = self._remove_lru_item()
           evicted.append(size)
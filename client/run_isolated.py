@@ -1680,6 +1680,8 @@ def main(args):
   # TODO(maruel): CIPD caches should be defined at an higher level here too, so
   # they can be cleaned the same way.
 
+  # The isolated cache keeps the json state, the Go isolated client reads and
+  # writes it when it uses this directory as its cache.
   isolate_cache = isolateserver.process_cache_options(options, trim=False)
   cas_cache = process_cas_cache_options(options)
 
@@ -303,6 +303,20 @@ def trigger_task_shards(swarming, task_request):
 # How often to print status updates to stdout in 'collect'.
 STATUS_UPDATE_INTERVAL = 5 * 60.
 
+# Maximum number of task IDs per tasks/get_states or tasks/wait_states request
+# in 'collect'.
+STATES_BATCH_SIZE = 100
+
+# Maximum number of seconds to long poll tasks/wait_states for in 'collect'.
+STATES_WAIT_SECS = 40
+
+# Default maximum number of threads fetching the results in 'collect'.
+COLLECT_MAX_THREADS = 16
+
+# Number of consecutive failed tasks/get_states rounds after which 'collect'
+# polls each task instead, when there is no timeout.
+STATES_MAX_FAILURES = 10
+
 
 class TaskState(object):
   """Represents the current task state.
@@ -351,7 +365,7 @@ class TaskOutputCollector(object):
   Optionally fetches task outputs from isolate server to local disk (used when
   --task-output-dir is passed).
 
-  This object is shared among multiple threads running 'retrieve_results'
+  This object is shared among the thread pool running 'retrieve_results'
   function, in particular they call 'process_shard_result' method in parallel.
   """
 
@@ -490,6 +504,48 @@ def parse_time(value):
   raise ValueError('Failed to parse %s' % value)
 
 
+class StatesUnavailable(Exception):
+  """The states of the tasks cannot be polled together."""
+
+
+class StatesAccessDenied(StatesUnavailable):
+  """The user is not allowed to read the states of all the tasks at once."""
+
+
+def get_task_states(base_url, task_ids, wait_secs):
+  """Returns the states of the tasks as a list of str.
+
+  When wait_secs is set, uses tasks/wait_states, which returns as soon as one of
+  the tasks is neither PENDING nor RUNNING or after wait_secs seconds.
+  Otherwise uses tasks/get_states, which returns immediately.
+
+  Returns:
+    list of str, one per task ID, or None on failure.
+
+  Raises:
+    StatesAccessDenied if the user cannot view all the tasks, which both APIs
+    require.
+  """
+  query = [('task_id', task_id) for task_id in task_ids]
+  if wait_secs:
+    query.append(('timeout_secs', int(wait_secs)))
+    url = '%s/_ah/api/swarming/v1/tasks/wait_states?' % base_url
+  else:
+    url = '%s/_ah/api/swarming/v1/tasks/get_states?' % base_url
+  # Disable internal retries in net.url_read_json, since the caller is doing
+  # retries itself.
+  result = net.url_read_json(
+      url + urllib.parse.urlencode(query), retry_50x=False,
+      expected_error_codes=(403,))
+  if result and result.get('error'):
+    if result['error'].get('code') == 403:
+      raise StatesAccessDenied(result['error'].get('message'))
+    return None
+  if not result or len(result.get('states', [])) != len(task_ids):
+    return None
+  return result['states']
+
+
 def retrieve_results(base_url, shard_index, task_id, timeout, should_stop,
                      output_collector, include_perf, fetch_stdout):
   """Retrieves results for a single task ID.
@@ -571,6 +627,83 @@ def retrieve_results(base_url, shard_index, task_id, timeout, should_stop,
       return result
 
 
+def poll_task_states(base_url, pending, timeout, should_stop, on_done):
+  """Polls the states of the pending tasks until they are all done.
+
+  The tasks are polled STATES_BATCH_SIZE at a time. When they all fit in one
+  batch, the server is long-polled with tasks/wait_states, falling back to
+  tasks/get_states with an increasing delay if it is not supported.
+
+  Arguments:
+    pending: dict(shard_index: task_id) of the tasks to poll. It is emptied as
+        tasks are done.
+    on_done: called with (shard_index, task_id) for each task that is done.
+
+  Returns:
+    True if all the tasks are done, False on timeout or abort.
+
+  Raises:
+    StatesAccessDenied if the user cannot read the states of all the tasks.
+    StatesUnavailable if there is no timeout and polling the states failed
+    STATES_MAX_FAILURES times in a row.
+  """
+  started = now()
+  deadline = started + timeout if timeout > 0 else None
+  use_wait = len(pending) <= STATES_BATCH_SIZE
+  attempt = 0
+  failures = 0
+  while pending and not should_stop.is_set():
+    attempt += 1
+
+    # Waiting for too long -> give up.
+    current_time = now()
+    if deadline and current_time >= deadline:
+      logging.error('poll_task_states(%s) timed out on attempt %d', base_url,
+                    attempt)
+      return False
+
+    # Do not spin too fast. Spin faster at the beginning though.
+    # Start with 1 sec delay and for each 30 sec of waiting add another second
+    # of delay, until hitting 15 sec ceiling. Long polling doesn't need it.
+    if attempt > 1 and not use_wait:
+      max_delay = min(15, 1 + (current_time - started) / 30.0)
+      delay = min(max_delay, deadline - current_time) if deadline else max_delay
+      if delay > 0:
+        logging.debug('Waiting %.1f sec before retrying', delay)
+        should_stop.wait(delay)
+        if should_stop.is_set():
+          return False
+
+    items = sorted(pending.items())
+    polled = False
+    for i in range(0, len(items), STATES_BATCH_SIZE):
+      batch = items[i:i + STATES_BATCH_SIZE]
+      task_ids = [task_id for _, task_id in batch]
+      states = None
+      if use_wait:
+        wait_secs = STATES_WAIT_SECS
+        if deadline:
+          wait_secs = min(wait_secs, deadline - current_time)
+        states = get_task_states(base_url, task_ids, max(wait_secs, 1))
+        if states is None:
+          logging.info('tasks/wait_states failed, falling back to polling')
+          use_wait = False
+      if states is None:
+        states = get_task_states(base_url, task_ids, 0)
+      if states is None:
+        continue
+      polled = True
+      for (shard_index, task_id), state in zip(batch, states):
+        if state not in TaskState.STATES_RUNNING:
+          del pending[shard_index]
+          on_done(shard_index, task_id)
+    failures = 0 if polled else failures + 1
+    if not deadline and failures >= STATES_MAX_FAILURES:
+      raise StatesUnavailable(
+          'Failed to poll the states %d times in a row' % failures)
+  return not pending
+
+
 def yield_results(swarm_base_url, task_ids, timeout, max_threads,
                   print_status_updates, output_collector, include_perf,
                   fetch_stdout):
@@ -580,9 +713,13 @@ def yield_results(swarm_base_url, task_ids, timeout, max_threads,
   Timed out shards are NOT yielded at all. Caller can compare number of yielded
   shards with len(task_keys) to verify all shards completed.
 
-  max_threads is optional and is used to limit the number of parallel fetches
-  done. Since in general the number of task_keys is in the range <=10, it's not
-  worth normally to limit the number threads. Mostly used for testing purposes.
+  The states of all the tasks are polled together by a single thread, see
+  poll_task_states(). The results, outputs and output files are only fetched
+  for the tasks that are done, on a shared pool of at most max_threads threads,
+  COLLECT_MAX_THREADS by default. Users who cannot view all the tasks are not
+  allowed to poll the states this way, so each task's result is polled
+  individually instead, on one thread per task unless max_threads is set. These
+  tasks share the deadline of the whole collection.
 
   output_collector is an optional instance of TaskOutputCollector that will be
   used to fetch files produced by a task from isolate server to the local disk.
@@ -591,12 +728,16 @@ def yield_results(swarm_base_url, task_ids, timeout, max_threads,
     (index, result). In particular, 'result' is defined as the
     GetRunnerResults() function in services/swarming/server/test_runner.py.
   """
-  number_threads = (
-      min(max_threads, len(task_ids)) if max_threads else len(task_ids))
+  if not task_ids:
+    return
+  deadline = now() + timeout if timeout > 0 else None
+  number_threads = min(max_threads or COLLECT_MAX_THREADS, len(task_ids))
   should_stop = threading.Event()
   results_channel = threading_utils.TaskChannel()
 
-  with threading_utils.ThreadPool(number_threads, number_threads, 0) as pool:
+  # One more thread for poll_task_states().
+  with threading_utils.ThreadPool(
+      number_threads + 1, number_threads + 1, 0) as pool:
     try:
       # Adds a task to the thread pool to call 'retrieve_results' and return
       # the results together with shard_index that produced them (as a tuple).
@@ -607,9 +748,49 @@ def yield_results(swarm_base_url, task_ids, timeout, max_threads,
                       shard_index, task_id, timeout, should_stop,
                       output_collector, include_perf, fetch_stdout)
 
-      # Enqueue 'retrieve_results' calls for each shard key to run in parallel.
-      for shard_index, task_id in enumerate(task_ids):
-        enqueue_retrieve_results(shard_index, task_id)
+      def poll_each_task():
+        # retrieve_results() polls the result until the task is done, so each
+        # pending task gets its own thread and the time left until the shared
+        # deadline.
+        def task_fn(shard_index, task_id):
+          task_timeout = timeout
+          if deadline:
+            task_timeout = deadline - now()
+            if task_timeout <= 0:
+              logging.error('retrieve_results(%s) timed out', task_id)
+              return shard_index, None
+          return shard_index, retrieve_results(
+              swarm_base_url, shard_index, task_id, task_timeout, should_stop,
+              output_collector, include_perf, fetch_stdout)
+
+        count = min(max_threads or len(pending), len(pending))
+        with threading_utils.ThreadPool(count, count, 0) as each_pool:
+          for shard_index, task_id in sorted(pending.items()):
+            del pending[shard_index]
+            each_pool.add_task(0, results_channel.wrap_task(task_fn),
+                               shard_index, task_id)
+
+      pending = dict(enumerate(task_ids))
+      if timeout == -1:
+        # Fetch the results right away, whatever the state of the tasks.
+        for shard_index, task_id in sorted(pending.items()):
+          enqueue_retrieve_results(shard_index, task_id)
+      else:
+        def poll():
+          try:
+            poll_task_states(swarm_base_url, pending, timeout, should_stop,
+                             enqueue_retrieve_results)
+          except StatesUnavailable as e:
+            logging.info('Polling each task instead of the states: %s', e)
+            poll_each_task()
+          except Exception:
+            logging.exception('Unexpected exception in poll_task_states')
+          finally:
+            # Unblock the loop below for the shards that are not done.
+            for shard_index in list(pending):
+              results_channel.send_result((shard_index, None))
+
+        pool.add_task(1, poll)
 
       # Wait for all of them to finish.
       # Convert to list, since range in Python3 doesn't have remove.
@@ -4,6 +4,7 @@
 # Use of this source code is governed under the Apache License, Version 2.0
 # that can be found in the LICENSE file.
 
+import errno
 import getpass
 import io
 import os
@@ -176,6 +177,34 @@ class FilePathTest(auto_stub.TestCase):
     # must be reset to be read-only after deleting one of the hard link
     # directory entry.
 
+  def test_copy_file(self):
+    src = os.path.join(self.tempdir, 'src')
+    dst = os.path.join(self.tempdir, 'dst')
+    write_content(src, b'foo' * 100000)
+    fs.chmod(src, 0o500)
+    method = file_path.copy_file(src, dst)
+    self.assertIn(
+        method, ('copy2', 'reflink', 'copy_file_range', 'sendfile', 'copy'))
+    with fs.open(dst, 'rb') as f:
+      self.assertEqual(b'foo' * 100000, f.read())
+    self.assertMaskedFileMode(dst, 0o100500)
+
+  if sys.platform.startswith('linux'):
+
+    def test_copy_file_fallback(self):
+      def unsupported(*_args):
+        raise OSError(errno.EOPNOTSUPP, 'Operation not supported')
+      self.mock(file_path.fcntl, 'ioctl', unsupported)
+      for name in ('copy_file_range', 'sendfile'):
+        if hasattr(os, name):
+          self.mock(os, name, unsupported)
+      src = os.path.join(self.tempdir, 'src')
+      dst = os.path.join(self.tempdir, 'dst')
+      write_content(src, b'foo')
+      self.assertEqual('copy', file_path.copy_file(src, dst))
+      with fs.open(dst, 'rb') as f:
+        self.assertEqual(b'foo', f.read())
+
   def test_ensure_tree(self):
     dir_foo = os.path.join(self.tempdir, 'foo')
     file_path.ensure_tree(dir_foo, 0o777)
@@ -0,0 +1,135 @@
+#!/usr/bin/env vpython3
+# Copyright 2026 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+import collections
+import hashlib
+import os
+import tempfile
+import unittest
+
+# Mutates sys.path.
+import test_env
+
+import isolated_format
+from utils import file_path
+from utils import hash_index
+
+
+Stat = collections.namedtuple(
+    'Stat', 'st_dev st_ino st_size st_mtime st_mtime_ns')
+
+
+def _stat(ino, size=10, mtime=1000):
+  return Stat(1, ino, size, mtime, mtime * 1000000000)
+
+
+class HashIndexTest(unittest.TestCase):
+  def setUp(self):
+    super(HashIndexTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'hash_index_test')
+    self.path = os.path.join(self.tempdir, u'index')
+
+  def tearDown(self):
+    file_path.rmtree(self.tempdir)
+    super(HashIndexTest, self).tearDown()
+
+  def test_get_add(self):
+    index = hash_index.HashIndex()
+    self.assertIsNone(index.get(_stat(1), 'sha1'))
+    self.assertTrue(index.add(_stat(1), 'sha1', 'ab' * 20))
+    self.assertEqual('ab' * 20, index.get(_stat(1), 'sha1'))
+    # Every part of the key matters.
+    self.assertIsNone(index.get(_stat(2), 'sha1'))
+    self.assertIsNone(index.get(_stat(1, size=11), 'sha1'))
+    self.assertIsNone(index.get(_stat(1, mtime=1001), 'sha1'))
+    self.assertIsNone(index.get(_stat(1), 'sha256'))
+    self.assertEqual((1, 5), (index.hits, index.misses))
+
+  def test_add_racy(self):
+    index = hash_index.HashIndex()
+    self.assertFalse(index.add(_stat(1), 'sha1', 'ab' * 20, now=1001))
+    self.assertTrue(index.add(_stat(1), 'sha1', 'ab' * 20, now=1002))
+
+  def test_add_unsupported(self):
+    index = hash_index.HashIndex()
+    self.assertFalse(index.add(_stat(0), 'sha1', 'ab' * 20))
+    self.assertFalse(index.add(_stat(1), 'md5', 'ab' * 16))
+    self.assertEqual(0, len(index))
+
+  def test_save_load(self):
+    index = hash_index.HashIndex()
+    index.add(_stat(1), 'sha1', 'ab' * 20)
+    index.add(_stat(2), 'sha512', 'cd' * 64)
+    self.assertTrue(index.save(self.path))
+    # Not modified.
+    self.assertFalse(index.save(self.path))
+
+    index = hash_index.HashIndex.load(self.path)
+    self.assertEqual(2, len(index))
+    self.assertEqual('ab' * 20, index.get(_stat(1), 'sha1'))
+    self.assertEqual('cd' * 64, index.get(_stat(2), 'sha512'))
+
+  def test_load_missing(self):
+    self.assertEqual(0, len(hash_index.HashIndex.load(self.path)))
+
+  def test_load_corrupted(self):
+    index = hash_index.HashIndex()
+    index.add(_stat(1), 'sha1', 'ab' * 20)
+    index.save(self.path)
+    with open(self.path, 'r+b') as f:
+      f.truncate(os.path.getsize(self.path) - 1)
+    self.assertEqual(0, len(hash_index.HashIndex.load(self.path)))
+    with open(self.path, 'wb') as f:
+      f.write(b'garbage')
+    self.assertEqual(0, len(hash_index.HashIndex.load(self.path)))
+
+  def test_eviction(self):
+    index = hash_index.HashIndex(max_entries=2)
+    index.add(_stat(1), 'sha1', 'ab' * 20)
+    index.add(_stat(2), 'sha1', 'cd' * 20)
+    index.save(self.path)
+
+    # Only entry 2 is used in the next session, so entry 1 is the oldest.
+    index = hash_index.HashIndex.load(self.path, max_entries=2)
+    self.assertEqual('cd' * 20, index.get(_stat(2), 'sha1'))
+    index.add(_stat(3), 'sha1', 'ef' * 20)
+    index.save(self.path)
+
+    index = hash_index.HashIndex.load(self.path, max_entries=2)
+    self.assertEqual(2, len(index))
+    self.assertIsNone(index.get(_stat(1), 'sha1'))
+    self.assertEqual('cd' * 20, index.get(_stat(2), 'sha1'))
+    self.assertEqual('ef' * 20, index.get(_stat(3), 'sha1'))
+
+  def test_hash_file(self):
+    path = os.path.join(self.tempdir, u'a')
+    with open(path, 'wb') as f:
+      f.write(b'hello')
+    expected = hashlib.sha256(b'hello').hexdigest()
+    index = hash_index.HashIndex()
+
+    # Freshly written files are not indexed.
+    self.assertEqual(
+        expected, isolated_format.hash_file(path, hashlib.sha256, index))
+    self.assertEqual(0, len(index))
+
+    os.utime(path, (1000000000, 1000000000))
+    self.assertEqual(
+        expected, isolated_format.hash_file(path, hashlib.sha256, index))
+    self.assertEqual(1, len(index))
+    self.assertEqual(
+        expected, isolated_format.hash_file(path, hashlib.sha256, index))
+    self.assertEqual(1, index.hits)
+
+    # Modifying the file invalidates the entry.
+    with open(path, 'wb') as f:
+      f.write(b'world')
+    self.assertEqual(
+        hashlib.sha256(b'world').hexdigest(),
+        isolated_format.hash_file(path, hashlib.sha256, index))
+
+
+if __name__ == '__main__':
+  test_env.main()
@@ -35,16 +35,38 @@ class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
 
   def read_body(self):
     """Reads the request body."""
+    if self._is_chunked():
+      return b''.join(self.yield_body())
     return self.rfile.read(int(self.headers['Content-Length']))
 
   def yield_body(self):
     """Yields the request body as 4kiB chunks."""
+    if self._is_chunked():
+      for chunk in self._yield_chunked_body():
+        yield chunk
+      return
     size = int(self.headers['Content-Length'])
     while size:
       chunk = min(4096, size)
       yield self.rfile.read(chunk)
       size -= chunk
 
+  def _is_chunked(self):
+    return self.headers.get('Transfer-Encoding', '').lower() == 'chunked'
+
+  def _yield_chunked_body(self):
+    """Yields the chunks of a body sent with chunked transfer encoding."""
+    while True:
+      size = int(self.rfile.readline().split(b';', 1)[0].strip(), 16)
+      if not size:
+        # Skip the optional trailers up to the final empty line.
+        while self.rfile.readline().strip():
+          pass
+        return
+      yield self.rfile.read(size)
+      # Each chunk is followed by CRLF.
+      self.rfile.readline()
+
   ### Overrides from BaseHTTPRequestHandler
 
   def do_OPTIONS(self):
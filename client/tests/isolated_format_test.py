@@ -21,6 +21,7 @@ from depot_tools import auto_stub
 import isolated_format
 from utils import file_path
 from utils import fs
+from utils import hash_index
 from utils import tools
 
 import isolateserver_fake
@@ -218,6 +219,129 @@ class TestIsolated(auto_stub.TestCase):
     expected = gen_data(os.path.sep)
     self.assertEqual(expected, actual)
 
+  def test_load_isolated_bundled_bad(self):
+    bundle = {
+      u'h': u'0123456789abcdef0123456789abcdef01234567',
+      u's': 1024,
+      u't': u'tar',
+    }
+    member = {
+      u'b': u'bundle.tar',
+      u'h': u'89abcdef0123456789abcdef0123456789abcdef',
+      u's': 2,
+    }
+    bad = [
+      # Bundles require version 2.1.
+      ({u'bundle.tar': bundle, u'a': member},
+       isolated_format.ISOLATED_FILE_VERSION),
+      ({u'a': member}, isolated_format.BUNDLED_FILE_VERSION),
+      ({u'bundle.tar': None, u'a': member},
+       isolated_format.BUNDLED_FILE_VERSION),
+      ({u'bundle.tar': dict(bundle, t=u'basic'), u'a': member},
+       isolated_format.BUNDLED_FILE_VERSION),
+    ]
+    for files, version in bad:
+      data = {u'files': files, u'version': version}
+      with self.assertRaises(isolated_format.IsolatedError):
+        isolated_format.load_isolated(json.dumps(data), isolateserver_fake.ALGO)
+    data = {
+      u'files': {u'bundle.tar': bundle, u'a': member},
+      u'version': isolated_format.BUNDLED_FILE_VERSION,
+    }
+    self.assertEqual(
+        data,
+        isolated_format.load_isolated(
+            json.dumps(data), isolateserver_fake.ALGO))
+
+  def test_load_isolated_chunked(self):
+    data = {
+      u'files': {
+        u'a': {
+          u'c': [
+              [u'0123456789abcdef0123456789abcdef01234567', 2],
+              [u'89abcdef0123456789abcdef0123456789abcdef', 1],
+          ],
+          u'h': u'0123456789abcdef0123456789abcdef01234567',
+          u'm': 0o500,
+          u's': 3,
+          u't': u'chunked',
+        },
+      },
+      u'version': isolated_format.CHUNKED_FILE_VERSION,
+    }
+    m = isolated_format.load_isolated(json.dumps(data), isolateserver_fake.ALGO)
+    self.assertEqual(data, m)
+
+  def test_load_isolated_chunked_bad(self):
+    chunked = {
+      u'c': [[u'0123456789abcdef0123456789abcdef01234567', 2]],
+      u'h': u'0123456789abcdef0123456789abcdef01234567',
+      u's': 2,
+      u't': u'chunked',
+    }
+    bad = [
+      # Chunks require version 2.1.
+      (dict(chunked), isolated_format.ISOLATED_FILE_VERSION),
+      (dict(chunked, s=3), isolated_format.CHUNKED_FILE_VERSION),
+      (dict(chunked, t=u'basic'), isolated_format.CHUNKED_FILE_VERSION),
+      (dict(chunked, c=[]), isolated_format.CHUNKED_FILE_VERSION),
+      (dict(chunked, c=[[u'foo', 2]]), isolated_format.CHUNKED_FILE_VERSION),
+    ]
+    for props, version in bad:
+      data = {u'files': {u'a': props}, u'version': version}
+      with self.assertRaises(isolated_format.IsolatedError):
+        isolated_format.load_isolated(json.dumps(data), isolateserver_fake.ALGO)
+
+  def test_chunk_file(self):
+    tempdir = tempfile.mkdtemp(prefix=u'isolated_format')
+    try:
+      path = os.path.join(tempdir, u'file')
+      content = os.urandom(8 * 1024 * 1024)
+      with fs.open(path, 'wb') as f:
+        f.write(content)
+      digest, chunks = isolated_format.chunk_file(path, ALGO)
+      self.assertEqual(ALGO(content).hexdigest(), digest)
+      offset = 0
+      for i, (chunk_digest, size) in enumerate(chunks):
+        self.assertLessEqual(size, isolated_format.CHUNK_MAX_SIZE)
+        if i != len(chunks) - 1:
+          self.assertGreater(size, isolated_format.CHUNK_MIN_SIZE)
+        self.assertEqual(
+            ALGO(content[offset:offset + size]).hexdigest(), chunk_digest)
+        offset += size
+      self.assertEqual(len(content), offset)
+
+      # Inserting data only modifies the chunks around it.
+      with fs.open(path, 'wb') as f:
+        f.write(content[:4000000] + b'inserted' + content[4000000:])
+      _, modified = isolated_format.chunk_file(path, ALGO)
+      self.assertLessEqual(len(set(modified) - set(chunks)), 2)
+    finally:
+      file_path.rmtree(tempdir)
+
+  def test_chunk_file_index(self):
+    tempdir = tempfile.mkdtemp(prefix=u'isolated_format')
+    try:
+      path = os.path.join(tempdir, u'file')
+      content = os.urandom(1024 * 1024)
+      with fs.open(path, 'wb') as f:
+        f.write(content)
+      # Make the file old enough to be indexed.
+      os.utime(path, (1000000000, 1000000000))
+      index = hash_index.HashIndex()
+      digest, chunks = isolated_format.chunk_file(path, ALGO, index)
+      self.assertEqual(ALGO(content).hexdigest(), digest)
+      self.assertEqual(
+          digest, index.get(fs.stat(path), hash_index.algo_name(ALGO)))
+
+      # The digest of the whole file is taken from the index, the chunks are
+      # still computed.
+      index.add(fs.stat(path), hash_index.algo_name(ALGO), u'0' * 40)
+      self.assertEqual(
+          (u'0' * 40, chunks), isolated_format.chunk_file(path, ALGO, index))
+    finally:
+      file_path.rmtree(tempdir)
+
   def test_save_isolated_good_long_size(self):
     calls = []
     self.mock(tools, 'write_json', lambda *x: calls.append(x))
@@ -9,6 +9,8 @@ import logging
 import re
 import zlib
 
+from six.moves import urllib
+
 import httpserver
 
 ALGO = hashlib.sha1
@@ -61,9 +63,12 @@ class FakeIsolateServerHandler(httpserver.Handler):
   def _storage_helper(self, body, finalize_gs):
     """Processes handlers_endpoints_v1.StorageRequest."""
     request = json.loads(body)
-    message = 'gs' if finalize_gs else 'datastore'
     content = base64.b64decode(request['content']) if not finalize_gs else None
-    embedded = FakeSigner.validate(request['upload_ticket'], message)
+    self._store(request['upload_ticket'], content, finalize_gs)
+
+  def _store(self, upload_ticket, content, finalize_gs):
+    message = 'gs' if finalize_gs else 'datastore'
+    embedded = FakeSigner.validate(upload_ticket, message)
     # Embedded is an internal format used by
     # handlers_endpoints_v1.IsolateService.generate_ticket.
     namespace = embedded['n']
@@ -92,6 +97,23 @@ class FakeIsolateServerHandler(httpserver.Handler):
       namespace, h = self.path[len('/FAKE_GCS/'):].split('/', 1)
       content = self.server.contents.get(namespace, {}).get(h)
       self.send_octet_stream(content)
+    elif self.path.startswith('/api/isolateservice/v1/retrieve_raw/'):
+      path = urllib.parse.urlparse(self.path)
+      namespace, h = path.path[
+          len('/api/isolateservice/v1/retrieve_raw/'):].split('/', 1)
+      offset = int(urllib.parse.parse_qs(path.query).get('offset', ['0'])[0])
+      data = self.server.contents.get(namespace, {}).get(h)
+      if data is None:
+        logging.error('Failed to retrieve %s / %s', namespace, h)
+        self.send_error(404)
+      elif self._should_push_to_gs(None, len(data)):
+        self.send_response(302)
+        self.send_header('Location', self._generate_signed_url(h, namespace))
+        self.end_headers()
+      else:
+        if self.server.store_hash_instead:
+          data = data.encode()
+        self.send_octet_stream(data[offset:])
     else:
       raise NotImplementedError(self.path)
 
@@ -128,6 +150,10 @@ class FakeIsolateServerHandler(httpserver.Handler):
             }, index, response['items'])
       logging.info('Returning %s' % response)
       self.send_json(response)
+    elif self.path.startswith('/api/isolateservice/v1/store_inline_raw'):
+      query = urllib.parse.urlparse(self.path).query
+      self._store(
+          urllib.parse.parse_qs(query)['upload_ticket'][0], body, False)
     elif self.path.startswith('/_ah/api/isolateservice/v1/store_inline'):
       self._storage_helper(body, False)
     elif self.path.startswith('/_ah/api/isolateservice/v1/finalize_gs_upload'):
@@ -0,0 +1,29 @@
+#!/usr/bin/env vpython
+# Copyright 2026 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Runs the end to end isolateserver tests on python 2.
+
+httplib and the evaluation order of python 2 differ enough from python 3 that
+streamed uploads and the .isolated files have to be exercised on both.
+"""
+
+import os
+
+# Mutates sys.path.
+import test_env
+
+import isolateserver_test
+
+
+for _name in dir(isolateserver_test):
+  if _name.startswith(
+      ('IsolateServerStorageSmokeTest', 'IsolateServerDownloadTest')):
+    globals()[_name] = getattr(isolateserver_test, _name)
+
+
+if __name__ == '__main__':
+  for e in ('ISOLATE_DEBUG', 'ISOLATE_SERVER'):
+    os.environ.pop(e, None)
+  test_env.main()
@@ -6,20 +6,24 @@
 from __future__ import print_function
 
 import base64
+import functools
 import hashlib
 import json
 import logging
 import io
 import os
+import struct
 import sys
 import tarfile
 import tempfile
+import threading
 import unittest
 import zlib
 
 import mock
 import parameterized
 import six
+from six.moves import urllib
 
 # Mutates sys.path.
 import test_env
@@ -34,7 +38,9 @@ import isolateserver
 import local_caching
 from utils import file_path
 from utils import fs
+from utils import hash_index
 from utils import logging_utils
+from utils import net
 from utils import threading_utils
 
 
@@ -45,6 +51,49 @@ CONTENTS = {
 }
 
 
+def retrieve_batch_request(server_ref, items):
+  """Returns the expected retrieve_batch request returning |items| inline.
+
+  |items| is a list of (digest, content) in the order they are requested.
+  """
+  body = b''
+  for _, content in items:
+    if server_ref.is_with_compression:
+      content = zlib.compress(content)
+    body += struct.pack('>BI', 0, len(content)) + content
+  return (
+      '%s/api/isolateservice/v1/retrieve_batch' % server_ref.url,
+      {
+          'content_type': net.JSON_CONTENT_TYPE,
+          'data': {
+              'digests': [six.ensure_str(h) for h, _ in items],
+              'namespace': server_ref.namespace,
+          },
+          'expected_error_codes': (404,),
+          'read_timeout': 60,
+      },
+      body,
+      {},
+  )
+
+
+def retrieve_raw_request(server_ref, digest, content):
+  """Returns the expected retrieve_raw request returning |content| inline."""
+  if server_ref.is_with_compression:
+    content = zlib.compress(content)
+  return (
+      '%s/api/isolateservice/v1/retrieve_raw/%s/%s?offset=0' % (
+          server_ref.url, server_ref.namespace, six.ensure_str(digest)),
+      {
+          'expected_error_codes': (404,),
+          'follow_redirects': False,
+          'read_timeout': 60,
+      },
+      content,
+      {},
+  )
+
+
 class TestCase(net_utils.TestCase):
   # These tests fail when running with other tests
   # Need to run in test_seq.py
@@ -145,7 +194,11 @@ class MockedStorageApi(isolate_storage.StorageApi):
   def push(self, item, push_state, content=None):
     logging.debug(
         'MockedStorageApi.push(%s, %s, %s)', item, push_state, content)
-    content = b''.join(item.content() if content is None else content)
+    if content is None:
+      content = item.content
+    if callable(content):
+      content = content()
+    content = b''.join(content)
     self.push_calls.append((item, push_state, content))
     if self._push_side_effect:
       self._push_side_effect()
@@ -289,6 +342,39 @@ class UtilsTest(TestCase):
       if tmpoutdir:
         file_path.rmtree(tmpoutdir)
 
+  def test_create_directories_thread_pool(self):
+    tmpdir = tempfile.mkdtemp(prefix=u'isolateserver_test')
+    try:
+      files = [
+          os.path.join(u'a', u'b', u'c', u'file'),
+          os.path.join(u'a', u'd', u'file'),
+          os.path.join(u'e', u'file'),
+          u'file',
+      ]
+      with threading_utils.ThreadPool(1, 4, 4) as pool:
+        isolateserver.create_directories(tmpdir, files, pool)
+      for d in (u'a', u'e', os.path.join(u'a', u'b', u'c'),
+                os.path.join(u'a', u'd')):
+        self.assertTrue(fs.isdir(os.path.join(tmpdir, d)), d)
+    finally:
+      file_path.rmtree(tmpdir)
+
+  def test_create_symlinks_thread_pool_already_exists(self):
+    if sys.platform == 'win32':
+      return
+    tmpdir = tempfile.mkdtemp(prefix=u'isolateserver_test')
+    try:
+      with fs.open(os.path.join(tmpdir, u'b'), 'wb') as f:
+        f.write(b'data')
+      files = [(u'a', {'l': u'b'}), (u'b', {'l': u'a'})]
+      with threading_utils.ThreadPool(1, 4, 4) as pool:
+        # The conflict is raised right away, not by a later join().
+        with self.assertRaises(isolateserver.AlreadyExists):
+          isolateserver._create_symlinks(tmpdir, files, pool)
+      self.assertTrue(fs.islink(os.path.join(tmpdir, u'a')))
+    finally:
+      file_path.rmtree(tmpdir)
+
   def test_fetch_stream_verifier_success(self):
     def teststream():
       yield b'abc'
@@ -381,6 +467,39 @@ class StorageTest(TestCase):
     result = storage.upload_items(())
     self.assertEqual([], result)
 
+  def test_async_fetch_batch(self):
+    server_ref = isolate_storage.ServerRef('http://localhost:1', 'default')
+    contents = [b'batched', b'fetched alone']
+    digests = [server_ref.hash_algo(c).hexdigest() for c in contents]
+    for fail_batch in (False, True):
+      calls = []
+      class BatchStorageApi(MockedStorageApi):
+        def fetch_batch(self, batch):
+          calls.append(('fetch_batch', batch))
+          if fail_batch:
+            raise IOError('Oops')
+          return {digests[0]: [contents[0]]}
+        def fetch(self, digest, size, offset):
+          calls.append(('fetch', digest))
+          return [contents[digests.index(digest)]]
+
+      storage = isolateserver.Storage(BatchStorageApi(server_ref, {}))
+      channel = threading_utils.TaskChannel()
+      fetched = {}
+      def sink(digest, stream):
+        fetched[digest] = b''.join(stream)
+      storage.async_fetch_batch(
+          channel, threading_utils.PRIORITY_MED,
+          [(d, len(c), functools.partial(sink, d))
+           for d, c in zip(digests, contents)])
+      self.assertEqual(
+          sorted(digests), sorted([channel.next(), channel.next()]))
+      storage.close()
+      self.assertEqual(dict(zip(digests, contents)), fetched)
+      expected = [('fetch_batch', digests)]
+      expected += [('fetch', d) for d in digests[not fail_batch:]]
+      self.assertEqual(expected, calls)
+
   def test_async_push(self):
     for use_zip in (False, True):
       item = FakeItem(b'1234567')
@@ -550,33 +669,158 @@ class StorageTest(TestCase):
     # 5 files, the isolated file.
     self.assertEqual(6, len(hot))
 
+  def test_archive_files_to_storage_tar_bundle(self):
+    def make_tree(root, mtime):
+      os.mkdir(root)
+      for i in range(6):
+        path = os.path.join(root, six.text_type(i))
+        with open(path, 'wb') as f:
+          f.write(b'fooo%d' % i)
+        os.utime(path, (mtime, mtime))
+      with open(os.path.join(root, u'large'), 'wb') as f:
+        f.write(b'x' * (isolateserver.TarBundle.MAX_FILE_SIZE + 1))
+
+    def archive(root):
+      server_ref = isolate_storage.ServerRef('http://localhost:1', 'default')
+      storage = isolateserver.Storage(MockedStorageApi(server_ref, {}))
+      _, cold, hot = isolateserver.archive_files_to_storage(
+          storage, [root], None, bundle_files=True)
+      self.assertEqual([], cold)
+      return hot
+
+    root1 = os.path.join(self.tempdir, u'1')
+    make_tree(root1, 1000000000)
+    hot = archive(root1)
+    # The large file, the bundle and the isolated file.
+    self.assertEqual(3, len(hot))
+    self.assertEqual(os.path.join(root1, u'large'), hot[0].path)
+    self.assertIsInstance(hot[1], isolateserver.TarBundle)
+    bundle_path = hot[1].digest + '.tar'
+    isolated = json.loads(b''.join(hot[2].content()).decode())
+    self.assertEqual(isolated_format.BUNDLED_FILE_VERSION, isolated['version'])
+    self.assertEqual(
+        {'h': hot[1].digest, 's': hot[1].size, 't': 'tar'},
+        isolated['files'][bundle_path])
+    for i in range(6):
+      meta = isolated['files'][six.text_type(i)]
+      self.assertEqual(bundle_path, meta['b'])
+      self.assertEqual(hashlib.sha1(b'fooo%d' % i).hexdigest(), meta['h'])
+    with tarfile.open(fileobj=io.BytesIO(b''.join(hot[1].content()))) as t:
+      self.assertEqual([six.text_type(i) for i in range(6)], t.getnames())
+
+    # The bundle only depends on the content.
+    root2 = os.path.join(self.tempdir, u'2')
+    make_tree(root2, 1200000000)
+    self.assertEqual(hot[1].digest, archive(root2)[1].digest)
+
+  def test_archive_files_to_storage_chunked(self):
+    self.mock(isolated_format, 'CHUNKED_FILE_THRESHOLD', 1024)
+    content = os.urandom(3 * 1024 * 1024)
+    with open(os.path.join(self.tempdir, u'large'), 'wb') as f:
+      f.write(content)
+    with open(os.path.join(self.tempdir, u'small'), 'wb') as f:
+      f.write(b'small')
+    server_ref = isolate_storage.ServerRef('http://localhost:1', 'default')
+    storage = isolateserver.Storage(MockedStorageApi(server_ref, {}))
+    _, cold, hot = isolateserver.archive_files_to_storage(
+        storage, [self.tempdir], None, chunk_files=True)
+    self.assertEqual([], cold)
+    isolated = json.loads(b''.join(hot[-1].content()).decode())
+    self.assertEqual(isolated_format.CHUNKED_FILE_VERSION, isolated['version'])
+    meta = isolated['files']['large']
+    self.assertEqual(hashlib.sha1(content).hexdigest(), meta['h'])
+    self.assertEqual('chunked', meta['t'])
+    self.assertEqual(len(content), meta['s'])
+    chunks = [i for i in hot if isinstance(i, isolateserver.FileChunk)]
+    self.assertEqual(meta['c'], [[c.digest, c.size] for c in chunks])
+    self.assertEqual(content, b''.join(b''.join(c.content()) for c in chunks))
+    self.assertNotIn('t', isolated['files']['small'])
+
+  def test_chunked_file_item_content(self):
+    self.mock(isolated_format, 'CHUNK_MIN_SIZE', 64)
+    self.mock(isolated_format, 'CHUNK_MAX_SIZE', 1024)
+    path = os.path.join(self.tempdir, u'large')
+    content = os.urandom(16 * 1024)
+    with open(path, 'wb') as f:
+      f.write(content)
+    item = isolateserver.ChunkedFileItem(path, hashlib.sha1)
+    self.assertEqual(content, b''.join(item.content()))
+    self.assertEqual(hashlib.sha1(content).hexdigest(), item.digest)
+    self.assertLess(1, len(list(item.chunks())))
+
+  def test_hash_items(self):
+    self.mock(isolateserver, 'HASH_MAX_INFLIGHT_FILES', 3)
+    entries = []
+    for i in range(20):
+      path = os.path.join(self.tempdir, six.text_type(i))
+      with open(path, 'wb') as f:
+        f.write(b'x' * i)
+      item = isolateserver.FileItem(path=path, algo=hashlib.sha1)
+      # Symlinks are passed through.
+      entries.append((item, i))
+      entries.append((None, -i))
+    stats = isolateserver.StageStats()
+    actual = list(isolateserver._hash_items(iter(entries), stats))
+    self.assertEqual(entries, actual)
+    for item, i in actual:
+      if item:
+        self.assertEqual(hashlib.sha1(b'x' * i).hexdigest(), item._digest)
+    self.assertEqual(20, stats.files)
+    self.assertEqual(sum(range(20)), stats.size)
+
+  def test_archive_files_to_storage_hash_index(self):
+    path = os.path.join(self.tempdir, u'a')
+    with open(path, 'wb') as f:
+      f.write(b'aaaa')
+    # Make the file old enough to be indexed.
+    os.utime(path, (1000000000, 1000000000))
+    index_path = os.path.join(self.tempdir, u'index')
+    server_ref = isolate_storage.ServerRef('http://localhost:1', 'default')
+
+    def archive():
+      index = hash_index.HashIndex.load(index_path)
+      storage = isolateserver.Storage(MockedStorageApi(server_ref, {}))
+      results, _, _ = isolateserver.archive_files_to_storage(
+          storage, [path], None, index=index)
+      index.save(index_path)
+      return results[path], index
+
+    digest, index = archive()
+    self.assertEqual(hashlib.sha1(b'aaaa').hexdigest(), digest)
+    self.assertEqual((0, 1), (index.hits, index.misses))
+
+    # Rewrite the file without changing its stat() identity; the stale digest
+    # is returned, proving the file wasn't read again.
+    with open(path, 'r+b') as f:
+      f.write(b'bbbb')
+    os.utime(path, (1000000000, 1000000000))
+    digest, index = archive()
+    self.assertEqual(hashlib.sha1(b'aaaa').hexdigest(), digest)
+    self.assertEqual((1, 0), (index.hits, index.misses))
+
 
 class IsolateServerStorageApiTest(TestCase):
   @staticmethod
   def mock_fetch_request(server_ref, item, data=None, offset=0):
-    compression = 'flate' if server_ref.is_with_compression else ''
     if data is None:
-      response = {
-        'url': '%s/some/gs/url/%s/%s' % (
+      response = b''
+      headers = {
+        'Location': '%s/some/gs/url/%s/%s' % (
             server_ref.url, server_ref.namespace, item),
       }
     else:
-      response = {'content': base64.b64encode(data[offset:])}
+      response = data[offset:]
+      headers = {}
     return (
-      '%s/_ah/api/isolateservice/v1/retrieve' % server_ref.url,
+      '%s/api/isolateservice/v1/retrieve_raw/%s/%s?offset=%d' % (
+          server_ref.url, server_ref.namespace, item, offset),
       {
-          'data': {
-              'digest': item,
-              'namespace': {
-                  'compression': compression,
-                  'digest_hash': 'sha-1',
-                  'namespace': server_ref.namespace,
-              },
-              'offset': offset,
-          },
+          'expected_error_codes': (404,),
+          'follow_redirects': False,
           'read_timeout': 60,
       },
       response,
+      headers,
     )
 
   @staticmethod
@@ -611,9 +855,38 @@ class IsolateServerStorageApiTest(TestCase):
 
   @staticmethod
   def mock_upload_request(server_ref, content, ticket, response=None):
-    url = server_ref.url + '/_ah/api/isolateservice/v1/store_inline'
-    request = {'content': content, 'upload_ticket': ticket}
-    return (url, {'data': request}, response)
+    url = '%s/api/isolateservice/v1/store_inline_raw?%s' % (
+        server_ref.url, urllib.parse.urlencode({'upload_ticket': ticket}))
+    request = {
+        'content_type': 'application/octet-stream',
+        'data': content,
+        'expected_error_codes': (404,),
+    }
+    if response is not None:
+      response = json.dumps(response).encode()
+    return (url, request, response, None)
+
+  def mock_gs_upload_request(self, url, data, size, goog_data=None):
+    """Returns a GS upload request whose body is checked by streaming it."""
+    def check(kwargs):
+      body = kwargs.pop('data')
+      self.assertIsInstance(body, net.RestartableBody)
+      self.assertEqual(size, body.size)
+      self.assertEqual(data, b''.join(body.open()))
+      self.assertEqual({
+          'content_type': 'application/octet-stream',
+          'method': 'PUT',
+          'headers': {
+              'Cache-Control': 'public, max-age=31536000'
+          },
+      }, kwargs)
+    md5 = hashlib.md5(data if goog_data is None else goog_data).digest()
+    return (
+        url,
+        check,
+        b'',
+        {'x-goog-hash': 'md5=' + base64.b64encode(md5).decode()},
+    )
 
   def test_server_capabilities_success(self):
     server_ref = isolate_storage.ServerRef('http://example.com', 'default')
@@ -635,11 +908,98 @@ class IsolateServerStorageApiTest(TestCase):
     server_ref = isolate_storage.ServerRef('http://example.com', 'default')
     item = isolateserver_fake.hash_content(b'something')
     self.expected_requests(
-        [self.mock_fetch_request(server_ref, item)[:-1] + (None,)])
+        [self.mock_fetch_request(server_ref, item)[:2] + (None, None)])
     storage = isolate_storage.IsolateServer(server_ref)
     with self.assertRaises(IOError):
       _ = ''.join(storage.fetch(item, 0, 0))
 
+  def test_fetch_batch(self):
+    server_ref = isolate_storage.ServerRef('http://example.com', 'default')
+    items = [
+        isolateserver_fake.hash_content(c) for c in (b'inline', b'gs', b'no')]
+    gs_url = '%s/some/gs/url/default/%s' % (server_ref.url, items[1])
+    request = retrieve_batch_request(server_ref, [(items[0], b'inline')])
+    body = (
+        request[2] +
+        struct.pack('>BI', 1, len(gs_url)) + gs_url.encode() +
+        struct.pack('>BI', 2, 0))
+    request[1]['data']['digests'] = items
+    self.expected_requests([
+        request[:2] + (body, {}),
+        (gs_url, {}, b'gs', {}),
+    ])
+    storage = isolate_storage.IsolateServer(server_ref)
+    fetched = storage.fetch_batch(items)
+    self.assertEqual(sorted(items[:2]), sorted(fetched))
+    self.assertEqual(b'inline', b''.join(fetched[items[0]]))
+    self.assertEqual(b'gs', b''.join(fetched[items[1]]))
+
+  def test_fetch_batch_truncated(self):
+    server_ref = isolate_storage.ServerRef('http://example.com', 'default')
+    item = isolateserver_fake.hash_content(b'inline')
+    request = retrieve_batch_request(server_ref, [(item, b'inline')])
+    self.expected_requests([request[:2] + (request[2][:-1], {})])
+    storage = isolate_storage.IsolateServer(server_ref)
+    with self.assertRaises(IOError):
+      storage.fetch_batch([item])
+
+  def test_fetch_batch_unsupported(self):
+    server_ref = isolate_storage.ServerRef('http://example.com', 'default')
+    item = isolateserver_fake.hash_content(b'inline')
+    calls = []
+    def url_open(url, **kwargs):
+      calls.append(url)
+      return net_utils.make_fake_response(b'Not found', url, code=404)
+    self.mock(net, 'url_open', url_open)
+    storage = isolate_storage.IsolateServer(server_ref)
+    self.assertEqual({}, storage.fetch_batch([item]))
+    # It is not tried again.
+    self.assertEqual({}, storage.fetch_batch([item]))
+    self.assertEqual(
+        ['%s/api/isolateservice/v1/retrieve_batch' % server_ref.url], calls)
+
+  def test_fetch_gs(self):
+    server_ref = isolate_storage.ServerRef('http://example.com', 'default')
+    item = isolateserver_fake.hash_content(b'gs')
+    self.expected_requests([
+        self.mock_fetch_request(server_ref, item),
+        ('%s/some/gs/url/default/%s' % (server_ref.url, item), {}, b'gs', {}),
+    ])
+    storage = isolate_storage.IsolateServer(server_ref)
+    self.assertEqual(b'gs', b''.join(storage.fetch(item, 0, 0)))
+
+  def test_fetch_raw_unsupported(self):
+    server_ref = isolate_storage.ServerRef('http://example.com', 'default')
+    data = b'inline'
+    item = isolateserver_fake.hash_content(data)
+    calls = []
+    def url_open(url, **kwargs):
+      calls.append(url)
+      return net_utils.make_fake_response(b'Not found', url, code=404)
+    self.mock(net, 'url_open', url_open)
+    json_request = (
+        '%s/_ah/api/isolateservice/v1/retrieve' % server_ref.url,
+        {
+            'data': {
+                'digest': item,
+                'namespace': {
+                    'compression': '',
+                    'digest_hash': 'sha-1',
+                    'namespace': server_ref.namespace,
+                },
+                'offset': 0,
+            },
+            'read_timeout': 60,
+        },
+        {'content': base64.b64encode(data)},
+    )
+    self.expected_requests([json_request, json_request])
+    storage = isolate_storage.IsolateServer(server_ref)
+    self.assertEqual(data, b''.join(storage.fetch(item, 0, 0)))
+    # It is not tried again once the JSON API returned the item.
+    self.assertEqual(data, b''.join(storage.fetch(item, 0, 0)))
+    self.assertEqual([self.mock_fetch_request(server_ref, item)[0]], calls)
+
   def test_fetch_offset_success(self):
     server_ref = isolate_storage.ServerRef('http://example.com', 'default')
     data = b''.join(str(x).encode() for x in range(1000))
@@ -703,7 +1063,7 @@ class IsolateServerStorageApiTest(TestCase):
                                    contains_response),
         self.mock_upload_request(
             server_ref,
-            base64.b64encode(data).decode(),
+            data,
             contains_response['items'][0]['upload_ticket'],
             {'ok': True},
         ),
@@ -729,7 +1089,7 @@ class IsolateServerStorageApiTest(TestCase):
                                    contains_response),
         self.mock_upload_request(
             server_ref,
-            base64.b64encode(data).decode(),
+            data,
             contains_response['items'][0]['upload_ticket'],
         ),
     ]
@@ -743,6 +1103,43 @@ class IsolateServerStorageApiTest(TestCase):
     self.assertFalse(push_state.uploaded)
     self.assertFalse(push_state.finalized)
 
+  def test_push_raw_unsupported(self):
+    server_ref = isolate_storage.ServerRef('http://example.com', 'default')
+    data = b'inline'
+    item = FakeItem(data)
+    contains_request = {'items': [
+        {'digest': item.digest, 'size': item.size, 'is_isolated': 0}]}
+    contains_response = {'items': [{'index': 0, 'upload_ticket': 'ticket!'}]}
+    calls = []
+    def url_open(url, **kwargs):
+      calls.append(url)
+      return net_utils.make_fake_response(b'Not found', url, code=404)
+    self.mock(net, 'url_open', url_open)
+    json_request = (
+        server_ref.url + '/_ah/api/isolateservice/v1/store_inline',
+        {'data': {
+            'content': base64.b64encode(data).decode(),
+            'upload_ticket': 'ticket!',
+        }},
+        {'ok': True},
+    )
+    self.expected_requests([
+        self.mock_contains_request(
+            server_ref, contains_request, contains_response),
+        self.mock_contains_request(
+            server_ref, contains_request, contains_response),
+        json_request,
+        json_request,
+    ])
+    storage = isolate_storage.IsolateServer(server_ref)
+    for _ in range(2):
+      push_state = storage.contains([item])[item]
+      storage.push(item, push_state, [data])
+      self.assertTrue(push_state.finalized)
+    # It is not tried again.
+    self.assertEqual([self.mock_upload_request(server_ref, data, 'ticket!')[0]],
+                     calls)
+
   def test_push_failure_finalize(self):
     server_ref = isolate_storage.ServerRef('http://example.com', 'default')
     data = b''.join(str(x).encode() for x in range(1000))
@@ -756,23 +1153,8 @@ class IsolateServerStorageApiTest(TestCase):
     requests = [
         self.mock_contains_request(server_ref, contains_request,
                                    contains_response),
-        (
-            '%s/FAKE_GCS/whatevs/1234' % server_ref.url,
-            {
-                'data': data,
-                'content_type': 'application/octet-stream',
-                'method': 'PUT',
-                'headers': {
-                    'Cache-Control': 'public, max-age=31536000'
-                },
-            },
-            b'',
-            {
-                'x-goog-hash':
-                    'md5=' +
-                    base64.b64encode(hashlib.md5(data).digest()).decode(),
-            },
-        ),
+        self.mock_gs_upload_request(
+            '%s/FAKE_GCS/whatevs/1234' % server_ref.url, data, len(data)),
         (
             '%s/_ah/api/isolateservice/v1/finalize_gs_upload' % server_ref.url,
             {
@@ -793,6 +1175,94 @@ class IsolateServerStorageApiTest(TestCase):
     self.assertTrue(push_state.uploaded)
     self.assertFalse(push_state.finalized)
 
+  def test_push_gs_streamed(self):
+    server_ref = isolate_storage.ServerRef('http://example.com', 'default-gzip')
+    data = b''.join(str(x).encode() for x in range(1000))
+    compressed = b''.join(isolateserver.zip_compress([data]))
+    item = FakeItem(data)
+    contains_response = {'items': [
+        {'index': 0,
+         'gs_upload_url': '%s/FAKE_GCS/whatevs/1234' % server_ref.url,
+         'upload_ticket': 'ticket!'}]}
+    requests = [
+        self.mock_contains_request(
+            server_ref,
+            {'items': [
+                {'digest': item.digest, 'size': item.size, 'is_isolated': 0}]},
+            contains_response),
+        # The compressed size is not known in advance.
+        self.mock_gs_upload_request(
+            '%s/FAKE_GCS/whatevs/1234' % server_ref.url, compressed, None),
+        (
+            '%s/_ah/api/isolateservice/v1/finalize_gs_upload' % server_ref.url,
+            {'data': {'upload_ticket': 'ticket!'}},
+            {'ok': True},
+        ),
+    ]
+    self.expected_requests(requests)
+    storage = isolate_storage.IsolateServer(server_ref, memory_budget=1)
+    # A streamed upload must not wait for the buffered ones to complete.
+    storage._memory_budget.acquire(10)
+    self.mock(storage._memory_budget, 'acquire', self.fail)
+    push_state = storage.contains([item])[item]
+    storage.push(
+        item, push_state, lambda: isolateserver.zip_compress(item.content()))
+    self.assertTrue(push_state.finalized)
+    # Streamed uploads do not use the memory budget.
+    self.assertEqual(10, storage._memory_budget.used)
+
+  def test_push_gs_retry_rereads_content(self):
+    server_ref = isolate_storage.ServerRef('http://example.com', 'default')
+    data = b''.join(str(x).encode() for x in range(1000))
+    item = FakeItem(data)
+    url = '%s/FAKE_GCS/whatevs/1234' % server_ref.url
+    contains_response = {'items': [
+        {'index': 0, 'gs_upload_url': url, 'upload_ticket': 'ticket!'}]}
+    requests = [
+        self.mock_contains_request(
+            server_ref,
+            {'items': [
+                {'digest': item.digest, 'size': item.size, 'is_isolated': 0}]},
+            contains_response),
+        # The first attempt is corrupted on the way.
+        self.mock_gs_upload_request(url, data, len(data), goog_data=b'bad'),
+        self.mock_gs_upload_request(url, data, len(data)),
+        (
+            '%s/_ah/api/isolateservice/v1/finalize_gs_upload' % server_ref.url,
+            {'data': {'upload_ticket': 'ticket!'}},
+            {'ok': True},
+        ),
+    ]
+    self.expected_requests(requests)
+    storage = isolate_storage.IsolateServer(server_ref)
+    push_state = storage.contains([item])[item]
+    with self.assertRaises(IOError):
+      storage.push(item, push_state)
+    self.assertFalse(push_state.uploaded)
+    storage.push(item, push_state)
+    self.assertTrue(push_state.finalized)
+
+  def test_memory_budget(self):
+    budget = isolate_storage.MemoryBudget(100)
+    budget.acquire(60)
+    acquired = threading.Event()
+    def acquire():
+      budget.acquire(60)
+      acquired.set()
+    thread = threading.Thread(target=acquire)
+    thread.daemon = True
+    thread.start()
+    self.assertFalse(acquired.wait(0.1))
+    budget.release(60)
+    self.assertTrue(acquired.wait(10))
+    thread.join()
+    self.assertEqual(60, budget.used)
+    budget.release(60)
+    # A request larger than the budget is admitted when nothing is in flight.
+    budget.acquire(1000)
+    self.assertEqual(1000, budget.used)
+    budget.release(1000)
+
   def test_contains_success(self):
     server_ref = isolate_storage.ServerRef('http://example.com', 'default')
     files = [
@@ -1011,14 +1481,13 @@ class IsolateServerDownloadTest(TestCase):
     with self._lock:
       if not self._requests:
         return None
-      if not self._flagged_requests:
-        self._flagged_requests = [0 for _element in self._requests]
       # Ignore 'stream' argument, it's not important for these tests.
       kwargs.pop('stream', None)
-      for i, (new_url, expected_kwargs, result) in enumerate(self._requests):
-        if new_url == url and expected_kwargs == kwargs:
-          self._flagged_requests[i] = 1
-          return result
+      for request in self._requests:
+        if request[0] == url and request[1] == kwargs:
+          # url_open() pops the requests, so they can't be flagged by index.
+          self._flagged_requests.add(id(request))
+          return request[2]
     self.fail('Unknown request %s' % url)
     return None
 
@@ -1038,12 +1507,12 @@ class IsolateServerDownloadTest(TestCase):
 
   def setUp(self):
     super(IsolateServerDownloadTest, self).setUp()
-    self._flagged_requests = []
+    self._flagged_requests = set()
     self.mock(logging_utils, 'prepare_logging', lambda *_: None)
     self.mock(logging_utils, 'set_console_level', lambda *_: None)
 
   def tearDown(self):
-    if all(self._flagged_requests):
+    if all(id(r) in self._flagged_requests for r in self._requests):
       self._requests = []
     super(IsolateServerDownloadTest, self).tearDown()
 
@@ -1059,24 +1528,9 @@ class IsolateServerDownloadTest(TestCase):
     server_ref = isolate_storage.ServerRef('http://example.com', 'default-gzip')
     coucou_sha1 = hashlib.sha1(b'Coucou').hexdigest()
     byebye_sha1 = hashlib.sha1(b'Bye Bye').hexdigest()
-    requests = [(
-        '%s/_ah/api/isolateservice/v1/retrieve' % server_ref.url,
-        {
-            'data': {
-                'digest': six.ensure_str(h),
-                'namespace': {
-                    'namespace': 'default-gzip',
-                    'digest_hash': 'sha-1',
-                    'compression': 'flate',
-                },
-                'offset': 0,
-            },
-            'read_timeout': 60,
-        },
-        {
-            'content': base64.b64encode(zlib.compress(v)).decode()
-        },
-    ) for h, v in [(coucou_sha1, b'Coucou'), (byebye_sha1, b'Bye Bye')]]
+    requests = [
+        retrieve_raw_request(server_ref, h, v)
+        for h, v in [(coucou_sha1, b'Coucou'), (byebye_sha1, b'Bye Bye')]]
     self.expected_requests(requests)
     cmd = [
       'download',
@@ -1127,29 +1581,15 @@ class IsolateServerDownloadTest(TestCase):
     isolated_data = json.dumps(
         isolated, sort_keys=True, separators=(',', ':')).encode()
     isolated_hash = isolateserver_fake.hash_content(isolated_data)
+    requests = [(isolated_hash, isolated_data)]
     requests = [
-      (v['h'], files[k]) for k, v in isolated['files'].items()
-      if 'h' in v
-    ]
-    requests.append((isolated_hash, isolated_data))
-    requests = [(
-        '%s/_ah/api/isolateservice/v1/retrieve' % server_ref.url,
-        {
-            'data': {
-                'digest': six.ensure_str(h),
-                'namespace': {
-                    'namespace': 'default-gzip',
-                    'digest_hash': 'sha-1',
-                    'compression': 'flate',
-                },
-                'offset': 0,
-            },
-            'read_timeout': 60,
-        },
-        {
-            'content': base64.b64encode(zlib.compress(v)).decode()
-        },
-    ) for h, v in requests]
+        retrieve_raw_request(server_ref, h, v) for h, v in requests]
+    # The small files are fetched at once, largest first.
+    requests.append(retrieve_batch_request(server_ref, [
+        (isolated['files']['b']['h'], files['b']),
+        (isolated['files'][os.path.join('a', 'foo')]['h'],
+         files[os.path.join('a', 'foo')]),
+    ]))
     cmd = [
       'download',
       '--isolate-server', server_ref.url,
@@ -1223,29 +1663,13 @@ class IsolateServerDownloadTest(TestCase):
     isolated_data = json.dumps(
         isolated, sort_keys=True, separators=(',', ':')).encode()
     isolated_hash = isolateserver_fake.hash_content(isolated_data)
+    requests = [(isolated_hash, isolated_data)]
     requests = [
-      (isolated['files']['archive1']['h'], archive),
-      (isolated['files']['c']['h'], files['c'][0]),
-    ]
-    requests.append((isolated_hash, isolated_data))
-    requests = [(
-        '%s/_ah/api/isolateservice/v1/retrieve' % server_ref.url,
-        {
-            'data': {
-                'digest': six.ensure_str(h),
-                'namespace': {
-                    'namespace': 'default-gzip',
-                    'digest_hash': 'sha-1',
-                    'compression': 'flate',
-                },
-                'offset': 0,
-            },
-            'read_timeout': 60,
-        },
-        {
-            'content': base64.b64encode(zlib.compress(v)).decode()
-        },
-    ) for h, v in requests]
+        retrieve_raw_request(server_ref, h, v) for h, v in requests]
+    requests.append(retrieve_batch_request(server_ref, [
+        (isolated['files']['archive1']['h'], archive),
+        (isolated['files']['c']['h'], files['c'][0]),
+    ]))
     cmd = [
       'download',
       '--isolate-server', server_ref.url,
@@ -1270,6 +1694,141 @@ class IsolateServerDownloadTest(TestCase):
     self.checkOutput(expected_stdout)
 
 
+  @unittest.skipIf(sys.platform == 'win32', 'crbug.com/1148174')
+  def test_download_isolated_tar_bundle(self):
+    server_ref = isolate_storage.ServerRef('http://example.com', 'default-gzip')
+    src = os.path.join(self.tempdir, u'src')
+    files = {
+        os.path.join(u'a', u'foo'): (b'Content', 0o500),
+        u'b': (b'More content', 0o600),
+        u'c': (b'Even more content!', 0o500),
+        u'd': (b'Small', 0o500),
+        u'e': (b'Smaller', 0o600),
+    }
+    bundle = isolateserver.TarBundle(src, hashlib.sha1)
+    for path, (content, mode) in sorted(files.items()):
+      fullpath = os.path.join(src, path)
+      file_path.ensure_tree(os.path.dirname(fullpath))
+      with open(fullpath, 'wb') as f:
+        f.write(content)
+      os.chmod(fullpath, mode)
+      self.assertTrue(
+          bundle.try_add(isolateserver.FileItem(fullpath, hashlib.sha1)))
+    archive = b''.join(bundle.content())
+    files_meta = bundle.files_meta()
+    # Files missing from the .isolated are not extracted.
+    del files_meta[u'e']
+    del files[u'e']
+
+    isolated = {
+      'files': files_meta,
+      'version': isolated_format.BUNDLED_FILE_VERSION,
+    }
+    isolated_data = json.dumps(
+        isolated, sort_keys=True, separators=(',', ':')).encode()
+    isolated_hash = isolateserver_fake.hash_content(isolated_data)
+    # Only the bundle is fetched, not its members.
+    requests = [
+      (bundle.digest, archive),
+      (isolated_hash, isolated_data),
+    ]
+    requests = [
+        retrieve_raw_request(server_ref, h, v) for h, v in requests]
+    cmd = [
+      'download',
+      '--isolate-server', server_ref.url,
+      '--namespace', server_ref.namespace,
+      '--target', os.path.join(self.tempdir, 'target'),
+      '--isolated', isolated_hash,
+      '--cache', os.path.join(self.tempdir, 'cache'),
+    ]
+    self.expected_requests(requests)
+    self.assertEqual(0, isolateserver.main(cmd))
+    expected = {
+      os.path.join(self.tempdir, 'target', k): v for k, v in files.items()
+    }
+    self.assertEqual(expected, self._get_actual())
+
+  @unittest.skipIf(sys.platform == 'win32', 'crbug.com/1148174')
+  def test_download_isolated_chunked(self):
+    server_ref = isolate_storage.ServerRef('http://example.com', 'default-gzip')
+    chunks = [b'Hello ', b'chunked ', b'world', b'chunked ']
+    content = b''.join(chunks)
+    isolated = {
+      'files': {
+          u'a': {
+              'c': [[isolateserver_fake.hash_content(c), len(c)]
+                    for c in chunks],
+              'h': isolateserver_fake.hash_content(content),
+              'm': 0o500,
+              's': len(content),
+              't': 'chunked',
+          },
+      },
+      'version': isolated_format.CHUNKED_FILE_VERSION,
+    }
+    isolated_data = json.dumps(
+        isolated, sort_keys=True, separators=(',', ':')).encode()
+    isolated_hash = isolateserver_fake.hash_content(isolated_data)
+    requests = [(isolated_hash, isolated_data)]
+    requests = [
+        retrieve_raw_request(server_ref, h, v) for h, v in requests]
+    # Each distinct chunk is fetched once, the whole file is never fetched.
+    requests.append(retrieve_batch_request(server_ref, [
+        (isolateserver_fake.hash_content(c), c)
+        for c in (chunks[1], chunks[0], chunks[2])
+    ]))
+    cmd = [
+      'download',
+      '--isolate-server', server_ref.url,
+      '--namespace', server_ref.namespace,
+      '--target', os.path.join(self.tempdir, 'target'),
+      '--isolated', isolated_hash,
+      '--cache', os.path.join(self.tempdir, 'cache'),
+    ]
+    self.expected_requests(requests)
+    self.assertEqual(0, isolateserver.main(cmd))
+    self.assertEqual(
+        {os.path.join(self.tempdir, 'target', u'a'): (content, 0o500)},
+        self._get_actual())
+
+  def test_fetch_isolated_no_space(self):
+    # The whole tree is planned before any data file is fetched.
+    server_ref = isolate_storage.ServerRef('http://example.com', 'default-gzip')
+    files = {
+        u'a': b'Content',
+        u'b': b'More content',
+    }
+    isolated = {
+      'files': {
+          k: {'h': isolateserver_fake.hash_content(v), 's': len(v)}
+          for k, v in files.items()
+      },
+      'version': isolated_format.ISOLATED_FILE_VERSION,
+    }
+    isolated_data = json.dumps(
+        isolated, sort_keys=True, separators=(',', ':')).encode()
+    isolated_hash = isolateserver_fake.hash_content(isolated_data)
+    # Only the .isolated file is fetched.
+    self.expected_requests([
+        retrieve_raw_request(server_ref, isolated_hash, isolated_data)])
+    policies = local_caching.CachePolicies(
+        max_cache_size=len(isolated_data) + 10,
+        min_free_space=0,
+        max_items=0,
+        max_age_secs=0)
+    cache = local_caching.DiskContentAddressedCache(
+        os.path.join(self.tempdir, u'cache'), policies, trim=False)
+    target = os.path.join(self.tempdir, u'target')
+    with isolateserver.get_storage(server_ref) as storage:
+      with self.assertRaises(local_caching.NoMoreSpace):
+        isolateserver.fetch_isolated(
+            isolated_hash, storage, cache, target, False)
+    self.assertEqual([isolated_hash], list(cache))
+    self.assertFalse(os.path.exists(target))
+
+
+
 def get_storage(server_ref):
   class StorageFake(object):
     def __enter__(self, *_):
@@ -1283,7 +1842,7 @@ def get_storage(server_ref):
       return server_ref
 
     @staticmethod
-    def upload_items(items, _verify_push):
+    def upload_items(items, _verify_push, _hash_stats=None):
       # Always returns the last item as not present.
       return [list(items)[-1]]
   return StorageFake()
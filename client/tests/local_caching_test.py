@@ -11,6 +11,7 @@ import string
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import unittest
 
@@ -315,6 +316,76 @@ class DiskContentAddressedCacheTest(TestCase, ContentAddressedCacheTestMixin):
 
     self.assertEqual(expected, str(cm.exception))
 
+  def test_reserve_evicts_in_batch(self):
+    cache = self.get_cache(_get_policies(max_cache_size=10))
+    for size in (1, 2, 3):
+      self._add_one_item(cache, size)
+    cache.save()
+    # Reload so the items are not protected by this run.
+    cache = self.get_cache(_get_policies(max_cache_size=10))
+    self.assertEqual(
+        [1, 2], cache.reserve([7, local_caching.UNKNOWN_FILE_SIZE]))
+    self.assertEqual(3, cache.total_size)
+    self.assertEqual([], cache.reserve([7]))
+
+  def test_reserve_protected(self):
+    cache = self.get_cache(_get_policies(max_cache_size=10))
+    digests = [self._add_one_item(cache, size) for size in (1, 2, 3)]
+    cache.save()
+    cache = self.get_cache(_get_policies(max_cache_size=10))
+    self.assertTrue(cache.touch(digests[0], 1))
+    # Only the items of 2 and 3 bytes can be evicted.
+    with self.assertRaises(local_caching.NoMoreSpace):
+      cache.reserve([10])
+    self.assertEqual(6, cache.total_size)
+    self.assertEqual([2, 3], cache.reserve([9]))
+    self.assertEqual([digests[0]], list(cache))
+
+  def test_reserve_min_free_space(self):
+    self._free_disk = 1005
+    cache = self.get_cache(_get_policies(min_free_space=1000))
+    self.assertEqual([], cache.reserve([2, 3]))
+    with self.assertRaises(local_caching.NoMoreSpace) as cm:
+      cache.reserve([2, 4])
+    expected = ('Not enough space to fetch the whole isolated tree.\n  '
+                'CachePolicies(max_cache_size=0 (0.000 GiB); max_items=0; '
+                'min_free_space=1000 (0.000 GiB); max_age_secs=0)\n  '
+                'cache=0 bytes (0.000 GiB), 0 items; '
+                '1005 bytes (0.000 GiB) free_space; '
+                '2 items of 6 bytes (0.000 GiB) to fetch')
+    self.assertEqual(expected, str(cm.exception))
+
+  def test_touch_queued_protected(self):
+    cache = self.get_cache(_get_policies())
+    digests = [self._add_one_item(cache, size) for size in (1, 2, 3)]
+    cache.save()
+    self._free_disk = 1004
+    cache = self.get_cache(_get_policies(min_free_space=1000))
+    self.assertTrue(cache.touch(digests[0], 1))
+    # The queued LRU bump is applied before evicting, so the touched item is
+    # kept.
+    n8 = self._add_one_item(cache, 8)
+    self.assertEqual([n8, digests[0]], list(cache))
+
+  def test_touch_concurrent(self):
+    cache = self.get_cache(_get_policies())
+    sizes = range(1, 41)
+    digests = [self._add_one_item(cache, size) for size in sizes]
+    results = []
+    def touch_all():
+      results.append(
+          all(cache.touch(d, size) for d, size in zip(digests, sizes)))
+    threads = [threading.Thread(target=touch_all) for _ in range(8)]
+    for t in threads:
+      t.start()
+    for _ in range(10):
+      cache.save()
+    for t in threads:
+      t.join()
+    self.assertEqual([True] * 8, results)
+    self.assertEqual(sorted(digests), sorted(cache))
+    self.assertEqual(sum(sizes), cache.total_size)
+
   def test_save_disk(self):
     cache = self.get_cache(_get_policies())
     self.assertEqual(
@@ -971,6 +1042,23 @@ class FnTest(TestCase):
     # sum(range(1, 15)) == 105, the first value after 100.
     self.assertEqual(list(range(1, 15)), trimmed)
 
+  def test_clean_caches_memory_free_space_estimated(self):
+    caches = self._get_5_caches()
+    self._free_disk = 900
+    calls = []
+    def get_free_space(_path):
+      calls.append(self._free_disk)
+      return self._free_disk
+    self.mock(file_path, 'get_free_space', get_free_space)
+    trimmed = local_caching.trim_caches(
+        caches,
+        self.tempdir,
+        min_free_space=1000,
+        max_age_secs=0)
+    self.assertEqual(list(range(1, 15)), trimmed)
+    # Once before trimming, once to confirm the estimate.
+    self.assertEqual([900, 1005], calls)
+
   def test_clean_caches_memory_time(self):
     # Test that cleaning is correctly distributed independent of the cache
     # location.
@@ -150,6 +150,20 @@ class LRUDictTest(unittest.TestCase):
     lru_dict.transform(lambda k, v: v + '*')
     self.assert_same_data([('ka', 'va*'), ('kb', 'vb*')], lru_dict)
 
+  def test_total_size(self):
+    lru_dict = _prepare_lru_dict([('ka', 'a'), ('kb', 'bb')])
+    lru_dict.set_size_fn(len)
+    self.assertEqual(3, lru_dict.total_size)
+    lru_dict.add('kc', 'ccc')
+    lru_dict.add('ka', 'aaaa')
+    self.assertEqual(9, lru_dict.total_size)
+    lru_dict.pop('kb')
+    self.assertEqual(7, lru_dict.total_size)
+    self.assertEqual('kc', lru_dict.pop_oldest()[0])
+    self.assertEqual(4, lru_dict.total_size)
+    lru_dict.transform(lambda k, v: v + '*')
+    self.assertEqual(5, lru_dict.total_size)
+
   def test_load_save_empty(self):
     self.assertFalse(_save_and_load(lru.LRUDict()))
 
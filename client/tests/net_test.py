@@ -430,6 +430,25 @@ class TestNetFunctions(auto_stub.TestCase):
     for value, expected in data:
       self.assertEqual(expected, net.fix_url(value))
 
+  def test_restartable_body_read(self):
+    body = net.RestartableBody(lambda: [b'abc', b'', b'defg'], 7)
+    f = body.open()
+    self.assertEqual(7, len(f))
+    self.assertEqual(b'ab', f.read(2))
+    self.assertEqual(b'cdef', f.read(4))
+    self.assertEqual(b'g', f.read())
+    self.assertEqual(b'', f.read(2))
+    # Each attempt reads the body from the start.
+    self.assertEqual(b'abcdefg', body.open().read())
+
+  def test_restartable_body_iter(self):
+    body = net.RestartableBody(lambda: iter([b'', b'abc', b'', b'de']))
+    f = body.open()
+    self.assertFalse(hasattr(f, '__len__'))
+    self.assertEqual(b'a', f.read(1))
+    # Empty chunks would end a chunked body.
+    self.assertEqual([b'bc', b'de'], list(f))
+
 
 if __name__ == '__main__':
   test_env.main()
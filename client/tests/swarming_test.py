@@ -741,45 +741,57 @@ class TestSwarmingTrigger(NetTestCase):
         swarming='https://localhost:1', task_request=task_request)
 
 
+def gen_states_request(task_ids, states, wait_secs=10):
+  """Returns the expected tasks/wait_states or tasks/get_states request."""
+  query = '&'.join('task_id=%s' % t for t in task_ids)
+  if wait_secs:
+    url = 'https://host:9001/_ah/api/swarming/v1/tasks/wait_states?%s' % query
+    url += '&timeout_secs=%d' % wait_secs
+  else:
+    url = 'https://host:9001/_ah/api/swarming/v1/tasks/get_states?%s' % query
+  return (url, {
+      'retry_50x': False,
+      'expected_error_codes': (403,)
+  }, {'states': states} if states else None)
+
+
+def gen_result_requests(task_id, output, **kwargs):
+  """Returns the expected result and stdout requests for a task."""
+  return [
+      (
+          'https://host:9001/_ah/api/swarming/v1/task/%s/result' % task_id,
+          {
+              'retry_50x': False
+          },
+          gen_result_response(**kwargs),
+      ),
+      (
+          'https://host:9001/_ah/api/swarming/v1/task/%s/stdout' % task_id,
+          {},
+          {
+              'output': output
+          },
+      ),
+  ]
+
+
 class TestSwarmingCollection(NetTestCase):
 
+  def setUp(self):
+    super(TestSwarmingCollection, self).setUp()
+    self.mock(swarming, 'now', lambda: 1000.)
+
   def test_success(self):
-    self.expected_requests([
-        (
-            'https://host:9001/_ah/api/swarming/v1/task/10100/result',
-            {
-                'retry_50x': False
-            },
-            gen_result_response(),
-        ),
-        (
-            'https://host:9001/_ah/api/swarming/v1/task/10100/stdout',
-            {},
-            {
-                'output': OUTPUT
-            },
-        ),
-    ])
+    self.expected_requests(
+        [gen_states_request(['10100'], ['COMPLETED'])] +
+        gen_result_requests('10100', OUTPUT))
     expected = [gen_yielded_data(0, output=OUTPUT)]
     self.assertEqual(expected, get_results(['10100']))
 
   def test_failure(self):
-    self.expected_requests([
-        (
-            'https://host:9001/_ah/api/swarming/v1/task/10100/result',
-            {
-                'retry_50x': False
-            },
-            gen_result_response(exit_code=1),
-        ),
-        (
-            'https://host:9001/_ah/api/swarming/v1/task/10100/stdout',
-            {},
-            {
-                'output': OUTPUT
-            },
-        ),
-    ])
+    self.expected_requests(
+        [gen_states_request(['10100'], ['COMPLETED'])] +
+        gen_result_requests('10100', OUTPUT, exit_code=1))
     expected = [gen_yielded_data(0, output=OUTPUT, exit_code=1)]
     self.assertEqual(expected, get_results(['10100']))
 
@@ -790,74 +802,112 @@ class TestSwarmingCollection(NetTestCase):
   def test_url_errors(self):
     self.mock(logging, 'error', lambda *_, **__: None)
     # NOTE: get_results() hardcodes timeout=10.
-    now = {}
-    lock = threading.Lock()
-
-    def get_now():
-      t = threading.current_thread()
-      with lock:
-        return now.setdefault(t, range(10)).pop(0)
-
-    self.mock(swarming.net, 'sleep_before_retry', lambda _x, _y: None)
-    self.mock(swarming, 'now', get_now)
-    # The actual number of requests here depends on 'now' progressing to 10
-    # seconds. It's called once per loop. Loop makes 9 iterations.
-    self.expected_requests(9 * [(
-        'https://host:9001/_ah/api/swarming/v1/task/10100/result',
-        {
-            'retry_50x': False
-        },
-        None,
-    )])
+    now = list(range(11))
+    self.mock(swarming, 'now', lambda: now.pop(0))
+    # The actual number of requests here depends on 'now' progressing to 11
+    # seconds. It's called once per loop after the two calls at the start. Loop
+    # makes 9 iterations.
+    self.expected_requests(
+        [gen_states_request(['10100'], None, wait_secs=9)] +
+        9 * [gen_states_request(['10100'], None, wait_secs=0)])
     actual = get_results(['10100'])
     self.assertEqual([], actual)
-    self.assertTrue(all(not v for v in now.values()), now)
+    self.assertEqual([], now)
 
-  def test_many_shards(self):
+  def test_wait_states_not_supported(self):
+    self.mock(logging, 'error', lambda *_, **__: None)
     self.expected_requests([
+        gen_states_request(['10100'], None),
+        gen_states_request(['10100'], ['PENDING'], wait_secs=0),
+        gen_states_request(['10100'], ['COMPLETED'], wait_secs=0),
+    ] + gen_result_requests('10100', OUTPUT))
+    expected = [gen_yielded_data(0, output=OUTPUT)]
+    self.assertEqual(expected, get_results(['10100']))
+
+  def test_states_access_denied(self):
+    # The user cannot view all the tasks, so each result is polled instead.
+    denied = gen_states_request(['10100'], None)
+    denied = denied[:2] + ({'error': {'code': 403, 'message': 'Denied'}},)
+    self.expected_requests([
+        denied,
         (
             'https://host:9001/_ah/api/swarming/v1/task/10100/result',
             {
                 'retry_50x': False
             },
-            gen_result_response(),
-        ),
-        (
-            'https://host:9001/_ah/api/swarming/v1/task/10100/stdout',
-            {},
-            {
-                'output': SHARD_OUTPUT_1
-            },
-        ),
-        (
-            'https://host:9001/_ah/api/swarming/v1/task/10200/result',
-            {
-                'retry_50x': False
-            },
-            gen_result_response(),
-        ),
-        (
-            'https://host:9001/_ah/api/swarming/v1/task/10200/stdout',
-            {},
-            {
-                'output': SHARD_OUTPUT_2
-            },
-        ),
-        (
-            'https://host:9001/_ah/api/swarming/v1/task/10300/result',
-            {
-                'retry_50x': False
-            },
-            gen_result_response(),
-        ),
-        (
-            'https://host:9001/_ah/api/swarming/v1/task/10300/stdout',
-            {},
-            {
-                'output': SHARD_OUTPUT_3
-            },
+            gen_result_response(state='RUNNING'),
         ),
-    ])
+    ] + gen_result_requests('10100', OUTPUT))
+    expected = [gen_yielded_data(0, output=OUTPUT)]
+    self.assertEqual(expected, get_results(['10100']))
+
+  def test_states_access_denied_deadline(self):
+    # The tasks polled individually only get the time left until the deadline.
+    denied = gen_states_request(['10100'], None, wait_secs=9)
+    denied = denied[:2] + ({'error': {'code': 403, 'message': 'Denied'}},)
+    self.expected_requests([denied])
+    now = [1000.]
+
+    def now_fn():
+      now[0] += 1
+      return now[0]
+
+    self.mock(swarming, 'now', now_fn)
+    timeouts = []
+
+    def retrieve_results(_base_url, _shard_index, _task_id, timeout, *_args):
+      timeouts.append(timeout)
+      return gen_result_response()
+
+    self.mock(swarming, 'retrieve_results', retrieve_results)
+    self.assertEqual([(0, gen_result_response())], get_results(['10100']))
+    # yield_results() started at 1001, the task at 1003.
+    self.assertEqual([7.], timeouts)
+
+  def test_states_unavailable(self):
+    # Without a timeout, each result is polled once the states failed too many
+    # times in a row.
+    self.mock(logging, 'error', lambda *_, **__: None)
+    self.mock(swarming, 'STATES_MAX_FAILURES', 2)
+    self.expected_requests([
+        gen_states_request(['10100'], None, wait_secs=40),
+        gen_states_request(['10100'], None, wait_secs=0),
+        gen_states_request(['10100'], None, wait_secs=0),
+    ] + gen_result_requests('10100', OUTPUT))
+    actual = list(
+        swarming.yield_results('https://host:9001', ['10100'], 0., None, True,
+                               None, False, True))
+    self.assertEqual([gen_yielded_data(0, output=OUTPUT)], actual)
+
+  def test_many_shards(self):
+    self.expected_requests(
+        [
+            gen_states_request(['10100', '10200', '10300'],
+                               ['COMPLETED', 'COMPLETED', 'COMPLETED']),
+        ] + gen_result_requests('10100', SHARD_OUTPUT_1) +
+        gen_result_requests('10200', SHARD_OUTPUT_2) +
+        gen_result_requests('10300', SHARD_OUTPUT_3))
+    expected = [
+        gen_yielded_data(0, output=SHARD_OUTPUT_1),
+        gen_yielded_data(1, output=SHARD_OUTPUT_2),
+        gen_yielded_data(2, output=SHARD_OUTPUT_3),
+    ]
+    actual = get_results(['10100', '10200', '10300'])
+    self.assertEqual(expected, sorted(actual))
+
+  def test_many_shards_batched(self):
+    # The states are polled in batches and only the tasks that are done are
+    # fetched.
+    self.mock(swarming, 'STATES_BATCH_SIZE', 2)
+    self.expected_requests([
+        gen_states_request(['10100', '10200'], ['COMPLETED', 'PENDING'],
+                           wait_secs=0),
+        gen_states_request(['10300'], ['RUNNING'], wait_secs=0),
+        gen_states_request(['10200', '10300'], ['COMPLETED', 'COMPLETED'],
+                           wait_secs=0),
+    ] + gen_result_requests('10100', SHARD_OUTPUT_1) +
+        gen_result_requests('10200', SHARD_OUTPUT_2) +
+        gen_result_requests('10300', SHARD_OUTPUT_3))
     expected = [
         gen_yielded_data(0, output=SHARD_OUTPUT_1),
         gen_yielded_data(1, output=SHARD_OUTPUT_2),
@@ -868,50 +918,13 @@ class TestSwarmingCollection(NetTestCase):
 
   def test_output_collector_called(self):
     # Three shards, one failed. All results are passed to output collector.
-    self.expected_requests([
-        (
-            'https://host:9001/_ah/api/swarming/v1/task/10100/result',
-            {
-                'retry_50x': False
-            },
-            gen_result_response(),
-        ),
-        (
-            'https://host:9001/_ah/api/swarming/v1/task/10100/stdout',
-            {},
-            {
-                'output': SHARD_OUTPUT_1
-            },
-        ),
-        (
-            'https://host:9001/_ah/api/swarming/v1/task/10200/result',
-            {
-                'retry_50x': False
-            },
-            gen_result_response(),
-        ),
-        (
-            'https://host:9001/_ah/api/swarming/v1/task/10200/stdout',
-            {},
-            {
-                'output': SHARD_OUTPUT_2
-            },
-        ),
-        (
-            'https://host:9001/_ah/api/swarming/v1/task/10300/result',
-            {
-                'retry_50x': False
-            },
-            gen_result_response(exit_code=1),
-        ),
-        (
-            'https://host:9001/_ah/api/swarming/v1/task/10300/stdout',
-            {},
-            {
-                'output': SHARD_OUTPUT_3
-            },
-        ),
-    ])
+    self.expected_requests(
+        [
+            gen_states_request(['10100', '10200', '10300'],
+                               ['COMPLETED', 'COMPLETED', 'COMPLETED']),
+        ] + gen_result_requests('10100', SHARD_OUTPUT_1) +
+        gen_result_requests('10200', SHARD_OUTPUT_2) +
+        gen_result_requests('10300', SHARD_OUTPUT_3, exit_code=1))
 
     class FakeOutputCollector(object):
 
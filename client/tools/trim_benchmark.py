@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# Copyright 2026 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Benchmarks loading and trimming a DiskContentAddressedCache.
+
+The cache state lists --entries items but no file is written, so the numbers
+measure the bookkeeping of the cache and not the file system.
+"""
+
+import hashlib
+import logging
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+CLIENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, CLIENT_DIR)
+
+from utils import tools
+tools.force_local_third_party(CLIENT_DIR)
+
+# pylint: disable=ungrouped-imports
+import local_caching
+from utils import lru
+
+
+def _timed(name, fn):
+  start = time.time()
+  result = fn()
+  print('%-12s %8.3fs' % (name, time.time() - start))
+  return result
+
+
+def _write_state(cache_dir, entries):
+  """Writes a cache state with |entries| items of 1 to 1000 bytes."""
+  items = lru.LRUDict()
+  for i in range(entries):
+    items.add(hashlib.sha1(str(i).encode()).hexdigest(), i % 1000 + 1)
+  items.save(os.path.join(
+      cache_dir, local_caching.DiskContentAddressedCache.STATE_FILE))
+  return sum(i % 1000 + 1 for i in range(entries))
+
+
+def main():
+  parser = optparse.OptionParser(description=sys.modules['__main__'].__doc__)
+  parser.add_option(
+      '-n', '--entries', type='int', default=1000000,
+      help='Number of entries in the cache. Default: %default')
+  parser.add_option(
+      '--evict', type='float', default=0.5,
+      help='Fraction of the cache size to evict. Default: %default')
+  options, args = parser.parse_args()
+  if args:
+    parser.error('Unknown args: %s' % args)
+  logging.basicConfig(level=logging.ERROR)
+
+  cache_dir = tempfile.mkdtemp(prefix=u'trim_benchmark')
+  try:
+    total_size = _timed(
+        'setup',
+        lambda: _write_state(cache_dir, options.entries))
+    policies = local_caching.CachePolicies(
+        max_cache_size=int(total_size * (1 - options.evict)),
+        min_free_space=0,
+        max_items=0,
+        max_age_secs=0)
+    cache = _timed(
+        'load',
+        lambda: local_caching.DiskContentAddressedCache(
+            cache_dir, policies, trim=False))
+    _timed('total_size', lambda: cache.total_size)
+    evicted = _timed('trim', cache.trim)
+    print('Evicted %d of %d entries, %d of %d bytes' % (
+        len(evicted), options.entries, sum(evicted), total_size))
+  finally:
+    shutil.rmtree(cache_dir)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
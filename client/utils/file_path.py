@@ -16,6 +16,7 @@ import os
 import posixpath
 import re
 import shlex
+import shutil
 import stat
 import sys
 import tempfile
@@ -35,6 +36,20 @@ HARDLINK, HARDLINK_WITH_FALLBACK, SYMLINK, SYMLINK_WITH_FALLBACK, COPY = range(
     1, 6)
 
 
+# FICLONE ioctl from linux/fs.h. The destination shares the extents of the
+# source until either is modified, on file systems supporting it like btrfs and
+# XFS.
+_FICLONE = 0x40049409
+
+
+# Errors meaning a copy method isn't supported for a pair of files, in which
+# case copy_file() tries the next one.
+_COPY_UNSUPPORTED_ERRNOS = frozenset(
+    getattr(errno, name)
+    for name in ('EINVAL', 'ENOSYS', 'ENOTSUP', 'ENOTTY', 'EOPNOTSUPP', 'EXDEV')
+    if hasattr(errno, name))
+
+
 ## OS-specific imports
 
 
@@ -44,6 +59,8 @@ if sys.platform == 'win32':
   from ctypes import windll  # pylint: disable=ungrouped-imports
 elif sys.platform == 'darwin':
   from utils import macos
+elif sys.platform.startswith('linux'):
+  import fcntl
 
 
 if sys.platform == 'win32':
@@ -867,9 +884,73 @@ def hardlink(source, link_name):
     fs.link(source, link_name)
 
 
+def copy_file(src, dst):
+  """Copies the content and the metadata of the file |src| to |dst|.
+
+  Like shutil.copy2() but on Linux, uses the fastest method supported by the
+  file systems: a FICLONE reflink, then copy_file_range() or sendfile() which
+  copy within the kernel, then a chunked copy.
+
+  Returns:
+    The name of the method used.
+  """
+  if not sys.platform.startswith('linux'):
+    fs.copy2(src, dst)
+    return 'copy2'
+  with fs.open(src, 'rb') as fsrc:
+    with fs.open(dst, 'wb') as fdst:
+      method = _copy_content(fsrc, fdst)
+  fs.copystat(src, dst)
+  return method
+
+
+def _copy_content(fsrc, fdst):
+  """Copies the content of the file object |fsrc| into the empty |fdst|."""
+  src_fd = fsrc.fileno()
+  dst_fd = fdst.fileno()
+  try:
+    fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+    return 'reflink'
+  except (IOError, OSError) as e:
+    if e.errno not in _COPY_UNSUPPORTED_ERRNOS:
+      raise
+
+  size = os.fstat(src_fd).st_size
+  kernel_copies = []
+  if hasattr(os, 'copy_file_range'):
+    kernel_copies.append((
+        'copy_file_range',
+        lambda count, offset: os.copy_file_range(
+            src_fd, dst_fd, count, offset, offset)))
+  if hasattr(os, 'sendfile'):
+    kernel_copies.append((
+        'sendfile',
+        lambda count, offset: os.sendfile(dst_fd, src_fd, offset, count)))
+  for name, copy in kernel_copies:
+    copied = 0
+    try:
+      while copied < size:
+        n = copy(size - copied, copied)
+        if not n:
+          # Some file systems report no data instead of an error.
+          if not copied:
+            raise OSError(errno.ENOTSUP, '%s copied nothing' % name)
+          break
+        copied += n
+      return name
+    except OSError as e:
+      # Only fall back if nothing was written yet.
+      if copied or e.errno not in _COPY_UNSUPPORTED_ERRNOS:
+        raise
+      logging.debug('%s is not supported: %s', name, e)
+
+  shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+  return 'copy'
+
+
 def readable_copy(outfile, infile):
   """Makes a copy of the file that is readable by everyone."""
-  fs.copy2(infile, outfile)
+  copy_file(infile, outfile)
   fs.chmod(
       outfile,
       fs.stat(outfile).st_mode | stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
@@ -436,6 +436,10 @@ def copy2(src, dst):
   return shutil.copy2(extend(src), extend(dst))
 
 
+def copystat(src, dst):
+  return shutil.copystat(extend(src), extend(dst))
+
+
 def rmtree(path, *args, **kwargs):
   return shutil.rmtree(extend(path), *args, **kwargs)
 
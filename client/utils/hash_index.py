@@ -0,0 +1,209 @@
+# Copyright 2026 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Persistent index of file digests keyed by the file's stat() identity.
+
+The index lets archiving skip re-reading files that did not change since the
+last run: a hit costs a single stat() instead of a full read and hash.
+
+An entry is keyed by (st_dev, st_ino, st_size, mtime_ns, algo). Any write to a
+file changes its mtime so the entry simply stops matching. Files modified
+within RACY_SECS of being hashed are never indexed, since a subsequent write
+within the file system's mtime granularity would not be detected.
+
+The on-disk format is a fixed size header followed by fixed size records
+sorted by key, so the file can be mmap'ed and bisected if needed:
+  header: magic, version, generation, number of records
+  record: dev, ino, size, mtime_ns, algo id, digest length, generation, digest
+
+The generation is incremented on every load and stamped on every entry used
+during the session. When the index grows over its maximum number of entries,
+the entries with the oldest generation are evicted first.
+"""
+
+import binascii
+import logging
+import struct
+import threading
+import time
+
+from utils import file_path
+from utils import fs
+
+
+# Bumped whenever the on-disk format changes. Older files are discarded.
+CURRENT_VERSION = 1
+
+
+# Default maximum number of entries, about 100MiB on disk.
+DEFAULT_MAX_ENTRIES = 1 << 20
+
+
+# Files modified more recently than this are not indexed.
+RACY_SECS = 2.
+
+
+_MAGIC = b'LUCIHIDX'
+_HEADER = struct.Struct('<8sIII')
+_RECORD = struct.Struct('<QQQqBBxxI64s')
+
+
+# Maps hashlib names to the id stored on disk. Must never be renumbered.
+_ALGO_IDS = {
+    'sha1': 1,
+    'sha256': 2,
+    'sha512': 3,
+}
+
+
+def algo_name(algo):
+  """Returns the name used to key |algo| or None if it can't be indexed.
+
+  |algo| is one of hashlib hashing algorithm.
+  """
+  # Python 2 may report the name in upper case.
+  name = algo().name.lower()
+  return name if name in _ALGO_IDS else None
+
+
+def stat_key(st, name):
+  """Returns the index key for a stat_result or None if it can't be indexed."""
+  if name not in _ALGO_IDS or not st.st_ino:
+    # Some file systems (and python 2 on Windows) do not report inodes.
+    return None
+  mtime_ns = getattr(st, 'st_mtime_ns', None)
+  if mtime_ns is None:
+    mtime_ns = int(st.st_mtime * 1e9)
+  return (st.st_dev, st.st_ino, st.st_size, mtime_ns, _ALGO_IDS[name])
+
+
+class HashIndex(object):
+  """Maps a file's stat() identity to its hex digest.
+
+  Thread safe, so it can be shared by items hashed concurrently. Concurrent
+  processes sharing the same file are safe too; the last one to save wins.
+  """
+
+  def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+    self._max_entries = max_entries
+    self._lock = threading.Lock()
+    # key -> [hex digest, generation]
+    self._entries = {}
+    self._generation = 1
+    self._dirty = False
+    self.hits = 0
+    self.misses = 0
+
+  def __len__(self):
+    return len(self._entries)
+
+  @classmethod
+  def load(cls, path, max_entries=DEFAULT_MAX_ENTRIES):
+    """Loads an index from |path|.
+
+    Returns an empty index if the file is missing, stale or corrupted.
+    """
+    index = cls(max_entries)
+    try:
+      with fs.open(path, 'rb') as f:
+        data = f.read()
+    except (IOError, OSError):
+      return index
+    try:
+      index._parse(data)
+    except ValueError as e:
+      logging.warning('Discarding hash index %s: %s', path, e)
+      index._entries = {}
+      index._generation = 1
+    return index
+
+  def save(self, path):
+    """Saves the index to |path| if it was modified.
+
+    Evicts the least recently used entries over the maximum first.
+    """
+    with self._lock:
+      if not self._dirty:
+        return False
+      self._trim()
+      body = self._serialize()
+      self._dirty = False
+    try:
+      file_path.atomic_replace(path, body)
+    except (IOError, OSError) as e:
+      logging.warning('Failed to save hash index %s: %s', path, e)
+      return False
+    return True
+
+  def get(self, st, name):
+    """Returns the hex digest for the file described by |st| or None."""
+    key = stat_key(st, name)
+    with self._lock:
+      entry = self._entries.get(key) if key else None
+      if not entry:
+        self.misses += 1
+        return None
+      self.hits += 1
+      if entry[1] != self._generation:
+        entry[1] = self._generation
+        self._dirty = True
+      return entry[0]
+
+  def add(self, st, name, digest, now=None):
+    """Records |digest| for the file described by |st|.
+
+    Ignored if the file was modified too recently to be trusted.
+    """
+    key = stat_key(st, name)
+    if not key:
+      return False
+    now = time.time() if now is None else now
+    if key[3] > (now - RACY_SECS) * 1e9:
+      return False
+    with self._lock:
+      self._entries[key] = [digest, self._generation]
+      self._dirty = True
+    return True
+
+  def _trim(self):
+    """Evicts the entries with the oldest generation over the maximum."""
+    excess = len(self._entries) - self._max_entries
+    if excess <= 0:
+      return
+    oldest = sorted(self._entries, key=lambda k: self._entries[k][1])
+    for key in oldest[:excess]:
+      del self._entries[key]
+    logging.info('Evicted %d entries from the hash index', excess)
+
+  def _serialize(self):
+    out = [_HEADER.pack(
+        _MAGIC, CURRENT_VERSION, self._generation, len(self._entries))]
+    for key in sorted(self._entries):
+      digest, generation = self._entries[key]
+      raw = binascii.unhexlify(digest)
+      out.append(_RECORD.pack(
+          key[0], key[1], key[2], key[3], key[4], len(raw), generation, raw))
+    return b''.join(out)
+
+  def _parse(self, data):
+    if len(data) < _HEADER.size:
+      raise ValueError('truncated header')
+    magic, version, generation, count = _HEADER.unpack_from(data, 0)
+    if magic != _MAGIC:
+      raise ValueError('invalid magic')
+    if version != CURRENT_VERSION:
+      raise ValueError('unsupported version %d' % version)
+    if len(data) != _HEADER.size + count * _RECORD.size:
+      raise ValueError('expected %d records' % count)
+    entries = {}
+    offset = _HEADER.size
+    for _ in range(count):
+      dev, ino, size, mtime_ns, algo, length, gen, raw = _RECORD.unpack_from(
+          data, offset)
+      offset += _RECORD.size
+      entries[(dev, ino, size, mtime_ns, algo)] = [
+          binascii.hexlify(raw[:length]).decode('ascii'), gen]
+    self._entries = entries
+    # Entries used from now on are stamped with a newer generation.
+    self._generation = generation + 1
@@ -36,6 +36,9 @@ class LRUDict(object):
     self._items = collections.OrderedDict()
     # True if was modified after loading.
     self._dirty = True
+    # Returns the size of a value, see set_size_fn().
+    self._size_fn = None
+    self._total_size = 0
 
   def __nonzero__(self):
     """False if dict is empty."""
@@ -120,16 +123,36 @@ class LRUDict(object):
           'version': CURRENT_VERSION,
           'items': list(self._items.items()),
       }
-      json.dump(contents, f, sort_keys=True, separators=(',', ':'))
+      # json.dumps() uses the C encoder, json.dump() doesn't.
+      f.write(json.dumps(contents, sort_keys=True, separators=(',', ':')))
 
     self._dirty = False
     return True
 
+  @property
+  def total_size(self):
+    """Sum of the sizes of all the values, see set_size_fn()."""
+    assert self._size_fn, 'set_size_fn() must be called first'
+    return self._total_size
+
+  def set_size_fn(self, size_fn):
+    """Sets the function returning the size of a value.
+
+    The values are summed once, then total_size is kept up to date as items are
+    added and removed.
+    """
+    self._size_fn = size_fn
+    self._total_size = sum(size_fn(val) for val, _ in self._items.values())
+
   def add(self, key, value):
     """Adds or replaces a |value| for |key|, marks it as most recently used."""
-    self._items.pop(key, None)
+    old = self._items.pop(key, None)
     self._items[key] = (value, self.time_fn())
     self._dirty = True
+    if self._size_fn:
+      if old is not None:
+        self._total_size -= self._size_fn(old[0])
+      self._total_size += self._size_fn(value)
 
   def get(self, key, default=None):
     """Returns value for |key| or |default| if not found."""
@@ -151,6 +174,8 @@ class LRUDict(object):
     """
     item = self._items.pop(key)
     self._dirty = True
+    if self._size_fn:
+      self._total_size -= self._size_fn(item[0])
     return item[0]
 
   def get_oldest(self):
@@ -171,6 +196,8 @@ class LRUDict(object):
     """
     item = self._items.popitem(last=False)
     self._dirty = True
+    if self._size_fn:
+      self._total_size -= self._size_fn(item[1][0])
     return item
 
   def items(self):
@@ -188,3 +215,5 @@ class LRUDict(object):
     for key, (val, timestamp) in self._items.items():
       self._items[key] = (mutator(key, val), timestamp)
     self._dirty = True
+    if self._size_fn:
+      self.set_size_fn(self._size_fn)
@@ -359,6 +359,77 @@ def get_case_insensitive_dict(original):
   return normalized
 
 
+class RestartableBody(object):
+  """Request body streamed from a source that can be re-read on retry.
+
+  |factory| is a callable returning a new iterable of bytes chunks each time it
+  is called. If |size| is known, the body is sent with a Content-Length header,
+  otherwise it is sent with chunked transfer encoding.
+  """
+
+  def __init__(self, factory, size=None):
+    self.factory = factory
+    self.size = size
+
+  def open(self):
+    """Returns a new file-like object over the body for one request attempt."""
+    if self.size is None:
+      return _StreamedBody(self.factory())
+    return _SizedStreamedBody(self.factory(), self.size)
+
+
+class _StreamedBody(object):
+  """File-like object reading the chunks of a RestartableBody.
+
+  httplib on python 2 only streams a body that has a read() method, while the
+  chunked transfer encoding of requests iterates over it.
+  """
+
+  def __init__(self, chunks):
+    self._chunks = iter(chunks)
+    self._chunk = b''
+    self._pos = 0
+
+  def __iter__(self):
+    # An empty chunk would terminate a chunked body early.
+    if self._pos < len(self._chunk):
+      yield self._chunk[self._pos:]
+    self._chunk = b''
+    self._pos = 0
+    for chunk in self._chunks:
+      if chunk:
+        yield chunk
+
+  def read(self, size=-1):
+    out = []
+    while size:
+      if self._pos == len(self._chunk):
+        self._chunk = next(self._chunks, None)
+        self._pos = 0
+        if self._chunk is None:
+          self._chunk = b''
+          break
+        continue
+      n = len(self._chunk) - self._pos
+      if size > 0:
+        n = min(n, size)
+        size -= n
+      out.append(self._chunk[self._pos:self._pos + n])
+      self._pos += n
+    return b''.join(out)
+
+
+class _SizedStreamedBody(_StreamedBody):
+  """_StreamedBody with a known length, so requests sets Content-Length."""
+
+  def __init__(self, chunks, size):
+    super(_SizedStreamedBody, self).__init__(chunks)
+    self._size = size
+
+  def __len__(self):
+    return self._size
+
+
 class HttpService(object):
   """Base class for a class that provides an API to HTTP based service:
     - Provides 'request' method.
@@ -451,6 +522,7 @@ class HttpService(object):
       - str for pre-encoded data
       - list for data to be form-encoded
       - dict for data to be form-encoded
+      - RestartableBody for data streamed as is, re-read on each attempt
 
     - Optionally retries HTTP 404 and 50x.
     - Retries up to |max_attempts| times. If None or 0, there's no limit in the
@@ -490,7 +562,11 @@ class HttpService(object):
     """
     assert urlpath and urlpath[0] == '/', urlpath
 
-    if data is not None:
+    if isinstance(data, RestartableBody):
+      assert method in (None, 'POST', 'PUT')
+      method = method or 'POST'
+      body = data
+    elif data is not None:
       assert method in (None, 'DELETE', 'POST', 'PUT')
       method = method or 'POST'
       content_type = content_type or DEFAULT_CONTENT_TYPE
@@ -511,7 +587,8 @@ class HttpService(object):
     # Prepare headers.
     headers = get_case_insensitive_dict(headers or {})
     if body is not None:
-      headers['Content-Length'] = str(len(body))
+      if not isinstance(body, RestartableBody):
+        headers['Content-Length'] = str(len(body))
       if content_type:
         headers['Content-Type'] = content_type
 
@@ -526,9 +603,11 @@ class HttpService(object):
             resource_url, attempt.attempt, max_attempts)
 
       try:
-        # Prepare and send a new request.
+        # Prepare and send a new request. A streamed body is consumed by each
+        # attempt, so it is reopened every time.
         request = HttpRequest(
-            method, resource_url, query_params, body,
+            method, resource_url, query_params,
+            body.open() if isinstance(body, RestartableBody) else body,
             headers, read_timeout, stream, follow_redirects)
         if self.authenticator:
           self.authenticator.authorize(request)
@@ -649,7 +728,7 @@ class HttpRequest(object):
       |method| - HTTP method to use
       |url| - relative URL to the resource, without query parameters
       |params| - list of (key, value) pairs to put into GET parameters
-      |body| - encoded body of the request (None or str)
+      |body| - encoded body of the request (None, str or iterable of str)
       |headers| - dict with request headers
       |timeout| - socket read timeout (None to disable)
       |stream| - True to stream response from socket